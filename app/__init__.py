@@ -15,12 +15,12 @@ from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from flask_caching import Cache
 from secure import SecureHeaders, SecurePolicies
 from flask_paranoid import Paranoid
 from redis import Redis
 import rq
 from config import Config
+from caching import cache
 import json
 
 db = SQLAlchemy()
@@ -33,7 +33,6 @@ mail = Mail()
 bootstrap = Bootstrap()
 moment = Moment()
 babel = Babel()
-cache = Cache()
 csp_value = (
     SecurePolicies.CSP()
     .default_src(SecurePolicies.CSP().Values.none)
@@ -120,6 +119,9 @@ def create_app(config_class=Config):
     from app.mapping import bp as mapping_bp
     app.register_blueprint(mapping_bp, url_prefix='/mapping')
 
+    from app.webhooks import bp as webhooks_bp
+    app.register_blueprint(webhooks_bp, url_prefix='/webhooks')
+
     if not app.debug and not app.testing:
         if app.config['MAIL_SERVER']:
             auth = None
@@ -4,18 +4,26 @@
 #    This file is part of SyncBoom and is MIT-licensed.
 #    Originally based on microblog, licensed under the MIT License.
 
-from datetime import datetime
+import threading
+import time
 from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app, send_from_directory
+    jsonify, current_app, send_from_directory, Response
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale, ngettext
 from guess_language import guess_language
+import redis
 from app import db
 from app.main.forms import makeAccountEditForm
-from app.models import User, Notification
+from app.models import User, Notification, PROGRESS_CHANNEL
 from app.main import bp
 from syncboom import perform_request
 
+# Seconds between the comments keeping an idle event stream open
+NOTIFICATIONS_KEEP_ALIVE = 15
+# Event streams open in this process, each holding one of its threads
+open_streams = {"count": 0}
+open_streams_lock = threading.Lock()
+
 
 def get_trello_authorizing_url():
     url = "https://trello.com/1/authorize?" \
@@ -31,8 +39,7 @@ def get_trello_authorizing_url():
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        current_user.record_last_seen()
     g.locale = str(get_locale())
 
 @bp.route('/')
@@ -103,11 +110,77 @@ def notifications():
     since = request.args.get('since', 0.0, type=float)
     notifications = current_user.notifications.filter(
         Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    return jsonify([{
+    payload = [{
         'name': n.name,
         'data': n.get_data(),
         'timestamp': n.timestamp
-    } for n in notifications])
+    } for n in notifications]
+    # The progress of running tasks is only saved in Redis, it doesn't move
+    # the timestamp of the last notification forward
+    timestamp = payload[-1]['timestamp'] if payload else since
+    for task in current_user.get_tasks_in_progress():
+        payload.append({
+            'name': 'task_progress',
+            'data': {'task_id': task.id, 'progress': task.get_progress()},
+            'timestamp': timestamp
+        })
+    return jsonify(payload)
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notifications_stream():
+    """
+    Stream the progress of the user's tasks as Server-Sent Events, from the
+    Redis channel the tasks publish it on. Each stream holds a thread of the
+    process, so only NOTIFICATIONS_MAX_STREAMS are open at once and each for
+    NOTIFICATIONS_STREAM_TIMEOUT seconds. Without Redis or when all the
+    streams are taken, the browser falls back to polling the notifications.
+    """
+    with open_streams_lock:
+        if open_streams["count"] >= \
+                current_app.config['NOTIFICATIONS_MAX_STREAMS']:
+            return jsonify([]), 503
+        open_streams["count"] += 1
+
+    pubsub = None
+
+    def release_stream():
+        with open_streams_lock:
+            open_streams["count"] -= 1
+        if pubsub:
+            # Closing it again after the stream did is harmless
+            pubsub.close()
+
+    try:
+        pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(PROGRESS_CHANNEL % current_user.id)
+    except redis.exceptions.RedisError:
+        release_stream()
+        return jsonify([]), 503
+    deadline = time.time() + current_app.config['NOTIFICATIONS_STREAM_TIMEOUT']
+
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while time.time() < deadline:
+                message = pubsub.get_message(timeout=NOTIFICATIONS_KEEP_ALIVE)
+                if message:
+                    yield 'event: task_progress\ndata: %s\n\n' % \
+                        message['data'].decode()
+                else:
+                    # Keep the connection open through the proxies
+                    yield ': keep-alive\n\n'
+        except redis.exceptions.RedisError:
+            pass
+        finally:
+            pubsub.close()
+    response = Response(stream(), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also released, closing the Redis connection, when the client leaves
+    # before the stream started
+    response.call_on_close(release_stream)
+    return response
 
 
 @bp.route('/contact')
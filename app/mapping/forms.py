@@ -59,6 +59,7 @@ class DeleteMappingForm(FlaskForm):
 
 
 class RunMappingForm(FlaskForm):
+    submit_changes = SubmitField(_l('Process the cards changed since the last run'))
     submit_board = SubmitField(_l('Process the entire master board'))
     lists = SelectField(_l('List'), coerce=str,
         validators=[Regexp("^[0-9a-fA-F]{24}$",
@@ -3,11 +3,10 @@
 
 #    This file is part of SyncBoom and is MIT-licensed.
 
-from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, g, \
+from flask import render_template, flash, redirect, url_for, request, \
     jsonify, current_app
 from flask_login import current_user, login_required
-from flask_babel import _, get_locale
+from flask_babel import _
 # from guess_language import guess_language
 from app import db
 from app.mapping.forms import makeNewMappingForm, DeleteMappingForm, \
@@ -17,16 +16,8 @@ from app.mapping import bp
 import requests
 import re
 from wtforms import BooleanField
-import json
-from syncboom import perform_request, new_webhook, delete_webhook
-
-
-@bp.before_app_request
-def before_request():
-    if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
-    g.locale = str(get_locale())
+from syncboom import perform_request, new_webhook, delete_webhook, \
+    get_boards_catalog, invalidate_boards_catalog, get_cards_index
 
 
 @bp.route('/<int:mapping_id>/edit', methods=['GET', 'POST'])
@@ -44,11 +35,9 @@ def new_or_edit(mapping_id=None):
             this_users_mappings = val1
             mapping = val2
         # Set the items on the mapping object like they would come from the form
-        try:
-            destination_lists = json.loads(mapping.destination_lists)
+        destination_lists = mapping.get_destination_lists()
+        if destination_lists:
             mapping.labels = list(destination_lists.keys())
-        except (TypeError, json.decoder.JSONDecodeError):
-            destination_lists = []
         i = 0
         for label_id in destination_lists:
             label_lists = []
@@ -60,14 +49,15 @@ def new_or_edit(mapping_id=None):
     else:
         num_map_labelN_lists = len(request.form.getlist('labels'))
 
-    # Get the list of boards for this user
-    all_boards = perform_request("GET", "members/me/boards",
-        key=current_app.config['TRELLO_API_KEY'],
-        token=current_user.trello_token)
-    boards = []
-    for b in all_boards:
-        if not b["closed"]:
-            boards.append(b)
+    # Get the boards and their lists for this user, the later steps are then
+    # rendered from the cached catalog
+    pr_args = {"key": current_app.config['TRELLO_API_KEY'],
+        "token": current_user.trello_token}
+    if request.method == 'GET':
+        # Starting a new mapping or opening one to edit, show the boards as
+        # they are now in Trello
+        invalidate_boards_catalog(pr_args)
+    boards = get_boards_catalog(pr_args)
     if not boards:
         title = _('No boards available in Trello')
         return render_template('mapping/new.html', title=title)
@@ -153,11 +143,16 @@ def new_or_edit(mapping_id=None):
                     deactivate_previous_webhook = True
                 if mapping.m_type == form.m_type.data:
                     mapping_type_changed = False
+                if mapping.master_board != form.master_board.data or \
+                    mapping.get_destination_lists() != destination_lists:
+                    # The cards changed since the checkpoint aren't the only
+                    # ones to sync anymore
+                    mapping.clear_checkpoint()
                 mapping.name = form.name.data
                 mapping.description=form.description.data
                 mapping.m_type=form.m_type.data
                 mapping.master_board=form.master_board.data
-                mapping.destination_lists = json.dumps(destination_lists)
+                mapping.set_destination_lists(destination_lists)
                 mapping.user_id = current_user.id
                 flash(_('Your mapping "%(name)s" has been updated.',
                     name=mapping.name))
@@ -168,8 +163,8 @@ def new_or_edit(mapping_id=None):
                     description=form.description.data,
                     m_type=form.m_type.data,
                     master_board=form.master_board.data,
-                    destination_lists = json.dumps(destination_lists),
                     user_id = current_user.id)
+                mapping.set_destination_lists(destination_lists)
                 current_user.mappings.append(mapping)
                 flash(_('Your new mapping "%(name)s" has been created.',
                     name=mapping.name))
@@ -202,10 +197,7 @@ def new_or_edit(mapping_id=None):
     if step > 3:
         lists_on_boards = []
         for b in boards:
-            boards_lists = perform_request("GET", "boards/%s/lists" % b["id"],
-                key=current_app.config['TRELLO_API_KEY'],
-                token=current_user.trello_token)
-            for l in boards_lists:
+            for l in b["lists"]:
                 lists_on_boards.append((l["id"], "%s | %s" % (b["name"], l["name"])))
         i = 0
         for l in selected_labels:
@@ -295,32 +287,36 @@ def run(mapping_id):
         return redirect(url_for('mapping.run', mapping_id=mapping_id))
 
     rmf = RunMappingForm()
-    lists = perform_request("GET", "boards/%s/lists" % mapping.master_board,
-        key=current_app.config['TRELLO_API_KEY'],
-        token=current_user.trello_token)
+    lists = get_master_board_lists(mapping)
     rmf.lists.choices = [(l["id"], l["name"]) for l in lists]
     list_names = {}
-    card_names = {}
     for l in lists:
         list_names[l["id"]] = l["name"]
-        cards = perform_request("GET", "lists/%s/cards" % l["id"],
-            key=current_app.config['TRELLO_API_KEY'],
-            token=current_user.trello_token)
-        cards_choices = [(c["id"], "%s | %s" % (l["name"], c["name"])) for c in cards]
-        if not rmf.cards.choices:
-            rmf.cards.choices = cards_choices
-        else:
-            rmf.cards.choices = rmf.cards.choices + cards_choices
-        for c in cards:
-            card_names[c["id"]] = "%s | %s" % (l["name"], c["name"])
+    # The cards are searched from the page, only the submitted one is needed
+    rmf.cards.choices = []
+    card_names = {}
+    if request.method == 'POST' and rmf.submit_card.data:
+        c = get_card_choice(mapping, lists, rmf.cards.data)
+        if not c:
+            flash(_("This card wasn't found on the master board."))
+            return redirect(url_for('mapping.run', mapping_id=mapping_id))
+        rmf.cards.choices = [(c["id"], c["text"])]
+        card_names[c["id"]] = c["text"]
 
     if request.method == 'POST':
         rmf.validate_on_submit()
+        if rmf.submit_changes.data:
+            current_user.launch_task('run_mapping',
+                (mapping.id, "changes", mapping.master_board),
+                _('Processing the cards changed on the "%(mapping_name)s" '
+                    'master board since the last run...',
+                    mapping_name=mapping.name))
         if rmf.submit_board.data:
             current_user.launch_task('run_mapping',
                 (mapping.id, "board", mapping.master_board),
                 _('Processing the full "%(mapping_name)s" master board...',
-                    mapping_name=mapping.name))
+                    mapping_name=mapping.name),
+                shards=current_app.config['RUN_MAPPING_SHARDS'])
         if rmf.submit_list.data and rmf.lists.validate(rmf):
             current_user.launch_task('run_mapping',
                 (mapping.id, "list", rmf.lists.data),
@@ -337,3 +333,74 @@ def run(mapping_id):
     title = _('Run mapping "%(name)s"', name=mapping.name)
     return render_template('mapping/run.html', title=title, mapping=mapping,
         rmf=rmf)
+
+
+@bp.route('/<int:mapping_id>/cards')
+@login_required
+def search_cards(mapping_id):
+    """
+    Search the cards of the master board by list and card name for the run
+    page, one page at a time
+    """
+    # Check if this user has access to this mapping
+    (valid_mapping, val1, val2) = check_mapping_ownership(mapping_id)
+    if not valid_mapping:
+        return val1, val2
+    else:
+        this_users_mappings = val1
+        mapping = val2
+
+    search = request.args.get('q', '').strip().lower()
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        page = 1
+    per_page = current_app.config['MAPPING_CARDS_PER_PAGE']
+    cards = [c for c in get_cards_choices(mapping,
+        get_master_board_lists(mapping)) if search in c["text"].lower()]
+    start = (page - 1) * per_page
+    return jsonify(cards=cards[start:start + per_page],
+        more=len(cards) > start + per_page)
+
+def get_master_board_lists(mapping):
+    return perform_request("GET", "boards/%s/lists" % mapping.master_board,
+        key=current_app.config['TRELLO_API_KEY'],
+        token=current_user.trello_token)
+
+def get_cards_choices(mapping, lists):
+    """
+    The cards of the master board named after their list, in the order of the
+    lists, from the cached index of the board's cards
+    """
+    list_names = {l["id"]: l["name"] for l in lists}
+    list_positions = {l["id"]: i for (i, l) in enumerate(lists)}
+    cards = get_cards_index(mapping.master_board,
+        {"key": current_app.config['TRELLO_API_KEY'],
+            "token": current_user.trello_token})
+    cards = sorted(cards,
+        key=lambda c: list_positions.get(c["idList"], len(lists)))
+    return [{"id": c["id"], "text": "%s | %s" % (list_names.get(c["idList"],
+        ""), c["name"])} for c in cards]
+
+def get_card_choice(mapping, lists, card_id):
+    """
+    The choice of the card submitted from the run page, from the cached index
+    of the board's cards or, for a card created since that index was cached,
+    from Trello. None if the card isn't an open card of the master board.
+    """
+    for c in get_cards_choices(mapping, lists):
+        if c["id"] == card_id:
+            return c
+    if not card_id or not re.match("^[0-9a-fA-F]{24}$", card_id):
+        return None
+    try:
+        card = perform_request("GET", "cards/%s" % card_id,
+            {"fields": "name,idBoard,idList,closed"},
+            key=current_app.config['TRELLO_API_KEY'],
+            token=current_user.trello_token)
+    except requests.exceptions.HTTPError:
+        return None
+    if card.get("idBoard") != mapping.master_board or card.get("closed"):
+        return None
+    list_names = {l["id"]: l["name"] for l in lists}
+    return {"id": card["id"], "text": "%s | %s" % (list_names.get(
+        card["idList"], ""), card["name"])}
@@ -5,12 +5,12 @@
 #    Originally based on microblog, licensed under the MIT License.
 
 import base64
-from datetime import datetime
+from datetime import datetime, timedelta
 from hashlib import md5
 import json
 import os
 from time import time
-from flask import current_app, url_for
+from flask import current_app, url_for, g, has_request_context
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
@@ -19,6 +19,13 @@ import rq
 from app import db, login
 
 
+# Redis channel on which the progress of a user's tasks is published
+PROGRESS_CHANNEL = "syncboom-progress:%d"
+# Redis hash of the times users were last seen, not yet in the database
+LAST_SEEN_KEY = "syncboom-last-seen"
+LAST_SEEN_USER_KEY = "syncboom-last-seen:%d"
+LAST_SEEN_FLUSH_KEY = "syncboom-last-seen-flush"
+
 mappings = db.Table(
     'mappings',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
@@ -78,10 +85,65 @@ class User(UserMixin, db.Model):
         db.session.add(n)
         return n
 
-    def launch_task(self, name, argument, description, *args, **kwargs):
+    def record_last_seen(self):
+        """
+        Record that the user was just seen, at most once per
+        LAST_SEEN_GRANULARITY seconds. The time is buffered in Redis, and a
+        job writes the buffered times to the database in bulk every
+        LAST_SEEN_FLUSH_INTERVAL seconds.
+        """
+        granularity = current_app.config['LAST_SEEN_GRANULARITY']
+        try:
+            if not current_app.redis.set(LAST_SEEN_USER_KEY % self.id, 1,
+                                         nx=True, ex=granularity):
+                return
+            current_app.redis.hset(LAST_SEEN_KEY, self.id, time())
+            flush_interval = current_app.config['LAST_SEEN_FLUSH_INTERVAL']
+            if current_app.redis.set(LAST_SEEN_FLUSH_KEY, 1, nx=True,
+                                     ex=flush_interval):
+                # Flush once the interval is over, with the times of all the
+                # users seen in the meantime
+                current_app.task_queue.enqueue_in(
+                    timedelta(seconds=flush_interval),
+                    'app.tasks.flush_last_seen')
+        except redis.exceptions.RedisError:
+            # Without Redis, write it directly
+            now = datetime.utcnow()
+            if self.last_seen is None or \
+                    now - self.last_seen >= timedelta(seconds=granularity):
+                self.last_seen = now
+                db.session.commit()
+
+    @staticmethod
+    def flush_last_seen():
+        """
+        Write the times users were last seen buffered in Redis to the
+        database. Returns the number of users updated.
+        """
+        pipeline = current_app.redis.pipeline()
+        pipeline.hgetall(LAST_SEEN_KEY)
+        pipeline.delete(LAST_SEEN_KEY)
+        last_seen = pipeline.execute()[0]
+        if not last_seen:
+            return 0
+        db.session.execute(
+            User.__table__.update().where(
+                User.id == db.bindparam('user_id')).values(
+                last_seen=db.bindparam('seen')),
+            [{'user_id': int(user_id),
+              'seen': datetime.utcfromtimestamp(float(seen))}
+             for (user_id, seen) in last_seen.items()])
+        db.session.commit()
+        return len(last_seen)
+
+    def launch_task(self, name, argument, description, *args, shards=1,
+                    **kwargs):
         task = None
         rq_job = None
         if name == "run_mapping" and len(argument) == 3:
+            if argument[1] == "board" and shards > 1:
+                # The job splits the board run into shard jobs
+                kwargs["shards"] = shards
             rq_job = current_app.task_queue.enqueue('app.tasks.' + name,
                 argument[0], argument[1], argument[2], *args, **kwargs)
         if rq_job:
@@ -91,14 +153,19 @@ class User(UserMixin, db.Model):
         return task
 
     def get_tasks_in_progress(self):
-        return Task.query.filter_by(user=self, complete=False).all()
+        tasks = Task.query.filter_by(user=self, complete=False).all()
+        # Their progress is usually displayed next
+        Task.fetch_progress(tasks)
+        return tasks
 
     def get_task_in_progress(self, name):
         return Task.query.filter_by(name=name, user=self,
                                     complete=False).first()
 
     def get_mappings(self):
-        return self.mappings.all()
+        # Their destinations are usually counted next
+        return self.mappings.options(
+            db.selectinload(Mapping.destinations)).order_by(Mapping.id).all()
 
     def get_recent_tasks(self):
         return self.tasks.order_by(Task.timestamp_start.desc()).limit(10).all()
@@ -137,9 +204,35 @@ class Task(db.Model):
             return None
         return rq_job
 
+    @staticmethod
+    def fetch_progress(tasks):
+        """
+        Get the progress of several tasks, with the jobs of the running ones
+        fetched from Redis in one round trip. Within a request, the progress
+        is cached for the next calls, e.g. from get_progress.
+        """
+        progress = {}
+        if has_request_context():
+            progress = g.setdefault('task_progress', {})
+        job_ids = []
+        for t in tasks:
+            if t.complete:
+                progress[t.id] = 100
+            elif t.id not in progress:
+                job_ids.append(t.id)
+        if job_ids:
+            try:
+                jobs = rq.job.Job.fetch_many(job_ids,
+                                             connection=current_app.redis)
+            except redis.exceptions.RedisError:
+                jobs = [None] * len(job_ids)
+            for (job_id, job) in zip(job_ids, jobs):
+                progress[job_id] = job.meta.get('progress', 0) \
+                    if job is not None else 100
+        return progress
+
     def get_progress(self):
-        job = self.get_rq_job()
-        return job.meta.get('progress', 0) if job is not None else 100
+        return Task.fetch_progress([self])[self.id]
 
     def get_duration(self):
         if not (self.timestamp_start and self.timestamp_end):
@@ -158,25 +251,74 @@ class Mapping(db.Model):
     name = db.Column(db.String(128), index=True)
     description = db.Column(db.String(128))
     m_type = db.Column(db.Enum("automatic", "manual", name="mappingtypes"))
-    master_board = db.Column(db.String(128))
-    destination_lists = db.Column(db.Text())
+    master_board = db.Column(db.String(128), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    last_action_id = db.Column(db.String(128))
+    last_action_date = db.Column(db.DateTime)
+    destinations = db.relationship('MappingDestination', backref='mapping',
+                                   order_by='MappingDestination.id',
+                                   cascade='all, delete-orphan')
+    card_links = db.relationship('CardLink', backref='mapping',
+                                 lazy='dynamic', cascade='all, delete-orphan')
 
     def __repr__(self):
         return '<Mapping {}>'.format(self.name)
 
+    def get_destination_lists(self):
+        """Get the destination lists of each label, in the mapping's order"""
+        destination_lists = {}
+        for d in self.destinations:
+            destination_lists.setdefault(d.label, []).append(d.destination_list)
+        return destination_lists
+
+    def set_destination_lists(self, destination_lists):
+        """Set the destination lists of each label, in the dict's order"""
+        self.destinations = [
+            MappingDestination(label=label, destination_list=list_id)
+            for label in destination_lists
+            for list_id in destination_lists[label]]
+
     def get_num_labels(self):
-        try:
-            return len(json.loads(self.destination_lists))
-        except (TypeError, json.decoder.JSONDecodeError):
-            return 0
+        return len(self.get_destination_lists())
+
+    def set_checkpoint(self, action):
+        """Record the most recent Trello action the last sync covered"""
+        self.last_action_id = action["id"]
+        self.last_action_date = datetime.strptime(action["date"],
+            "%Y-%m-%dT%H:%M:%S.%fZ")
+
+    def clear_checkpoint(self):
+        """Have the next sync of changes process the entire master board"""
+        self.last_action_id = None
+        self.last_action_date = None
 
     def get_num_dest_lists(self):
-        num_dest_lists = 0
-        try:
-            dest_lists = json.loads(self.destination_lists)
-            for label in dest_lists:
-                num_dest_lists += len(dest_lists[label])
-        except (TypeError, json.decoder.JSONDecodeError):
-            pass
-        return num_dest_lists
+        return len(self.destinations)
+
+
+class MappingDestination(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    mapping_id = db.Column(db.Integer, db.ForeignKey('mapping.id'),
+                           index=True)
+    label = db.Column(db.String(128), index=True)
+    destination_list = db.Column(db.String(128), index=True)
+
+    def __repr__(self):
+        return '<MappingDestination {} -> {}>'.format(self.label,
+                                                     self.destination_list)
+
+
+class CardLink(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    mapping_id = db.Column(db.Integer, db.ForeignKey('mapping.id'))
+    master_card = db.Column(db.String(128))
+    slave_card = db.Column(db.String(128))
+    slave_list = db.Column(db.String(128), index=True)
+    timestamp_reconciled = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_card_link_mapping_id_master_card', 'mapping_id',
+                 'master_card'),
+    )
+
+    def __repr__(self):
+        return '<CardLink {} -> {}>'.format(self.master_card, self.slave_card)
@@ -7,47 +7,98 @@
 import json
 import sys
 import time
-from datetime import datetime
+import redis
+from datetime import datetime, timedelta
 from flask import render_template
 from rq import get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
 from app import create_app, db
-from app.models import Task, Mapping, User
+from app.models import Task, Mapping, User, PROGRESS_CHANNEL
 from app.email import send_email
-from syncboom import perform_request, process_master_card, output_summary
+from syncboom import perform_request, process_master_card, output_summary, \
+    get_transport_stats, get_rate_limit_stats, get_retry_stats, \
+    get_cards_snapshot, sync_master_cards, get_changed_master_cards, \
+    get_latest_board_action, batch_get, cache_bypassed, CARD_NESTED_QUERY
 
 app = create_app()
 app.app_context().push()
 
+# Outputs of the master cards already processed by a run's job, or by the
+# shards of a board run, to resume it
+RUN_CHECKPOINT_KEY = "syncboom-run-checkpoint:%s"
+# Combined state of the shards of a board run
+RUN_SHARDS_KEY = "syncboom-run-shards:%s"
+SUMMARY_FIELDS = ("active_master_cards", "slave_card", "new_slave_card")
+# When and at which progress each running job last saved its progress
+progress_saved = {}
+# Channel each running job publishes its progress on
+progress_channels = {}
 
-def run_mapping(mapping_id, run_type, elem_id):
+
+def run_mapping(mapping_id, run_type, elem_id, shards=1):
     mapping = Mapping.query.filter_by(id=mapping_id).first()
+    rate_limit_stats_start = get_rate_limit_stats()
+    retry_stats_start = get_retry_stats()
+    checkpoint_key = None
     try:
         job = get_current_job()
+        if job and run_type != "card":
+            # A job enqueued again after an interruption keeps its id and
+            # resumes the run, a new run of the same cards starts over
+            checkpoint_key = RUN_CHECKPOINT_KEY % job.get_id()
         _set_task_progress(0)
         app.logger.info('Starting task for mapping %d, %s %s' %
             (mapping_id, run_type, elem_id))
-        destination_lists = []
+        destination_lists = {}
         if mapping:
-            try:
-                destination_lists = json.loads(mapping.destination_lists)
-            except (TypeError, json.decoder.JSONDecodeError):
+            destination_lists = mapping.get_destination_lists()
+            if not destination_lists:
                 app.logger.error("Mapping has invalid destination_lists")
             user = User.query.get(mapping.user_id)
-        if destination_lists and run_type in ("card", "list", "board"):
+        if destination_lists and run_type in ("card", "list", "board",
+                "changes"):
             args_from_app = {
                 "destination_lists": destination_lists,
                 "key": app.config['TRELLO_API_KEY'],
-                "token": user.trello_token
+                "token": user.trello_token,
+                "mapping_id": mapping.id
             }
             if run_type == "card":
                 status_information = "Job running... Processing one single card."
                 _set_task_progress(0, status_information)
-                master_cards = [perform_request("GET", "cards/%s" % elem_id,
-                    key=args_from_app["key"], token=args_from_app["token"])]
-            elif run_type in ("list", "board"):
-                master_cards = perform_request("GET", "%s/%s/cards" %
-                    (run_type, elem_id),
-                    key=args_from_app["key"], token=args_from_app["token"])
+                with cache_bypassed():
+                    master_cards = [perform_request("GET", "cards/%s" %
+                        elem_id, CARD_NESTED_QUERY, key=args_from_app["key"],
+                        token=args_from_app["token"])]
+            elif run_type == "changes" and mapping.last_action_id:
+                (master_cards, latest_action) = get_changed_master_cards(
+                    elem_id, mapping.last_action_id,
+                    {"key": args_from_app["key"],
+                    "token": args_from_app["token"]})
+                status_information = "Job running... Processing %d cards " \
+                    "changed since the last run." % len(master_cards)
+                _set_task_progress(0, status_information)
+            elif run_type in ("list", "board", "changes"):
+                if run_type != "list":
+                    # Without a checkpoint yet, changes need a full board run,
+                    # which records the checkpoint for the next runs
+                    run_type = "board"
+                    latest_action = get_latest_board_action(elem_id,
+                        {"key": args_from_app["key"],
+                        "token": args_from_app["token"]})
+                master_cards = get_cards_snapshot(run_type, elem_id,
+                    {"key": args_from_app["key"],
+                    "token": args_from_app["token"]})
+                if run_type == "board" and job and shards > 1 and \
+                        len(master_cards) > 1:
+                    num_shards = _launch_shards(job, mapping, master_cards,
+                        shards, latest_action)
+                    _set_task_progress(0, "Job running... Processing %d cards "
+                        "in %d shards." % (len(master_cards), num_shards))
+                    app.logger.info('Split task for mapping %d, %s %s in %d '
+                        'shards' % (mapping_id, run_type, elem_id, num_shards))
+                    return
                 status_information = "Job running... Processing %d cards." % \
                     len(master_cards)
                 _set_task_progress(0, status_information)
@@ -56,15 +107,33 @@ def run_mapping(mapping_id, run_type, elem_id):
                 "active_master_cards": 0,
                 "slave_card": 0,
                 "new_slave_card": 0}
+            completed = _get_run_checkpoint(checkpoint_key)
+            if completed:
+                app.logger.info("Resuming the run, %d master cards were "
+                    "already processed" % len(completed))
+            pending_master_cards = [mc for mc in master_cards
+                if not (completed and mc["id"] in completed)]
+            outputs = _sync_master_cards(pending_master_cards, args_from_app)
             for idx, master_card in enumerate(master_cards):
-                app.logger.info("Processing master card %d/%d - %s" %
-                    (idx+1, len(master_cards), master_card["name"]))
-                output = process_master_card(master_card, args_from_app)
+                if completed and master_card["id"] in completed:
+                    output = completed[master_card["id"]]
+                else:
+                    output = next(outputs)
+                    app.logger.info("Processed master card %d/%d - %s" %
+                        (idx+1, len(master_cards), master_card["name"]))
+                    if checkpoint_key:
+                        checkpoint_key = _save_run_checkpoint(checkpoint_key,
+                            master_card["id"], output)
                 summary["active_master_cards"] += output[0]
                 summary["slave_card"] += output[1]
                 summary["new_slave_card"] += output[2]
                 if idx < len(master_cards)-1:
                     _set_task_progress(int(100.0 * (idx+1) / len(master_cards)))
+            if run_type in ("board", "changes") and latest_action:
+                # The next run only needs the cards changed after this one
+                mapping.set_checkpoint(latest_action)
+                db.session.commit()
+            _delete_run_checkpoint(checkpoint_key)
             status_information = "Run complete. %s" % output_summary(None, summary)
         else:
             app.logger.error("Invalid task, ignoring")
@@ -72,6 +141,22 @@ def run_mapping(mapping_id, run_type, elem_id):
         _set_task_progress(100, status_information)
         app.logger.info('Completed task for mapping %d, %s %s' %
             (mapping_id, run_type, elem_id))
+        app.logger.debug('Trello connections: %s' % get_transport_stats())
+        rate_limit_stats = get_rate_limit_stats()
+        for s in rate_limit_stats:
+            rate_limit_stats[s] -= rate_limit_stats_start[s]
+        if rate_limit_stats["throttled"]:
+            app.logger.info('Waited %.1fs for the Trello rate limits (%d of %d '
+                'requests throttled, %.1fs in total across the threads)' % (
+                rate_limit_stats["wait_time"], rate_limit_stats["throttled"],
+                rate_limit_stats["requests"],
+                rate_limit_stats["thread_wait_time"]))
+        retry_stats = get_retry_stats()
+        retries = retry_stats["retries"] - retry_stats_start["retries"]
+        if retries:
+            app.logger.info('Retried %d Trello requests after transient '
+                'errors (%d attempts in total)' % (retries,
+                retry_stats["attempts"] - retry_stats_start["attempts"]))
     except:
         _set_task_progress(100, "The job errored out.")
         app.logger.error(
@@ -79,17 +164,329 @@ def run_mapping(mapping_id, run_type, elem_id):
             (mapping_id, run_type, elem_id), exc_info=sys.exc_info())
 
 
-def _set_task_progress(progress, status_information=None):
-    job = get_current_job()
-    if job:
-        job.meta['progress'] = progress
+def run_webhook_card(mapping_id, card_id, pending_key):
+    # From now on, new actions on this card need a new run
+    app.redis.delete(pending_key)
+    try:
+        mapping = Mapping.query.filter_by(id=mapping_id).first()
+        destination_lists = {}
+        if mapping:
+            destination_lists = mapping.get_destination_lists()
+            if not destination_lists:
+                app.logger.error("Mapping has invalid destination_lists")
+        if not destination_lists:
+            app.logger.error("Invalid webhook task, ignoring")
+            return
+        user = User.query.get(mapping.user_id)
+        args_from_app = {
+            "destination_lists": destination_lists,
+            "key": app.config['TRELLO_API_KEY'],
+            "token": user.trello_token,
+            "mapping_id": mapping.id
+        }
+        with cache_bypassed():
+            master_card = perform_request("GET", "cards/%s" % card_id,
+                CARD_NESTED_QUERY, key=args_from_app["key"],
+                token=args_from_app["token"])
+        if master_card["idBoard"] != mapping.master_board:
+            app.logger.info("Card %s is no longer on the master board of "
+                "mapping %d, ignoring" % (card_id, mapping_id))
+            return
+        if master_card.get("closed"):
+            # Like the board runs, which only sync the open cards
+            app.logger.info("Card %s is archived, ignoring" % card_id)
+            return
+        app.logger.info("Processing master card %s - %s for mapping %d" %
+            (card_id, master_card["name"], mapping_id))
+        output = process_master_card(master_card, args_from_app)
+        summary = {
+            "master_cards": 1,
+            "active_master_cards": output[0],
+            "slave_card": output[1],
+            "new_slave_card": output[2]}
+        app.logger.info("Completed webhook task for mapping %d, card %s. %s" %
+            (mapping_id, card_id, output_summary(None, summary)))
+    except:
+        app.logger.error(
+            'run_webhook_card: Unhandled exception while running task %d %s' %
+            (mapping_id, card_id), exc_info=sys.exc_info())
+
+
+def run_mapping_shard(parent_id, mapping_id, card_ids):
+    """
+    Process some of the master cards of a board, for a board run split in
+    shards. The outputs of the shards are checkpointed together, so that a
+    shard enqueued again resumes where it stopped and no card is counted
+    twice. The progress is reported on the task of the board run, and the
+    last shard to complete reports the merged summary.
+    """
+    shards_key = RUN_SHARDS_KEY % parent_id
+    checkpoint_key = RUN_CHECKPOINT_KEY % parent_id
+    errors = 0
+    parent_job = None
+    try:
+        parent_job = Job.fetch(parent_id, connection=app.redis)
+        if app.redis.hexists(shards_key, "completed"):
+            app.logger.warning('Ignoring shard of task %s, the task was '
+                'already completed' % parent_id)
+            return
+        mapping = Mapping.query.filter_by(id=mapping_id).first()
+        user = User.query.get(mapping.user_id)
+        args_from_app = {
+            "destination_lists": mapping.get_destination_lists(),
+            "key": app.config['TRELLO_API_KEY'],
+            "token": user.trello_token,
+            "mapping_id": mapping.id
+        }
+        # Only the cards of this shard are fetched again, the deleted ones
+        # and the ones moved to another board since the snapshot are skipped
+        with cache_bypassed():
+            master_cards = batch_get(["cards/%s" % card_id
+                for card_id in card_ids], {"key": args_from_app["key"],
+                "token": args_from_app["token"]}, CARD_NESTED_QUERY)
+        master_cards = [mc for mc in master_cards
+            if mc and mc["idBoard"] == mapping.master_board]
+        app.logger.info('Starting shard of task for mapping %d, %d cards' %
+            (mapping_id, len(master_cards)))
+        # The cards a previous attempt of this shard already processed
+        completed_cards = app.redis.hmget(checkpoint_key,
+            [mc["id"] for mc in master_cards]) if master_cards else []
+        num_completed = len([c for c in completed_cards if c])
+        if num_completed:
+            app.logger.info("Resuming the shard, %d master cards were "
+                "already processed" % num_completed)
+        master_cards = [mc for (mc, c) in zip(master_cards, completed_cards)
+            if not c]
+        outputs = _sync_master_cards(master_cards, args_from_app)
+        for (master_card, output) in zip(master_cards, outputs):
+            app.logger.info("Processed master card %s - %s" %
+                (master_card["id"], master_card["name"]))
+            # The progress counts the checkpointed cards, each card once even
+            # if its shard is enqueued again
+            pipeline = app.redis.pipeline(transaction=False)
+            pipeline.hset(checkpoint_key, master_card["id"], json.dumps(output))
+            pipeline.expire(checkpoint_key, app.config["RUN_CHECKPOINT_TIMEOUT"])
+            pipeline.hlen(checkpoint_key)
+            pipeline.hget(shards_key, "master_cards")
+            pipeline.hget(shards_key, "completed")
+            (_, _, processed, total, completed) = pipeline.execute()
+            if completed:
+                app.logger.warning('Stopping shard of task %s, the task timed '
+                    'out' % parent_id)
+                break
+            # Only the last shard completes the task
+            _set_task_progress(min(99, int(100.0 * processed / int(total))),
+                job=parent_job)
+    except:
+        errors = 1
+        app.logger.error(
+            'run_mapping_shard: Unhandled exception while running shard of '
+            'task %s' % parent_id, exc_info=sys.exc_info())
+    # Report that this shard is done, whether it failed or not
+    pipeline = app.redis.pipeline()
+    pipeline.hincrby(shards_key, "errors", errors)
+    pipeline.hincrby(shards_key, "remaining", -1)
+    remaining = pipeline.execute()[-1]
+    if remaining == 0 and parent_job:
+        _complete_shards(parent_job, shards_key, checkpoint_key, mapping_id)
+
+
+def check_run_shards(parent_id, mapping_id):
+    """
+    Complete the task of a board run whose shards aren't all done in time,
+    e.g. after the worker of a shard was lost
+    """
+    try:
+        parent_job = Job.fetch(parent_id, connection=app.redis)
+    except NoSuchJobError:
+        return
+    shards_key = RUN_SHARDS_KEY % parent_id
+    if app.redis.exists(shards_key):
+        _complete_shards(parent_job, shards_key,
+            RUN_CHECKPOINT_KEY % parent_id, mapping_id, timed_out=True)
+
+
+def flush_last_seen():
+    num_users = User.flush_last_seen()
+    app.logger.info("Recorded when %d users were last seen" % num_users)
+
+
+def _launch_shards(job, mapping, master_cards, shards, latest_action):
+    """
+    Split a board run in shard jobs, each processing some of the master
+    cards of the snapshot. The cards created since the snapshot are left to
+    the next run of changes. Returns the number of shards.
+    """
+    card_ids = [mc["id"] for mc in master_cards]
+    shard_size = -(-len(card_ids) // shards)
+    shard_card_ids = [card_ids[i:i + shard_size]
+        for i in range(0, len(card_ids), shard_size)]
+    shards_key = RUN_SHARDS_KEY % job.get_id()
+    pipeline = app.redis.pipeline()
+    pipeline.hset(shards_key, mapping={
+        "master_cards": len(card_ids),
+        "remaining": len(shard_card_ids),
+        "latest_action": json.dumps(latest_action)})
+    pipeline.expire(shards_key, app.config["RUN_CHECKPOINT_TIMEOUT"])
+    pipeline.execute()
+    # The shards report their progress on this job once it's done
+    job.result_ttl = app.config["RUN_CHECKPOINT_TIMEOUT"]
+    for card_ids in shard_card_ids:
+        app.task_queue.enqueue('app.tasks.run_mapping_shard', job.get_id(),
+            mapping.id, card_ids,
+            job_timeout=app.config["RUN_SHARDS_TIMEOUT"])
+    # A lost shard doesn't leave the task running forever
+    app.task_queue.enqueue_in(timedelta(
+        seconds=app.config["RUN_SHARDS_TIMEOUT"]), 'app.tasks.check_run_shards',
+        job.get_id(), mapping.id)
+    return len(shard_card_ids)
+
+
+def _complete_shards(parent_job, shards_key, checkpoint_key, mapping_id,
+    timed_out=False):
+    """
+    Complete the task of a board run once all its shards are done, or once
+    they timed out. The summary is merged from the checkpoint of the shards.
+    The shards' key is kept until it expires, for the shards still running
+    to know the task is complete.
+    """
+    pipeline = app.redis.pipeline()
+    pipeline.hsetnx(shards_key, "completed", 1)
+    pipeline.hgetall(shards_key)
+    pipeline.hvals(checkpoint_key)
+    (claimed, shards, outputs) = pipeline.execute()
+    if not claimed:
+        # Both the last shard and the timeout check got there
+        return
+    shards = {k.decode(): v.decode() for (k, v) in shards.items()}
+    if timed_out:
+        status_information = "The job timed out."
+        app.logger.warning('Shards of task for mapping %d not done after %ds, '
+            '%s of them remaining' % (mapping_id,
+            app.config["RUN_SHARDS_TIMEOUT"], shards.get("remaining")))
+        _set_task_progress(100, status_information, parent_job)
+        return
+    if int(shards.get("errors", 0)):
+        status_information = "The job errored out."
+    else:
+        latest_action = json.loads(shards["latest_action"])
+        if latest_action:
+            # The next run only needs the cards changed after this one
+            mapping = Mapping.query.filter_by(id=mapping_id).first()
+            mapping.set_checkpoint(latest_action)
+            db.session.commit()
+        outputs = [json.loads(output) for output in outputs]
+        summary = {f: sum([output[i] for output in outputs])
+            for (i, f) in enumerate(SUMMARY_FIELDS)}
+        summary["master_cards"] = len(outputs)
+        status_information = "Run complete. %s" % output_summary(None,
+            summary)
+    _delete_run_checkpoint(checkpoint_key)
+    _set_task_progress(100, status_information, parent_job)
+    app.logger.info('Completed task for mapping %d, board run in shards' %
+        mapping_id)
+
+
+def _sync_master_cards(master_cards, args_from_app):
+    """
+    Sync the master cards in batches of RUN_MAPPING_BATCH_SIZE, the plans of
+    a whole batch being applied together. Yields the output of each card once
+    its batch is synced.
+    """
+    batch_size = app.config["RUN_MAPPING_BATCH_SIZE"]
+    for i in range(0, len(master_cards), batch_size):
+        yield from sync_master_cards(master_cards[i:i+batch_size],
+            args_from_app)
+
+
+def _get_run_checkpoint(checkpoint_key):
+    """Get the outputs of the master cards processed by previous attempts"""
+    if not checkpoint_key:
+        return {}
+    try:
+        checkpoint = app.redis.hgetall(checkpoint_key)
+    except redis.exceptions.RedisError:
+        app.logger.warning("Unable to get the run checkpoint, starting over")
+        return {}
+    return {card_id.decode(): tuple(json.loads(output))
+        for (card_id, output) in checkpoint.items()}
+
+
+def _save_run_checkpoint(checkpoint_key, card_id, output):
+    """
+    Record that a master card was processed. Returns the checkpoint key, or
+    None if the checkpoints can't be saved for the rest of the run.
+    """
+    try:
+        pipeline = app.redis.pipeline(transaction=False)
+        pipeline.hset(checkpoint_key, card_id, json.dumps(output))
+        pipeline.expire(checkpoint_key, app.config["RUN_CHECKPOINT_TIMEOUT"])
+        pipeline.execute()
+    except redis.exceptions.RedisError:
+        app.logger.warning("Unable to save the run checkpoint, the run won't "
+            "be resumable")
+        return None
+    return checkpoint_key
+
+
+def _delete_run_checkpoint(checkpoint_key):
+    if not checkpoint_key:
+        return
+    try:
+        app.redis.delete(checkpoint_key)
+    except redis.exceptions.RedisError:
+        # It expires anyway
+        pass
+
+
+def _publish_task_progress(job_id, progress):
+    """Push the progress of a task to the browsers of its user"""
+    if job_id not in progress_channels:
+        task = Task.query.get(job_id)
+        progress_channels[job_id] = PROGRESS_CHANNEL % task.user_id \
+            if task and task.user_id else None
+    if not progress_channels[job_id]:
+        return
+    try:
+        app.redis.publish(progress_channels[job_id], json.dumps(
+            {'task_id': job_id, 'progress': progress}))
+    except redis.exceptions.RedisError:
+        # The browsers still get the progress by polling
+        pass
+
+
+def _set_task_progress(progress, status_information=None, job=None):
+    """
+    Report the progress of a task. While the task runs, its progress is only
+    kept in the job's meta in Redis, saved and published at most every
+    TASK_PROGRESS_INTERVAL seconds. The task itself is only updated in the
+    database when its status changes and when it completes.
+    """
+    if job is None:
+        job = get_current_job()
+    if not job:
+        return
+    job.meta['progress'] = progress
+    job_id = job.get_id()
+    transition = status_information is not None or progress >= 100
+    (saved_time, saved_progress) = progress_saved.get(job_id, (0, None))
+    now = time.time()
+    if transition or (progress != saved_progress and
+            now - saved_time >= app.config['TASK_PROGRESS_INTERVAL']):
         job.save_meta()
-        task = Task.query.get(job.get_id())
-        task.user.add_notification('task_progress', {'task_id': job.get_id(),
-                                                     'progress': progress})
-        if progress >= 100:
-            task.complete = True
-            task.timestamp_end = datetime.utcnow()
-        if status_information:
-            task.status = status_information
-        db.session.commit()
+        progress_saved[job_id] = (now, progress)
+        _publish_task_progress(job_id, progress)
+    if progress >= 100:
+        progress_saved.pop(job_id, None)
+        progress_channels.pop(job_id, None)
+    if not transition:
+        return
+    task = Task.query.get(job_id)
+    task.user.add_notification('task_progress', {'task_id': job_id,
+                                                 'progress': progress})
+    if progress >= 100:
+        task.complete = True
+        task.timestamp_end = datetime.utcnow()
+    if status_information:
+        task.status = status_information
+    db.session.commit()
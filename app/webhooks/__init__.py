@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of SyncBoom and is MIT-licensed.
+
+from flask import Blueprint
+
+bp = Blueprint('webhooks', __name__)
+
+from app.webhooks import routes
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of SyncBoom and is MIT-licensed.
+
+import base64
+import hashlib
+import hmac
+import json
+from flask import request, current_app, abort
+import redis
+from app.models import Mapping
+from app.webhooks import bp
+from syncboom import get_action_entities, invalidate_cached_entities, \
+    is_master_card_action, is_boards_catalog_action, invalidate_boards_catalog
+
+
+def is_valid_signature(body, signature):
+    """
+    Check the signature Trello computed over the body and callback URL with
+    the API secret, see https://developer.atlassian.com/cloud/trello/guides/
+    rest-api/webhooks/#webhook-signatures
+    """
+    secret = current_app.config['TRELLO_API_SECRET']
+    if not secret or not signature:
+        return False
+    content = body + request.url
+    digest = hmac.new(secret.encode("utf-8"), content.encode("utf-8"),
+        hashlib.sha1).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode("utf-8"),
+        signature)
+
+
+def invalidate_boards_catalogs(board_id):
+    """
+    Refresh the catalogs of the boards and lists of the users mapping this
+    board, as its name or lists changed
+    """
+    for mapping in Mapping.query.filter_by(master_board=board_id).all():
+        for user in mapping.users:
+            invalidate_boards_catalog({"token": user.trello_token})
+
+
+def enqueue_master_card(mapping, card_id):
+    """
+    Queue one run for this master card, unless one is already waiting in the
+    queue: a burst of actions on the same card is then synced at once
+    """
+    pending_key = "syncboom-webhook-pending:%d:%s" % (mapping.id, card_id)
+    if not current_app.redis.set(pending_key, 1, nx=True,
+            ex=current_app.config['TRELLO_WEBHOOK_PENDING_TIMEOUT']):
+        current_app.logger.debug("A run is already queued for card %s of "
+            "mapping %d" % (card_id, mapping.id))
+        return None
+    return current_app.task_queue.enqueue('app.tasks.run_webhook_card',
+        mapping.id, card_id, pending_key)
+
+
+@bp.route('/1/', methods=['HEAD', 'POST'])
+def trello_webhook():
+    if request.method == 'HEAD':
+        # Trello checks the callback URL exists when creating the webhook
+        return "", 200
+    body = request.get_data(as_text=True)
+    if not is_valid_signature(body, request.headers.get("X-Trello-Webhook")):
+        current_app.logger.warning("Ignoring a webhook call with an invalid "
+            "signature")
+        abort(403)
+    try:
+        payload = json.loads(body)
+        action = payload["action"]
+        model_id = payload["model"]["id"]
+    except (ValueError, KeyError, TypeError):
+        abort(400)
+
+    invalidate_cached_entities(get_action_entities(action))
+    if is_boards_catalog_action(action):
+        invalidate_boards_catalogs(model_id)
+    if not is_master_card_action(action):
+        return "", 200
+    card = action["data"]["card"]
+    try:
+        for mapping in Mapping.query.filter_by(master_board=model_id,
+                m_type="automatic").all():
+            enqueue_master_card(mapping, card["id"])
+    except redis.exceptions.RedisError:
+        current_app.logger.error("Unable to queue the webhook run for card %s"
+            % card["id"])
+        # Trello retries the webhook calls that don't succeed
+        abort(503)
+    return "", 200
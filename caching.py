@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of SyncBoom and is MIT-licensed.
+
+from flask_caching import Cache
+
+# The cache is shared by the website and the command line, which mustn't
+# import the whole app and its web-only dependencies just to use it
+cache = Cache()
@@ -26,7 +26,79 @@ class Config(object):
     LANGUAGES = ['en']
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
     TRELLO_API_KEY = os.environ.get('TRELLO_API_KEY')
-    CACHE_TYPE = 'simple'
+    TRELLO_API_SECRET = os.environ.get('TRELLO_API_SECRET')
+    TRELLO_WEBHOOK_PENDING_TIMEOUT = int(
+        os.environ.get('TRELLO_WEBHOOK_PENDING_TIMEOUT') or 600)
+    # Keep the progress of an interrupted or sharded run for that long
+    RUN_CHECKPOINT_TIMEOUT = int(
+        os.environ.get('RUN_CHECKPOINT_TIMEOUT') or 86400)
+    # Save the progress of a running task at most every that many seconds
+    TASK_PROGRESS_INTERVAL = int(os.environ.get('TASK_PROGRESS_INTERVAL') or 2)
+    # The browser reconnects to the task progress stream after that long
+    NOTIFICATIONS_STREAM_TIMEOUT = int(
+        os.environ.get('NOTIFICATIONS_STREAM_TIMEOUT') or 60)
+    # Task progress streams open at once in each web process, each holding
+    # one of its threads, the other browsers poll the notifications
+    NOTIFICATIONS_MAX_STREAMS = int(
+        os.environ.get('NOTIFICATIONS_MAX_STREAMS') or 4)
+    # Only record when users were last seen with that many seconds of
+    # precision, and write it to the database every that many seconds
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(
+        os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 300)
+    # Master cards of a run planned then applied together, the progress and
+    # the checkpoint of the run being saved once each batch is synced
+    RUN_MAPPING_BATCH_SIZE = int(os.environ.get('RUN_MAPPING_BATCH_SIZE') or 100)
+    # Number of jobs a board run is split into, to run on several workers
+    RUN_MAPPING_SHARDS = int(os.environ.get('RUN_MAPPING_SHARDS') or 1)
+    # A board run in shards is reported as timed out if its shards aren't all
+    # done after that many seconds
+    RUN_SHARDS_TIMEOUT = int(os.environ.get('RUN_SHARDS_TIMEOUT') or 3600)
+    # Cards returned per page by the card search of the run page
+    MAPPING_CARDS_PER_PAGE = int(os.environ.get('MAPPING_CARDS_PER_PAGE') or 50)
+    TRELLO_POOL_SIZE = int(os.environ.get('TRELLO_POOL_SIZE') or 10)
+    # Connections the requests fanned out on an event loop share
+    TRELLO_ASYNC_POOL_SIZE = int(os.environ.get('TRELLO_ASYNC_POOL_SIZE') or 50)
+    TRELLO_KEEP_ALIVE = os.environ.get('TRELLO_KEEP_ALIVE') != "0"
+    # Trello allows 300 requests per 10 seconds per API key and 100 requests
+    # per 10 seconds per token
+    TRELLO_KEY_RATE_LIMIT = int(os.environ.get('TRELLO_KEY_RATE_LIMIT') or 300)
+    TRELLO_TOKEN_RATE_LIMIT = int(
+        os.environ.get('TRELLO_TOKEN_RATE_LIMIT') or 100)
+    TRELLO_RATE_LIMIT_PERIOD = 10
+    # Requests sent at once before being paced, taken out of the margin
+    TRELLO_RATE_LIMIT_BURST = int(
+        os.environ.get('TRELLO_RATE_LIMIT_BURST') or 10)
+    # Share of the rate limits the steady pace leaves unused, for the bursts
+    TRELLO_RATE_LIMIT_MARGIN = float(
+        os.environ.get('TRELLO_RATE_LIMIT_MARGIN') or 0.1)
+    TRELLO_RETRY_MAX_ATTEMPTS = int(
+        os.environ.get('TRELLO_RETRY_MAX_ATTEMPTS') or 5)
+    TRELLO_RETRY_DEADLINE = int(os.environ.get('TRELLO_RETRY_DEADLINE') or 120)
+    TRELLO_RETRY_BACKOFF = 0.5
+    TRELLO_RETRY_MAX_BACKOFF = 30
+    # Each attempt gives up after these many seconds to connect and to read
+    # the response, or sooner when the total deadline is closer
+    TRELLO_CONNECT_TIMEOUT = int(os.environ.get('TRELLO_CONNECT_TIMEOUT') or 5)
+    TRELLO_READ_TIMEOUT = int(os.environ.get('TRELLO_READ_TIMEOUT') or 30)
+    TRELLO_CONCURRENCY = int(os.environ.get('TRELLO_CONCURRENCY') or 4)
+    TRELLO_LINK_RECONCILE_INTERVAL = int(
+        os.environ.get('TRELLO_LINK_RECONCILE_INTERVAL') or 86400)
+    # Share the cache between the web and worker processes through Redis
+    # when it is set up, with a per-process cache otherwise
+    CACHE_TYPE = 'redis' if os.environ.get('REDIS_URL') else 'simple'
+    CACHE_REDIS_URL = os.environ.get('REDIS_URL')
+    CACHE_KEY_PREFIX = 'syncboom-cache:'
+    CACHE_THRESHOLD = int(os.environ.get('CACHE_THRESHOLD') or 500)
+    CACHE_MAX_VALUE_SIZE = int(os.environ.get('CACHE_MAX_VALUE_SIZE') or 262144)
+    TRELLO_REQUEST_CACHE_TIMEOUT = 60
+    # The names looked up are mostly those of destination boards and lists,
+    # which no webhook watches, so renames have to expire from the cache
+    TRELLO_NAME_CACHE_TIMEOUT = 300
+    # The boards and lists shown in the mapping wizard, refreshed when it starts
+    TRELLO_CATALOG_CACHE_TIMEOUT = 3600
+    # The cards searched on the run page, also invalidated by the webhooks
+    TRELLO_CARDS_INDEX_CACHE_TIMEOUT = 300
     SESSION_COOKIE_SECURE = True
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax'
@@ -7,7 +7,6 @@ Create Date: 2020-06-15 11:36:49.712790
 """
 from alembic import op
 import sqlalchemy as sa
-from app.models import Mapping
 
 
 # revision identifiers, used by Alembic.
@@ -23,16 +22,16 @@ def upgrade():
             create_constraint=False)
         , nullable=True))
 
-    # Populate m_type for all existing mappings default to manual
+    # Populate m_type for all existing mappings default to manual. Use a
+    # table stub rather than the Mapping model, which may have columns that
+    # later migrations add.
+    mapping = sa.table('mapping', sa.column('m_type', sa.String))
     bind = op.get_bind()
-    session = sa.orm.Session(bind=bind)
-    mappings = session.query(Mapping)
-    num_mappings = len(list(mappings))
+    num_mappings = bind.execute(
+        sa.select([sa.func.count()]).select_from(mapping)).scalar()
     if num_mappings > 0:
         print("Setting m_type to 'manual' for all %d mappings" % num_mappings)
-        for m in mappings:
-            m.m_type = "manual"
-    session.commit()
+        op.execute(mapping.update().values(m_type="manual"))
 
 
 def downgrade():
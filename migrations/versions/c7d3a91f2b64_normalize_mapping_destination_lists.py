@@ -0,0 +1,86 @@
+"""Normalize Mapping.destination_lists into a MappingDestination table
+
+Revision ID: c7d3a91f2b64
+Revises: 53819a3ae8e8
+Create Date: 2026-10-16 20:10:52.184630
+
+"""
+import json
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d3a91f2b64'
+down_revision = '53819a3ae8e8'
+branch_labels = None
+depends_on = None
+
+# Table stubs rather than the models, which may change in later migrations
+mapping = sa.table('mapping',
+    sa.column('id', sa.Integer),
+    sa.column('destination_lists', sa.Text))
+mapping_destination = sa.table('mapping_destination',
+    sa.column('id', sa.Integer),
+    sa.column('mapping_id', sa.Integer),
+    sa.column('label', sa.String),
+    sa.column('destination_list', sa.String))
+
+
+def upgrade():
+    op.create_table('mapping_destination',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('mapping_id', sa.Integer(), nullable=True),
+    sa.Column('label', sa.String(length=128), nullable=True),
+    sa.Column('destination_list', sa.String(length=128), nullable=True),
+    sa.ForeignKeyConstraint(['mapping_id'], ['mapping.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_mapping_destination_destination_list'), 'mapping_destination', ['destination_list'], unique=False)
+    op.create_index(op.f('ix_mapping_destination_label'), 'mapping_destination', ['label'], unique=False)
+    op.create_index(op.f('ix_mapping_destination_mapping_id'), 'mapping_destination', ['mapping_id'], unique=False)
+    op.create_index(op.f('ix_mapping_master_board'), 'mapping', ['master_board'], unique=False)
+
+    # Copy the destination lists of the existing mappings
+    bind = op.get_bind()
+    destinations = []
+    for (mapping_id, destination_lists) in bind.execute(
+            sa.select([mapping.c.id, mapping.c.destination_lists])):
+        try:
+            destination_lists = json.loads(destination_lists)
+        except (TypeError, ValueError):
+            continue
+        for label in destination_lists:
+            for list_id in destination_lists[label]:
+                destinations.append({"mapping_id": mapping_id, "label": label,
+                    "destination_list": list_id})
+    if destinations:
+        print("Copying %d destination lists" % len(destinations))
+        op.bulk_insert(mapping_destination, destinations)
+
+    # Deleting a column in SQLite has us go through Batch mode
+    with op.batch_alter_table("mapping") as batch_op:
+        batch_op.drop_column('destination_lists')
+
+
+def downgrade():
+    op.add_column('mapping', sa.Column('destination_lists', sa.Text(), nullable=True))
+
+    bind = op.get_bind()
+    destination_lists = {}
+    for (mapping_id, label, list_id) in bind.execute(
+            sa.select([mapping_destination.c.mapping_id,
+                mapping_destination.c.label,
+                mapping_destination.c.destination_list]).order_by(
+                mapping_destination.c.id)):
+        destination_lists.setdefault(mapping_id, {}).setdefault(label,
+            []).append(list_id)
+    for mapping_id in destination_lists:
+        op.execute(mapping.update().where(mapping.c.id == mapping_id).values(
+            destination_lists=json.dumps(destination_lists[mapping_id])))
+
+    op.drop_index(op.f('ix_mapping_master_board'), table_name='mapping')
+    op.drop_index(op.f('ix_mapping_destination_mapping_id'), table_name='mapping_destination')
+    op.drop_index(op.f('ix_mapping_destination_label'), table_name='mapping_destination')
+    op.drop_index(op.f('ix_mapping_destination_destination_list'), table_name='mapping_destination')
+    op.drop_table('mapping_destination')
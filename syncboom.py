@@ -4,14 +4,25 @@
 #    This file is part of SyncBoom and is MIT-licensed.
 
 import argparse
+import asyncio
 import logging
 import json
 import requests
 import os
 import sys
 import re
-from slugify import slugify
-from app import create_app, cache
+import threading
+import time
+import hashlib
+import random
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import Flask, current_app, has_app_context
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+from caching import cache
+from config import Config
 
 try:
     import readline
@@ -21,12 +32,117 @@ except ImportError:
 
 METADATA_PHRASE = "DO NOT EDIT BELOW THIS LINE"
 METADATA_SEPARATOR = "\n\n%s\n*== %s ==*\n" % ("-" * 32, METADATA_PHRASE)
+# Cached values depend on the generation of the Trello entities they're about
+CACHE_GENERATION_KEY = "generation:%s"
+TRELLO_ENTITY_URL = re.compile(r"^(?:board|list|card)s?/([0-9a-zA-Z]+)")
+# Fields of a Trello action's data that point to a board, list or card
+TRELLO_ENTITY_FIELDS = ("board", "boardSource", "boardTarget", "list",
+    "listBefore", "listAfter", "card", "cardSource")
+# Get a card's attachments and checklists nested in the card itself
+CARD_NESTED_QUERY = {
+    "attachments": "true",
+    "attachment_fields": "id,url",
+    "checklists": "all",
+    "checklist_fields": "id,name"
+}
+# Trello's batch endpoint accepts up to 10 URLs per request
+BATCH_SIZE = 10
+# Trello returns at most 1000 cards per request
+SNAPSHOT_PAGE_SIZE = 1000
+CARDS_SNAPSHOT_QUERY = dict(CARD_NESTED_QUERY,
+    fields="id,name,desc,labels,badges,idBoard,idList,shortLink,shortUrl,url",
+    limit=SNAPSHOT_PAGE_SIZE)
+# Only what the cleanup needs to empty the slave lists
+CLEANUP_CARDS_QUERY = {"fields": "id,idList", "limit": SNAPSHOT_PAGE_SIZE}
+# Only what the card picker of the run page shows and searches
+CARDS_INDEX_QUERY = {"fields": "name,idList", "limit": SNAPSHOT_PAGE_SIZE}
+# Trello returns at most 1000 actions per request
+ACTIONS_PAGE_SIZE = 1000
+# Actions on a master card that can change what needs to be synced
+MASTER_CARD_ACTIONS = ("createCard", "copyCard", "updateCard",
+    "moveCardToBoard", "addLabelToCard", "removeLabelFromCard",
+    "deleteAttachmentFromCard", "convertToCardFromCheckItem")
+# Actions that change the names or lists of a board in the users' catalogs
+BOARDS_CATALOG_ACTIONS = ("createList", "updateList", "moveListToBoard",
+    "moveListFromBoard", "updateBoard")
+# Open boards with their open lists, in a single request
+BOARDS_CATALOG_QUERY = {
+    "filter": "open",
+    "fields": "id,name,closed",
+    "lists": "open",
+    "list_fields": "id,name"
+}
+# Card fields whose update doesn't change what needs to be synced, such as
+# the master card metadata written to the description during a sync
+UNSYNCED_CARD_FIELDS = ("desc", "pos")
+# Stages in which the operations of sync plans are applied, each stage only
+# depending on the results of the previous ones. The slave cards are copies of
+# their master card with its checklists, the checklist of the teams is only
+# created once they are. The master card's metadata only lists the slave
+# cards that were created.
+PLAN_STAGES = (("create_slave_card",),
+    ("create_checklist", "link_slave_card", "update_desc"),
+    ("add_checklist_item",))
 
 class TrelloConnectionError(Exception):
     pass
 class TrelloAuthenticationError(Exception):
     pass
 
+# One HTTP session (and thus one connection pool) per process
+session = None
+session_pid = None
+session_lock = threading.Lock()
+
+# Pace the calls to Trello with a token bucket (GCRA), shared between all the
+# workers through Redis. KEYS are the "blocked until" keys (ARGV[2] of them,
+# set after a 429 response) followed by the buckets' theoretical arrival time
+# keys, each with an emission interval and burst tolerance in ARGV.
+RATE_LIMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local num_blocks = tonumber(ARGV[2])
+local wait = 0
+for i = 1, num_blocks do
+    local blocked_until = tonumber(redis.call('GET', KEYS[i]) or 0)
+    if blocked_until - now > wait then
+        wait = blocked_until - now
+    end
+end
+for i = num_blocks + 1, #KEYS do
+    local interval = tonumber(ARGV[(i - num_blocks) * 2 + 1])
+    local tolerance = tonumber(ARGV[(i - num_blocks) * 2 + 2])
+    local tat = math.max(tonumber(redis.call('GET', KEYS[i]) or 0), now)
+    local new_tat = tat + interval
+    if tat - tolerance - now > wait then
+        wait = tat - tolerance - now
+    end
+    redis.call('SET', KEYS[i], tostring(new_tat),
+        'PX', math.ceil((new_tat - now) * 1000) + 1000)
+end
+return tostring(wait)
+"""
+rate_limit_state = {}
+rate_limit_lock = threading.Lock()
+# wait_time is how long requests were held back, thread_wait_time adds up the
+# waits of the concurrent threads
+rate_limit_stats = {"requests": 0, "throttled": 0, "wait_time": 0.0,
+    "thread_wait_time": 0.0}
+rate_limit_waiting_until = 0
+redis_unavailable_until = 0
+
+# Transient failures from Trello that are worth retrying
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "PUT", "DELETE")
+retry_lock = threading.Lock()
+retry_stats = {"attempts": 0, "retries": 0, "failures": 0, "errors": {}}
+
+# Whether the requests of each thread currently bypass the cache
+cache_bypass = threading.local()
+# Size of the body of the last response each thread got from Trello
+last_response = threading.local()
+# Not to log the selector of each event loop run_async creates
+logging.getLogger("asyncio").setLevel(logging.INFO)
+
 
 def rlinput(prompt, prefill=''):
     """Provide an editable input string
@@ -56,12 +172,14 @@ def output_summary(args, summary):
         # Called from the script
         logging.info("="*64)
         if args.cleanup:
-            logging.info("Summary%scleaned up %d master cards and deleted %d slave cards from %d slave boards/%d slave lists." % (
+            logging.info("Summary%scleaned up %d master cards and deleted %d slave cards from %d slave boards/%d slave lists in %.1fs (%.1f slave cards/s)." % (
                 " [DRY RUN]: would have " if args.dry_run else ": ",
                 summary["cleaned_up_master_cards"],
                 summary["deleted_slave_cards"],
                 summary["erased_destination_boards"],
-                summary["erased_destination_lists"]))
+                summary["erased_destination_lists"],
+                summary["duration"],
+                summary["slave_cards_per_second"]))
         elif args.propagate:
             logging.info("Summary%s: processed %d master cards (of which %d active) that have %d slave cards (of which %d %snew)." % (
                 " [DRY RUN]" if args.dry_run else "",
@@ -73,25 +191,195 @@ def output_summary(args, summary):
 
 def get_card_attachments(card, pr_args={}):
     card_attachments = []
-    if card["badges"]["attachments"] > 0:
+    if "attachments" in card:
+        # The attachments are already part of the card's snapshot
+        attachments = card["attachments"]
+    elif card["badges"]["attachments"] > 0:
         logging.debug("Getting %d attachments on master card %s" % (card["badges"]["attachments"], card["id"]))
-        for a in perform_request("GET", "cards/%s/attachments" % card["id"], **pr_args):
-            # Only keep attachments that are links to other Trello cards
-            card_shorturl_regex = "https://trello.com/c/([a-zA-Z0-9_-]{8})/.*"
-            card_shorturl_regex_match = re.match(card_shorturl_regex, a["url"])
-            if card_shorturl_regex_match:
-                a["card_shortUrl"] = card_shorturl_regex_match.group(1)
-                card_attachments.append(a)
+        attachments = perform_request("GET", "cards/%s/attachments" % card["id"], **pr_args)
+    else:
+        attachments = []
+    for a in attachments:
+        # Only keep attachments that are links to other Trello cards
+        card_shorturl_regex = "https://trello.com/c/([a-zA-Z0-9_-]{8})/.*"
+        card_shorturl_regex_match = re.match(card_shorturl_regex, a["url"])
+        if card_shorturl_regex_match:
+            a["card_shortUrl"] = card_shorturl_regex_match.group(1)
+            card_attachments.append(a)
     return card_attachments
 
+def get_attached_slave_cards(master_card, pr_args={}):
+    """Get the slave cards attached to a master card"""
+    master_card_attachments = get_card_attachments(master_card, pr_args)
+    attached_cards = batch_get(["cards/%s" % mca["card_shortUrl"]
+        for mca in master_card_attachments], pr_args)
+    return [ac for ac in attached_cards if ac]
+
+def get_linked_slave_cards(master_card, mapping_id=None, pr_args={}):
+    """
+    Get the slave cards linked to a master card. For a mapping, the links come
+    from the CardLink index. The master card's attachments are only scanned
+    every TRELLO_LINK_RECONCILE_INTERVAL seconds to reconcile the index with
+    the links edited in Trello, or to build it for the cards synced before.
+    """
+    if not mapping_id:
+        return get_attached_slave_cards(master_card, pr_args)
+    from app import db
+    from app.models import CardLink
+    links = CardLink.query.filter_by(mapping_id=mapping_id,
+        master_card=master_card["id"]).all()
+    reconciled_since = datetime.utcnow() - \
+        timedelta(seconds=get_setting("TRELLO_LINK_RECONCILE_INTERVAL"))
+    if links and min([l.timestamp_reconciled for l in links]) > reconciled_since:
+        logging.debug("Master card has %d indexed slave cards" % len(links))
+        slave_cards = batch_get(["cards/%s" % l.slave_card for l in links],
+            pr_args)
+        # Unindex the slave cards deleted from Trello, a new one replaces
+        # them and gets its own link
+        stale_links = [l for (l, sc) in zip(links, slave_cards) if not sc]
+        if stale_links:
+            logging.debug("Unindexing %d deleted slave cards" %
+                len(stale_links))
+            for link in stale_links:
+                db.session.delete(link)
+            db.session.commit()
+        return [sc for sc in slave_cards if sc]
+    if not links and not (master_card.get("attachments") or
+            master_card["badges"]["attachments"] > 0):
+        return []
+    slave_cards = get_attached_slave_cards(master_card, pr_args)
+    logging.debug("Reconciling the index with %d attached slave cards" %
+        len(slave_cards))
+    for link in links:
+        db.session.delete(link)
+    for slave_card in slave_cards:
+        add_card_link(mapping_id, master_card["id"], slave_card)
+    db.session.commit()
+    return slave_cards
+
+def add_card_link(mapping_id, master_card_id, slave_card):
+    # Only the website and its workers index the links, in their database
+    from app import db
+    from app.models import CardLink
+    db.session.add(CardLink(mapping_id=mapping_id, master_card=master_card_id,
+        slave_card=slave_card["id"], slave_list=slave_card["idList"]))
+
+def get_card_checklists(card, pr_args={}):
+    if "checklists" in card:
+        # The checklists are already part of the card's snapshot
+        return card["checklists"]
+    logging.debug("Retrieving checklists from card %s" % card["id"])
+    return perform_request("GET", "cards/%s/checklists" % card["id"], **pr_args)
+
+def get_cards_snapshot(model, model_id, pr_args={}):
+    """
+    Get all the open cards of a board or list with their attachments and
+    checklists nested, in one request per 1000 cards instead of several
+    requests per card.
+    """
+    cards = get_all_cards("%s/%s/cards" % (model, model_id),
+        CARDS_SNAPSHOT_QUERY, pr_args)
+    logging.debug("Snapshot of %s %s: %d cards" % (model, model_id, len(cards)))
+    return cards
+
+def get_all_cards(url, query, pr_args={}):
+    """
+    Get the cards of a Trello URL, through all its pages of 1000 cards. They
+    are always read from Trello: the writes to the cards, e.g. to their
+    checklists, don't invalidate the cached cards of their board or list.
+    """
+    cards = []
+    card_ids = set()
+    page_query = query
+    while True:
+        with cache_bypassed():
+            page = perform_request("GET", url, page_query, **pr_args)
+        num_cards = len(cards)
+        for card in page:
+            if card["id"] not in card_ids:
+                card_ids.add(card["id"])
+                cards.append(card)
+        # A page without new cards means that the URL doesn't page, e.g. it
+        # ignores the before parameter, and would loop over the same page
+        if len(page) < SNAPSHOT_PAGE_SIZE or len(cards) == num_cards:
+            break
+        # Trello pages through the cards from the most recent to the oldest
+        page_query = dict(query, before=min(c["id"] for c in page))
+    return cards
+
+def is_master_card_action(action):
+    """Whether a Trello action can change how a master card is synced"""
+    data = action.get("data", {})
+    if action.get("type") not in MASTER_CARD_ACTIONS or "card" not in data:
+        return False
+    if action["type"] == "updateCard" and data.get("old") and \
+            all([f in UNSYNCED_CARD_FIELDS for f in data["old"]]):
+        return False
+    return True
+
+def is_boards_catalog_action(action):
+    """Whether a Trello action changes the catalog of the boards and lists"""
+    return action.get("type") in BOARDS_CATALOG_ACTIONS
+
+def get_board_actions(board_id, since=None, pr_args={}):
+    """
+    Get the actions on a board since the given action ID or date, from the
+    most recent to the oldest
+    """
+    actions = []
+    query = {"fields": "id,type,date,data", "limit": ACTIONS_PAGE_SIZE}
+    if since:
+        query["since"] = since
+    while True:
+        page = perform_request("GET", "boards/%s/actions" % board_id, query,
+            **pr_args)
+        actions += page
+        if len(page) < ACTIONS_PAGE_SIZE:
+            break
+        query = dict(query, before=page[-1]["id"])
+    return actions
+
+def get_changed_master_cards(board_id, since, pr_args={}):
+    """
+    Get the open cards of the master board that actions changed since the
+    given action ID or date, and the most recent of these actions to resume
+    from next time (None without new actions)
+    """
+    actions = get_board_actions(board_id, since, pr_args)
+    card_ids = []
+    for action in actions:
+        if is_master_card_action(action) and \
+                action["data"]["card"]["id"] not in card_ids:
+            card_ids.append(action["data"]["card"]["id"])
+    logging.debug("%d actions on board %s since %s changed %d cards" %
+        (len(actions), board_id, since, len(card_ids)))
+    # With their attachments and checklists, as in a snapshot of the board,
+    # and as fresh as one
+    with cache_bypassed():
+        cards = batch_get(["cards/%s" % c for c in card_ids], pr_args,
+            CARD_NESTED_QUERY)
+    # Skip the cards deleted, archived or moved to another board since
+    master_cards = [c for c in cards
+        if c and not c.get("closed") and c["idBoard"] == board_id]
+    return (master_cards, actions[0] if actions else None)
+
+def get_latest_board_action(board_id, pr_args={}):
+    """The most recent action on a board, None if there is none"""
+    actions = perform_request("GET", "boards/%s/actions" % board_id,
+        {"fields": "id,type,date,data", "limit": 1}, **pr_args)
+    return actions[0] if actions else None
+
 def cleanup_test_boards(master_cards):
     # Check if this config has been enabled for cleaning up
     if "cleanup_boards" not in config:
         logging.critical("This configuration has not been enabled to accept the --cleanup operation. See the `cleanup_boards` section in the config file. Exiting...")
         sys.exit(43)
+    started = time.time()
 
     logging.debug("Removing slave cards attachments on the master cards")
     cleaned_up_master_cards = 0
+    # The changes to all the master cards are made at once, in parallel
+    calls = []
     for idx, master_card in enumerate(master_cards):
         logging.debug("="*64)
         logging.info("Cleaning up master card %d/%d - %s" %(idx+1, len(master_cards), master_card["name"]))
@@ -100,62 +388,75 @@ def cleanup_test_boards(master_cards):
             cleaned_up_master_cards += 1
             for a in master_card_attachments:
                 logging.debug("Deleting attachment %s from master card %s" %(a["id"], master_card["id"]))
-                perform_request("DELETE", "cards/%s/attachments/%s" % (master_card["id"], a["id"]))
+                calls.append(("DELETE", "cards/%s/attachments/%s" % (master_card["id"], a["id"])))
 
         # Removing teams checklist from the master card
-        logging.debug("Retrieving checklists from card %s" % master_card["id"])
-        for c in perform_request("GET", "cards/%s/checklists" % master_card["id"]):
+        for c in get_card_checklists(master_card):
             if "Involved Teams" == c["name"]:
                 logging.debug("Deleting checklist %s (%s) from master card %s" %(c["name"], c["id"], master_card["id"]))
-                perform_request("DELETE", "checklists/%s" % (c["id"]))
+                calls.append(("DELETE", "checklists/%s" % (c["id"])))
 
         # Removing metadata from the master cards
-        update_master_card_metadata(master_card, "")
+        new_full_desc = get_new_master_card_desc(master_card, "")
+        if new_full_desc is not None:
+            logging.debug("Removing the metadata from master card %s" % master_card["id"])
+            calls.append(("PUT", "cards/%s" % master_card["id"], {"desc": new_full_desc}))
+    perform_requests(calls)
 
     logging.debug("Deleting slave cards")
-    erased_destination_boards = []
-    num_lists_to_cleanup = 0
-    num_lists_inspected = 0
+    # The boards holding the destination lists, with the names of their lists
+    boards = {}
+    for dl in config["destination_lists"]:
+        for l in config["destination_lists"][dl]:
+            if any([l in b["lists"] for b in boards.values()]):
+                continue
+            # Get the board which contains this destination list
+            board = perform_request("GET", "lists/%s/board" % l)
+            # Validate that this board has been whitelisted for cleanup, to
+            # prevent real data from being wiped out inadvertently
+            if board["id"] not in config["cleanup_boards"]:
+                logging.critical("This board %s is not whitelisted to be cleaned up. See the `cleanup_boards` section in the config file. Exiting..." % board["id"])
+                sys.exit(44)
+            # Get all the lists on that board which contains this destination list
+            lists = perform_request("GET", "boards/%s/lists" % board["id"])
+            boards[board["id"]] = {"name": board["name"],
+                "lists": {ll["id"]: ll["name"] for ll in lists}}
+    erased_destination_boards = 0
     num_erased_destination_lists = 0
     deleted_slave_cards = 0
-    destination_lists = []
-    for dl in config["destination_lists"]:
-        for idx, l in enumerate((config["destination_lists"][dl])):
-            if l not in destination_lists:
-                # Get the board which contains this destination list
-                board_id = perform_request("GET", "lists/%s/board" % config["destination_lists"][dl][idx])["id"]
-                # Validate that this board has been whitelisted for cleanup, to
-                # prevent real data from being wiped out inadvertently
-                if board_id not in config["cleanup_boards"]:
-                    logging.critical("This board %s is not whitelisted to be cleaned up. See the `cleanup_boards` section in the config file. Exiting..." % board_id)
-                    sys.exit(44)
-                # Get all the lists on that board which contains this destination list
-                lists = perform_request("GET", "boards/%s/lists" % board_id)
-                for ll in lists:
-                    if ll["id"] not in destination_lists:
-                        destination_lists.append(ll["id"])
-                        num_lists_to_cleanup += 1
-    for l in destination_lists:
+    for (board_id, board) in boards.items():
         logging.debug("="*64)
-        num_lists_inspected += 1
-        board_name = get_board_name_from_list(l)
-        list_name = get_name("list", l)
-        logging.debug("Retrieve cards from list %s|%s (list %d/%d)" % (board_name, list_name, num_lists_inspected, num_lists_to_cleanup))
-        slave_cards = perform_request("GET", "lists/%s/cards" % l)
-        logging.debug(slave_cards)
-        logging.debug("List %s/%s has %d cards to delete" % (board_name, list_name, len(slave_cards)))
-        if len(slave_cards) > 0:
-            num_erased_destination_lists += 1
-            if not board_name in erased_destination_boards:
-                erased_destination_boards.append(board_name)
-        for sc in slave_cards:
-            logging.debug("Deleting slave card %s" % sc["id"])
-            deleted_slave_cards += 1
-            perform_request("DELETE", "cards/%s" % sc["id"])
+        logging.debug("Retrieve cards from board %s (%d lists)" % (board["name"], len(board["lists"])))
+        # One request per 1000 cards of the board rather than one per list
+        slave_cards = [c for c in get_all_cards("boards/%s/cards" % board_id,
+            CLEANUP_CARDS_QUERY) if c["idList"] in board["lists"]]
+        erased_lists = []
+        for (list_id, list_name) in board["lists"].items():
+            num_cards = len([c for c in slave_cards if c["idList"] == list_id])
+            logging.debug("List %s/%s has %d cards to delete" % (board["name"], list_name, num_cards))
+            if num_cards > 0:
+                erased_lists.append(list_id)
+        if not erased_lists:
+            continue
+        erased_destination_boards += 1
+        num_erased_destination_lists += len(erased_lists)
+        # Archiving empties each list at once, in one request per list
+        perform_requests([("POST", "lists/%s/archiveAllCards" % l)
+            for l in erased_lists])
+        # Trello can't delete cards in bulk, the archived cards are then
+        # deleted in parallel, within the rate limits
+        logging.debug("Deleting %d archived slave cards from board %s" % (len(slave_cards), board["name"]))
+        perform_requests([("DELETE", "cards/%s" % sc["id"])
+            for sc in slave_cards])
+        deleted_slave_cards += len(slave_cards)
+    duration = time.time() - started
     return {"cleaned_up_master_cards": cleaned_up_master_cards,
             "deleted_slave_cards": deleted_slave_cards,
-            "erased_destination_boards": len(erased_destination_boards),
-            "erased_destination_lists": num_erased_destination_lists}
+            "erased_destination_boards": erased_destination_boards,
+            "erased_destination_lists": num_erased_destination_lists,
+            "duration": round(duration, 1),
+            "slave_cards_per_second": round(deleted_slave_cards / duration, 1)
+                if duration > 0 else 0}
 
 def split_master_card_metadata(master_card_desc):
     if METADATA_SEPARATOR not in master_card_desc:
@@ -172,76 +473,834 @@ def split_master_card_metadata(master_card_desc):
         match = re.search(regex_pattern, master_card_desc, re.DOTALL)
         return [match.group(1), match.group(3)]
 
-def update_master_card_metadata(master_card, new_master_card_metadata, pr_args={}):
+def get_new_master_card_desc(master_card, new_master_card_metadata):
+    """Get the master card's new description, or None if it's unchanged"""
     (main_desc, current_master_card_metadata) = split_master_card_metadata(master_card["desc"])
-    if new_master_card_metadata != current_master_card_metadata:
+    if new_master_card_metadata == current_master_card_metadata:
+        return None
+    if new_master_card_metadata:
+        return "%s%s%s" % (main_desc, METADATA_SEPARATOR, new_master_card_metadata)
+    # Also remove the metadata separator when removing the metadata
+    return main_desc
+
+def update_master_card_metadata(master_card, new_master_card_metadata, pr_args={}):
+    new_full_desc = get_new_master_card_desc(master_card, new_master_card_metadata)
+    if new_full_desc is not None:
         logging.debug("Updating master card metadata")
-        if new_master_card_metadata:
-            new_full_desc = "%s%s%s" % (main_desc, METADATA_SEPARATOR, new_master_card_metadata)
-        else:
-            # Also remove the metadata separator when removing the metadata
-            new_full_desc = main_desc
         logging.debug(new_full_desc)
         perform_request("PUT", "cards/%s" % master_card["id"], {"desc": new_full_desc}, **pr_args)
 
-@cache.memoize(60)
+def cache_name(fname):
+    """
+    Name the memoized functions after the token from the script's config, as
+    it isn't part of their arguments, so that the shared cache never serves
+    the values fetched with one token to another
+    """
+    if "config" in globals() and config and config.get("token"):
+        return "%s.%s" % (fname, fingerprint(config["token"]))
+    return fname
+
+def fits_in_cache(value):
+    """Don't cache the values larger than CACHE_MAX_VALUE_SIZE"""
+    try:
+        size = len(json.dumps(value))
+    except (TypeError, ValueError):
+        return False
+    return size <= get_setting("CACHE_MAX_VALUE_SIZE")
+
+def fits_response_in_cache(value):
+    """
+    Don't cache the responses larger than CACHE_MAX_VALUE_SIZE, measured on
+    the body Trello sent rather than by serializing the response again
+    """
+    return getattr(last_response, "size", 0) <= \
+        get_setting("CACHE_MAX_VALUE_SIZE")
+
+def get_url_entities(url, query=None):
+    """IDs of the Trello boards, lists and cards a request URL is about"""
+    if url == "batch" and query and "urls" in query:
+        entities = []
+        for batched_url in query["urls"].split(","):
+            entities += get_url_entities(batched_url.lstrip("/"))
+        return entities
+    match = TRELLO_ENTITY_URL.match(url)
+    return [match.group(1)] if match else []
+
+def get_action_entities(action):
+    """IDs and short links of the boards, lists and cards a Trello action changed"""
+    entities = []
+    for name, value in action.get("data", {}).items():
+        if name in TRELLO_ENTITY_FIELDS and isinstance(value, dict):
+            for field in ("id", "shortLink"):
+                if value.get(field) and value[field] not in entities:
+                    entities.append(value[field])
+    return entities
+
+def get_cache_generations(entities):
+    """
+    The current cache generation of each entity, "0" for the entities never
+    invalidated
+    """
+    if not entities:
+        return ""
+    try:
+        generations = cache.get_many(*[CACHE_GENERATION_KEY % e
+            for e in entities])
+    except Exception:
+        # No usable cache, e.g. outside of the app context
+        return ""
+    return ".".join([str(g or 0) for g in generations])
+
+def invalidate_cached_entities(entities):
+    """
+    Move the given entities to a new cache generation, so that none of the
+    values cached for them is used anymore. Those values then expire with
+    their own timeout.
+    """
+    for entity in entities:
+        try:
+            # A new random generation, rather than an increment, never goes
+            # back to a previous generation whose values might still be cached
+            cache.set(CACHE_GENERATION_KEY % entity, uuid.uuid4().hex[:8],
+                timeout=0)
+        except Exception:
+            pass
+    if entities:
+        logging.debug("Invalidated the cached values of %s" %
+            ", ".join(entities))
+
+def invalidated_by(get_entities):
+    """
+    Add the cache generations of the entities returned by get_entities for the
+    call's arguments to the keys of a memoized function, so that
+    invalidate_cached_entities precisely expires what depends on them
+    """
+    def decorator(memoized):
+        make_cache_key = memoized.make_cache_key
+        def make_entity_cache_key(f, *args, **kwargs):
+            key = make_cache_key(f, *args, **kwargs)
+            generations = get_cache_generations(get_entities(*args, **kwargs))
+            if generations:
+                key += ".%s" % generations
+            return key
+        memoized.make_cache_key = make_entity_cache_key
+        return memoized
+    return decorator
+
+@invalidated_by(lambda record_type, record_id, pr_args={}: [record_id])
+@cache.memoize(Config.TRELLO_NAME_CACHE_TIMEOUT, make_name=cache_name,
+    response_filter=fits_in_cache)
 def get_name(record_type, record_id, pr_args={}):
     return perform_request("GET", "%s/%s" % (record_type, record_id), **pr_args)["name"]
 
-@cache.memoize(60)
+@invalidated_by(lambda list_id, pr_args={}: [list_id])
+@cache.memoize(Config.TRELLO_NAME_CACHE_TIMEOUT, make_name=cache_name,
+    response_filter=fits_in_cache)
+def get_board_id_from_list(list_id, pr_args={}):
+    return perform_request("GET", "lists/%s" % list_id, **pr_args)["idBoard"]
+
 def get_board_name_from_list(list_id, pr_args={}):
-    return get_name("board", perform_request("GET", "lists/%s" % list_id, **pr_args)["idBoard"], pr_args)
+    # Cache the board ID and name separately to invalidate them separately
+    return get_name("board", get_board_id_from_list(list_id, pr_args), pr_args)
 
-def generate_master_card_metadata(slave_cards, pr_args={}):
-    mcm = ""
+def get_boards_catalog_entities(pr_args={}):
+    """
+    The entity standing for the catalog of the user the token belongs to, to
+    invalidate it separately from the other users' catalogs
+    """
+    token = pr_args.get("token")
+    if not token and "config" in globals() and config:
+        token = config.get("token")
+    return ["boards-catalog.%s" % fingerprint(token)] if token else []
+
+@invalidated_by(get_boards_catalog_entities)
+@cache.memoize(Config.TRELLO_CATALOG_CACHE_TIMEOUT, make_name=cache_name,
+    response_filter=fits_in_cache)
+def get_boards_catalog(pr_args={}):
+    """
+    Get the open boards of the user with their open lists, all in one request
+    rather than one request per board. Only the IDs and names are kept.
+    """
+    boards = perform_request("GET", "members/me/boards", BOARDS_CATALOG_QUERY,
+        **pr_args)
+    return [{"id": b["id"], "name": b["name"],
+        "lists": [{"id": l["id"], "name": l["name"]} for l in b.get("lists", [])]}
+        for b in boards if not b.get("closed")]
+
+def invalidate_boards_catalog(pr_args={}):
+    """Fetch the user's boards and lists again the next time they're needed"""
+    invalidate_cached_entities(get_boards_catalog_entities(pr_args))
+
+@invalidated_by(lambda board_id, pr_args={}: [board_id])
+@cache.memoize(Config.TRELLO_CARDS_INDEX_CACHE_TIMEOUT, make_name=cache_name,
+    response_filter=fits_in_cache)
+def get_cards_index(board_id, pr_args={}):
+    """
+    Get the ID, name and list of all the open cards of a board, to search
+    them without fetching the cards of each list
+    """
+    return [{"id": c["id"], "name": c["name"], "idList": c["idList"]}
+        for c in get_all_cards("boards/%s/cards" % board_id,
+            CARDS_INDEX_QUERY, pr_args)]
+
+def get_names(records, pr_args={}):
+    """
+    Get the names of several boards and lists at once. The names get_name
+    already has in cache are reused, the others are fetched through the batch
+    endpoint and then cached for get_name.
+    """
+    names = {}
+    missing = []
+    for record in records:
+        if record in names or record in missing:
+            continue
+        name = None
+        try:
+            name = cache.get(get_name.make_cache_key(get_name, record[0],
+                record[1], pr_args))
+        except Exception:
+            # No usable cache, e.g. outside of the app context
+            pass
+        if name is None:
+            missing.append(record)
+        else:
+            names[record] = name
+    results = batch_get(["%s/%s" % r for r in missing], pr_args)
+    for (record, result) in zip(missing, results):
+        if result is None:
+            names[record] = get_name(record[0], record[1], pr_args)
+            continue
+        names[record] = result["name"]
+        try:
+            cache.set(get_name.make_cache_key(get_name, record[0], record[1],
+                pr_args), result["name"], timeout=get_name.cache_timeout)
+        except Exception:
+            pass
+    return names
+
+def get_master_card_metadata_lines(slave_cards, pr_args={}):
+    """The line of the master card metadata listing each slave card"""
+    records = []
     for sc in slave_cards:
-        mcm += "\n- '%s' on list '**%s|%s**'" % (sc["name"],
-            get_name("board", sc["idBoard"], pr_args),
-            get_name("list", sc["idList"], pr_args))
+        records += [("board", sc["idBoard"]), ("list", sc["idList"])]
+    names = get_names(records, pr_args)
+    return ["\n- '%s' on list '**%s|%s**'" % (sc["name"],
+        names[("board", sc["idBoard"])], names[("list", sc["idList"])])
+        for sc in slave_cards]
+
+def generate_master_card_metadata(slave_cards, pr_args={}):
+    mcm = "".join(get_master_card_metadata_lines(slave_cards, pr_args))
     logging.debug("New master card metadata: %s" % mcm)
     return mcm
 
-def is_not_get_call(*args, **kwargs):
-    return not (args[1] == "GET")
+def create_cli_app(config_class=Config):
+    """
+    Create a bare Flask app for the command line, with the settings and the
+    cache of the website but without its database, extensions and blueprints.
+    Redis is only connected to when it is set up, to share the rate limits
+    with the website's workers.
+    """
+    cli_app = Flask(__name__)
+    cli_app.config.from_object(config_class)
+    cache.init_app(cli_app)
+    if os.environ.get('REDIS_URL'):
+        from redis import Redis
+        cli_app.redis = Redis.from_url(cli_app.config['REDIS_URL'])
+    return cli_app
+
+def get_setting(name):
+    """Read a setting from the Flask app in use, falling back to Config"""
+    if has_app_context():
+        return current_app.config.get(name, getattr(Config, name, None))
+    if "app" in globals() and app:
+        return app.config.get(name, getattr(Config, name, None))
+    return getattr(Config, name, None)
+
+def get_session():
+    """
+    Return this process' HTTP session, which keeps the connections to Trello
+    alive between calls instead of doing a new TCP+TLS handshake each time.
+    gunicorn and RQ fork their workers, so a new session is built whenever the
+    process ID changes instead of sharing the parent's sockets.
+    """
+    global session
+    global session_pid
+    with session_lock:
+        if session is None or session_pid != os.getpid():
+            pool_size = get_setting("TRELLO_POOL_SIZE")
+            new_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size)
+            new_session.mount("https://", adapter)
+            new_session.mount("http://", adapter)
+            if not get_setting("TRELLO_KEEP_ALIVE"):
+                new_session.headers["Connection"] = "close"
+            session = new_session
+            session_pid = os.getpid()
+    return session
+
+def get_transport_stats():
+    """Connection reuse statistics for this process' HTTP session"""
+    stats = {"pools": 0, "requests": 0, "connections": 0, "reused": 0}
+    if session is None or session_pid != os.getpid():
+        return stats
+    adapters = {id(a): a for a in session.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            stats["pools"] += 1
+            stats["requests"] += pool.num_requests
+            stats["connections"] += pool.num_connections
+    stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+    return stats
+
+def get_redis():
+    """Return the app's Redis connection, or None when it can't be used"""
+    if time.time() < redis_unavailable_until:
+        return None
+    if has_app_context():
+        return getattr(current_app, "redis", None)
+    if "app" in globals() and app:
+        return getattr(app, "redis", None)
+    return None
+
+def redis_failed():
+    """Stop trying to use Redis for a minute after it failed"""
+    global redis_unavailable_until
+    redis_unavailable_until = time.time() + 60
+
+def fingerprint(value):
+    """Short hash of a Trello key or token, never store them in clear"""
+    return hashlib.sha256(str(value).encode("utf-8")).hexdigest()[:16]
+
+def get_rate_limit_buckets(key, token):
+    """The rate limit blocks and buckets that apply to these credentials"""
+    blocks = ["trello-rate-limit:block:key:%s" % fingerprint(key),
+        "trello-rate-limit:block:token:%s" % fingerprint(token)]
+    buckets = []
+    period = get_setting("TRELLO_RATE_LIMIT_PERIOD")
+    for (name, value, limit) in (
+        ("key", key, get_setting("TRELLO_KEY_RATE_LIMIT")),
+        ("token", token, get_setting("TRELLO_TOKEN_RATE_LIMIT"))):
+        if limit:
+            (interval, tolerance) = get_rate_limit_pace(limit, period)
+            buckets.append(("trello-rate-limit:%s:%s" % (name, fingerprint(value)),
+                interval, tolerance))
+    return (blocks, buckets)
+
+def get_rate_limit_pace(limit, period):
+    """
+    The emission interval and burst tolerance of a bucket. The steady pace is
+    the limit over its period, less the TRELLO_RATE_LIMIT_MARGIN share: 9
+    requests per second for the 100 requests per 10 seconds of a token. The
+    bucket lets bursts of up to TRELLO_RATE_LIMIT_BURST requests through on
+    top of that pace, only out of the margin for Trello's sliding window to
+    never count more than the limit.
+    """
+    margin = limit * get_setting("TRELLO_RATE_LIMIT_MARGIN")
+    interval = float(period) / max(limit - margin, 1)
+    burst = max(min(get_setting("TRELLO_RATE_LIMIT_BURST"), int(margin)), 1)
+    return (interval, interval * (burst - 1))
+
+def reserve_rate_limit(blocks, buckets):
+    """
+    Reserve a slot in each bucket and return how long to wait before sending
+    the request. Falls back to this process' own buckets without Redis.
+    """
+    now = time.time()
+    redis_conn = get_redis()
+    if redis_conn is not None:
+        script_args = [now, len(blocks)]
+        for (name, interval, tolerance) in buckets:
+            script_args += [interval, tolerance]
+        # The client is only set up when Redis is, so is its library
+        import redis
+        try:
+            script = redis_conn.register_script(RATE_LIMIT_SCRIPT)
+            return max(float(script(
+                keys=blocks + [b[0] for b in buckets], args=script_args)), 0)
+        except redis.exceptions.RedisError:
+            redis_failed()
+    with rate_limit_lock:
+        wait = 0
+        for name in blocks:
+            wait = max(wait, rate_limit_state.get(name, 0) - now)
+        for (name, interval, tolerance) in buckets:
+            tat = max(rate_limit_state.get(name, 0), now)
+            wait = max(wait, tat - tolerance - now)
+            rate_limit_state[name] = tat + interval
+    return wait
+
+def wait_for_rate_limit(key, token):
+    """Wait until these credentials can send a new request to Trello"""
+    wait = get_rate_limit_wait(key, token)
+    if wait > 0:
+        time.sleep(wait)
+    return wait
+
+def get_rate_limit_wait(key, token):
+    """
+    Reserve the slot of a new request with these credentials, and return how
+    long to wait before sending it
+    """
+    (blocks, buckets) = get_rate_limit_buckets(key, token)
+    if not buckets:
+        return 0
+    global rate_limit_waiting_until
+    wait = reserve_rate_limit(blocks, buckets)
+    with rate_limit_lock:
+        rate_limit_stats["requests"] += 1
+        if wait > 0:
+            # Only the part of this wait no other thread was waiting for
+            now = time.time()
+            rate_limit_stats["throttled"] += 1
+            rate_limit_stats["wait_time"] += max(now + wait -
+                max(now, rate_limit_waiting_until), 0)
+            rate_limit_stats["thread_wait_time"] += wait
+            rate_limit_waiting_until = max(rate_limit_waiting_until, now + wait)
+    return wait
+
+def block_rate_limit(key, token, retry_after, error_message=""):
+    """
+    Honor the Retry-After header of a 429 response: no worker sends requests
+    with these credentials until that delay has passed.
+    """
+    (blocks, buckets) = get_rate_limit_buckets(key, token)
+    # Trello tells whether the key or the token exceeded its limit
+    blocks = [blocks[0]] if "API_KEY" in error_message else [blocks[1]]
+    blocked_until = time.time() + retry_after
+    redis_conn = get_redis()
+    if redis_conn is not None:
+        import redis
+        try:
+            for name in blocks:
+                redis_conn.set(name, blocked_until,
+                    px=int(retry_after * 1000) + 1000)
+            return
+        except redis.exceptions.RedisError:
+            redis_failed()
+    with rate_limit_lock:
+        for name in blocks:
+            rate_limit_state[name] = max(rate_limit_state.get(name, 0),
+                blocked_until)
+
+def honor_retry_after(response, key, token):
+    """Block the rate limited credentials for the delay Trello asks for"""
+    try:
+        retry_after = float(response.headers["Retry-After"])
+    except (KeyError, TypeError, ValueError):
+        return
+    if retry_after > 0:
+        logging.warning("Trello rate limit exceeded, retrying after %ss" %
+            retry_after)
+        block_rate_limit(key, token, retry_after, str(response.content))
+
+def get_rate_limit_stats():
+    """How many requests got throttled and how long they waited in total"""
+    with rate_limit_lock:
+        return dict(rate_limit_stats)
+
+def is_not_cached_call(*args, **kwargs):
+    return not (args[1] == "GET") or getattr(cache_bypass, "active", False)
+
+@contextmanager
+def cache_bypassed():
+    """
+    Get what the requests made within by this thread read from Trello itself,
+    without caching it either
+    """
+    previous = getattr(cache_bypass, "active", False)
+    cache_bypass.active = True
+    try:
+        yield
+    finally:
+        cache_bypass.active = previous
 
-@cache.memoize(60, unless=is_not_get_call)
-def perform_request(method, url, query=None, key=None, token=None,
+def get_retry_delay(method, status, attempt, started):
+    """
+    How long to wait before retrying a failed request, or None if it must not
+    be retried. A 429 response means Trello rejected the request, so any
+    method can be retried; otherwise only the idempotent methods are.
+    Uses exponential backoff with full jitter, within a total deadline.
+    """
+    if status != 429 and (status not in RETRYABLE_STATUSES or
+        method not in IDEMPOTENT_METHODS):
+        return None
+    if attempt >= get_setting("TRELLO_RETRY_MAX_ATTEMPTS"):
+        return None
+    backoff = min(get_setting("TRELLO_RETRY_MAX_BACKOFF"),
+        get_setting("TRELLO_RETRY_BACKOFF") * 2 ** (attempt - 1))
+    delay = random.uniform(0, backoff)
+    if time.time() + delay - started > get_setting("TRELLO_RETRY_DEADLINE"):
+        return None
+    return delay
+
+def get_attempt_timeout(started):
+    """
+    The (connect, read) timeout of the next attempt, so that a stalled
+    connection doesn't block the request beyond its total deadline
+    """
+    remaining = max(1, get_setting("TRELLO_RETRY_DEADLINE") -
+        (time.time() - started))
+    return (min(get_setting("TRELLO_CONNECT_TIMEOUT"), remaining),
+        min(get_setting("TRELLO_READ_TIMEOUT"), remaining))
+
+def record_attempt(status, retried):
+    """Keep count of the attempts made to send requests to Trello"""
+    with retry_lock:
+        retry_stats["attempts"] += 1
+        if status is not None:
+            retry_stats["errors"][str(status)] = \
+                retry_stats["errors"].get(str(status), 0) + 1
+            if retried:
+                retry_stats["retries"] += 1
+            else:
+                retry_stats["failures"] += 1
+
+def get_retry_stats():
+    """How many attempts, retries and definitive failures happened"""
+    with retry_lock:
+        stats = dict(retry_stats)
+        stats["errors"] = dict(retry_stats["errors"])
+        return stats
+
+def prepare_request(method, url, key=None, token=None,
     base_url="https://api.trello.com/1/%s"):
+    """
+    Get the full URL of a request and the credentials it is sent with, as
+    (url, logged_url, trello_request, key, token), or None for a write
+    skipped by a dry run
+    """
     if method not in ("GET", "POST", "PUT", "DELETE"):
         logging.critical("HTTP method '%s' not supported. Exiting..." % method)
         sys.exit(30)
     url = base_url % url
     if "args" in globals() and args.dry_run and method != "GET":
         logging.debug("Skipping %s call to '%s' due to --dry-run parameter" % (method, url))
-        return {}
-    if url.startswith("https://api.trello.com/1/"):
+        return None
+    logged_url = url
+    trello_request = url.startswith("https://api.trello.com/1/")
+    if trello_request:
         if not (key and token) and "config" in globals() and "app" in globals():
             key = app.config['TRELLO_API_KEY']
             token = config["token"]
         url += "?key=%s&token=%s" % (key, token)
+    return (url, logged_url, trello_request, key, token)
+
+def get_attempt_outcome(method, logged_url, attempt, started, response,
+    error_status, key, token):
+    """
+    Check the response of an attempt, or the error that stopped it, and
+    return (delay, already_deleted): how long to wait before the next
+    attempt, None once the request is done. Raises the error of a request
+    that can't be retried.
+    """
+    if error_status is None:
+        # Raise an exception if the response status code indicates an issue
+        try:
+            response.raise_for_status()
+            record_attempt(None, False)
+            return (None, False)
+        except requests.exceptions.HTTPError as http_error:
+            last_error = http_error
+            status = http_error.response.status_code
+            if status == 404 and method == "DELETE" and attempt > 1:
+                # A previous attempt deleted it but its response was lost
+                logging.debug("%s '%s' already done by attempt %d" %
+                    (method, logged_url, attempt - 1))
+                record_attempt(None, False)
+                return (None, True)
+            if status == 401:
+                record_attempt(status, False)
+                raise TrelloAuthenticationError
+            if status == 429:
+                honor_retry_after(http_error.response, key, token)
+    else:
+        status = error_status
+    # Connection errors are only retried for idempotent methods
+    delay = get_retry_delay(method, 503 if error_status else status,
+        attempt, started)
+    record_attempt(status, delay is not None)
+    if delay is None:
+        if error_status:
+            raise TrelloConnectionError
+        logging.critical("Request failed with code %s and message '%s'" %
+            (status, response.content))
+        raise last_error
+    logging.warning("Attempt %d for %s '%s' failed (%s), retrying in %.2fs" %
+        (attempt, method, logged_url, status, delay))
+    return (delay, False)
+
+def complete_request(method, path, query, trello_request, response,
+    already_deleted):
+    """Get the result of a request once it is done"""
+    if trello_request and method != "GET":
+        # Don't serve what was cached before this change
+        invalidate_cached_entities(get_url_entities(path, query))
+    if already_deleted:
+        return {}
+    return response.json()
+
+@invalidated_by(lambda method, url, query=None, *args, **kwargs:
+    get_url_entities(url, query))
+@cache.memoize(Config.TRELLO_REQUEST_CACHE_TIMEOUT, make_name=cache_name,
+    unless=is_not_cached_call, response_filter=fits_response_in_cache)
+def perform_request(method, url, query=None, key=None, token=None,
+    base_url="https://api.trello.com/1/%s"):
+    path = url
+    prepared = prepare_request(method, path, key, token, base_url)
+    if not prepared:
+        return {}
+    (url, logged_url, trello_request, key, token) = prepared
+    started = time.time()
+    attempt = 0
+    while True:
+        attempt += 1
+        if trello_request:
+            wait_for_rate_limit(key, token)
+        (response, error_status) = (None, None)
+        try:
+            response = get_session().request(
+                method,
+                url,
+                params=query,
+                timeout=get_attempt_timeout(started)
+            )
+        except requests.exceptions.Timeout:
+            # The request may have been received, handled like a lost
+            # connection: only the idempotent methods are retried
+            error_status = "timeout"
+        except requests.exceptions.ConnectionError:
+            error_status = "connection error"
+        (delay, already_deleted) = get_attempt_outcome(method, logged_url,
+            attempt, started, response, error_status, key, token)
+        if delay is None:
+            break
+        time.sleep(delay)
+    if method == "GET" and not already_deleted:
+        last_response.size = len(response.content)
+    return complete_request(method, path, query, trello_request, response,
+        already_deleted)
+
+def get_flask_app():
+    """Get the Flask app in use, to run code within its context in threads"""
+    if has_app_context():
+        return current_app._get_current_object()
+    if "app" in globals():
+        return app
+    return None
+
+def call_in_app_context(flask_app, function, *args, **kwargs):
+    if not flask_app:
+        return function(*args, **kwargs)
+    with flask_app.app_context():
+        return function(*args, **kwargs)
+
+def get_async_session():
+    """
+    Create the aiohttp session of the requests sent on one event loop. Its
+    connections to Trello are pooled and kept alive like those of
+    perform_request's session, with up to TRELLO_ASYNC_POOL_SIZE of them
+    open at once.
+    """
+    # Only imported once requests are fanned out, not to slow the script down
+    import aiohttp
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+        limit=get_setting("TRELLO_ASYNC_POOL_SIZE"),
+        force_close=not get_setting("TRELLO_KEEP_ALIVE")))
+
+async def send_async_request(session, method, url, query, timeout):
+    """
+    Send a request on an aiohttp session, and return its response as a
+    requests Response for the checks shared with perform_request
+    """
+    import aiohttp
+    params = None
+    if query:
+        # As requests does, leave out the None values and send the others as text
+        params = {k: str(v) for (k, v) in query.items() if v is not None}
+    async with session.request(method, url, params=params,
+            timeout=aiohttp.ClientTimeout(sock_connect=timeout[0],
+            sock_read=timeout[1])) as async_response:
+        response = requests.models.Response()
+        response.status_code = async_response.status
+        response.reason = async_response.reason
+        response.url = str(async_response.url)
+        response.headers = requests.structures.CaseInsensitiveDict(
+            async_response.headers)
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers)
+        response._content = await async_response.read()
+    return response
+
+def get_request_cache_key(method, url, query=None, key=None, token=None,
+    base_url="https://api.trello.com/1/%s"):
+    """
+    The key perform_request caches the response of a request under, or None
+    if it isn't cached
+    """
+    if is_not_cached_call(perform_request.uncached, method, url):
+        return None
     try:
-        response = requests.request(
-            method,
-            url,
-            params=query
-        )
-    except requests.exceptions.ConnectionError:
-        raise TrelloConnectionError
-    # Raise an exception if the response status code indicates an issue
+        return perform_request.make_cache_key(perform_request.uncached,
+            method, url, query, key, token, base_url)
+    except Exception:
+        # No usable cache, e.g. outside of the app context
+        return None
+
+async def async_perform_request(session, method, url, query=None, key=None,
+    token=None, base_url="https://api.trello.com/1/%s"):
+    """
+    Perform a request on an aiohttp session, with the semantics of
+    perform_request: dry run, errors, retries, rate limits, base_url and the
+    cache of the GET requests. Waiting for the rate limits, the response or
+    the next attempt doesn't block the thread running the event loop.
+    """
+    import aiohttp
+    path = url
+    cache_key = get_request_cache_key(method, path, query, key, token,
+        base_url)
+    if cache_key:
+        try:
+            cached = cache.get(cache_key)
+        except Exception:
+            cached = None
+        if cached is not None:
+            return cached
+    prepared = prepare_request(method, path, key, token, base_url)
+    if not prepared:
+        return {}
+    (url, logged_url, trello_request, key, token) = prepared
+    started = time.time()
+    attempt = 0
+    while True:
+        attempt += 1
+        if trello_request:
+            wait = get_rate_limit_wait(key, token)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        (response, error_status) = (None, None)
+        try:
+            response = await send_async_request(session, method, url, query,
+                get_attempt_timeout(started))
+        except asyncio.TimeoutError:
+            # The request may have been received, handled like a lost
+            # connection: only the idempotent methods are retried
+            error_status = "timeout"
+        except aiohttp.ClientConnectionError:
+            error_status = "connection error"
+        (delay, already_deleted) = get_attempt_outcome(method, logged_url,
+            attempt, started, response, error_status, key, token)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
+    result = complete_request(method, path, query, trello_request, response,
+        already_deleted)
+    if cache_key and not already_deleted and \
+            len(response.content) <= get_setting("CACHE_MAX_VALUE_SIZE"):
+        try:
+            cache.set(cache_key, result, timeout=perform_request.cache_timeout)
+        except Exception:
+            pass
+    return result
+
+async def async_perform_requests(calls, pr_args={}, return_exceptions=False,
+    session=None):
+    """
+    Perform several independent requests at once on the event loop, on the
+    given aiohttp session or a new one. Each call is a (method, url) or
+    (method, url, query) tuple, the results are returned in the same order.
+    All the requests are waited for, then the first error is raised or, with
+    return_exceptions, the error of a failed request is returned in place of
+    its result.
+    """
+    if session is None:
+        async with get_async_session() as session:
+            return await async_perform_requests(calls, pr_args,
+                return_exceptions, session)
+    results = await asyncio.gather(*[async_perform_request(session, *c,
+        **pr_args) for c in calls], return_exceptions=True)
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    return results
+
+def run_async(coroutine):
+    """
+    Run a coroutine to completion on a new event loop in this thread, where
+    it has the app context of the caller
+    """
+    loop = asyncio.new_event_loop()
     try:
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as http_error:
-        if http_error.response.status_code == 401:
-            raise TrelloAuthenticationError
-        else:
-            logging.critical("Request failed with code %s and message '%s'" %
-                (http_error.response.status_code, response.content))
-            raise http_error
-    return response.json()
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
 
-def create_new_slave_card(master_card, destination_list, pr_args={}):
-    logging.debug("Creating new slave card")
-    query = {
+def perform_requests(calls, pr_args={}, return_exceptions=False):
+    """
+    Perform several independent requests at once with the async client, all
+    of them being in flight on one event loop instead of blocking a thread
+    each. Their number is only bounded by the rate limits and the
+    connections of the session.
+    Each call is a (method, url) or (method, url, query) tuple, the results
+    are returned in the same order and the first error is raised. With
+    return_exceptions, all the requests are waited for and the error of a
+    failed one is returned in place of its result.
+    """
+    if not calls:
+        return []
+    if len(calls) == 1:
+        try:
+            return [perform_request(*calls[0], **pr_args)]
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            return [e]
+    return run_async(async_perform_requests(calls, pr_args,
+        return_exceptions))
+
+def batch_get(urls, pr_args={}, query=None):
+    """
+    GET several independent Trello URLs through the batch endpoint, up to 10
+    per request, each with the same query if any. The results are returned
+    in the same order as the URLs, with None for the URLs Trello couldn't
+    answer.
+    """
+    results = []
+    # The batched URLs are separated by commas, those of the query are escaped
+    query_string = "?%s" % urlencode(query) if query else ""
+    for i in range(0, len(urls), BATCH_SIZE):
+        chunk = urls[i:i + BATCH_SIZE]
+        if len(chunk) == 1:
+            # No need for the batch endpoint for a single URL, which fails the
+            # same way as in a batch
+            request_args = ("GET", chunk[0], query) if query else \
+                ("GET", chunk[0])
+            try:
+                results.append(perform_request(*request_args, **pr_args))
+            except requests.exceptions.HTTPError as http_error:
+                logging.warning("GET call to '%s' failed: %s" % (chunk[0],
+                    http_error.response.status_code))
+                results.append(None)
+            continue
+        responses = perform_request("GET", "batch",
+            {"urls": ",".join(["/%s%s" % (u, query_string) for u in chunk])},
+            **pr_args)
+        for (url, response) in zip(chunk, responses):
+            if "200" in response:
+                results.append(response["200"])
+            else:
+                logging.warning("Batched GET call to '%s' failed: %s" %
+                    (url, response))
+                results.append(None)
+    return results
+
+def get_new_slave_card_query(master_card, destination_list):
+    return {
        "idList": destination_list,
        "desc": "%s\n\nCreated from master card %s" % (master_card["desc"], master_card["shortUrl"]),
        "pos": "bottom",
@@ -249,22 +1308,27 @@ def create_new_slave_card(master_card, destination_list, pr_args={}):
         # Explicitly don't keep labels,members
         "keepFromSource": "attachments,checklists,comments,due,stickers"
     }
+
+def create_new_slave_card(master_card, destination_list, pr_args={}):
+    logging.debug("Creating new slave card")
+    query = get_new_slave_card_query(master_card, destination_list)
     new_slave_card = perform_request("POST", "cards", query, **pr_args)
     if new_slave_card:
         logging.debug("New slave card ID: %s" % new_slave_card["id"])
     return new_slave_card
 
-def process_master_card(master_card, args_from_app=None):
-    logging.debug("="*64)
-    logging.debug("Process master card '%s'" % master_card["name"])
-    # Check if this card is to be synced on a destination list
+def get_pr_args(args_from_app=None):
+    if not args_from_app:
+        return {}
+    return {"key": args_from_app["key"], "token": args_from_app["token"]}
+
+def get_destination_lists(master_card, args_from_app=None):
+    """Get the lists a master card is to be synced on, based on its labels"""
     destination_lists = []
     if not args_from_app:
         conf_destination_lists = config["destination_lists"]
-        pr_args = {}
     else:
         conf_destination_lists = args_from_app["destination_lists"]
-        pr_args = {"key": args_from_app["key"], "token": args_from_app["token"]}
     for l in master_card["labels"]:
         if not args_from_app:
             # TODO: Change script config setup from label Name to label ID (#37)
@@ -275,90 +1339,259 @@ def process_master_card(master_card, args_from_app=None):
             for list in conf_destination_lists[tracked_label_value]:
                 if list not in destination_lists:
                     destination_lists.append(list)
-    logging.debug("Master card is to be synced on %d destination lists" % len(destination_lists))
+    return destination_lists
+
+def get_checklist_item_name(destination_list, pr_args={}):
+    # Use that list's board's name as checklist name
+    checklistitem_name = get_board_name_from_list(destination_list, pr_args)
+    # Ability to define a more friendly name than the destination board's name
+    #TODO: Support friendly names from the website (#38)
+    if "config" in globals() and checklistitem_name in config["friendly_names"].keys():
+        checklistitem_name = config["friendly_names"][checklistitem_name]
+    return checklistitem_name
+
+def process_master_card(master_card, args_from_app=None):
+    """
+    Sync a single master card, planning then applying its operations as
+    sync_master_cards does for a whole snapshot
+    """
+    return sync_master_cards([master_card], args_from_app)[0]
 
-    # Check if slave cards are already attached to this master card
+def plan_master_card(master_card, args_from_app=None):
+    """
+    First phase of a sync: compute the operations that sync a master card,
+    reading from Trello but without writing to it. An operation that needs
+    the result of another one, e.g. the checklist a checklist item is added
+    to, refers to it and is applied in a later stage.
+    """
+    logging.debug("="*64)
+    logging.debug("Plan master card '%s'" % master_card["name"])
+    destination_lists = get_destination_lists(master_card, args_from_app)
+    pr_args = get_pr_args(args_from_app)
+    mapping_id = args_from_app.get("mapping_id") if args_from_app else None
+    logging.debug("Master card is to be synced on %d destination lists" % len(destination_lists))
     linked_slave_cards = []
-    master_card_attachments = get_card_attachments(master_card, pr_args)
-    for mca in master_card_attachments:
-        attached_card = perform_request("GET", "cards/%s" % mca["card_shortUrl"], **pr_args)
-        linked_slave_cards.append(attached_card)
-
-    new_master_card_metadata = ""
-    # Check if slave cards need to be unlinked
-    if len(destination_lists) == 0 and len(linked_slave_cards) > 0:
-        logging.debug("Master card has been unlinked from slave cards")
-        # Information on the master card needs to be updated to remove the reference to the slave cards
-        new_master_card_metadata = ""
-        #TODO: Determine what to do with the slave cards
+    if destination_lists:
+        # Check if slave cards are already linked to this master card
+        linked_slave_cards = get_linked_slave_cards(master_card, mapping_id,
+            pr_args)
 
-    num_new_cards = 0
+    operations = []
     slave_cards = []
-    newly_created_slave_cards = []
-    if len(destination_lists) > 0:
-        for dl in destination_lists:
-            existing_slave_card = None
-            for lsc in linked_slave_cards:
-                if dl == lsc["idList"]:
-                    existing_slave_card = lsc
-            if existing_slave_card:
-                logging.debug("Slave card %s already exists on list %s" % (existing_slave_card["id"], dl))
-                logging.debug(existing_slave_card)
-                card = existing_slave_card
-            else:
-                # A new slave card needs to be created for this slave board
-                num_new_cards += 1
-                card = create_new_slave_card(master_card, dl, pr_args)
-                if card:
-                    newly_created_slave_cards.append(card)
-            slave_cards.append(card)
-        if card:
-            # Generate master card metadata based on the slave cards info
-            new_master_card_metadata = generate_master_card_metadata(slave_cards, pr_args)
-        logging.info("This master card has %d slave cards (%d newly created)" % (len(slave_cards), num_new_cards))
+    # The operation creating each slave card, None for the existing ones
+    slave_card_creations = []
+    num_new_cards = 0
+    for dl in destination_lists:
+        existing_slave_card = None
+        for lsc in linked_slave_cards:
+            if dl == lsc["idList"]:
+                existing_slave_card = lsc
+        if existing_slave_card:
+            slave_cards.append(existing_slave_card)
+            slave_card_creations.append(None)
+            continue
+        num_new_cards += 1
+        create = {"type": "create_slave_card", "master_card": master_card["id"],
+            "query": get_new_slave_card_query(master_card, dl)}
+        operations.append(create)
+        operations.append({"type": "link_slave_card",
+            "master_card": master_card["id"], "slave_card": create,
+            "url": master_card["url"]})
+        # The new slave card is a copy of the master card on that list
+        slave_cards.append({"name": master_card["name"], "idList": dl,
+            "idBoard": get_board_id_from_list(dl, pr_args)})
+        slave_card_creations.append(create)
+
+    metadata_lines = []
+    if slave_cards:
+        metadata_lines = get_master_card_metadata_lines(slave_cards, pr_args)
+    new_full_desc = get_new_master_card_desc(master_card,
+        "".join(metadata_lines))
+    if new_full_desc is not None:
+        update = {"type": "update_desc", "card": master_card["id"],
+            "desc": new_full_desc}
+        if num_new_cards:
+            # The description is written as planned if all the new slave
+            # cards get created, and without the ones that failed otherwise
+            update["current_desc"] = master_card["desc"]
+            update["metadata"] = list(zip(metadata_lines, slave_card_creations))
+        operations.append(update)
+
+    if destination_lists:
+        master_card_checklists = get_card_checklists(master_card, pr_args)
+        if "Involved Teams" not in [c["name"] for c in master_card_checklists or []]:
+            checklist = {"type": "create_checklist", "card": master_card["id"],
+                "name": "Involved Teams"}
+            operations.append(checklist)
+            # The items are added concurrently, their position keeps the
+            # order of the destination lists
+            for (pos, dl) in enumerate(destination_lists, 1):
+                operations.append({"type": "add_checklist_item",
+                    "checklist": checklist,
+                    "name": get_checklist_item_name(dl, pr_args), "pos": pos})
+    logging.info("This master card has %d slave cards (%d to be created) and "
+        "needs %d operations" % (len(slave_cards), num_new_cards,
+        len(operations)))
+    return {"master_card": master_card["id"], "mapping_id": mapping_id,
+        "operations": operations,
+        "output": (1 if destination_lists else 0, len(slave_cards),
+            num_new_cards)}
+
+def get_operation_calls(operation):
+    """
+    Get the Trello writes of a planned operation, once the operations it
+    refers to are applied. Nothing is written if one of them failed, or
+    wasn't applied.
+    """
+    if operation["type"] == "create_slave_card":
+        return [("POST", "cards", operation["query"])]
+    if operation["type"] == "update_desc":
+        desc = operation["desc"]
+        if operation.get("metadata"):
+            metadata = "".join([line for (line, create)
+                in operation["metadata"] if not create or create.get("result")])
+            desc = get_new_master_card_desc({"desc": operation["current_desc"]},
+                metadata)
+            if desc is None:
+                return []
+        return [("PUT", "cards/%s" % operation["card"], {"desc": desc})]
+    if operation["type"] == "create_checklist":
+        return [("POST", "cards/%s/checklists" % operation["card"],
+            {"name": operation["name"]})]
+    if operation["type"] == "add_checklist_item":
+        checklist = operation["checklist"].get("result")
+        if not checklist:
+            return []
+        return [("POST", "checklists/%s/checkItems" % checklist["id"],
+            {"name": operation["name"], "pos": operation["pos"]})]
+    if operation["type"] == "link_slave_card":
+        slave_card = operation["slave_card"].get("result")
+        if not slave_card:
+            return []
+        return [("POST", "cards/%s/attachments" % slave_card["id"],
+            {"url": operation["url"]}),
+            ("POST", "cards/%s/attachments" % operation["master_card"],
+            {"url": slave_card["url"]})]
+    raise ValueError("Unknown operation type '%s'" % operation["type"])
+
+def count_operations(plans):
+    """Count the operations of sync plans by type"""
+    counts = {}
+    for plan in plans:
+        for operation in plan["operations"]:
+            counts[operation["type"]] = counts.get(operation["type"], 0) + 1
+    return counts
+
+def apply_plans(plans, args_from_app=None):
+    """
+    Second phase of a sync: apply the operations of several plans. The
+    operations of all the plans are applied stage by stage, the writes of a
+    stage being performed concurrently. Several description updates of the
+    same card are coalesced into the last one. A failed operation doesn't
+    stop the others: only the operations that depend on it are skipped, and
+    its error is raised once all the others are applied and the new slave
+    cards indexed. Returns the number of writes.
+    """
+    pr_args = get_pr_args(args_from_app)
+    num_writes = 0
+    errors = []
+    for stage in PLAN_STAGES:
+        operations = {}
+        for plan in plans:
+            for operation in plan["operations"]:
+                if operation["type"] not in stage:
+                    continue
+                if operation["type"] == "update_desc":
+                    # Only the last description of a card needs to be written
+                    operations[("update_desc", operation["card"])] = operation
+                else:
+                    operations[id(operation)] = operation
+        calls = []
+        calls_per_operation = []
+        for operation in operations.values():
+            operation_calls = get_operation_calls(operation)
+            calls += operation_calls
+            calls_per_operation.append((operation, len(operation_calls)))
+        logging.debug("Applying %d operations with %d writes (%s)" %
+            (len(operations), len(calls), ", ".join(stage)))
+        results = perform_requests(calls, pr_args, return_exceptions=True)
+        offset = 0
+        for (operation, num_calls) in calls_per_operation:
+            operation_results = results[offset:offset+num_calls]
+            operation_errors = [r for r in operation_results
+                if isinstance(r, Exception)]
+            if operation_errors:
+                errors += operation_errors
+            elif num_calls:
+                operation["result"] = operation_results[0]
+            offset += num_calls
+        num_writes += len(calls)
+
+    # Index the links to the new slave cards
+    new_card_links = False
+    for plan in plans:
+        if not plan["mapping_id"]:
+            continue
+        for operation in plan["operations"]:
+            if operation["type"] == "create_slave_card" and operation.get("result"):
+                add_card_link(plan["mapping_id"], plan["master_card"],
+                    operation["result"])
+                new_card_links = True
+    if new_card_links:
+        from app import db
+        db.session.commit()
+    if errors:
+        raise errors[0]
+    return num_writes
+
+def sync_master_cards(master_cards, args_from_app=None):
+    """
+    Sync several master cards from one snapshot in two phases. The plans of
+    all the cards are computed first, then their operations are applied
+    together. A dry run stops after the plans, with the exact counts of what
+    would have been done. Returns the outputs of each master card, as
+    process_master_card does.
+    """
+    plans = list(process_master_cards(master_cards, args_from_app,
+        plan_master_card))
+    counts = count_operations(plans)
+    logging.info("Planned %d operations: %s" % (sum(counts.values()),
+        ", ".join(["%d %s" % (counts[t], t) for t in sorted(counts)])))
+    if "args" in globals() and args.dry_run:
+        logging.debug("Skipping the planned operations due to --dry-run parameter")
     else:
-        logging.info("This master card has no slave cards")
-
-    # Update the master card's metadata if needed
-    update_master_card_metadata(master_card, new_master_card_metadata, pr_args)
-
-    # Add a checklist for each team on the master card
-    if len(destination_lists) > 0 and not ("args" in globals() and args.dry_run):
-        logging.debug("Retrieving checklists from card %s" % master_card["id"])
-        master_card_checklists = perform_request("GET", "cards/%s/checklists" % master_card["id"], **pr_args)
-        create_checklist = True
-        if master_card_checklists:
-            logging.debug("Already %d checklists on this master card: %s" % (len(master_card_checklists), ", ".join([c["name"] for c in master_card_checklists])))
-            for c in master_card_checklists:
-                if "Involved Teams" == c["name"]:
-                    #TODO: check if each team is on the checklist and update accordingly
-                    create_checklist = False
-                    logging.debug("Master card already contains a checklist name 'Involved Teams', skipping checklist creation")
-        if create_checklist:
-            logging.debug("Creating new checklist")
-            cl = perform_request("POST", "cards/%s/checklists" % master_card["id"], {"name": "Involved Teams"}, **pr_args)
-            logging.debug(cl)
-            for dl in destination_lists:
-                # Use that list's board's name as checklist name
-                checklistitem_name = get_board_name_from_list(dl, pr_args)
-                # Ability to define a more friendly name than the destination board's name
-                #TODO: Support friendly names from the website (#38)
-                if "config" in globals() and checklistitem_name in config["friendly_names"].keys():
-                    checklistitem_name = config["friendly_names"][checklistitem_name]
-                logging.debug("Adding new checklistitem '%s' to checklist %s" % (checklistitem_name, cl["id"]))
-                new_checklistitem = perform_request("POST", "checklists/%s/checkItems" % cl["id"], {"name": checklistitem_name}, **pr_args)
-                logging.debug(new_checklistitem)
-
-        #TODO: Mark checklist item as Complete if slave card is Done
-
-    # Link master and newly created child cards together
-    for card in newly_created_slave_cards:
-        logging.debug("Attaching master card %s to slave card %s" % (master_card["id"], card["id"]))
-        perform_request("POST", "cards/%s/attachments" % card["id"], {"url": master_card["url"]}, **pr_args)
-        logging.debug("Attaching slave card %s to master card %s" % (card["id"], master_card["id"]))
-        perform_request("POST", "cards/%s/attachments" % master_card["id"], {"url": card["url"]}, **pr_args)
-
-    return (1 if len(destination_lists) > 0 else 0, len(slave_cards), num_new_cards)
+        num_writes = apply_plans(plans, args_from_app)
+        logging.info("Applied the planned operations with %d writes" %
+            num_writes)
+    return [plan["output"] for plan in plans]
+
+def process_master_cards(master_cards, args_from_app=None, process=None):
+    """
+    Process several master cards concurrently, with at most
+    TRELLO_CONCURRENCY cards in flight. The outputs are yielded in the order
+    of master_cards, as soon as each one and all the previous ones are done.
+    """
+    if process is None:
+        process = process_master_card
+    concurrency = min(get_setting("TRELLO_CONCURRENCY") or 1, len(master_cards))
+    if concurrency <= 1:
+        for master_card in master_cards:
+            yield process(master_card, args_from_app)
+        return
+
+    # The worker threads need the app context for the settings and the cache
+    flask_app = get_flask_app()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    futures = [executor.submit(call_in_app_context, flask_app, process,
+        master_card, args_from_app) for master_card in master_cards]
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        # Don't start the remaining cards if one failed or the caller stopped
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
 
 def create_new_config():
     global config
@@ -514,6 +1747,7 @@ def create_new_config():
 
     logging.debug(config)
 
+    from slugify import slugify
     config_file = "data/config_%s.json" % slugify(config_name)
     while os.path.isfile(config_file):
         #TODO: ask the user to enter a new valid file name
@@ -524,7 +1758,8 @@ def create_new_config():
     return config_file
 
 def is_production_environment():
-    return os.environ.get('ON_HEROKU') == True
+    # Environment variables are strings, set as ON_HEROKU=True on Heroku
+    return os.environ.get('ON_HEROKU', '').lower() in ('true', '1')
 
 def new_webhook(master_board, temp_webhook_file = "data/temp_webhook.json",
     key=None, token=None):
@@ -657,8 +1892,11 @@ def init():
         global config
         global app
 
-        # Initiate the Flask app to access config, database
-        app = create_app()
+        # Initiate a lightweight Flask app to access the config and cache
+        app = create_cli_app()
+        if not has_app_context():
+            # The memoized functions need an app context, for the whole run
+            app.app_context().push()
 
         # Parse the provided command-line arguments
         args = parse_args(sys.argv[1:])
@@ -685,7 +1923,7 @@ def init():
                     if s.lower() in ("yes", "oui", "ok", "yep", "no problemo", "aye"):
                         warning_acknowledged = True
             logging.debug("Get list of cards on the master Trello board")
-            master_cards = perform_request("GET", "boards/%s/cards" % config["master_board"])
+            master_cards = get_cards_snapshot("boards", config["master_board"])
             # Delete all the master card attachments and cards on the slave boards
             summary = cleanup_test_boards(master_cards)
         elif args.propagate:
@@ -693,7 +1931,9 @@ def init():
             if args.card:
                 # Validate that this specific card is on the master board
                 try:
-                    master_card = perform_request("GET", "cards/%s" % args.card)
+                    with cache_bypassed():
+                        master_card = perform_request("GET",
+                            "cards/%s" % args.card, CARD_NESTED_QUERY)
                 except requests.exceptions.HTTPError:
                     logging.critical("Invalid card ID %s, card not found. Exiting..." % args.card)
                     sys.exit(33)
@@ -719,18 +1959,18 @@ def init():
                             logging.debug("List %s is on the master board" % master_list["id"])
                             valid_master_list = True
                             # Get the list of cards on this master list
-                            master_cards = perform_request("GET", "lists/%s/cards" % master_list["id"])
+                            master_cards = get_cards_snapshot("lists", master_list["id"])
                             break
                     if not valid_master_list:
                         logging.critical("List %s is not on the master board %s. Exiting..." % (args.list, config["master_board"]))
                         sys.exit(32)
                 else:
                     logging.debug("Get list of cards on the master Trello board")
-                    master_cards = perform_request("GET", "boards/%s/cards" % config["master_board"])
-                # Loop over all cards on the master board or list to sync the slave boards
-                for idx, master_card in enumerate(master_cards):
-                    logging.info("Processing master card %d/%d - %s" %(idx+1, len(master_cards), master_card["name"]))
-                    output = process_master_card(master_card)
+                    master_cards = get_cards_snapshot("boards", config["master_board"])
+                # Plan the sync of all cards on the master board or list, then apply it
+                outputs = sync_master_cards(master_cards)
+                for idx, (master_card, output) in enumerate(zip(master_cards, outputs)):
+                    logging.info("Processed master card %d/%d - %s" %(idx+1, len(master_cards), master_card["name"]))
                     summary["master_cards"] = len(master_cards)
                     summary["active_master_cards"] += output[0]
                     summary["slave_card"] += output[1]
@@ -743,5 +1983,7 @@ def init():
             elif args.webhook == "delete":
                 delete_webhook(config["master_board"])
         output_summary(args, summary)
+        logging.debug("Trello connections: %s" % get_transport_stats())
+        logging.debug("Trello rate limiting: %s" % get_rate_limit_stats())
 
 init()
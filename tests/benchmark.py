@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of SyncBoom and is MIT-licensed.
+
+"""
+Benchmark the sync and the cleanup of the command line against the Trello
+simulator, without any network:
+$ python3 -m tests.benchmark --cards 500 --latency 0.1 --token-rate-limit 100
+"""
+
+import argparse
+import logging
+import random
+import sys
+import time
+from uuid import uuid4
+from config import Config
+from tests.trello_simulator import TrelloSimulator
+
+sys.path.append('.')
+syncboom = __import__("syncboom")
+
+
+def parse_args(arguments):
+    parser = argparse.ArgumentParser(description="Benchmark SyncBoom against "
+        "a simulated Trello API")
+    parser.add_argument("--cards", type=int, default=200,
+        help="Number of master cards")
+    parser.add_argument("--teams", type=int, default=4,
+        help="Number of teams, each with a label and a slave board")
+    parser.add_argument("--labels-per-card", type=int, default=2,
+        help="Maximum number of team labels per master card")
+    parser.add_argument("--latency", type=float, default=0.05,
+        help="Seconds each request to Trello takes")
+    parser.add_argument("--jitter", type=float, default=0.05,
+        help="Up to that many more seconds for each request")
+    parser.add_argument("--key-rate-limit", type=int, default=300,
+        help="Requests Trello allows per API key and period")
+    parser.add_argument("--token-rate-limit", type=int, default=100,
+        help="Requests Trello allows per token and period")
+    parser.add_argument("--rate-limit-period", type=float, default=10,
+        help="Seconds of the rate limits' period")
+    parser.add_argument("--error-rate", type=float, default=0,
+        help="Share of the requests failing with a 5xx error. Only the "
+        "idempotent ones are retried, a failed write ends the benchmark.")
+    parser.add_argument("--concurrency", type=int,
+        default=Config.TRELLO_CONCURRENCY,
+        help="Master cards processed concurrently")
+    parser.add_argument("--pool-size", type=int, default=Config.TRELLO_POOL_SIZE,
+        help="Concurrent requests to Trello")
+    parser.add_argument("--no-client-rate-limit", action="store_true",
+        help="Don't pace the requests, only honor Trello's 429 responses")
+    parser.add_argument("--seed", type=int, default=0,
+        help="Seed of the generated boards, latencies and errors")
+    parser.add_argument("--debug", action="store_true",
+        help="Output the logs of SyncBoom")
+    return parser.parse_args(arguments)
+
+def seed_boards(simulator, args):
+    """Generate a master board and the boards of the teams, return a config"""
+    generator = random.Random(args.seed)
+    master_board = simulator.add_board("Master board")
+    master_lists = [simulator.add_list(master_board, name)
+        for name in ("Backlog", "Doing", "Done")]
+    labels = []
+    destination_lists = {}
+    for team in range(args.teams):
+        name = "Team %d" % (team + 1)
+        labels.append(simulator.add_label(master_board, name))
+        board = simulator.add_board("%s board" % name)
+        destination_lists[name] = [simulator.add_list(board, "Inbox")["id"]]
+    for i in range(args.cards):
+        num_labels = generator.randint(0, min(args.labels_per_card, len(labels)))
+        simulator.add_card(master_lists[i % len(master_lists)],
+            "Master card %d" % (i + 1), "Description of master card %d" % (i + 1),
+            generator.sample(labels, num_labels))
+    return {"name": "Benchmark", "key": Config.TRELLO_API_KEY,
+        "token": uuid4().hex, "master_board": master_board["id"],
+        "destination_lists": destination_lists, "friendly_names": {},
+        "cleanup_boards": [simulator.lists[dl[0]]["idBoard"]
+            for dl in destination_lists.values()]}
+
+def measure(simulator, name, function, *args):
+    """Run one step of the benchmark and output what it took"""
+    simulator.reset_stats()
+    rate_limit_stats = syncboom.get_rate_limit_stats()
+    retries = syncboom.get_retry_stats()["retries"]
+    started = time.time()
+    result = function(*args)
+    duration = time.time() - started
+    stats = simulator.stats
+    print("%-8s %8.2f %9d %8.1f %10d %10.1f %8d %8d" % (name, duration,
+        stats["requests"], stats["requests"] / duration if duration else 0,
+        stats["throttled"], syncboom.get_rate_limit_stats()["wait_time"] -
+        rate_limit_stats["wait_time"], syncboom.get_retry_stats()["retries"] -
+        retries, stats["max_in_flight"]))
+    return result
+
+def snapshot_and_sync(master_board):
+    return syncboom.sync_master_cards(syncboom.get_cards_snapshot("boards",
+        master_board))
+
+def snapshot_and_cleanup(master_board):
+    return syncboom.cleanup_test_boards(syncboom.get_cards_snapshot("boards",
+        master_board))
+
+def main(arguments):
+    args = parse_args(arguments)
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s",
+        level=logging.DEBUG if args.debug else logging.ERROR)
+
+    class BenchmarkConfig(Config):
+        TRELLO_API_KEY = Config.TRELLO_API_KEY or "benchmark"
+        TRELLO_CONCURRENCY = args.concurrency
+        TRELLO_POOL_SIZE = args.pool_size
+        TRELLO_KEY_RATE_LIMIT = 0 if args.no_client_rate_limit else \
+            args.key_rate_limit
+        TRELLO_TOKEN_RATE_LIMIT = 0 if args.no_client_rate_limit else \
+            args.token_rate_limit
+        TRELLO_RATE_LIMIT_PERIOD = args.rate_limit_period
+
+    simulator = TrelloSimulator(latency=args.latency, jitter=args.jitter,
+        key_rate_limit=args.key_rate_limit,
+        token_rate_limit=args.token_rate_limit,
+        rate_limit_period=args.rate_limit_period, error_rate=args.error_rate,
+        seed=args.seed)
+    syncboom.app = syncboom.create_cli_app(BenchmarkConfig)
+    syncboom.args = argparse.Namespace(dry_run=False)
+    with syncboom.app.app_context(), simulator.patch():
+        syncboom.config = dict(seed_boards(simulator, args),
+            key=BenchmarkConfig.TRELLO_API_KEY)
+        master_board = syncboom.config["master_board"]
+        print("%d master cards, %d teams, %.3fs latency, %d requests per %gs "
+            "per token" % (args.cards, args.teams, args.latency,
+            args.token_rate_limit, args.rate_limit_period))
+        print("%-8s %8s %9s %8s %10s %10s %8s %8s" % ("step", "seconds",
+            "requests", "req/s", "throttled", "waited (s)", "retries",
+            "parallel"))
+        outputs = measure(simulator, "sync", snapshot_and_sync, master_board)
+        measure(simulator, "resync", snapshot_and_sync, master_board)
+        summary = measure(simulator, "cleanup", snapshot_and_cleanup,
+            master_board)
+    print("Synced %d active master cards to %d new slave cards, then deleted "
+        "%d slave cards" % (sum([o[0] for o in outputs]),
+        sum([o[2] for o in outputs]), summary["deleted_slave_cards"]))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -14,14 +14,22 @@ import os
 import logging
 import json
 from unittest.mock import patch, call, MagicMock
+import asyncio
 import io
 import contextlib
+import threading
+import time
 import inspect
+import subprocess
 import tempfile
 from uuid import uuid4
-from requests.exceptions import HTTPError, ConnectionError
+from datetime import datetime, timedelta
+from requests.exceptions import HTTPError, ConnectionError, ReadTimeout
+from redis.exceptions import RedisError
 from app import create_app, db
+from app.models import CardLink
 from config import Config
+from tests.trello_simulator import TrelloSimulator, CONNECTION_ERROR
 
 sys.path.append('.')
 target = __import__("syncboom")
@@ -36,6 +44,11 @@ def setUpModule():
         return mock_raw_input_values[mock_raw_input_counter - 1]
     target.input = mock_raw_input
 
+# Answer the requests of the async client with the patched perform_request,
+# for the tests faking Trello there
+async def forward_async_perform_request(session, *args, **kwargs):
+    return target.perform_request(*args, **kwargs)
+
 # Ensure config and cached values are empty before each new test
 def setUp(cls):
     target.config = None
@@ -113,12 +126,14 @@ class TestOutputSummary(FlaskTestCase):
         summary = {"cleaned_up_master_cards": 4,
             "deleted_slave_cards": 6,
             "erased_destination_boards": 2,
-            "erased_destination_lists": 2}
+            "erased_destination_lists": 2,
+            "duration": 3.0,
+            "slave_cards_per_second": 2.0}
         with self.assertLogs(level='INFO') as cm:
             target.output_summary(args, summary)
         self.assertEqual(cm.output, [
             "INFO:root:================================================================",
-            "INFO:root:Summary: cleaned up 4 master cards and deleted 6 slave cards from 2 slave boards/2 slave lists."])
+            "INFO:root:Summary: cleaned up 4 master cards and deleted 6 slave cards from 2 slave boards/2 slave lists in 3.0s (2.0 slave cards/s)."])
 
     def test_output_summary_cleanup_dry_run(self):
         """
@@ -131,12 +146,14 @@ class TestOutputSummary(FlaskTestCase):
         summary = {"cleaned_up_master_cards": 4,
             "deleted_slave_cards": 6,
             "erased_destination_boards": 2,
-            "erased_destination_lists": 2}
+            "erased_destination_lists": 2,
+            "duration": 0.5,
+            "slave_cards_per_second": 12.0}
         with self.assertLogs(level='INFO') as cm:
             target.output_summary(args, summary)
         self.assertEqual(cm.output, [
             "INFO:root:================================================================",
-            "INFO:root:Summary [DRY RUN]: would have cleaned up 4 master cards and deleted 6 slave cards from 2 slave boards/2 slave lists."])
+            "INFO:root:Summary [DRY RUN]: would have cleaned up 4 master cards and deleted 6 slave cards from 2 slave boards/2 slave lists in 0.5s (12.0 slave cards/s)."])
 
     def test_output_summary_new_config(self):
         """
@@ -205,6 +222,338 @@ class TestGetCardAttachments(FlaskTestCase):
         self.assertEqual(card_attachments, expected_card_attachments)
 
 
+    @patch("syncboom.perform_request")
+    def test_get_card_attachments_snapshot(self, t_pr):
+        """
+        Test retrieving the attachments nested in a card's snapshot
+        """
+        shortLink = "eoK0Rngb"
+        card = {"id": "1a2b3c", "badges": {"attachments": 2}, "attachments": [
+            {"id": "a1", "url": "https://trello.com/c/%s/blablabla" % shortLink},
+            {"id": "a2", "url": "https://monip.org"}]}
+        card_attachments = target.get_card_attachments(card)
+        self.assertEqual(card_attachments, [{"id": "a1", "card_shortUrl": shortLink,
+            "url": "https://trello.com/c/%s/blablabla" % shortLink}])
+        # No network call needed
+        self.assertEqual(t_pr.mock_calls, [])
+
+
+@patch("syncboom.async_perform_request", forward_async_perform_request)
+class TestGetLinkedSlaveCards(FlaskTestCase):
+    def get_master_card(self, num_attachments):
+        return {"id": "m"*24, "badges": {"attachments": num_attachments},
+            "attachments": [{"id": "a%d" % i,
+            "url": "https://trello.com/c/abcd123%d/card" % i}
+            for i in range(num_attachments)]}
+
+    @patch("syncboom.batch_get")
+    def test_get_linked_slave_cards_no_mapping(self, t_bg):
+        """
+        Test that the attachments are used without a mapping
+        """
+        t_bg.return_value = [{"id": "s"*24, "idList": "l"*24}, None]
+        slave_cards = target.get_linked_slave_cards(self.get_master_card(2))
+        self.assertEqual(slave_cards, [{"id": "s"*24, "idList": "l"*24}])
+        self.assertEqual(t_bg.mock_calls, [call(["cards/abcd1230",
+            "cards/abcd1231"], {})])
+        self.assertEqual(CardLink.query.count(), 0)
+
+    @patch("syncboom.batch_get")
+    def test_get_linked_slave_cards_none(self, t_bg):
+        """
+        Test a master card without links nor attachments
+        """
+        slave_cards = target.get_linked_slave_cards(self.get_master_card(0), 1)
+        self.assertEqual(slave_cards, [])
+        self.assertEqual(t_bg.mock_calls, [])
+
+    @patch("syncboom.batch_get")
+    def test_get_linked_slave_cards_build_index(self, t_bg):
+        """
+        Test building the index from the attachments of a master card
+        """
+        t_bg.return_value = [{"id": "s"*24, "idList": "l"*24},
+            {"id": "t"*24, "idList": "k"*24}]
+        slave_cards = target.get_linked_slave_cards(self.get_master_card(2), 1,
+            {"token": "jkl"})
+        self.assertEqual(slave_cards, t_bg.return_value)
+        self.assertEqual(t_bg.mock_calls, [call(["cards/abcd1230",
+            "cards/abcd1231"], {"token": "jkl"})])
+        links = CardLink.query.order_by(CardLink.slave_card).all()
+        self.assertEqual([(l.mapping_id, l.master_card, l.slave_card,
+            l.slave_list) for l in links], [(1, "m"*24, "s"*24, "l"*24),
+            (1, "m"*24, "t"*24, "k"*24)])
+
+    @patch("syncboom.batch_get")
+    def test_get_linked_slave_cards_indexed(self, t_bg):
+        """
+        Test getting the slave cards from the index, without the attachments
+        """
+        db.session.add(CardLink(mapping_id=1, master_card="m"*24,
+            slave_card="s"*24, slave_list="l"*24))
+        db.session.add(CardLink(mapping_id=2, master_card="m"*24,
+            slave_card="t"*24, slave_list="k"*24))
+        db.session.commit()
+        t_bg.return_value = [{"id": "s"*24, "idList": "l"*24}]
+        slave_cards = target.get_linked_slave_cards(self.get_master_card(3), 1)
+        self.assertEqual(slave_cards, t_bg.return_value)
+        self.assertEqual(t_bg.mock_calls, [call(["cards/%s" % ("s"*24)], {})])
+
+    @patch("syncboom.batch_get")
+    def test_get_linked_slave_cards_deleted(self, t_bg):
+        """
+        Test that a slave card deleted from Trello is removed from the index
+        """
+        for slave_card in ("s"*24, "t"*24):
+            db.session.add(CardLink(mapping_id=1, master_card="m"*24,
+                slave_card=slave_card, slave_list="l"*24))
+        db.session.commit()
+        t_bg.return_value = [{"id": "s"*24, "idList": "l"*24}, None]
+        with self.assertLogs(level='DEBUG') as cm:
+            slave_cards = target.get_linked_slave_cards(
+                self.get_master_card(2), 1)
+        self.assertEqual(slave_cards, [{"id": "s"*24, "idList": "l"*24}])
+        self.assertEqual(cm.output, ["DEBUG:root:Master card has 2 indexed "
+            "slave cards", "DEBUG:root:Unindexing 1 deleted slave cards"])
+        self.assertEqual([l.slave_card for l in CardLink.query.all()],
+            ["s"*24])
+        # The next lookups don't ask Trello for the deleted card anymore
+        t_bg.return_value = [{"id": "s"*24, "idList": "l"*24}]
+        slave_cards = target.get_linked_slave_cards(self.get_master_card(2), 1)
+        self.assertEqual(slave_cards, t_bg.return_value)
+        self.assertEqual(t_bg.mock_calls[-1], call(["cards/%s" % ("s"*24)],
+            {}))
+
+    @patch("syncboom.batch_get")
+    def test_get_linked_slave_cards_reconcile(self, t_bg):
+        """
+        Test reconciling the index with the attachments once it's too old
+        """
+        db.session.add(CardLink(mapping_id=1, master_card="m"*24,
+            slave_card="s"*24, slave_list="l"*24,
+            timestamp_reconciled=datetime.utcnow() - timedelta(days=2)))
+        db.session.commit()
+        t_bg.return_value = [{"id": "t"*24, "idList": "k"*24}]
+        with self.assertLogs(level='DEBUG') as cm:
+            slave_cards = target.get_linked_slave_cards(
+                self.get_master_card(1), 1)
+        self.assertEqual(slave_cards, t_bg.return_value)
+        self.assertEqual(cm.output, ["DEBUG:root:Reconciling the index with "
+            "1 attached slave cards"])
+        links = CardLink.query.all()
+        self.assertEqual([(l.slave_card, l.slave_list) for l in links],
+            [("t"*24, "k"*24)])
+        self.assertGreater(links[0].timestamp_reconciled,
+            datetime.utcnow() - timedelta(minutes=1))
+
+    @patch("syncboom.perform_request")
+    def test_process_master_card_indexes_new_slave_cards(self, t_pr):
+        """
+        Test that the new slave cards of a mapping are added to the index
+        """
+        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
+        master_card = {"id": "m"*24, "desc": "abc", "name": "Card name",
+            "url": "https://trello.com/c/abcd1234/card",
+            "shortUrl": "https://trello.com/c/abcd1234",
+            "labels": [{"id": "label_id_1"}], "badges": {"attachments": 0},
+            "attachments": [], "checklists": [{"id": "c", "name": "Involved Teams"}]}
+        args_from_app = {"destination_lists": {"label_id_1": ["l"*24]},
+            "key": "ghi", "token": "jkl", "mapping_id": 1}
+        responses = {"GET lists/%s" % ("l"*24): {"idBoard": "b"*24},
+            "GET batch": [{"200": {"name": "Board name"}},
+                {"200": {"name": "List name"}}],
+            "POST cards": {"id": "s"*24, "name": "Card name",
+                "idBoard": "b"*24, "idList": "l"*24,
+                "url": "https://trello.com/c/efgh5678/card"}}
+        t_pr.side_effect = lambda method, url, *args, **kwargs: \
+            responses.get("%s %s" % (method, url), {})
+        with self.assertLogs(level='INFO'):
+            output = target.process_master_card(master_card, args_from_app)
+        self.assertEqual(output, (1, 1, 1))
+        links = CardLink.query.all()
+        self.assertEqual([(l.mapping_id, l.master_card, l.slave_card,
+            l.slave_list) for l in links], [(1, "m"*24, "s"*24, "l"*24)])
+        target.args = None
+
+
+class TestGetCardChecklists(FlaskTestCase):
+    @patch("syncboom.perform_request")
+    def test_get_card_checklists(self, t_pr):
+        """
+        Test retrieving a card's checklists from Trello
+        """
+        t_pr.return_value = [{"id": "c1", "name": "Involved Teams"}]
+        checklists = target.get_card_checklists({"id": "1a2b3c"}, {"token": "jkl"})
+        self.assertEqual(checklists, t_pr.return_value)
+        self.assertEqual(t_pr.mock_calls, [call("GET", "cards/1a2b3c/checklists",
+            token="jkl")])
+
+    @patch("syncboom.perform_request")
+    def test_get_card_checklists_snapshot(self, t_pr):
+        """
+        Test retrieving the checklists nested in a card's snapshot
+        """
+        card = {"id": "1a2b3c", "checklists": [{"id": "c1", "name": "Other"}]}
+        self.assertEqual(target.get_card_checklists(card), card["checklists"])
+        self.assertEqual(t_pr.mock_calls, [])
+
+
+class TestGetCardsSnapshot(FlaskTestCase):
+    @patch("syncboom.perform_request")
+    def test_get_cards_snapshot(self, t_pr):
+        """
+        Test getting a board's cards with nested attachments and checklists
+        """
+        t_pr.return_value = [{"id": "b"*24}, {"id": "a"*24}]
+        cards = target.get_cards_snapshot("boards", "z"*24, {"token": "jkl"})
+        self.assertEqual(cards, t_pr.return_value)
+        self.assertEqual(t_pr.mock_calls, [call("GET",
+            "boards/zzzzzzzzzzzzzzzzzzzzzzzz/cards", target.CARDS_SNAPSHOT_QUERY,
+            token="jkl")])
+        self.assertEqual(target.CARDS_SNAPSHOT_QUERY["attachments"], "true")
+        self.assertEqual(target.CARDS_SNAPSHOT_QUERY["checklists"], "all")
+
+    @patch("syncboom.SNAPSHOT_PAGE_SIZE", 2)
+    @patch("syncboom.perform_request")
+    def test_get_cards_snapshot_paginated(self, t_pr):
+        """
+        Test getting the cards of a board bigger than one page
+        """
+        t_pr.side_effect = [[{"id": "d"*24}, {"id": "c"*24}],
+            [{"id": "b"*24}, {"id": "a"*24}],
+            []]
+        cards = target.get_cards_snapshot("lists", "z"*24)
+        self.assertEqual([c["id"][0] for c in cards], ["d", "c", "b", "a"])
+        self.assertEqual(len(t_pr.mock_calls), 3)
+        self.assertNotIn("before", t_pr.mock_calls[0][1][2])
+        self.assertEqual(t_pr.mock_calls[1][1][2]["before"], "c"*24)
+        self.assertEqual(t_pr.mock_calls[2][1][2]["before"], "a"*24)
+
+    @patch("syncboom.SNAPSHOT_PAGE_SIZE", 2)
+    @patch("syncboom.perform_request")
+    def test_get_cards_snapshot_not_paginated(self, t_pr):
+        """
+        Test that the pages stop when a URL ignores the pagination and sends
+        the same full page again
+        """
+        t_pr.return_value = [{"id": "b"*24}, {"id": "a"*24}]
+        cards = target.get_cards_snapshot("lists", "z"*24)
+        self.assertEqual([c["id"][0] for c in cards], ["b", "a"])
+        self.assertEqual(len(t_pr.mock_calls), 2)
+
+    @patch("syncboom.perform_request")
+    def test_get_cards_index(self, t_pr):
+        """
+        Test getting the names and lists of a board's cards, cached until
+        the board is invalidated
+        """
+        t_pr.side_effect = [
+            [{"id": "b"*24, "name": "Card B", "idList": "l"*24, "badges": {}}],
+            []]
+        expected_cards = [{"id": "b"*24, "name": "Card B", "idList": "l"*24}]
+        self.assertEqual(target.get_cards_index("z"*24, {"token": "jkl"}),
+            expected_cards)
+        self.assertEqual(target.get_cards_index("z"*24, {"token": "jkl"}),
+            expected_cards)
+        target.invalidate_cached_entities(["z"*24])
+        self.assertEqual(target.get_cards_index("z"*24, {"token": "jkl"}), [])
+        self.assertEqual(t_pr.mock_calls, [call("GET",
+            "boards/zzzzzzzzzzzzzzzzzzzzzzzz/cards", target.CARDS_INDEX_QUERY,
+            token="jkl")] * 2)
+        self.assertEqual(target.CARDS_INDEX_QUERY["fields"], "name,idList")
+
+class TestIsMasterCardAction(FlaskTestCase):
+    def test_is_master_card_action(self):
+        """
+        Test which Trello actions change how a master card is synced
+        """
+        card = {"id": "c"*24}
+        self.assertTrue(target.is_master_card_action({"type": "createCard",
+            "data": {"card": card}}))
+        self.assertTrue(target.is_master_card_action({"type": "addLabelToCard",
+            "data": {"card": card}}))
+        self.assertTrue(target.is_master_card_action({"type": "updateCard",
+            "data": {"card": card, "old": {"idList": "l"*24}}}))
+        self.assertFalse(target.is_master_card_action({"type": "updateCard",
+            "data": {"card": card, "old": {"desc": "Old description"}}}))
+        self.assertFalse(target.is_master_card_action({"type": "updateCard",
+            "data": {"card": card, "old": {"pos": 1024}}}))
+        self.assertFalse(target.is_master_card_action({"type":
+            "addChecklistToCard", "data": {"card": card}}))
+        self.assertFalse(target.is_master_card_action({"type": "updateList",
+            "data": {"list": {"id": "l"*24}}}))
+
+
+class TestGetBoardActions(FlaskTestCase):
+    @patch("syncboom.perform_request")
+    def test_get_board_actions(self, t_pr):
+        """
+        Test getting the actions on a board since a previous action, over
+        several pages
+        """
+        target.ACTIONS_PAGE_SIZE = 2
+        t_pr.side_effect = [[{"id": "a4"}, {"id": "a3"}], [{"id": "a2"}]]
+        actions = target.get_board_actions("b"*24, "a1", {"token": "jkl"})
+        target.ACTIONS_PAGE_SIZE = 1000
+        self.assertEqual(actions, [{"id": "a4"}, {"id": "a3"}, {"id": "a2"}])
+        query = {"fields": "id,type,date,data", "limit": 2, "since": "a1"}
+        self.assertEqual(t_pr.mock_calls, [
+            call("GET", "boards/%s/actions" % ("b"*24), query, token="jkl"),
+            call("GET", "boards/%s/actions" % ("b"*24),
+                dict(query, before="a3"), token="jkl")])
+
+    @patch("syncboom.perform_request")
+    def test_get_latest_board_action(self, t_pr):
+        """
+        Test getting the most recent action on a board
+        """
+        t_pr.side_effect = [[{"id": "a4"}], []]
+        self.assertEqual(target.get_latest_board_action("b"*24), {"id": "a4"})
+        self.assertEqual(target.get_latest_board_action("b"*24), None)
+        self.assertEqual(t_pr.mock_calls[0], call("GET", "boards/%s/actions" %
+            ("b"*24), {"fields": "id,type,date,data", "limit": 1}))
+
+
+class TestGetChangedMasterCards(FlaskTestCase):
+    @patch("syncboom.batch_get")
+    @patch("syncboom.perform_request")
+    def test_get_changed_master_cards(self, t_pr, t_bg):
+        """
+        Test getting the master cards changed since a previous action
+        """
+        board = "b"*24
+        t_pr.return_value = [
+            {"id": "a6", "type": "addLabelToCard", "data": {"card": {"id": "c1"}}},
+            {"id": "a5", "type": "updateCard",
+                "data": {"card": {"id": "c2"}, "old": {"desc": ""}}},
+            {"id": "a4", "type": "updateList", "data": {"list": {"id": "l1"}}},
+            {"id": "a3", "type": "createCard", "data": {"card": {"id": "c3"}}},
+            {"id": "a2", "type": "createCard", "data": {"card": {"id": "c4"}}},
+            {"id": "a1", "type": "removeLabelFromCard",
+                "data": {"card": {"id": "c1"}}}]
+        t_bg.return_value = [{"id": "c1", "idBoard": board},
+            {"id": "c3", "idBoard": board, "closed": True}, None]
+        (cards, latest_action) = target.get_changed_master_cards(board, "a0",
+            {"token": "jkl"})
+        self.assertEqual(cards, [{"id": "c1", "idBoard": board}])
+        self.assertEqual(latest_action["id"], "a6")
+        self.assertEqual(t_bg.mock_calls, [call(["cards/c1", "cards/c3",
+            "cards/c4"], {"token": "jkl"}, target.CARD_NESTED_QUERY)])
+
+    @patch("syncboom.batch_get")
+    @patch("syncboom.perform_request")
+    def test_get_changed_master_cards_none(self, t_pr, t_bg):
+        """
+        Test getting the master cards without any action since last time
+        """
+        t_pr.return_value = []
+        t_bg.return_value = []
+        (cards, latest_action) = target.get_changed_master_cards("b"*24, "a0")
+        self.assertEqual(cards, [])
+        self.assertEqual(latest_action, None)
+
+
+@patch("syncboom.async_perform_request", forward_async_perform_request)
 class TestCleanupTestBoards(FlaskTestCase):
     @patch("syncboom.perform_request")
     def test_cleanup_test_boards_not_configured(self, t_pr):
@@ -233,17 +582,30 @@ class TestCleanupTestBoards(FlaskTestCase):
             },
             "cleanup_boards": ["r"*24]}
         master_cards = []
-        t_pr.return_value = {"id": "q"*24}
+        t_pr.return_value = {"id": "q"*24, "name": "Board name"}
         with self.assertRaises(SystemExit) as cm1, self.assertLogs(level='CRITICAL') as cm2:
             summary = target.cleanup_test_boards(master_cards)
         self.assertEqual(cm1.exception.code, 44)
         self.assertEqual(cm2.output, ["CRITICAL:root:This board qqqqqqqqqqqqqqqqqqqqqqqq is not whitelisted to be cleaned up. See the `cleanup_boards` section in the config file. Exiting..."])
 
-    @patch("syncboom.perform_request")
-    def test_cleanup_test_boards_none(self, t_pr):
-        """
-        Test cleaning up the test boards when there is no master card and no cards on the slave lists
-        """
+    def get_cleanup_requests(self, slave_cards=[], attachments=[],
+        checklists=[]):
+        """Answer the requests of the cleanup, in whatever order they're made"""
+        responses = {
+            ("GET", "lists/aaa/board"): {"id": "q"*24,
+                "name": "Destination board name"},
+            ("GET", "boards/%s/lists" % ("q"*24)): [
+                {"id": "aaa", "name": "Destination list name 1"},
+                {"id": "ddd", "name": "Destination list name 2"}],
+            ("GET", "boards/%s/cards" % ("q"*24)): slave_cards,
+            ("GET", "cards/%s/attachments" % ("t"*24)): attachments,
+            ("GET", "cards/%s/checklists" % ("t"*24)): checklists,
+        }
+        def perform_request(method, url, *args, **kwargs):
+            return responses.get((method, url), {})
+        return perform_request
+
+    def set_cleanup_config(self):
         target.config = {"token": "jkl",
             "destination_lists": {
                 "Label One": ["aaa"],
@@ -254,173 +616,130 @@ class TestCleanupTestBoards(FlaskTestCase):
                 ]
             },
             "cleanup_boards": ["q"*24]}
+
+    @patch("syncboom.time")
+    @patch("syncboom.perform_request")
+    def test_cleanup_test_boards_none(self, t_pr, t_t):
+        """
+        Test cleaning up the test boards when there is no master card and no cards on the slave lists
+        """
+        self.set_cleanup_config()
         master_cards = []
-        t_pr.side_effect = [
-            {"id": "q"*24},
-            [{"id": "aaa"}, {"id": "ddd"}],
-            {"idBoard": "h"*24},
-            {"name": "Destination board name 1"},
-            {"name": "Destination list name 1"},
-            [],
-            {"idBoard": "y"*24},
-            {"name": "Destination board name 2"},
-            {"name": "Destination list name 2"},
-            []]
+        t_pr.side_effect = self.get_cleanup_requests()
+        t_t.time.side_effect = [100, 100]
         with self.assertLogs(level='DEBUG') as cm:
             summary = target.cleanup_test_boards(master_cards)
         self.assertEqual(summary, {"cleaned_up_master_cards": 0,
             "deleted_slave_cards": 0,
             "erased_destination_boards": 0,
-            "erased_destination_lists": 0})
+            "erased_destination_lists": 0,
+            "duration": 0,
+            "slave_cards_per_second": 0})
         expected = ["DEBUG:root:Removing slave cards attachments on the master cards",
             "DEBUG:root:Deleting slave cards",
             "DEBUG:root:================================================================",
-            "DEBUG:root:Retrieve cards from list Destination board name 1|Destination list name 1 (list 1/2)",
-            "DEBUG:root:[]",
-            "DEBUG:root:List Destination board name 1/Destination list name 1 has 0 cards to delete",
-            "DEBUG:root:================================================================",
-            "DEBUG:root:Retrieve cards from list Destination board name 2|Destination list name 2 (list 2/2)",
-            "DEBUG:root:[]",
-            "DEBUG:root:List Destination board name 2/Destination list name 2 has 0 cards to delete"]
+            "DEBUG:root:Retrieve cards from board Destination board name (2 lists)",
+            "DEBUG:root:List Destination board name/Destination list name 1 has 0 cards to delete",
+            "DEBUG:root:List Destination board name/Destination list name 2 has 0 cards to delete"]
         self.assertEqual(cm.output, expected)
-
+        # The board and its lists are only retrieved once
+        self.assertEqual(t_pr.mock_calls, [
+            call("GET", "lists/aaa/board"),
+            call("GET", "boards/%s/lists" % ("q"*24)),
+            call("GET", "boards/%s/cards" % ("q"*24),
+                target.CLEANUP_CARDS_QUERY)])
+
+    @patch("syncboom.time")
     @patch("syncboom.perform_request")
-    def test_cleanup_test_boards_no_mc_yes_sc(self, t_pr):
+    def test_cleanup_test_boards_no_mc_yes_sc(self, t_pr, t_t):
         """
         Test cleaning up the test boards when there is no master card and cards on the slave lists
         """
-        target.config = {"token": "jkl",
-            "destination_lists": {
-                "Label One": ["aaa"],
-                "Label Two": ["ddd"],
-                "All Teams": [
-                  "aaa",
-                  "ddd"
-                ]
-            },
-            "cleanup_boards": ["q"*24]}
+        self.set_cleanup_config()
         master_cards = []
-        t_pr.side_effect = [
-            {"id": "q"*24},
-            [{"id": "aaa"}, {"id": "ddd"}],
-            {"idBoard": "h"*24},
-            {"name": "Destination board name 1"},
-            {"name": "Destination list name 1"},
-            [{"id": "u"*24}],
-            {},
-            {"idBoard": "y"*24},
-            {"name": "Destination board name 2"},
-            {"name": "Destination list name 2"},
-            [{"id": "j"*24}],
-            {}]
+        t_pr.side_effect = self.get_cleanup_requests(slave_cards=[
+            {"id": "u"*24, "idList": "aaa"},
+            {"id": "j"*24, "idList": "aaa"},
+            # Not on a destination list
+            {"id": "k"*24, "idList": "zzz"}])
+        t_t.time.side_effect = [100, 104]
         with self.assertLogs(level='DEBUG') as cm:
             summary = target.cleanup_test_boards(master_cards)
         self.assertEqual(summary, {"cleaned_up_master_cards": 0,
             "deleted_slave_cards": 2,
-            "erased_destination_boards": 2,
-            "erased_destination_lists": 2})
+            "erased_destination_boards": 1,
+            "erased_destination_lists": 1,
+            "duration": 4,
+            "slave_cards_per_second": 0.5})
         expected = ["DEBUG:root:Removing slave cards attachments on the master cards",
             "DEBUG:root:Deleting slave cards",
             "DEBUG:root:================================================================",
-            "DEBUG:root:Retrieve cards from list Destination board name 1|Destination list name 1 (list 1/2)",
-            "DEBUG:root:[{'id': 'uuuuuuuuuuuuuuuuuuuuuuuu'}]",
-            "DEBUG:root:List Destination board name 1/Destination list name 1 has 1 cards to delete",
-            "DEBUG:root:Deleting slave card uuuuuuuuuuuuuuuuuuuuuuuu",
-            "DEBUG:root:================================================================",
-            "DEBUG:root:Retrieve cards from list Destination board name 2|Destination list name 2 (list 2/2)",
-            "DEBUG:root:[{'id': 'jjjjjjjjjjjjjjjjjjjjjjjj'}]",
-            "DEBUG:root:List Destination board name 2/Destination list name 2 has 1 cards to delete",
-            "DEBUG:root:Deleting slave card jjjjjjjjjjjjjjjjjjjjjjjj"]
+            "DEBUG:root:Retrieve cards from board Destination board name (2 lists)",
+            "DEBUG:root:List Destination board name/Destination list name 1 has 2 cards to delete",
+            "DEBUG:root:List Destination board name/Destination list name 2 has 0 cards to delete",
+            "DEBUG:root:Deleting 2 archived slave cards from board Destination board name"]
         self.assertEqual(cm.output, expected)
-
+        # The list is archived at once, then its cards are deleted
+        self.assertEqual(t_pr.mock_calls[3], call("POST",
+            "lists/aaa/archiveAllCards"))
+        self.assertCountEqual(t_pr.mock_calls[4:], [
+            call("DELETE", "cards/%s" % ("u"*24)),
+            call("DELETE", "cards/%s" % ("j"*24))])
+
+    @patch("syncboom.time")
     @patch("syncboom.perform_request")
-    def test_cleanup_test_boards_master_card_no_attach(self, t_pr):
+    def test_cleanup_test_boards_master_card_no_attach(self, t_pr, t_t):
         """
         Test cleaning up the test boards with a master card without attachment
         """
-        target.config = {"token": "jkl",
-            "destination_lists": {
-                "Label One": ["aaa"],
-                "Label Two": ["ddd"],
-                "All Teams": [
-                  "aaa",
-                  "ddd"
-                ]
-            },
-            "cleanup_boards": ["q"*24]}
+        self.set_cleanup_config()
         master_cards = [{"id": "t"*24, "desc": "abc", "name": "Card name",
             "badges": {"attachments": 0}}]
-        t_pr.side_effect = [
-            [],
-            {"id": "q"*24},
-            [{"id": "aaa"}, {"id": "ddd"}],
-            {"idBoard": "h"*24},
-            {"name": "Destination board name 1"},
-            {"name": "Destination list name 1"},
-            [],
-            {"idBoard": "y"*24},
-            {"name": "Destination board name 2"},
-            {"name": "Destination list name 2"},
-            []]
+        t_pr.side_effect = self.get_cleanup_requests()
+        t_t.time.side_effect = [100, 100]
         with self.assertLogs(level='DEBUG') as cm:
             summary = target.cleanup_test_boards(master_cards)
         self.assertEqual(summary, {"cleaned_up_master_cards": 0,
             "deleted_slave_cards": 0,
             "erased_destination_boards": 0,
-            "erased_destination_lists": 0})
+            "erased_destination_lists": 0,
+            "duration": 0,
+            "slave_cards_per_second": 0})
         expected = ["DEBUG:root:Removing slave cards attachments on the master cards",
             "DEBUG:root:================================================================",
             "INFO:root:Cleaning up master card 1/1 - Card name",
             "DEBUG:root:Retrieving checklists from card tttttttttttttttttttttttt",
             "DEBUG:root:Deleting slave cards",
             "DEBUG:root:================================================================",
-            "DEBUG:root:Retrieve cards from list Destination board name 1|Destination list name 1 (list 1/2)",
-            "DEBUG:root:[]",
-            "DEBUG:root:List Destination board name 1/Destination list name 1 has 0 cards to delete",
-            "DEBUG:root:================================================================",
-            "DEBUG:root:Retrieve cards from list Destination board name 2|Destination list name 2 (list 2/2)",
-            "DEBUG:root:[]",
-            "DEBUG:root:List Destination board name 2/Destination list name 2 has 0 cards to delete"]
+            "DEBUG:root:Retrieve cards from board Destination board name (2 lists)",
+            "DEBUG:root:List Destination board name/Destination list name 1 has 0 cards to delete",
+            "DEBUG:root:List Destination board name/Destination list name 2 has 0 cards to delete"]
         self.assertEqual(cm.output, expected)
 
+    @patch("syncboom.time")
     @patch("syncboom.perform_request")
-    def test_cleanup_test_boards_master_card_attach(self, t_pr):
+    def test_cleanup_test_boards_master_card_attach(self, t_pr, t_t):
         """
         Test cleaning up the test boards with a master card with related attachment
         """
-        target.config = {"token": "jkl",
-            "destination_lists": {
-                "Label One": ["aaa"],
-                "Label Two": ["ddd"],
-                "All Teams": [
-                  "aaa",
-                  "ddd"
-                ]
-            },
-            "cleanup_boards": ["q"*24]}
-        master_cards = [{"id": "t"*24, "desc": "abc", "name": "Card name",
+        self.set_cleanup_config()
+        master_cards = [{"id": "t"*24, "name": "Card name",
+            "desc": "abc%s- 'Slave card' on list '**Board|List**'" %
+                target.METADATA_SEPARATOR,
             "badges": {"attachments": 1}}]
-        t_pr.side_effect = [
-            [{"id": "a"*24, "url": "https://trello.com/c/eoK0Rngb/blablabla"}],
-            {},
-            [{"id": "b"*24, "name": "Involved Teams"}],
-            {},
-            {"id": "q"*24},
-            [{"id": "aaa"}, {"id": "ddd"}],
-            {"idBoard": "h"*24},
-            {"name": "Destination board name 1"},
-            {"name": "Destination list name 1"},
-            [],
-            {"idBoard": "y"*24},
-            {"name": "Destination board name 2"},
-            {"name": "Destination list name 2"},
-            []]
+        t_pr.side_effect = self.get_cleanup_requests(
+            attachments=[{"id": "a"*24,
+                "url": "https://trello.com/c/eoK0Rngb/blablabla"}],
+            checklists=[{"id": "b"*24, "name": "Involved Teams"}])
+        t_t.time.side_effect = [100, 100]
         with self.assertLogs(level='DEBUG') as cm:
             summary = target.cleanup_test_boards(master_cards)
         self.assertEqual(summary, {"cleaned_up_master_cards": 1,
             "deleted_slave_cards": 0,
             "erased_destination_boards": 0,
-            "erased_destination_lists": 0})
+            "erased_destination_lists": 0,
+            "duration": 0,
+            "slave_cards_per_second": 0})
         expected = ["DEBUG:root:Removing slave cards attachments on the master cards",
             "DEBUG:root:================================================================",
             "INFO:root:Cleaning up master card 1/1 - Card name",
@@ -428,16 +747,18 @@ class TestCleanupTestBoards(FlaskTestCase):
             "DEBUG:root:Deleting attachment aaaaaaaaaaaaaaaaaaaaaaaa from master card tttttttttttttttttttttttt",
             "DEBUG:root:Retrieving checklists from card tttttttttttttttttttttttt",
             "DEBUG:root:Deleting checklist Involved Teams (bbbbbbbbbbbbbbbbbbbbbbbb) from master card tttttttttttttttttttttttt",
+            "DEBUG:root:Removing the metadata from master card tttttttttttttttttttttttt",
             "DEBUG:root:Deleting slave cards",
             "DEBUG:root:================================================================",
-            "DEBUG:root:Retrieve cards from list Destination board name 1|Destination list name 1 (list 1/2)",
-            "DEBUG:root:[]",
-            "DEBUG:root:List Destination board name 1/Destination list name 1 has 0 cards to delete",
-            "DEBUG:root:================================================================",
-            "DEBUG:root:Retrieve cards from list Destination board name 2|Destination list name 2 (list 2/2)",
-            "DEBUG:root:[]",
-            "DEBUG:root:List Destination board name 2/Destination list name 2 has 0 cards to delete"]
+            "DEBUG:root:Retrieve cards from board Destination board name (2 lists)",
+            "DEBUG:root:List Destination board name/Destination list name 1 has 0 cards to delete",
+            "DEBUG:root:List Destination board name/Destination list name 2 has 0 cards to delete"]
         self.assertEqual(cm.output, expected)
+        # The changes to the master card are made in parallel
+        self.assertCountEqual(t_pr.mock_calls[2:5], [
+            call("DELETE", "cards/%s/attachments/%s" % ("t"*24, "a"*24)),
+            call("DELETE", "checklists/%s" % ("b"*24)),
+            call("PUT", "cards/%s" % ("t"*24), {"desc": "abc"})])
 
 
 class TestUpdateMasterCardMetadata(FlaskTestCase):
@@ -606,6 +927,284 @@ class TestGetName(FlaskTestCase):
         self.assertEqual(len(t_pr.mock_calls), 1)
         self.assertEqual(list_name, expected_name)
 
+    @patch("syncboom.perform_request")
+    def test_get_name_cached_per_token(self, t_pr):
+        """
+        Test that the names fetched with the config's token aren't shared
+        with another token
+        """
+        t_pr.side_effect = [{"name": "First name"}, {"name": "Second name"}]
+        target.config = {"token": "jkl"}
+        self.assertEqual(target.get_name("board", "a1b2c3"), "First name")
+        self.assertEqual(target.get_name("board", "a1b2c3"), "First name")
+        target.config = {"token": "mno"}
+        self.assertEqual(target.get_name("board", "a1b2c3"), "Second name")
+        self.assertEqual(len(t_pr.mock_calls), 2)
+
+
+
+class TestCacheName(FlaskTestCase):
+    def test_cache_name_no_config(self):
+        """
+        Test naming a memoized function without the script's config
+        """
+        target.config = None
+        self.assertEqual(target.cache_name("syncboom.get_name"),
+            "syncboom.get_name")
+
+    def test_cache_name_config_token(self):
+        """
+        Test naming a memoized function after the config's token
+        """
+        target.config = {"token": "jkl"}
+        self.assertEqual(target.cache_name("syncboom.get_name"),
+            "syncboom.get_name.%s" % target.fingerprint("jkl"))
+        self.assertNotIn("jkl", target.cache_name("syncboom.get_name"))
+
+
+class TestFitsInCache(FlaskTestCase):
+    def test_fits_in_cache(self):
+        """
+        Test which values are small enough to be cached
+        """
+        target.app.config["CACHE_MAX_VALUE_SIZE"] = 20
+        self.assertTrue(target.fits_in_cache("Board name"))
+        self.assertTrue(target.fits_in_cache({"name": "Board"}))
+        self.assertFalse(target.fits_in_cache([{"name": "Board"}] * 3))
+        self.assertFalse(target.fits_in_cache(object()))
+
+
+class TestCacheInvalidation(FlaskTestCase):
+    def test_get_url_entities(self):
+        """
+        Test finding the Trello entities a request URL is about
+        """
+        self.assertEqual(target.get_url_entities("cards/a1b2c3d4"), ["a1b2c3d4"])
+        self.assertEqual(target.get_url_entities("boards/%s/lists" % ("b"*24)),
+            ["b"*24])
+        self.assertEqual(target.get_url_entities("list/%s" % ("c"*24)), ["c"*24])
+        self.assertEqual(target.get_url_entities("members/me/boards"), [])
+        self.assertEqual(target.get_url_entities("batch",
+            {"urls": "/cards/abc,/lists/def,/members/me"}), ["abc", "def"])
+
+    def test_get_action_entities(self):
+        """
+        Test finding the Trello entities changed by a webhook action
+        """
+        action = {"type": "updateCard", "data": {
+            "card": {"id": "c"*24, "shortLink": "abcd1234", "name": "Card"},
+            "listBefore": {"id": "l"*24, "name": "Before"},
+            "listAfter": {"id": "m"*24, "name": "After"},
+            "board": {"id": "b"*24, "shortLink": "efgh5678"},
+            "old": {"idList": "l"*24}}}
+        self.assertEqual(target.get_action_entities(action),
+            ["c"*24, "abcd1234", "l"*24, "m"*24, "b"*24, "efgh5678"])
+        self.assertEqual(target.get_action_entities({"type": "x"}), [])
+
+    @patch("syncboom.perform_request")
+    def test_get_name_invalidated(self, t_pr):
+        """
+        Test that a name is fetched again once its board is invalidated
+        """
+        t_pr.side_effect = [{"name": "Old name"}, {"name": "New name"}]
+        self.assertEqual(target.get_name("board", "b"*24), "Old name")
+        self.assertEqual(target.get_name("board", "b"*24), "Old name")
+        target.invalidate_cached_entities(["l"*24])
+        self.assertEqual(target.get_name("board", "b"*24), "Old name")
+        target.invalidate_cached_entities(target.get_action_entities(
+            {"type": "updateBoard", "data": {"board": {"id": "b"*24}}}))
+        self.assertEqual(target.get_name("board", "b"*24), "New name")
+        self.assertEqual(len(t_pr.mock_calls), 2)
+
+    @patch("syncboom.perform_request")
+    def test_get_board_name_from_list_invalidated(self, t_pr):
+        """
+        Test that only the board's name is fetched again once the board is
+        invalidated
+        """
+        t_pr.side_effect = [{"idBoard": "x"*24}, {"name": "Old name"},
+            {"name": "New name"}]
+        self.assertEqual(target.get_board_name_from_list("z"*24), "Old name")
+        target.invalidate_cached_entities(["x"*24])
+        self.assertEqual(target.get_board_name_from_list("z"*24), "New name")
+        expected_calls = [call('GET', 'lists/zzzzzzzzzzzzzzzzzzzzzzzz'),
+            call('GET', 'board/xxxxxxxxxxxxxxxxxxxxxxxx'),
+            call('GET', 'board/xxxxxxxxxxxxxxxxxxxxxxxx')]
+        self.assertEqual(t_pr.mock_calls, expected_calls)
+
+    @patch("syncboom.perform_request")
+    def test_get_boards_catalog(self, t_pr):
+        """
+        Test getting the open boards and lists of a user in one request,
+        cached per user until their catalog is invalidated
+        """
+        t_pr.side_effect = [
+            [{"id": "a"*24, "name": "Board A", "closed": False, "prefs": {},
+                "lists": [{"id": "l"*24, "name": "List L", "pos": 1}]},
+            {"id": "c"*24, "name": "Board C", "closed": True, "lists": []},
+            {"id": "b"*24, "name": "Board B", "closed": False}],
+            [{"id": "x"*24, "name": "Board X", "closed": False, "lists": []}],
+            [],
+        ]
+        pr_args = {"key": "ghi", "token": "jkl"}
+        expected_catalog = [
+            {"id": "a"*24, "name": "Board A",
+                "lists": [{"id": "l"*24, "name": "List L"}]},
+            {"id": "b"*24, "name": "Board B", "lists": []}]
+        self.assertEqual(target.get_boards_catalog(pr_args), expected_catalog)
+        self.assertEqual(target.get_boards_catalog(pr_args), expected_catalog)
+        # Another user's catalog is cached separately
+        self.assertEqual(target.get_boards_catalog({"key": "ghi",
+            "token": "mno"}), [{"id": "x"*24, "name": "Board X", "lists": []}])
+        target.invalidate_boards_catalog({"key": "ghi", "token": "mno"})
+        self.assertEqual(target.get_boards_catalog(pr_args), expected_catalog)
+        target.invalidate_boards_catalog(pr_args)
+        self.assertEqual(target.get_boards_catalog(pr_args), [])
+        self.assertEqual(t_pr.mock_calls, [
+            call("GET", "members/me/boards", target.BOARDS_CATALOG_QUERY,
+                key="ghi", token="jkl"),
+            call("GET", "members/me/boards", target.BOARDS_CATALOG_QUERY,
+                key="ghi", token="mno"),
+            call("GET", "members/me/boards", target.BOARDS_CATALOG_QUERY,
+                key="ghi", token="jkl")])
+
+    def test_is_boards_catalog_action(self):
+        """
+        Test finding the webhook actions that change the boards catalogs
+        """
+        self.assertTrue(target.is_boards_catalog_action({"type": "createList"}))
+        self.assertTrue(target.is_boards_catalog_action({"type": "updateBoard"}))
+        self.assertFalse(target.is_boards_catalog_action({"type": "updateCard"}))
+        self.assertFalse(target.is_boards_catalog_action({}))
+
+    @patch("requests.Session.request")
+    def test_perform_request_invalidated_by_write(self, r_r):
+        """
+        Test that writing to a card invalidates its cached GET requests
+        """
+        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
+        target.config = {"token": "jkl"}
+        mock_response = MagicMock(content=b"{}")
+        mock_response.json.side_effect = [{"desc": "Old"}, {}, {"desc": "New"}]
+        r_r.return_value = mock_response
+        self.assertEqual(target.perform_request("GET", "cards/a1b2c3d4"),
+            {"desc": "Old"})
+        self.assertEqual(target.perform_request("GET", "cards/a1b2c3d4"),
+            {"desc": "Old"})
+        with self.assertLogs(level='DEBUG') as cm:
+            target.perform_request("PUT", "cards/a1b2c3d4", {"desc": "New"})
+        self.assertEqual(cm.output,
+            ["DEBUG:root:Invalidated the cached values of a1b2c3d4"])
+        self.assertEqual(target.perform_request("GET", "cards/a1b2c3d4"),
+            {"desc": "New"})
+        self.assertEqual(len(r_r.mock_calls), 9)
+        target.args = None
+
+
+class TestGetNames(FlaskTestCase):
+    @patch("syncboom.perform_request")
+    def test_get_names(self, t_pr):
+        """
+        Test getting several names at once, reusing and filling the cache
+        """
+        t_pr.return_value = {"name": "Cached board"}
+        target.get_name("board", "b1", {})
+        t_pr.reset_mock()
+        t_pr.return_value = [{"200": {"name": "List one"}},
+            {"200": {"name": "Board two"}}]
+        names = target.get_names([("board", "b1"), ("list", "l1"),
+            ("board", "b2"), ("list", "l1")])
+        self.assertEqual(names, {("board", "b1"): "Cached board",
+            ("list", "l1"): "List one", ("board", "b2"): "Board two"})
+        self.assertEqual(t_pr.mock_calls, [call("GET", "batch",
+            {"urls": "/list/l1,/board/b2"})])
+        # The fetched names are now available to get_name
+        t_pr.reset_mock()
+        self.assertEqual(target.get_name("board", "b2", {}), "Board two")
+        self.assertEqual(t_pr.mock_calls, [])
+
+    @patch("syncboom.perform_request")
+    def test_get_names_batch_error(self, t_pr):
+        """
+        Test falling back to get_name when a batched lookup failed
+        """
+        t_pr.side_effect = [[{"200": {"name": "List one"}},
+            {"name": "ServerError", "statusCode": 500}], {"name": "Board two"}]
+        with self.assertLogs(level='WARNING'):
+            names = target.get_names([("list", "l1"), ("board", "b2")])
+        self.assertEqual(names, {("list", "l1"): "List one",
+            ("board", "b2"): "Board two"})
+        self.assertEqual(t_pr.mock_calls[1], call("GET", "board/b2"))
+
+
+class TestBatchGet(FlaskTestCase):
+    @patch("syncboom.perform_request")
+    def test_batch_get(self, t_pr):
+        """
+        Test getting 11 URLs in one batch of 10 and one single request
+        """
+        urls = ["cards/%d" % i for i in range(11)]
+        t_pr.side_effect = [[{"200": {"id": i}} for i in range(10)],
+            {"id": 10}]
+        results = target.batch_get(urls, {"token": "jkl"})
+        self.assertEqual(results, [{"id": i} for i in range(11)])
+        self.assertEqual(t_pr.mock_calls, [
+            call("GET", "batch", {"urls": ",".join(["/cards/%d" % i
+                for i in range(10)])}, token="jkl"),
+            call("GET", "cards/10", token="jkl")])
+
+    @patch("syncboom.perform_request")
+    def test_batch_get_query(self, t_pr):
+        """
+        Test getting URLs with a query, escaped within the batched URLs
+        """
+        t_pr.side_effect = [[{"200": {"id": "a"}}, {"200": {"id": "b"}}],
+            {"id": "c"}]
+        query = {"fields": "id,name", "checklists": "all"}
+        results = target.batch_get(["cards/a", "cards/b"], query=query)
+        results += target.batch_get(["cards/c"], query=query)
+        self.assertEqual(results, [{"id": "a"}, {"id": "b"}, {"id": "c"}])
+        self.assertEqual(t_pr.mock_calls, [
+            call("GET", "batch", {"urls": "/cards/a?fields=id%2Cname&"
+                "checklists=all,/cards/b?fields=id%2Cname&checklists=all"}),
+            call("GET", "cards/c", query)])
+
+    @patch("syncboom.perform_request")
+    def test_batch_get_error(self, t_pr):
+        """
+        Test getting a batch where one of the URLs failed
+        """
+        t_pr.return_value = [{"200": {"id": "a"}},
+            {"name": "NotFoundError", "message": "Not found", "statusCode": 404}]
+        with self.assertLogs(level='WARNING') as cm:
+            results = target.batch_get(["cards/a", "cards/b"])
+        self.assertEqual(results, [{"id": "a"}, None])
+        self.assertEqual(cm.output, ["WARNING:root:Batched GET call to " \
+            "'cards/b' failed: {'name': 'NotFoundError', 'message': " \
+            "'Not found', 'statusCode': 404}"])
+
+    @patch("syncboom.perform_request")
+    def test_batch_get_single_error(self, t_pr):
+        """
+        Test that a URL getting its own request fails as it would in a batch
+        """
+        response = MagicMock()
+        response.status_code = 404
+        t_pr.side_effect = [[{"200": {"id": i}} for i in range(10)],
+            HTTPError("", response=response)]
+        with self.assertLogs(level='WARNING') as cm:
+            results = target.batch_get(["cards/%d" % i for i in range(11)])
+        self.assertEqual(results, [{"id": i} for i in range(10)] + [None])
+        self.assertEqual(cm.output, ["WARNING:root:GET call to 'cards/10' "
+            "failed: 404"])
+
+    @patch("syncboom.perform_request")
+    def test_batch_get_empty(self, t_pr):
+        """
+        Test that no request is sent without URLs
+        """
+        self.assertEqual(target.batch_get([]), [])
+        self.assertEqual(t_pr.mock_calls, [])
 
 class TestGetBoardNameFromList(FlaskTestCase):
     @patch("syncboom.perform_request")
@@ -661,19 +1260,15 @@ class TestGenerateMasterCardMetadata(FlaskTestCase):
         slave_cards = [{"name": "name1", "idBoard": "idBoard1", "idList": "idList1"},
                        {"name": "name2", "idBoard": "idBoard2", "idList": "idList2"},
                        {"name": "name3", "idBoard": "idBoard3", "idList": "idList3"}]
-        t_pr.side_effect = [{"name": "record name1"},
-            {"name": "record name2"},
-            {"name": "record name3"},
-            {"name": "record name4"},
-            {"name": "record name5"},
-            {"name": "record name6"}]
+        t_pr.side_effect = [[{"200": {"name": "record name1"}},
+            {"200": {"name": "record name2"}},
+            {"200": {"name": "record name3"}},
+            {"200": {"name": "record name4"}},
+            {"200": {"name": "record name5"}},
+            {"200": {"name": "record name6"}}]]
         new_master_card_metadata = target.generate_master_card_metadata(slave_cards)
-        expected = [call('GET', 'board/idBoard1'),
-            call('GET', 'list/idList1'),
-            call('GET', 'board/idBoard2'),
-            call('GET', 'list/idList2'),
-            call('GET', 'board/idBoard3'),
-            call('GET', 'list/idList3')]
+        expected = [call('GET', 'batch', {'urls': '/board/idBoard1,/list/idList1,' \
+            '/board/idBoard2,/list/idList2,/board/idBoard3,/list/idList3'})]
         self.assertEqual(t_pr.mock_calls, expected)
         expected = "\n- 'name1' on list '**record name1|record name2**'\n- 'name2' on list '**record name3|record name4**'\n- 'name3' on list '**record name5|record name6**'"
         self.assertEqual(new_master_card_metadata, expected)
@@ -689,41 +1284,41 @@ class TestPerformRequest(FlaskTestCase):
         self.assertEqual(cm1.exception.code, 30)
         self.assertEqual(cm2.output, ["CRITICAL:root:HTTP method 'INVALID' not supported. Exiting..."])
 
-    @patch("requests.request")
+    @patch("requests.Session.request")
     def test_perform_request_get(self, r_r):
         """
         Test performing a GET request
         """
         target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
         target.config = {"token": "jkl"}
-        mock_response = MagicMock()
+        mock_response = MagicMock(content=b"{}")
         mock_response.json.return_value = {}
         r_r.return_value = mock_response
         target.perform_request("GET", "cards/a1b2c3d4")
-        expected = [call('GET', 'https://api.trello.com/1/cards/a1b2c3d4?key=ghi&token=jkl', params=None),
+        expected = [call('GET', 'https://api.trello.com/1/cards/a1b2c3d4?key=ghi&token=jkl', params=None, timeout=(5, 30)),
             call().raise_for_status(),
             call().json()]
         self.assertEqual(r_r.mock_calls, expected)
         target.args = None
 
-    @patch("requests.request")
+    @patch("requests.Session.request")
     def test_perform_request_get_dry_run(self, r_r):
         """
         Test performing a GET request with --dry-run
         """
         target.args = type(inspect.stack()[0][3], (object,), {"dry_run": True})()
         target.config = {"token": "jkl"}
-        mock_response = MagicMock()
+        mock_response = MagicMock(content=b"{}")
         mock_response.json.return_value = {}
         r_r.return_value = mock_response
         target.perform_request("GET", "cards/a1b2c3d4")
-        expected = [call('GET', 'https://api.trello.com/1/cards/a1b2c3d4?key=ghi&token=jkl', params=None),
+        expected = [call('GET', 'https://api.trello.com/1/cards/a1b2c3d4?key=ghi&token=jkl', params=None, timeout=(5, 30)),
             call().raise_for_status(),
             call().json()]
         self.assertEqual(r_r.mock_calls, expected)
         target.args = None
 
-    @patch("requests.request")
+    @patch("requests.Session.request")
     def test_perform_request_post(self, r_r):
         """
         Test performing a POST request
@@ -731,13 +1326,13 @@ class TestPerformRequest(FlaskTestCase):
         target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
         target.config = {"token": "jkl"}
         target.perform_request("POST", "cards/a1b2c3d4", {"abc": "def"})
-        expected = [call('POST', 'https://api.trello.com/1/cards/a1b2c3d4?key=ghi&token=jkl', params={'abc': 'def'}),
+        expected = [call('POST', 'https://api.trello.com/1/cards/a1b2c3d4?key=ghi&token=jkl', params={'abc': 'def'}, timeout=(5, 30)),
             call().raise_for_status(),
             call().json()]
         self.assertEqual(r_r.mock_calls, expected)
         target.args = None
 
-    @patch("requests.request")
+    @patch("requests.Session.request")
     def test_perform_request_post_dry_run(self, r_r):
         """
         Test performing a POST request with --dry-run
@@ -751,7 +1346,7 @@ class TestPerformRequest(FlaskTestCase):
         self.assertEqual(r_r.mock_calls, [])
         target.args = None
 
-    @patch("requests.request")
+    @patch("requests.Session.request")
     def test_perform_request_put(self, r_r):
         """
         Test performing a PUT request
@@ -759,13 +1354,13 @@ class TestPerformRequest(FlaskTestCase):
         target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
         target.config = {"token": "jkl"}
         target.perform_request("PUT", "cards/a1b2c3d4", {"abc": "def"})
-        expected = [call('PUT', 'https://api.trello.com/1/cards/a1b2c3d4?key=ghi&token=jkl', params={'abc': 'def'}),
+        expected = [call('PUT', 'https://api.trello.com/1/cards/a1b2c3d4?key=ghi&token=jkl', params={'abc': 'def'}, timeout=(5, 30)),
             call().raise_for_status(),
             call().json()]
         self.assertEqual(r_r.mock_calls, expected)
         target.args = None
 
-    @patch("requests.request")
+    @patch("requests.Session.request")
     def test_perform_request_put_dry_run(self, r_r):
         """
         Test performing a PUT request with --dry-run
@@ -779,7 +1374,7 @@ class TestPerformRequest(FlaskTestCase):
         self.assertEqual(r_r.mock_calls, [])
         target.args = None
 
-    @patch("requests.request")
+    @patch("requests.Session.request")
     def test_perform_request_delete(self, r_r):
         """
         Test performing a DELETE request
@@ -787,13 +1382,13 @@ class TestPerformRequest(FlaskTestCase):
         target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
         target.config = {"token": "jkl"}
         target.perform_request("DELETE", "cards/a1b2c3d4")
-        expected = [call('DELETE', 'https://api.trello.com/1/cards/a1b2c3d4?key=ghi&token=jkl', params=None),
+        expected = [call('DELETE', 'https://api.trello.com/1/cards/a1b2c3d4?key=ghi&token=jkl', params=None, timeout=(5, 30)),
             call().raise_for_status(),
             call().json()]
         self.assertEqual(r_r.mock_calls, expected)
         target.args = None
 
-    @patch("requests.request")
+    @patch("requests.Session.request")
     def test_perform_request_delete_dry_run(self, r_r):
         """
         Test performing a DELETE request with --dry-run
@@ -807,8 +1402,9 @@ class TestPerformRequest(FlaskTestCase):
         self.assertEqual(r_r.mock_calls, [])
         target.args = None
 
-    @patch("requests.request")
-    def test_perform_request_connection_error(self, r_r):
+    @patch("time.sleep")
+    @patch("requests.Session.request")
+    def test_perform_request_connection_error(self, r_r, t_s):
         """
         Confirm a connection error to Trello raises TrelloConnectionError
         """
@@ -817,8 +1413,11 @@ class TestPerformRequest(FlaskTestCase):
         r_r.side_effect = ConnectionError()
         with self.assertRaises(target.TrelloConnectionError) as cm:
             target.perform_request("GET", "cards/a1b2c3d4")
+        # The request has been attempted the maximum number of times
+        self.assertEqual(len(r_r.mock_calls), 5)
+        self.assertEqual(len(t_s.mock_calls), 4)
 
-    @patch("requests.request")
+    @patch("requests.Session.request")
     def test_perform_request_http_error_401(self, r_r):
         """
         Confirm a 401 response code from Trello raises TrelloAuthenticationError
@@ -833,7 +1432,7 @@ class TestPerformRequest(FlaskTestCase):
         with self.assertRaises(target.TrelloAuthenticationError) as cm:
             target.perform_request("GET", "cards/a1b2c3d4")
 
-    @patch("requests.request")
+    @patch("requests.Session.request")
     def test_perform_request_http_error_other(self, r_r):
         """
         Confirm a 401 response code from Trello raises TrelloAuthenticationError
@@ -849,18 +1448,18 @@ class TestPerformRequest(FlaskTestCase):
             target.perform_request("GET", "cards/a1b2c3d4")
         self.assertTrue("CRITICAL:root:Request failed with code OTHER and message '<MagicMock name='request().content' id='" in cm2.output[0])
 
-    @patch("requests.request")
+    @patch("requests.Session.request")
     def test_perform_request_cached(self, r_r):
         """
         Test performing twice the same GET request, the second call will return the cached content
         """
         target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
         target.config = {"token": "jkl"}
-        mock_response = MagicMock()
+        mock_response = MagicMock(content=b"{}")
         mock_response.json.return_value = {"key1": "value1", "key2": "value2"}
         r_r.return_value = mock_response
         output_first = target.perform_request("GET", "cards/a1b2c3d4")
-        expected = [call('GET', 'https://api.trello.com/1/cards/a1b2c3d4?key=ghi&token=jkl', params=None),
+        expected = [call('GET', 'https://api.trello.com/1/cards/a1b2c3d4?key=ghi&token=jkl', params=None, timeout=(5, 30)),
             call().raise_for_status(),
             call().json()]
         self.assertEqual(r_r.mock_calls, expected)
@@ -872,6 +1471,1000 @@ class TestPerformRequest(FlaskTestCase):
         self.assertEqual(output_first, output_second)
         target.args = None
 
+    @patch("requests.Session.request")
+    def test_perform_request_cache_bypassed(self, r_r):
+        """
+        Test that the GET requests within cache_bypassed() neither use nor
+        fill the cache
+        """
+        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
+        target.config = {"token": "jkl"}
+        mock_response = MagicMock(content=b"{}")
+        mock_response.json.side_effect = [{"name": "first"},
+            {"name": "second"}, {"name": "third"}]
+        r_r.return_value = mock_response
+        self.assertEqual(target.perform_request("GET", "cards/a1b2c3d4"),
+            {"name": "first"})
+        with target.cache_bypassed():
+            self.assertEqual(target.perform_request("GET", "cards/a1b2c3d4"),
+                {"name": "second"})
+            with target.cache_bypassed():
+                pass
+            self.assertEqual(target.perform_request("GET", "cards/a1b2c3d4"),
+                {"name": "third"})
+        # The cached response is still the one from before
+        self.assertEqual(target.perform_request("GET", "cards/a1b2c3d4"),
+            {"name": "first"})
+        self.assertEqual(len(r_r.mock_calls), 9)
+        target.args = None
+
+    @patch("requests.Session.request")
+    def test_perform_request_too_large_to_cache(self, r_r):
+        """
+        Test that the responses larger than CACHE_MAX_VALUE_SIZE aren't cached
+        """
+        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
+        target.config = {"token": "jkl"}
+        target.app.config["CACHE_MAX_VALUE_SIZE"] = 100
+        mock_responses = []
+        for value in ({"desc": "a"*100}, {"desc": "b"*10}, {"desc": "c"*10}):
+            mock_responses.append(MagicMock(content=json.dumps(value).encode()))
+            mock_responses[-1].json.return_value = value
+        r_r.side_effect = mock_responses
+        self.assertEqual(target.perform_request("GET", "cards/a1b2c3d4"),
+            {"desc": "a"*100})
+        self.assertEqual(target.perform_request("GET", "cards/a1b2c3d4"),
+            {"desc": "b"*10})
+        self.assertEqual(target.perform_request("GET", "cards/a1b2c3d4"),
+            {"desc": "b"*10})
+        self.assertEqual(r_r.call_count, 2)
+        target.args = None
+
+
+
+
+class TestAsyncPerformRequest(FlaskTestCase):
+    def setUp(self):
+        super().setUp()
+        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
+        target.config = {"token": "jkl"}
+        target.app.config["TRELLO_TOKEN_RATE_LIMIT"] = 0
+        target.app.config["TRELLO_KEY_RATE_LIMIT"] = 0
+        self.simulator = TrelloSimulator(seed=1)
+        self.board = self.simulator.add_board("Board name")
+        self.card = self.simulator.add_card(self.simulator.add_list(
+            self.board, "List name"), "Card name")
+
+    def tearDown(self):
+        target.args = None
+        super().tearDown()
+
+    def perform(self, *args, **kwargs):
+        return target.run_async(target.async_perform_request(
+            self.simulator.async_session(), *args, **kwargs))
+
+    def test_async_perform_request_get(self):
+        """
+        Test performing a GET request with the async client
+        """
+        result = self.perform("GET", "cards/%s" % self.card["id"],
+            {"fields": "name"})
+        self.assertEqual(result, {"id": self.card["id"], "name": "Card name"})
+
+    def test_async_perform_request_post_dry_run(self):
+        """
+        Test that a POST request is skipped with --dry-run
+        """
+        target.args.dry_run = True
+        result = self.perform("PUT", "cards/%s" % self.card["id"],
+            {"name": "New name"})
+        self.assertEqual(result, {})
+        self.assertEqual(self.simulator.stats["requests"], 0)
+        self.assertEqual(self.card["name"], "Card name")
+
+    def test_async_perform_request_http_error_401(self):
+        """
+        Confirm a 401 response code raises TrelloAuthenticationError
+        """
+        self.simulator.fail_next(401)
+        with self.assertRaises(target.TrelloAuthenticationError):
+            self.perform("GET", "cards/%s" % self.card["id"])
+
+    def test_async_perform_request_http_error_404(self):
+        """
+        Confirm the HTTP error of a request that can't be retried is raised
+        """
+        with self.assertRaises(HTTPError), self.assertLogs(level='CRITICAL'):
+            self.perform("GET", "cards/%s" % ("z"*24))
+
+    @patch("time.sleep")
+    def test_async_perform_request_retry(self, t_s):
+        """
+        Test that a failed request is retried without blocking the thread
+        """
+        target.app.config["TRELLO_RETRY_BACKOFF"] = 0.01
+        self.simulator.fail_next(503)
+        self.simulator.fail_next(CONNECTION_ERROR)
+        with self.assertLogs(level='WARNING') as cm:
+            result = self.perform("PUT", "cards/%s" % self.card["id"],
+                {"name": "New name"})
+        self.assertEqual(result["name"], "New name")
+        self.assertEqual(len(cm.output), 2)
+        self.assertEqual(self.simulator.stats["requests"], 3)
+        self.assertEqual(t_s.mock_calls, [])
+
+    def test_async_perform_request_connection_error(self):
+        """
+        Test that a POST isn't retried after a lost connection
+        """
+        self.simulator.fail_next(CONNECTION_ERROR)
+        with self.assertRaises(target.TrelloConnectionError):
+            self.perform("POST", "cards", {"idList": self.card["idList"],
+                "name": "Other card"})
+        self.assertEqual(self.simulator.stats["requests"], 1)
+
+    def test_async_perform_request_base_url(self):
+        """
+        Test a request to another service than Trello
+        """
+        result = self.perform("POST", "token",
+            base_url="https://webhook.site/%s")
+        self.assertIn("uuid", result)
+
+    def test_async_perform_request_shared_cache(self):
+        """
+        Test that the GET requests share the cache of perform_request
+        """
+        url = "cards/%s" % self.card["id"]
+        with self.simulator.patch():
+            self.assertEqual(target.perform_request("GET", url)["name"],
+                "Card name")
+        self.assertEqual(self.perform("GET", url)["name"], "Card name")
+        self.assertEqual(self.simulator.stats["requests"], 1)
+        target.cache.clear()
+        self.assertEqual(self.perform("GET", url)["name"], "Card name")
+        with self.simulator.patch():
+            self.assertEqual(target.perform_request("GET", url)["name"],
+                "Card name")
+        self.assertEqual(self.simulator.stats["requests"], 2)
+
+    def test_async_perform_request_invalidates_cache(self):
+        """
+        Test that a write invalidates what was cached about its card
+        """
+        url = "cards/%s" % self.card["id"]
+        self.perform("GET", url)
+        self.perform("PUT", url, {"name": "New name"})
+        self.assertEqual(self.perform("GET", url)["name"], "New name")
+        self.assertEqual(self.simulator.stats["requests"], 3)
+
+    def test_async_perform_request_no_cache_when_bypassed(self):
+        """
+        Test that the requests read from Trello when the cache is bypassed
+        """
+        url = "cards/%s" % self.card["id"]
+        self.perform("GET", url)
+        with target.cache_bypassed():
+            self.perform("GET", url)
+        self.assertEqual(self.simulator.stats["requests"], 2)
+
+
+class TestPerformRequests(FlaskTestCase):
+    @patch("syncboom.perform_request")
+    def test_perform_requests_none(self, t_pr):
+        """
+        Test performing no request at all
+        """
+        self.assertEqual(target.perform_requests([]), [])
+        self.assertEqual(t_pr.mock_calls, [])
+
+    @patch("syncboom.async_perform_request")
+    @patch("syncboom.perform_request")
+    def test_perform_requests_single(self, t_pr, t_apr):
+        """
+        Test that a single request is performed directly
+        """
+        t_pr.return_value = {}
+        results = target.perform_requests([("DELETE", "cards/abc")],
+            {"token": "jkl"})
+        self.assertEqual(results, [{}])
+        self.assertEqual(t_pr.mock_calls, [call("DELETE", "cards/abc",
+            token="jkl")])
+        self.assertEqual(t_apr.mock_calls, [])
+
+    @patch("syncboom.async_perform_request")
+    def test_perform_requests_ordered(self, t_apr):
+        """
+        Test that the results come in the order of the requests
+        """
+        async def perform_request(session, method, url, query=None,
+            token=None):
+            await asyncio.sleep(0.001 * (10 - int(url)))
+            return {"url": url, "query": query, "token": token}
+        t_apr.side_effect = perform_request
+        calls = [("GET", str(i)) for i in range(10)] + \
+            [("POST", "10", {"a": "b"})]
+        results = target.perform_requests(calls, {"token": "jkl"})
+        expected = [{"url": str(i), "query": None, "token": "jkl"}
+            for i in range(10)] + [{"url": "10", "query": {"a": "b"},
+            "token": "jkl"}]
+        self.assertEqual(results, expected)
+
+    @patch("syncboom.async_perform_request")
+    def test_perform_requests_concurrent(self, t_apr):
+        """
+        Test that the requests are in flight at the same time, in one thread
+        """
+        in_flight = []
+        threads = set()
+        async def perform_request(session, method, url):
+            in_flight.append(url)
+            threads.add(threading.get_ident())
+            # Only returns once all the requests were sent
+            while len(in_flight) < 3:
+                await asyncio.sleep(0)
+            return url
+        t_apr.side_effect = perform_request
+        results = target.perform_requests([("GET", "a"), ("GET", "b"),
+            ("GET", "c")])
+        self.assertEqual(results, ["a", "b", "c"])
+        self.assertEqual(threads, {threading.get_ident()})
+
+    @patch("syncboom.async_perform_request")
+    def test_perform_requests_error(self, t_apr):
+        """
+        Test that an error raised by one of the requests is raised
+        """
+        async def perform_request(session, method, url):
+            if url == "b":
+                raise target.TrelloConnectionError
+            return {}
+        t_apr.side_effect = perform_request
+        with self.assertRaises(target.TrelloConnectionError):
+            target.perform_requests([("GET", "a"), ("GET", "b")])
+
+    @patch("syncboom.async_perform_request")
+    @patch("syncboom.perform_request")
+    def test_perform_requests_return_exceptions(self, t_pr, t_apr):
+        """
+        Test getting the error of a failed request in place of its result
+        """
+        error = target.TrelloConnectionError()
+        def perform_request(method, url, *args):
+            if url == "b":
+                raise error
+            return {"url": url}
+        async def async_perform_request(session, *args):
+            return perform_request(*args)
+        t_pr.side_effect = perform_request
+        t_apr.side_effect = async_perform_request
+        self.assertEqual(target.perform_requests([("GET", "a"), ("GET", "b"),
+            ("GET", "c")], return_exceptions=True),
+            [{"url": "a"}, error, {"url": "c"}])
+        self.assertEqual(target.perform_requests([("GET", "b")],
+            return_exceptions=True), [error])
+
+    def test_perform_requests_simulator(self):
+        """
+        Test that the requests of a sync are all in flight at once
+        """
+        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
+        target.config = {"token": "jkl"}
+        target.app.config["TRELLO_TOKEN_RATE_LIMIT"] = 0
+        target.app.config["TRELLO_KEY_RATE_LIMIT"] = 0
+        simulator = TrelloSimulator(latency=0.05)
+        board = simulator.add_board("Board name")
+        trello_list = simulator.add_list(board, "List name")
+        calls = [("POST", "cards", {"idList": trello_list["id"],
+            "name": "Card %d" % i}) for i in range(30)]
+        with simulator.patch():
+            results = target.perform_requests(calls)
+        target.args = None
+        self.assertEqual([r["name"] for r in results],
+            ["Card %d" % i for i in range(30)])
+        self.assertEqual(simulator.stats["max_in_flight"], 30)
+
+
+class TestRetry(FlaskTestCase):
+    def setUp(self):
+        super().setUp()
+        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
+        target.config = {"token": "jkl"}
+        target.retry_stats.update({"attempts": 0, "retries": 0, "failures": 0,
+            "errors": {}})
+        target.app.config["TRELLO_TOKEN_RATE_LIMIT"] = 0
+        target.app.config["TRELLO_KEY_RATE_LIMIT"] = 0
+
+    def tearDown(self):
+        target.args = None
+        super().tearDown()
+
+    def mock_response(self, status_code):
+        response = MagicMock()
+        response.status_code = status_code
+        response.headers = {}
+        if status_code >= 400:
+            response.raise_for_status.side_effect = HTTPError("",
+                response=response)
+        response.json.return_value = {"status": status_code}
+        return response
+
+    @patch("time.sleep")
+    @patch("random.uniform")
+    @patch("requests.Session.request")
+    def test_perform_request_retry_get(self, r_r, r_u, t_s):
+        """
+        Test retrying a GET request after transient errors, with backoff
+        """
+        r_r.side_effect = [self.mock_response(502), self.mock_response(503),
+            self.mock_response(200)]
+        r_u.side_effect = lambda a, b: b
+        with self.assertLogs(level='WARNING') as cm:
+            output = target.perform_request("GET", "cards/a1b2c3d4")
+        self.assertEqual(output, {"status": 200})
+        self.assertEqual(t_s.mock_calls, [call(0.5), call(1.0)])
+        self.assertEqual(cm.output, [
+            "WARNING:root:Attempt 1 for GET 'https://api.trello.com/1/cards/a1b2c3d4' failed (502), retrying in 0.50s",
+            "WARNING:root:Attempt 2 for GET 'https://api.trello.com/1/cards/a1b2c3d4' failed (503), retrying in 1.00s"])
+        self.assertEqual(target.get_retry_stats(), {"attempts": 3,
+            "retries": 2, "failures": 0, "errors": {"502": 1, "503": 1}})
+
+    @patch("time.sleep")
+    @patch("requests.Session.request")
+    def test_perform_request_retry_max_attempts(self, r_r, t_s):
+        """
+        Test giving up after the maximum number of attempts
+        """
+        target.app.config["TRELLO_RETRY_MAX_ATTEMPTS"] = 3
+        r_r.side_effect = [self.mock_response(500) for i in range(3)]
+        with self.assertRaises(HTTPError), self.assertLogs(level='WARNING'):
+            target.perform_request("PUT", "cards/a1b2c3d4", {"desc": "abc"})
+        self.assertEqual(len(r_r.mock_calls), 3)
+        self.assertEqual(len(t_s.mock_calls), 2)
+        self.assertEqual(target.get_retry_stats(), {"attempts": 3,
+            "retries": 2, "failures": 1, "errors": {"500": 3}})
+
+    @patch("time.sleep")
+    @patch("requests.Session.request")
+    def test_perform_request_retry_delete_done(self, r_r, t_s):
+        """
+        Test that a DELETE retried after its response was lost succeeds when
+        the card is already gone, but not when it was never there
+        """
+        r_r.side_effect = [self.mock_response(502), self.mock_response(404)]
+        with self.assertLogs(level='DEBUG') as cm:
+            output = target.perform_request("DELETE", "cards/a1b2c3d4")
+        self.assertEqual(output, {})
+        self.assertIn("DEBUG:root:DELETE "
+            "'https://api.trello.com/1/cards/a1b2c3d4' already done by "
+            "attempt 1", cm.output)
+        r_r.side_effect = [ConnectionError(), self.mock_response(404)]
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(target.perform_request("DELETE",
+                "cards/a1b2c3d4"), {})
+        r_r.side_effect = [self.mock_response(404)]
+        with self.assertRaises(HTTPError), self.assertLogs(level='CRITICAL'):
+            target.perform_request("DELETE", "cards/a1b2c3d4")
+
+    @patch("time.sleep")
+    @patch("requests.Session.request")
+    def test_perform_request_retry_post(self, r_r, t_s):
+        """
+        Test that a POST is only retried when Trello rejected it with a 429
+        """
+        r_r.side_effect = [self.mock_response(429), self.mock_response(200)]
+        with self.assertLogs(level='WARNING'):
+            output = target.perform_request("POST", "cards", {"name": "abc"})
+        self.assertEqual(output, {"status": 200})
+        r_r.side_effect = [self.mock_response(503), self.mock_response(200)]
+        with self.assertRaises(HTTPError), self.assertLogs(level='CRITICAL'):
+            target.perform_request("POST", "cards", {"name": "abc"})
+        self.assertEqual(len(r_r.mock_calls), 3)
+        r_r.side_effect = ConnectionError()
+        with self.assertRaises(target.TrelloConnectionError):
+            target.perform_request("POST", "cards", {"name": "abc"})
+        self.assertEqual(len(t_s.mock_calls), 1)
+
+    @patch("syncboom.time")
+    @patch("requests.Session.request")
+    def test_perform_request_retry_deadline(self, r_r, t_t):
+        """
+        Test not retrying any more once the total deadline would be exceeded
+        """
+        t_t.time.side_effect = [1000.0, 1000.0, 1050.0, 1100.0, 1150.0]
+        r_r.side_effect = [self.mock_response(503), self.mock_response(503)]
+        with self.assertRaises(HTTPError), self.assertLogs(level='WARNING'):
+            target.perform_request("GET", "cards/a1b2c3d4")
+        self.assertEqual(len(r_r.mock_calls), 2)
+        self.assertEqual(len(t_t.sleep.mock_calls), 1)
+        # The second attempt could only take what was left of the deadline
+        self.assertEqual(r_r.mock_calls[1][2]["timeout"], (5, 20.0))
+
+    @patch("time.sleep")
+    @patch("requests.Session.request")
+    def test_perform_request_retry_timeout(self, r_r, t_s):
+        """
+        Test that each attempt has a timeout, a timed out GET being retried
+        but not a timed out POST
+        """
+        r_r.side_effect = [ReadTimeout(), self.mock_response(200)]
+        with self.assertLogs(level='WARNING') as cm:
+            output = target.perform_request("GET", "cards/a1b2c3d4")
+        self.assertEqual(output, {"status": 200})
+        self.assertIn("failed (timeout)", cm.output[0])
+        self.assertEqual([c[2]["timeout"] for c in r_r.mock_calls[:2]],
+            [(5, 30), (5, 30)])
+        r_r.side_effect = ReadTimeout()
+        with self.assertRaises(target.TrelloConnectionError):
+            target.perform_request("POST", "cards", {"name": "abc"})
+        self.assertEqual(len(t_s.mock_calls), 1)
+        self.assertEqual(target.get_retry_stats()["errors"], {"timeout": 2})
+
+class TestGetSession(FlaskTestCase):
+    def test_get_session_reused(self):
+        """
+        Test that the same HTTP session is returned within one process
+        """
+        target.session = None
+        session = target.get_session()
+        self.assertEqual(target.get_session(), session)
+        adapter = session.get_adapter("https://api.trello.com/1/")
+        self.assertEqual(adapter._pool_maxsize, 10)
+        self.assertEqual(session.headers["Connection"], "keep-alive")
+
+    @patch("os.getpid")
+    def test_get_session_forked(self, o_g):
+        """
+        Test that a new HTTP session is created after the process got forked
+        """
+        target.session = None
+        o_g.return_value = 1234
+        session = target.get_session()
+        o_g.return_value = 5678
+        self.assertNotEqual(target.get_session(), session)
+        self.assertEqual(target.session_pid, 5678)
+
+    def test_get_session_config(self):
+        """
+        Test the pool size and keep-alive settings of the HTTP session
+        """
+        target.session = None
+        target.app.config["TRELLO_POOL_SIZE"] = 3
+        target.app.config["TRELLO_KEEP_ALIVE"] = False
+        session = target.get_session()
+        adapter = session.get_adapter("https://api.trello.com/1/")
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(session.headers["Connection"], "close")
+        target.session = None
+
+
+class TestGetTransportStats(FlaskTestCase):
+    def test_get_transport_stats_no_session(self):
+        """
+        Test the connection statistics before any request got sent
+        """
+        target.session = None
+        self.assertEqual(target.get_transport_stats(),
+            {"pools": 0, "requests": 0, "connections": 0, "reused": 0})
+
+    def test_get_transport_stats(self):
+        """
+        Test the connection statistics after requests reused connections
+        """
+        target.session = None
+        adapter = target.get_session().get_adapter("https://api.trello.com/1/")
+        pool = adapter.poolmanager.connection_from_url("https://api.trello.com/1/")
+        pool.num_requests = 12
+        pool.num_connections = 2
+        self.assertEqual(target.get_transport_stats(),
+            {"pools": 1, "requests": 12, "connections": 2, "reused": 10})
+        target.session = None
+
+
+class TestRateLimit(FlaskTestCase):
+    def setUp(self):
+        super().setUp()
+        target.app.config["TRELLO_KEY_RATE_LIMIT"] = 0
+        target.app.config["TRELLO_TOKEN_RATE_LIMIT"] = 10
+        target.app.config["TRELLO_RATE_LIMIT_PERIOD"] = 1
+        target.app.config["TRELLO_RATE_LIMIT_BURST"] = 1
+        target.app.config["TRELLO_RATE_LIMIT_MARGIN"] = 0
+        target.rate_limit_state.clear()
+        for s in target.rate_limit_stats:
+            target.rate_limit_stats[s] = 0
+        target.rate_limit_waiting_until = 0
+        # No Redis server available by default
+        target.redis_unavailable_until = float("inf")
+
+    def tearDown(self):
+        target.redis_unavailable_until = 0
+        super().tearDown()
+
+    @patch("time.sleep")
+    @patch("time.time")
+    def test_wait_for_rate_limit_local(self, t_t, t_s):
+        """
+        Test pacing the requests without Redis
+        """
+        t_t.return_value = 1000.0
+        waits = [target.wait_for_rate_limit("ghi", "jkl") for i in range(3)]
+        self.assertEqual([round(w, 3) for w in waits], [0, 0.1, 0.2])
+        self.assertEqual([round(c[1][0], 3) for c in t_s.mock_calls], [0.1, 0.2])
+        stats = target.get_rate_limit_stats()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["throttled"], 2)
+        # Both requests waited at the same time
+        self.assertEqual(round(stats["wait_time"], 3), 0.2)
+        self.assertEqual(round(stats["thread_wait_time"], 3), 0.3)
+        # Other tokens have their own budget
+        self.assertEqual(target.wait_for_rate_limit("ghi", "mno"), 0)
+
+    def test_get_rate_limit_pace(self):
+        """
+        Test that the steady pace only keeps the margin of the limits unused,
+        and that the bursts never exceed the limits in a sliding window
+        """
+        target.app.config["TRELLO_RATE_LIMIT_BURST"] = 10
+        target.app.config["TRELLO_RATE_LIMIT_MARGIN"] = 0.1
+        for limit in (100, 300):
+            (interval, tolerance) = target.get_rate_limit_pace(limit, 10)
+            self.assertAlmostEqual(1 / interval, limit * 0.9 / 10)
+            self.assertEqual(round(tolerance / interval), 9)
+        # Without any margin, the pace is the limit and there are no bursts
+        target.app.config["TRELLO_RATE_LIMIT_MARGIN"] = 0
+        self.assertEqual(target.get_rate_limit_pace(100, 10), (0.1, 0))
+        # The burst can't take more than the margin of a small limit
+        target.app.config["TRELLO_RATE_LIMIT_MARGIN"] = 0.2
+        (interval, tolerance) = target.get_rate_limit_pace(10, 1)
+        self.assertEqual((round(interval, 3), round(tolerance, 3)),
+            (0.125, 0.125))
+
+    @patch("time.sleep")
+    @patch("time.time")
+    def test_rate_limit_sliding_window(self, t_t, t_s):
+        """
+        Test that the requests sent as fast as allowed by the default
+        settings stay under the limit in any window of the period
+        """
+        target.app.config["TRELLO_TOKEN_RATE_LIMIT"] = 100
+        target.app.config["TRELLO_RATE_LIMIT_PERIOD"] = 10
+        target.app.config["TRELLO_RATE_LIMIT_BURST"] = 10
+        target.app.config["TRELLO_RATE_LIMIT_MARGIN"] = 0.1
+        now = [1000.0]
+        t_t.side_effect = lambda: now[0]
+        sent = []
+        for i in range(500):
+            now[0] += target.get_rate_limit_wait("ghi", "jkl")
+            sent.append(now[0])
+        for (i, start) in enumerate(sent):
+            in_window = len([t for t in sent[i:] if t < start + 10])
+            self.assertLessEqual(in_window, 100)
+        # The steady pace is 90% of the limit
+        self.assertAlmostEqual((len(sent) - 10) / (sent[-1] - sent[0]), 9, 1)
+
+    @patch("time.sleep")
+    def test_wait_for_rate_limit_disabled(self, t_s):
+        """
+        Test that no pacing happens when no limits are configured
+        """
+        target.app.config["TRELLO_TOKEN_RATE_LIMIT"] = 0
+        for i in range(20):
+            self.assertEqual(target.wait_for_rate_limit("ghi", "jkl"), 0)
+        self.assertEqual(t_s.mock_calls, [])
+        self.assertEqual(target.get_rate_limit_stats()["requests"], 0)
+
+    @patch("time.sleep")
+    def test_wait_for_rate_limit_redis(self, t_s):
+        """
+        Test pacing the requests through the Redis shared by all workers
+        """
+        target.redis_unavailable_until = 0
+        target.app.redis = MagicMock()
+        script = target.app.redis.register_script.return_value
+        script.return_value = b"0.25"
+        wait = target.wait_for_rate_limit("ghi", "jkl")
+        self.assertEqual(wait, 0.25)
+        t_s.assert_called_once_with(0.25)
+        target.app.redis.register_script.assert_called_once_with(
+            target.RATE_LIMIT_SCRIPT)
+        keys = script.call_args[1]["keys"]
+        self.assertEqual(keys, [
+            "trello-rate-limit:block:key:%s" % target.fingerprint("ghi"),
+            "trello-rate-limit:block:token:%s" % target.fingerprint("jkl"),
+            "trello-rate-limit:token:%s" % target.fingerprint("jkl")])
+        self.assertEqual(script.call_args[1]["args"][1:], [2, 0.1, 0.0])
+        self.assertNotIn("jkl", "".join(keys))
+
+    @patch("time.sleep")
+    def test_wait_for_rate_limit_redis_error(self, t_s):
+        """
+        Test falling back to local pacing when Redis isn't reachable
+        """
+        target.redis_unavailable_until = 0
+        target.app.redis = MagicMock()
+        target.app.redis.register_script.side_effect = RedisError()
+        self.assertEqual(target.wait_for_rate_limit("ghi", "jkl"), 0)
+        self.assertIsNone(target.get_redis())
+        target.wait_for_rate_limit("ghi", "jkl")
+        self.assertEqual(len(target.app.redis.register_script.mock_calls), 1)
+
+    @patch("time.sleep")
+    @patch("requests.Session.request")
+    def test_perform_request_retry_after(self, r_r, t_s):
+        """
+        Test that a 429 response blocks the token for the Retry-After delay
+        """
+        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
+        target.config = {"token": "jkl"}
+        target.app.config["TRELLO_TOKEN_RATE_LIMIT"] = 0
+        mock_exception_response = MagicMock()
+        mock_exception_response.status_code = 429
+        mock_exception_response.headers = {"Retry-After": "5"}
+        mock_exception_response.content = b"API_TOKEN_LIMIT_EXCEEDED"
+        mock_request = MagicMock()
+        mock_request.content = b"API_TOKEN_LIMIT_EXCEEDED"
+        mock_request.raise_for_status.side_effect = HTTPError("",
+            response=mock_exception_response)
+        r_r.return_value = mock_request
+        with self.assertRaises(HTTPError), self.assertLogs(level='WARNING') as cm:
+            target.perform_request("GET", "cards/a1b2c3d4")
+        self.assertEqual(cm.output[0],
+            "WARNING:root:Trello rate limit exceeded, retrying after 5.0s")
+        target.app.config["TRELLO_TOKEN_RATE_LIMIT"] = 10
+        wait = target.wait_for_rate_limit("ghi", "jkl")
+        self.assertTrue(4.9 < wait <= 5)
+        # The API key itself isn't blocked
+        self.assertEqual(target.wait_for_rate_limit("ghi", "mno"), 0)
+        target.args = None
+
+class TestProcessMasterCards(FlaskTestCase):
+    def test_process_master_cards_ordered(self):
+        """
+        Test that the outputs come in order even if later cards finish first
+        """
+        master_cards = [{"id": i} for i in range(6)]
+        def process(master_card, args_from_app):
+            time.sleep(0.01 * (6 - master_card["id"]))
+            return (1, master_card["id"], 0)
+        outputs = list(target.process_master_cards(master_cards, None, process))
+        self.assertEqual(outputs, [(1, i, 0) for i in range(6)])
+
+    def test_process_master_cards_bounded(self):
+        """
+        Test that no more than TRELLO_CONCURRENCY cards are processed at once
+        """
+        target.app.config["TRELLO_CONCURRENCY"] = 3
+        lock = threading.Lock()
+        running = {"current": 0, "max": 0}
+        def process(master_card, args_from_app):
+            with lock:
+                running["current"] += 1
+                running["max"] = max(running["max"], running["current"])
+            time.sleep(0.01)
+            with lock:
+                running["current"] -= 1
+            return (0, 0, 0)
+        outputs = list(target.process_master_cards([{}] * 12, None, process))
+        self.assertEqual(len(outputs), 12)
+        self.assertEqual(running["max"], 3)
+
+    def test_process_master_cards_sequential(self):
+        """
+        Test processing the cards in the calling thread without concurrency
+        """
+        target.app.config["TRELLO_CONCURRENCY"] = 1
+        threads = set()
+        def process(master_card, args_from_app):
+            threads.add(threading.current_thread())
+            return (1, 1, 1)
+        outputs = list(target.process_master_cards([{}, {}], {"a": "b"},
+            process))
+        self.assertEqual(outputs, [(1, 1, 1), (1, 1, 1)])
+        self.assertEqual(threads, {threading.current_thread()})
+
+    def test_process_master_cards_app_context(self):
+        """
+        Test that the cards are processed within the app context
+        """
+        def process(master_card, args_from_app):
+            return target.get_setting("TRELLO_API_KEY")
+        outputs = list(target.process_master_cards([{}, {}], None, process))
+        self.assertEqual(outputs, ["ghi", "ghi"])
+
+    def test_process_master_cards_error(self):
+        """
+        Test that an error is raised in order and the pending cards are skipped
+        """
+        target.app.config["TRELLO_CONCURRENCY"] = 2
+        processed = []
+        def process(master_card, args_from_app):
+            if master_card["id"] == 1:
+                raise ValueError("Failed")
+            time.sleep(0.01)
+            processed.append(master_card["id"])
+            return (1, 0, 0)
+        outputs = target.process_master_cards([{"id": i} for i in range(20)],
+            None, process)
+        self.assertEqual(next(outputs), (1, 0, 0))
+        with self.assertRaises(ValueError):
+            next(outputs)
+        self.assertLess(len(processed), 20)
+
+    @patch("syncboom.process_master_card")
+    def test_process_master_cards_default(self, t_pmc):
+        """
+        Test that process_master_card is used by default
+        """
+        t_pmc.return_value = (1, 2, 3)
+        outputs = list(target.process_master_cards([{}], {"a": "b"}))
+        self.assertEqual(outputs, [(1, 2, 3)])
+        self.assertEqual(t_pmc.mock_calls, [call({}, {"a": "b"})])
+
+
+class TestPlanMasterCard(FlaskTestCase):
+    master_card = {"id": "t"*24, "desc": "abc", "name": "Card name",
+        "labels": [{"name": "Label One"}], "attachments": [],
+        "checklists": [], "badges": {"attachments": 0},
+        "shortUrl": "https://trello.com/c/eoK0Rngb",
+        "url": "https://trello.com/c/eoK0Rngb/blablabla"}
+
+    def setUp(self):
+        super().setUp()
+        target.config = {"key": "ghi", "token": "jkl", "friendly_names": {},
+            "destination_lists": {
+                "Label One": ["a1"*12],
+                "All Teams": ["a1"*12, "d4"*12]
+            }}
+
+    @patch("syncboom.get_checklist_item_name")
+    @patch("syncboom.get_master_card_metadata_lines")
+    @patch("syncboom.get_board_id_from_list")
+    @patch("syncboom.perform_request")
+    def test_plan_master_card_new(self, t_pr, t_gbifl, t_gmcml, t_gcin):
+        """
+        Test planning a new master card without writing to Trello
+        """
+        t_gbifl.return_value = "k"*24
+        t_gmcml.return_value = ["\n- 'Card name' on list '**Board|List**'"]
+        t_gcin.return_value = "Board"
+        plan = target.plan_master_card(self.master_card)
+        self.assertEqual(t_pr.mock_calls, [])
+        self.assertEqual(plan["output"], (1, 1, 1))
+        self.assertEqual(plan["mapping_id"], None)
+        self.assertEqual([o["type"] for o in plan["operations"]],
+            ["create_slave_card", "link_slave_card", "update_desc",
+            "create_checklist", "add_checklist_item"])
+        self.assertEqual(t_gmcml.mock_calls, [call([{"name": "Card name",
+            "idList": "a1"*12, "idBoard": "k"*24}], {})])
+        (create, link, update, checklist, item) = plan["operations"]
+        self.assertEqual(create["query"]["idList"], "a1"*12)
+        self.assertEqual(create["query"]["idCardSource"], "t"*24)
+        self.assertIs(link["slave_card"], create)
+        self.assertEqual(update["desc"], "abc%s\n- 'Card name' on list "
+            "'**Board|List**'" % target.METADATA_SEPARATOR)
+        # The new slave card is only listed in the description once created
+        self.assertEqual(update["current_desc"], "abc")
+        self.assertEqual(update["metadata"], [("\n- 'Card name' on list "
+            "'**Board|List**'", create)])
+        self.assertIs(item["checklist"], checklist)
+        self.assertEqual(item["name"], "Board")
+        self.assertEqual(item["pos"], 1)
+
+    @patch("syncboom.get_master_card_metadata_lines")
+    @patch("syncboom.get_linked_slave_cards")
+    def test_plan_master_card_up_to_date(self, t_glsc, t_gmcml):
+        """
+        Test that a master card already in sync needs no operations
+        """
+        t_glsc.return_value = [{"id": "b"*24, "name": "Card name",
+            "idList": "a1"*12, "idBoard": "k"*24}]
+        t_gmcml.return_value = ["\n- 'Card name' on list '**Board|List**'"]
+        master_card = dict(self.master_card, desc="abc%s%s" %
+            (target.METADATA_SEPARATOR, t_gmcml.return_value[0]),
+            checklists=[{"id": "c"*24, "name": "Involved Teams"}])
+        plan = target.plan_master_card(master_card)
+        self.assertEqual(plan["operations"], [])
+        self.assertEqual(plan["output"], (1, 1, 0))
+
+    @patch("syncboom.get_linked_slave_cards")
+    def test_plan_master_card_unlinked(self, t_glsc):
+        """
+        Test that the metadata of a master card without labels is removed
+        """
+        master_card = dict(self.master_card, labels=[], desc="abc%s- 'a'" %
+            target.METADATA_SEPARATOR)
+        plan = target.plan_master_card(master_card)
+        self.assertEqual(t_glsc.mock_calls, [])
+        self.assertEqual(plan["operations"], [{"type": "update_desc",
+            "card": "t"*24, "desc": "abc"}])
+        self.assertEqual(plan["output"], (0, 0, 0))
+
+
+class TestApplyPlans(FlaskTestCase):
+    METADATA = "\n- 'Card' on list '**Board|List**'"
+
+    def get_plan(self, master_card_id, mapping_id=None):
+        create = {"type": "create_slave_card", "master_card": master_card_id,
+            "query": {"idList": "a1"*12}}
+        checklist = {"type": "create_checklist", "card": master_card_id,
+            "name": "Involved Teams"}
+        return {"master_card": master_card_id, "mapping_id": mapping_id,
+            "output": (1, 1, 1),
+            "operations": [create,
+                {"type": "link_slave_card", "master_card": master_card_id,
+                    "slave_card": create, "url": "https://trello.com/c/m"},
+                {"type": "update_desc", "card": master_card_id,
+                    "desc": "abc%s%s" % (target.METADATA_SEPARATOR,
+                    self.METADATA), "current_desc": "abc",
+                    "metadata": [(self.METADATA, create)]},
+                checklist,
+                {"type": "add_checklist_item", "checklist": checklist,
+                    "name": "Board", "pos": 1}]}
+
+    @patch("syncboom.perform_requests")
+    def test_apply_plans(self, t_prs):
+        """
+        Test applying the plans of two cards stage by stage, the checklists
+        only once the slave cards copying the master cards are created
+        """
+        t_prs.side_effect = [
+            [{"id": "b1"*12, "url": "https://trello.com/c/s1"},
+                {"id": "b2"*12, "url": "https://trello.com/c/s2"}],
+            [{}, {}, {}, {"id": "c1"}, {}, {}, {}, {"id": "c2"}], [{}] * 2]
+        plans = [self.get_plan("m1"), self.get_plan("m2")]
+        self.assertEqual(target.apply_plans(plans, {"key": "ghi",
+            "token": "jkl", "destination_lists": {}}), 12)
+        pr_args = {"key": "ghi", "token": "jkl"}
+        desc = "abc%s%s" % (target.METADATA_SEPARATOR, self.METADATA)
+        self.assertEqual(t_prs.mock_calls, [
+            call([("POST", "cards", {"idList": "a1"*12}),
+                ("POST", "cards", {"idList": "a1"*12})],
+                pr_args, return_exceptions=True),
+            call([("POST", "cards/%s/attachments" % ("b1"*12),
+                    {"url": "https://trello.com/c/m"}),
+                ("POST", "cards/m1/attachments",
+                    {"url": "https://trello.com/c/s1"}),
+                ("PUT", "cards/m1", {"desc": desc}),
+                ("POST", "cards/m1/checklists", {"name": "Involved Teams"}),
+                ("POST", "cards/%s/attachments" % ("b2"*12),
+                    {"url": "https://trello.com/c/m"}),
+                ("POST", "cards/m2/attachments",
+                    {"url": "https://trello.com/c/s2"}),
+                ("PUT", "cards/m2", {"desc": desc}),
+                ("POST", "cards/m2/checklists", {"name": "Involved Teams"})],
+                pr_args, return_exceptions=True),
+            call([("POST", "checklists/c1/checkItems", {"name": "Board",
+                    "pos": 1}),
+                ("POST", "checklists/c2/checkItems", {"name": "Board",
+                    "pos": 1})],
+                pr_args, return_exceptions=True)])
+
+    @patch("syncboom.perform_requests")
+    def test_apply_plans_coalesced(self, t_prs):
+        """
+        Test that the description updates of the same card are coalesced
+        """
+        t_prs.return_value = [{}]
+        plans = [{"master_card": "m1", "mapping_id": None, "operations": [
+            {"type": "update_desc", "card": "m1", "desc": "first"}]},
+            {"master_card": "m1", "mapping_id": None, "operations": [
+            {"type": "update_desc", "card": "m1", "desc": "last"}]}]
+        self.assertEqual(target.apply_plans(plans), 1)
+        self.assertEqual(t_prs.mock_calls[1],
+            call([("PUT", "cards/m1", {"desc": "last"})], {},
+            return_exceptions=True))
+
+    @patch("syncboom.perform_requests")
+    def test_apply_plans_failed_dependency(self, t_prs):
+        """
+        Test that nothing is written for the operations of a failed one
+        """
+        t_prs.side_effect = [[{}], [{}], []]
+        self.assertEqual(target.apply_plans([self.get_plan("m1")]), 2)
+        self.assertEqual(t_prs.mock_calls[1], call([("POST",
+            "cards/m1/checklists", {"name": "Involved Teams"})], {},
+            return_exceptions=True))
+        self.assertEqual(t_prs.mock_calls[2], call([], {},
+            return_exceptions=True))
+
+    @patch("syncboom.perform_requests")
+    def test_apply_plans_failed_operation(self, t_prs):
+        """
+        Test that a failed operation only skips the operations depending on
+        it, the other plans being applied and its error raised at the end.
+        The slave card that failed to be created isn't listed in the
+        description of its master card.
+        """
+        error = target.TrelloConnectionError()
+        t_prs.side_effect = [
+            [error, {"id": "b2"*12, "idList": "a1"*12,
+                "url": "https://trello.com/c/s2"}],
+            [{"id": "c1"}, {}, {}, {}, {"id": "c2"}], [{}] * 2]
+        with self.assertRaises(target.TrelloConnectionError):
+            target.apply_plans([self.get_plan("m1", 3),
+                self.get_plan("m2", 3)])
+        self.assertEqual([len(c[1][0]) for c in t_prs.mock_calls],
+            [2, 5, 2])
+        self.assertEqual(t_prs.mock_calls[1][1][0][0], ("POST",
+            "cards/m1/checklists", {"name": "Involved Teams"}))
+        self.assertEqual([c[1] for c in t_prs.mock_calls[1][1][0]
+            if c[0] == "PUT"], ["cards/m2"])
+        card_links = CardLink.query.all()
+        self.assertEqual([(l.master_card, l.slave_card) for l in card_links],
+            [("m2", "b2"*12)])
+
+    def test_get_operation_calls_update_desc(self):
+        """
+        Test that the description lists the existing slave cards and the
+        created ones, but not those that failed to be created
+        """
+        created = {"type": "create_slave_card", "result": {"id": "b1"*12}}
+        failed = {"type": "create_slave_card"}
+        update = {"type": "update_desc", "card": "m1", "desc": "planned",
+            "current_desc": "abc", "metadata": [("\n- 'a'", None),
+            ("\n- 'b'", created), ("\n- 'c'", failed)]}
+        self.assertEqual(target.get_operation_calls(update), [("PUT",
+            "cards/m1", {"desc": "abc%s\n- 'a'\n- 'b'" %
+            target.METADATA_SEPARATOR})])
+        created["result"] = None
+        update["current_desc"] = "abc%s\n- 'a'" % target.METADATA_SEPARATOR
+        self.assertEqual(target.get_operation_calls(update), [])
+
+    @patch("syncboom.perform_requests")
+    def test_apply_plans_card_links(self, t_prs):
+        """
+        Test that the new slave cards of a mapping are indexed
+        """
+        t_prs.side_effect = [
+            [{"id": "b1"*12, "idList": "a1"*12, "url": "https://trello.com/c/s1"}],
+            [{}, {}, {}, {"id": "c1"}], [{}]]
+        target.apply_plans([self.get_plan("m1", 3)])
+        card_links = CardLink.query.all()
+        self.assertEqual(len(card_links), 1)
+        self.assertEqual((card_links[0].mapping_id, card_links[0].master_card,
+            card_links[0].slave_card, card_links[0].slave_list),
+            (3, "m1", "b1"*12, "a1"*12))
+
+
+class TestSyncMasterCards(FlaskTestCase):
+    @patch("syncboom.apply_plans")
+    @patch("syncboom.plan_master_card")
+    def test_sync_master_cards(self, t_pmc, t_ap):
+        """
+        Test planning several master cards, then applying their plans
+        """
+        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
+        plans = [{"operations": [{"type": "update_desc"}], "output": (1, 2, 0)},
+            {"operations": [{"type": "create_slave_card"},
+            {"type": "link_slave_card"}], "output": (1, 1, 1)}]
+        t_pmc.side_effect = plans
+        t_ap.return_value = 4
+        with self.assertLogs(level="INFO") as cm:
+            outputs = target.sync_master_cards([{"id": 1}, {"id": 2}])
+        self.assertEqual(outputs, [(1, 2, 0), (1, 1, 1)])
+        self.assertEqual(t_ap.mock_calls, [call(plans, None)])
+        self.assertEqual(cm.output, ["INFO:root:Planned 3 operations: "
+            "1 create_slave_card, 1 link_slave_card, 1 update_desc",
+            "INFO:root:Applied the planned operations with 4 writes"])
+        target.args = None
+
+    @patch("syncboom.apply_plans")
+    @patch("syncboom.plan_master_card")
+    def test_sync_master_cards_dry_run(self, t_pmc, t_ap):
+        """
+        Test that a dry run only plans the master cards
+        """
+        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": True})()
+        t_pmc.return_value = {"operations": [{"type": "update_desc"}],
+            "output": (1, 2, 0)}
+        with self.assertLogs(level="DEBUG") as cm:
+            outputs = target.sync_master_cards([{"id": 1}])
+        self.assertEqual(outputs, [(1, 2, 0)])
+        self.assertEqual(t_ap.mock_calls, [])
+        self.assertTrue("DEBUG:root:Skipping the planned operations due to "
+            "--dry-run parameter" in cm.output)
+        target.args = None
+
 
 class TestCreateNewSlaveCard(FlaskTestCase):
     @patch("syncboom.perform_request")
@@ -909,8 +2502,15 @@ class TestGlobals(FlaskTestCase):
 
 class TestIsProductionEnvironment(FlaskTestCase):
     def test_is_production_environment(self):
-        self.assertEqual(target.is_production_environment(),
-            os.environ.get('ON_HEROKU') == True)
+        with patch.dict(os.environ, {"ON_HEROKU": "True"}):
+            self.assertTrue(target.is_production_environment())
+        with patch.dict(os.environ, {"ON_HEROKU": "1"}):
+            self.assertTrue(target.is_production_environment())
+        with patch.dict(os.environ, {"ON_HEROKU": "False"}):
+            self.assertFalse(target.is_production_environment())
+        with patch.dict(os.environ):
+            os.environ.pop("ON_HEROKU", None)
+            self.assertFalse(target.is_production_environment())
 
 
 class TestNewWebhook(FlaskTestCase):
@@ -971,6 +2571,19 @@ class TestNewWebhook(FlaskTestCase):
         ]
         self.assertEqual(t_pr.mock_calls, expected)
 
+    @patch("syncboom.perform_request")
+    def test_new_webhook_on_heroku(self, t_pr):
+        """
+        Test creating a new webhook on Heroku, calling back the website
+        """
+        t_pr.return_value = {}
+        with patch.dict(os.environ, {"ON_HEROKU": "True"}):
+            target.new_webhook("cde")
+        expected = [
+            call('POST', 'webhooks', {'callbackURL': 'https://syncboom.com/webhooks/1/?c=config', 'idModel': 'cde'}, key=None, token=None)
+        ]
+        self.assertEqual(t_pr.mock_calls, expected)
+
 
 class TestListWebhooks(FlaskTestCase):
     @patch("syncboom.perform_request")
@@ -1422,7 +3035,7 @@ Exiting...
             target.init()
         self.assertEqual(cm1.exception.code, 35)
 
-    @patch("syncboom.process_master_card")
+    @patch("syncboom.plan_master_card")
     @patch("syncboom.perform_request")
     def test_init_propagate_empty(self, t_pr, t_pmc):
         """
@@ -1431,11 +3044,12 @@ Exiting...
         target.__name__ = "__main__"
         target.sys.argv = ["scriptname.py", "--propagate", "--config", "data/sample_config.json"]
         t_pr.side_effect = [[{"id": "a"*24, "name": "Master card name", "labels": {}, "badges": {"attachments": 0}, "desc": "Desc"}]]
-        t_pmc.return_value = (20, 30, 40)
+        t_pmc.return_value = {"master_card": "a"*24, "mapping_id": None,
+            "operations": [], "output": (20, 30, 40)}
         with self.assertLogs(level='DEBUG') as cm:
             target.init()
         self.assertEqual(len(t_pmc.mock_calls), 1)
-        self.assertEqual(t_pmc.mock_calls[0], call({'id': 'aaaaaaaaaaaaaaaaaaaaaaaa', 'name': 'Master card name', 'labels': {}, 'badges': {'attachments': 0}, 'desc': 'Desc'}))
+        self.assertEqual(t_pmc.mock_calls[0], call({'id': 'aaaaaaaaaaaaaaaaaaaaaaaa', 'name': 'Master card name', 'labels': {}, 'badges': {'attachments': 0}, 'desc': 'Desc'}, None))
         self.assertTrue("INFO:root:Summary: processed 1 master cards (of which 20 active) that have 30 slave cards (of which 40 new)." in cm.output)
 
     @patch("syncboom.perform_request")
@@ -1450,7 +3064,7 @@ Exiting...
         self.assertEqual(cm1.exception.code, 32)
         self.assertTrue("CRITICAL:root:List b2b2b2b2b2b2b2b2b2b2b2b2 is not on the master board ghi. Exiting..." in cm2.output)
 
-    @patch("syncboom.process_master_card")
+    @patch("syncboom.plan_master_card")
     @patch("syncboom.perform_request")
     def test_init_propagate_list(self, t_pr, t_pmc):
         """
@@ -1462,12 +3076,13 @@ Exiting...
             [{"id": "c3"*12}],
             [{"id": "a"*24, "name": "Master card name", "labels": {}, "badges": {"attachments": 0}, "desc": "Desc"}]
         ]
-        t_pmc.return_value = (30, 40, 50)
+        t_pmc.return_value = {"master_card": "a"*24, "mapping_id": None,
+            "operations": [], "output": (30, 40, 50)}
         f = io.StringIO()
         with self.assertLogs(level='DEBUG') as cm:
             target.init()
         self.assertEqual(len(t_pmc.mock_calls), 1)
-        self.assertEqual(t_pmc.mock_calls[0], call({'id': 'aaaaaaaaaaaaaaaaaaaaaaaa', 'name': 'Master card name', 'labels': {}, 'badges': {'attachments': 0}, 'desc': 'Desc'}))
+        self.assertEqual(t_pmc.mock_calls[0], call({'id': 'aaaaaaaaaaaaaaaaaaaaaaaa', 'name': 'Master card name', 'labels': {}, 'badges': {'attachments': 0}, 'desc': 'Desc'}, None))
         self.assertTrue("INFO:root:Summary: processed 1 master cards (of which 30 active) that have 40 slave cards (of which 50 new)." in cm.output)
 
     @patch("syncboom.perform_request")
@@ -1555,6 +3170,60 @@ Exiting...
         self.assertEqual(t_dw.mock_calls, [call("ghi")])
 
 
+class TestCliStartup(FlaskTestCase):
+    # Seconds the script may take to import, and the margin allowed for the
+    # load of the host running the tests
+    IMPORT_TIME_BUDGET = 0.5
+    IMPORT_TIME_MARGIN = 4
+    WEB_ONLY_MODULES = ("app", "sqlalchemy", "flask_sqlalchemy",
+        "flask_migrate", "flask_login", "flask_mail", "flask_bootstrap",
+        "flask_moment", "flask_babel", "secure", "flask_paranoid", "redis",
+        "rq", "slugify")
+
+    def test_create_cli_app(self):
+        """
+        Test creating the lightweight app of the script, with the settings
+        and the cache of the website
+        """
+        with patch.dict(os.environ, {"REDIS_URL": ""}):
+            cli_app = target.create_cli_app(TestConfig)
+        self.assertEqual(cli_app.config["TRELLO_API_KEY"], "ghi")
+        self.assertFalse(hasattr(cli_app, "redis"))
+        self.assertEqual(cli_app.blueprints, {})
+        with cli_app.app_context(), \
+                patch("syncboom.perform_request") as t_pr:
+            t_pr.return_value = {"name": "Board name"}
+            self.assertEqual(target.get_name("board", "b"*24), "Board name")
+            self.assertEqual(target.get_name("board", "b"*24), "Board name")
+            self.assertEqual(len(t_pr.mock_calls), 1)
+        # Redis is only used when it is set up
+        with patch.dict(os.environ, {"REDIS_URL": "redis://localhost:1"}):
+            cli_app = target.create_cli_app(TestConfig)
+        self.assertTrue(hasattr(cli_app, "redis"))
+
+    def test_cli_import_time(self):
+        """
+        Test that importing the script does not import the website's
+        dependencies, and stays within the startup budget
+        """
+        code = ("import sys, time; started = time.perf_counter(); "
+            "import syncboom; print(time.perf_counter() - started); "
+            "print(' '.join(sorted(set(m.split('.')[0] for m in sys.modules))))")
+        result = subprocess.run([sys.executable, "-c", code],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        (import_time, loaded_modules) = result.stdout.splitlines()
+        loaded_modules = loaded_modules.split()
+        self.assertIn("syncboom", loaded_modules)
+        web_only_modules = [m for m in self.WEB_ONLY_MODULES
+            if m in loaded_modules]
+        self.assertEqual(web_only_modules, [])
+        # The margin keeps the test stable on busy hosts
+        self.assertLess(float(import_time),
+            self.IMPORT_TIME_BUDGET * self.IMPORT_TIME_MARGIN)
+
+
 class TestLicense(FlaskTestCase):
     def test_license_file(self):
         """Validate that the project has a LICENSE file, check part of its content"""
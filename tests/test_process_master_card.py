@@ -12,31 +12,31 @@ import unittest
 import sys
 from unittest.mock import patch
 import inspect
+from config import Config
 
 sys.path.append('.')
 target = __import__("syncboom")
 
 
+class ProcessConfig(Config):
+    TESTING = True
+    CACHE_TYPE = 'simple'
+
+
+# Answer the requests of the async client with the patched perform_request
+async def forward_async_perform_request(session, *args, **kwargs):
+    return target.perform_request(*args, **kwargs)
+
+
+@patch("syncboom.async_perform_request", forward_async_perform_request)
 class TestProcessMasterCard(unittest.TestCase):
-    def test_process_master_card_0(self):
-        """
-        Test processing a new master card without labels or attachments
-        """
-        target.config = {"key": "ghi", "token": "jkl", "destination_lists": []}
-        master_card = {"id": "1a2b3c", "desc": "abc", "name": "Card name",
-            "labels": [], "badges": {"attachments": 0}}
-        with self.assertLogs(level='DEBUG') as cm:
-            output = target.process_master_card(master_card)
-        self.assertEqual(output, (0, 0, 0))
-        self.assertEqual(cm.output, ['DEBUG:root:================================================================',
-            "DEBUG:root:Process master card 'Card name'",
-            'DEBUG:root:Master card is to be synced on 0 destination lists',
-            'INFO:root:This master card has no slave cards'])
+    master_card = {"id": "t"*24, "desc": "abc", "name": "Card name",
+        "labels": [{"name": "Label One"}], "badges": {"attachments": 0},
+        "shortUrl": "https://trello.com/c/eoK0Rngb",
+        "url": "https://trello.com/c/eoK0Rngb/blablabla"}
 
-    def test_process_master_card_unknown_label(self):
-        """
-        Test processing a new master card with one label that is not in the config
-        """
+    def setUp(self):
+        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
         target.config = {"key": "ghi", "token": "jkl",
             "destination_lists": {
                 "Label One": ["a1a1a1a1a1a1a1a1a1a1a1a1"],
@@ -45,122 +45,116 @@ class TestProcessMasterCard(unittest.TestCase):
                   "a1a1a1a1a1a1a1a1a1a1a1a1",
                   "ddd"
                 ]
-            }}
-        master_card = {"id": "1a2b3c", "desc": "abc", "name": "Card name",
-            "labels": [{"name": "Unknown label"}], "badges": {"attachments": 0}}
+            },
+            "friendly_names": {}}
+        target.app = target.create_cli_app(ProcessConfig)
+        self.app_context = target.app.app_context()
+        self.app_context.push()
+        target.cache.clear()
+
+    def tearDown(self):
+        self.app_context.pop()
+        target.args = None
+        target.app = None
+
+    def get_responses(self, checklists=[]):
+        return {"GET lists/a1a1a1a1a1a1a1a1a1a1a1a1": {"idBoard": "k"*24},
+            "GET lists/ddd": {"idBoard": "k"*24},
+            "GET batch": [{"200": {"name": "Board name"}},
+                {"200": {"name": "List name"}}],
+            "GET cards/%s/checklists" % ("t"*24): checklists,
+            "POST cards": {"id": "b"*24, "name": "Card name",
+                "idBoard": "k"*24, "idList": "a1a1a1a1a1a1a1a1a1a1a1a1",
+                "url": "https://trello.com/c/abcd1234/blablabla2"},
+            "POST cards/%s/checklists" % ("t"*24): {"id": "w"*24,
+                "name": "Involved Teams"}}
+
+    def fake_trello(self, t_pr, responses):
+        """Answer the requests by method and URL, whatever their order"""
+        t_pr.side_effect = lambda method, url, *args, **kwargs: \
+            responses.get("%s %s" % (method, url), {})
+
+    def get_writes(self, t_pr):
+        return sorted([(c[1][0], c[1][1]) + tuple(c[1][2:3])
+            for c in t_pr.mock_calls if c[1][0] != "GET"], key=str)
+
+    @patch("syncboom.perform_request")
+    def test_process_master_card_0(self, t_pr):
+        """
+        Test processing a new master card without labels or attachments
+        """
+        master_card = dict(self.master_card, labels=[])
         with self.assertLogs(level='DEBUG') as cm:
             output = target.process_master_card(master_card)
         self.assertEqual(output, (0, 0, 0))
-        self.assertEqual(cm.output, ['DEBUG:root:================================================================',
-            "DEBUG:root:Process master card 'Card name'",
+        self.assertEqual(t_pr.mock_calls, [])
+        self.assertEqual(cm.output[:4], ['DEBUG:root:================================================================',
+            "DEBUG:root:Plan master card 'Card name'",
             'DEBUG:root:Master card is to be synced on 0 destination lists',
-            'INFO:root:This master card has no slave cards'])
+            'INFO:root:This master card has 0 slave cards (0 to be created) and needs 0 operations'])
+
+    @patch("syncboom.perform_request")
+    def test_process_master_card_unknown_label(self, t_pr):
+        """
+        Test processing a new master card with one label that is not in the config
+        """
+        master_card = dict(self.master_card, labels=[{"name": "Unknown label"}])
+        with self.assertLogs(level='DEBUG'):
+            output = target.process_master_card(master_card)
+        self.assertEqual(output, (0, 0, 0))
+        self.assertEqual(t_pr.mock_calls, [])
 
     @patch("syncboom.perform_request")
     def test_process_master_card_one_label(self, t_pr):
         """
-        Test processing a new master card with one recognized label
+        Test processing a new master card with one recognized label, as a dry
+        run which only counts the operations
         """
         target.args = type(inspect.stack()[0][3], (object,), {"dry_run": True})()
-        target.config = {"key": "ghi", "token": "jkl",
-            "destination_lists": {
-                "Label One": ["a1a1a1a1a1a1a1a1a1a1a1a1"],
-                "Label Two": ["ddd"],
-                "All Teams": [
-                  "a1a1a1a1a1a1a1a1a1a1a1a1",
-                  "ddd"
-                ]
-            }}
-        master_card = {"id": "t"*24, "desc": "abc", "name": "Card name",
-            "labels": [{"name": "Label One"}], "badges": {"attachments": 0},
-            "shortUrl": "https://trello.com/c/eoK0Rngb",
-            "url": "https://trello.com/c/eoK0Rngb/blablabla"}
-        t_pr.side_effect = [{"id": "b"*24, "name": "Slave card One",
-                "idBoard": "k"*24, "idList": "l"*24,
-                "url": "https://trello.com/c/abcd1234/blablabla2"},
-            {"name": "Board name"},
-            {"name": "List name"},
-            {},
-            {},
-            {}]
+        self.fake_trello(t_pr, self.get_responses())
         with self.assertLogs(level='DEBUG') as cm:
-            output = target.process_master_card(master_card)
+            output = target.process_master_card(self.master_card)
         self.assertEqual(output, (1, 1, 1))
-        expected = ['DEBUG:root:================================================================',
-            "DEBUG:root:Process master card 'Card name'",
-            'DEBUG:root:Master card is to be synced on 1 destination lists',
-            'DEBUG:root:Creating new slave card',
-            'DEBUG:root:New slave card ID: bbbbbbbbbbbbbbbbbbbbbbbb',
-            "DEBUG:root:New master card metadata: \n- 'Slave card One' on list '**Board name|List name**'",
-            'INFO:root:This master card has 1 slave cards (1 newly created)',
-            'DEBUG:root:Updating master card metadata',
-            "DEBUG:root:abc\n\n--------------------------------\n*== DO NOT EDIT BELOW THIS LINE ==*\n\n- 'Slave card One' on list '**Board name|List name**'",
-            'DEBUG:root:Attaching master card tttttttttttttttttttttttt to slave card bbbbbbbbbbbbbbbbbbbbbbbb',
-            'DEBUG:root:Attaching slave card bbbbbbbbbbbbbbbbbbbbbbbb to master card tttttttttttttttttttttttt']
-        self.assertEqual(cm.output, expected)
-        target.args = None
+        self.assertEqual(self.get_writes(t_pr), [])
+        self.assertIn("INFO:root:This master card has 1 slave cards (1 to be "
+            "created) and needs 5 operations", cm.output)
+        self.assertIn("INFO:root:Planned 5 operations: 1 add_checklist_item, "
+            "1 create_checklist, 1 create_slave_card, 1 link_slave_card, "
+            "1 update_desc", cm.output)
 
-    def test_process_master_card_label_multiple(self):
+    @patch("syncboom.perform_request")
+    def test_process_master_card_label_multiple(self, t_pr):
         """
         Test processing a new master card with one label that maps to multiple lists
         """
         target.args = type(inspect.stack()[0][3], (object,), {"dry_run": True})()
-        target.config = {"key": "ghi", "token": "jkl",
-            "destination_lists": {
-                "Label One": ["a1a1a1a1a1a1a1a1a1a1a1a1"],
-                "Label Two": ["ddd"],
-                "All Teams": [
-                  "a1a1a1a1a1a1a1a1a1a1a1a1",
-                  "ddd"
-                ]
-            }}
-        master_card = {"id": "1a2b3c", "desc": "abc", "name": "Card name",
-            "labels": [{"name": "All Teams"}], "badges": {"attachments": 0},
-            "shortUrl": "https://trello.com/c/eoK0Rngb"}
+        responses = self.get_responses()
+        responses["GET batch"].append({"200": {"name": "Other list name"}})
+        self.fake_trello(t_pr, responses)
+        master_card = dict(self.master_card, labels=[{"name": "All Teams"}])
         with self.assertLogs(level='DEBUG') as cm:
             output = target.process_master_card(master_card)
         self.assertEqual(output, (1, 2, 2))
-        expected = ['DEBUG:root:================================================================',
-            "DEBUG:root:Process master card 'Card name'",
-            'DEBUG:root:Master card is to be synced on 2 destination lists',
-            'DEBUG:root:Creating new slave card',
-            "DEBUG:root:Skipping POST call to 'https://api.trello.com/1/cards' due to --dry-run parameter",
-            'DEBUG:root:Creating new slave card',
-            "DEBUG:root:Skipping POST call to 'https://api.trello.com/1/cards' due to --dry-run parameter",
-            'INFO:root:This master card has 2 slave cards (2 newly created)']
-        self.assertEqual(cm.output, expected)
-        target.args = None
+        self.assertEqual(self.get_writes(t_pr), [])
+        self.assertIn("INFO:root:Planned 8 operations: 2 add_checklist_item, "
+            "1 create_checklist, 2 create_slave_card, 2 link_slave_card, "
+            "1 update_desc", cm.output)
 
-    def test_process_master_card_label_multiple_and_duplicate_single(self):
+    @patch("syncboom.perform_request")
+    def test_process_master_card_label_multiple_and_duplicate_single(self, t_pr):
         """
         Test processing a new master card with one label that maps to multiple lists and another single label that was already in the multiple list
         """
         target.args = type(inspect.stack()[0][3], (object,), {"dry_run": True})()
-        target.config = {"key": "ghi", "token": "jkl",
-            "destination_lists": {
-                "Label One": ["a1a1a1a1a1a1a1a1a1a1a1a1"],
-                "Label Two": ["ddd"],
-                "All Teams": [
-                  "a1a1a1a1a1a1a1a1a1a1a1a1",
-                  "ddd"
-                ]
-            }}
-        master_card = {"id": "1a2b3c", "desc": "abc", "name": "Card name",
-            "labels": [{"name": "All Teams"}, {"name": "Label One"}], "badges": {"attachments": 0},
-            "shortUrl": "https://trello.com/c/eoK0Rngb"}
-        with self.assertLogs(level='DEBUG') as cm:
+        responses = self.get_responses()
+        responses["GET batch"].append({"200": {"name": "Other list name"}})
+        self.fake_trello(t_pr, responses)
+        master_card = dict(self.master_card, labels=[{"name": "All Teams"},
+            {"name": "Label One"}])
+        with self.assertLogs(level='DEBUG'):
             output = target.process_master_card(master_card)
         self.assertEqual(output, (1, 2, 2))
-        expected = ['DEBUG:root:================================================================',
-            "DEBUG:root:Process master card 'Card name'",
-            'DEBUG:root:Master card is to be synced on 2 destination lists',
-            'DEBUG:root:Creating new slave card',
-            "DEBUG:root:Skipping POST call to 'https://api.trello.com/1/cards' due to --dry-run parameter",
-            'DEBUG:root:Creating new slave card',
-            "DEBUG:root:Skipping POST call to 'https://api.trello.com/1/cards' due to --dry-run parameter",
-            'INFO:root:This master card has 2 slave cards (2 newly created)']
-        self.assertEqual(cm.output, expected)
-        target.args = None
+        self.assertEqual(self.get_writes(t_pr), [])
 
     @patch("syncboom.perform_request")
     def test_process_master_card_dummy_attachment(self, t_pr):
@@ -168,217 +162,94 @@ class TestProcessMasterCard(unittest.TestCase):
         Test processing a new master card with one non-Trello attachment
         """
         target.args = type(inspect.stack()[0][3], (object,), {"dry_run": True})()
-        target.config = {"key": "ghi", "token": "jkl",
-            "destination_lists": {
-                "Label One": ["a1a1a1a1a1a1a1a1a1a1a1a1"],
-                "Label Two": ["ddd"],
-                "All Teams": [
-                  "a1a1a1a1a1a1a1a1a1a1a1a1",
-                  "ddd"
-                ]
-            }}
-        master_card = {"id": "t"*24, "desc": "abc", "name": "Card name",
-            "labels": [{"name": "Label One"}], "badges": {"attachments": 1},
-            "shortUrl": "https://trello.com/c/eoK0Rngb",
-            "url": "https://trello.com/c/eoK0Rngb/blablabla"}
-        t_pr.side_effect = [[{"id": "rrr", "url": "https://monip.org"}],
-            {"id": "b"*24, "name": "Slave card One",
-                "idBoard": "k"*24, "idList": "l"*24,
-                "url": "https://trello.com/c/abcd1234/blablabla2"},
-            {"name": "Board name"},
-            {"name": "List name"},
-            {},
-            {},
-            {}]
+        responses = self.get_responses()
+        responses["GET cards/%s/attachments" % ("t"*24)] = [{"id": "rrr",
+            "url": "https://monip.org"}]
+        self.fake_trello(t_pr, responses)
+        master_card = dict(self.master_card, badges={"attachments": 1})
         with self.assertLogs(level='DEBUG') as cm:
             output = target.process_master_card(master_card)
         self.assertEqual(output, (1, 1, 1))
-        expected = ['DEBUG:root:================================================================',
-            "DEBUG:root:Process master card 'Card name'",
-            'DEBUG:root:Master card is to be synced on 1 destination lists',
-            'DEBUG:root:Getting 1 attachments on master card tttttttttttttttttttttttt',
-            'DEBUG:root:Creating new slave card',
-            'DEBUG:root:New slave card ID: bbbbbbbbbbbbbbbbbbbbbbbb',
-            "DEBUG:root:New master card metadata: \n- 'Slave card One' on list '**Board name|List name**'",
-            'INFO:root:This master card has 1 slave cards (1 newly created)',
-            'DEBUG:root:Updating master card metadata',
-            "DEBUG:root:abc\n\n--------------------------------\n*== DO NOT EDIT BELOW THIS LINE ==*\n\n- 'Slave card One' on list '**Board name|List name**'",
-            'DEBUG:root:Attaching master card tttttttttttttttttttttttt to slave card bbbbbbbbbbbbbbbbbbbbbbbb',
-            'DEBUG:root:Attaching slave card bbbbbbbbbbbbbbbbbbbbbbbb to master card tttttttttttttttttttttttt']
-        self.assertEqual(cm.output, expected)
-        target.args = None
+        self.assertIn('DEBUG:root:Getting 1 attachments on master card '
+            'tttttttttttttttttttttttt', cm.output)
 
     @patch("syncboom.perform_request")
     def test_process_master_card_attachment(self, t_pr):
         """
-        Test processing a new master card with one Trello attachment
+        Test processing a master card with one Trello attachment to its
+        slave card on the destination list
         """
-        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": True})()
-        target.config = {"key": "ghi", "token": "jkl",
-            "destination_lists": {
-                "Label One": ["aaa"],
-                "Label Two": ["ddd"],
-                "All Teams": [
-                  "aaa",
-                  "ddd"
-                ]
-            }}
-        master_card = {"id": "t"*24, "desc": "abc", "name": "Card name",
-            "labels": [{"name": "Label One"}], "badges": {"attachments": 1},
-            "shortUrl": "https://trello.com/c/eoK0Rngb",
-            "url": "https://trello.com/c/eoK0Rngb/blablabla"}
-        t_pr.side_effect = [[{"id": "rrr", "url": "https://trello.com/c/abcd1234/blablabla4"}],
-            {"id": "q"*24, "name": "Slave card One",
-                "idBoard": "k"*24, "idList": "aaa"},
-            {"name": "Board name"},
-            {"name": "List name"},
-            {}]
-        with self.assertLogs(level='DEBUG') as cm:
+        responses = self.get_responses([{"name": "Involved Teams"}])
+        responses["GET cards/%s/attachments" % ("t"*24)] = [{"id": "rrr",
+            "url": "https://trello.com/c/abcd1234/blablabla4"}]
+        responses["GET cards/abcd1234"] = {"id": "q"*24,
+            "name": "Slave card One", "idBoard": "k"*24,
+            "idList": "a1a1a1a1a1a1a1a1a1a1a1a1"}
+        self.fake_trello(t_pr, responses)
+        master_card = dict(self.master_card, badges={"attachments": 1})
+        with self.assertLogs(level='DEBUG'):
             output = target.process_master_card(master_card)
         self.assertEqual(output, (1, 1, 0))
-        expected = ['DEBUG:root:================================================================',
-            "DEBUG:root:Process master card 'Card name'",
-            'DEBUG:root:Master card is to be synced on 1 destination lists',
-            'DEBUG:root:Getting 1 attachments on master card tttttttttttttttttttttttt',
-            "DEBUG:root:Slave card qqqqqqqqqqqqqqqqqqqqqqqq already exists on list aaa",
-            "DEBUG:root:{'id': 'qqqqqqqqqqqqqqqqqqqqqqqq', 'name': 'Slave card One', 'idBoard': 'kkkkkkkkkkkkkkkkkkkkkkkk', 'idList': 'aaa'}",
-            "DEBUG:root:New master card metadata: \n- 'Slave card One' on list '**Board name|List name**'",
-            'INFO:root:This master card has 1 slave cards (0 newly created)',
-            'DEBUG:root:Updating master card metadata',
-            "DEBUG:root:abc\n\n--------------------------------\n*== DO NOT EDIT BELOW THIS LINE ==*\n\n- 'Slave card One' on list '**Board name|List name**'"]
-        self.assertEqual(cm.output, expected)
-        target.args = None
+        # Only the metadata of the master card is written
+        self.assertEqual(self.get_writes(t_pr), [("PUT", "cards/%s" % ("t"*24),
+            {"desc": "abc%s\n- 'Slave card One' on list '**Board name|List "
+            "name**'" % target.METADATA_SEPARATOR})])
 
     @patch("syncboom.perform_request")
     def test_process_master_card_attachment_no_label(self, t_pr):
         """
-        Test processing a new master card with one Trello attachment but no label
+        Test processing a master card with one Trello attachment but no
+        label, which is unlinked from its slave cards
         """
-        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": True})()
-        target.config = {"key": "ghi", "token": "jkl",
-            "destination_lists": {
-                "Label One": ["a1a1a1a1a1a1a1a1a1a1a1a1"],
-                "Label Two": ["ddd"],
-                "All Teams": [
-                  "a1a1a1a1a1a1a1a1a1a1a1a1",
-                  "ddd"
-                ]
-            }}
-        master_card = {"id": "t"*24, "desc": "abc", "name": "Card name",
-            "labels": [], "badges": {"attachments": 1},
-            "shortUrl": "https://trello.com/c/eoK0Rngb",
-            "url": "https://trello.com/c/eoK0Rngb/blablabla"}
-        t_pr.side_effect = [[{"id": "rrr", "url": "https://trello.com/c/abcd1234/blablabla4"}],
-            {"id": "q"*24, "name": "Slave card One",
-                "idBoard": "k"*24, "idList": "aaa"},
-            {"name": "Board name"},
-            {"name": "List name"},
-            {}]
-        with self.assertLogs(level='DEBUG') as cm:
+        self.fake_trello(t_pr, self.get_responses())
+        master_card = dict(self.master_card, labels=[],
+            badges={"attachments": 1}, desc="abc%s\n- 'Slave card One' on "
+            "list '**Board name|List name**'" % target.METADATA_SEPARATOR)
+        with self.assertLogs(level='DEBUG'):
             output = target.process_master_card(master_card)
         self.assertEqual(output, (0, 0, 0))
-        expected = ['DEBUG:root:================================================================',
-            "DEBUG:root:Process master card 'Card name'",
-            'DEBUG:root:Master card is to be synced on 0 destination lists',
-            'DEBUG:root:Getting 1 attachments on master card tttttttttttttttttttttttt',
-            "DEBUG:root:Master card has been unlinked from slave cards",
-            "INFO:root:This master card has no slave cards"]
-        self.assertEqual(cm.output, expected)
-        target.args = None
+        # The attachments aren't needed to remove the metadata
+        self.assertEqual([c[1][:2] for c in t_pr.mock_calls],
+            [("PUT", "cards/%s" % ("t"*24))])
+        self.assertEqual(t_pr.mock_calls[0][1][2], {"desc": "abc"})
 
     @patch("syncboom.perform_request")
     def test_process_master_card_one_label_wet_run_no_checklist(self, t_pr):
         """
         Test processing a new master card with one recognized label, no dry_run, without a checklist
         """
-        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
-        target.config = {"key": "ghi", "token": "jkl",
-            "destination_lists": {
-                "Label One": ["a1a1a1a1a1a1a1a1a1a1a1a1"],
-                "Label Two": ["ddd"],
-                "All Teams": [
-                  "a1a1a1a1a1a1a1a1a1a1a1a1",
-                  "ddd"
-                ]
-            },
-            "friendly_names": {
-                "Label Two": "Nicer Label"
-            }}
-        master_card = {"id": "t"*24, "desc": "abc", "name": "Card name",
-            "labels": [{"name": "Label One"}], "badges": {"attachments": 0},
-            "shortUrl": "https://trello.com/c/eoK0Rngb",
-            "url": "https://trello.com/c/eoK0Rngb/blablabla"}
-        t_pr.side_effect = [{"id": "b"*24, "name": "Slave card One",
-                "idBoard": "k"*24, "idList": "l"*24,
-                "url": "https://trello.com/c/abcd1234/blablabla2"},
-            {"name": "Board name"},
-            {"name": "List name"},
-            {},
-            [],
-            {"id": "w"*24, "name": "New checklist"},
-            {"idBoard": "hhh"},
-            {"name": "Destination board name"},
-            {"name": "New checklist item"},
-            {},
-            {}]
+        self.fake_trello(t_pr, self.get_responses())
         with self.assertLogs(level='DEBUG') as cm:
-            output = target.process_master_card(master_card)
+            output = target.process_master_card(self.master_card)
         self.assertEqual(output, (1, 1, 1))
-        expected = "\n".join(["DEBUG:root:Retrieving checklists from card tttttttttttttttttttttttt",
-            "DEBUG:root:Creating new checklist",
-            "DEBUG:root:{'id': 'wwwwwwwwwwwwwwwwwwwwwwww', 'name': 'New checklist'}",
-            "DEBUG:root:Adding new checklistitem 'Destination board name' to checklist wwwwwwwwwwwwwwwwwwwwwwww",
-            "DEBUG:root:{'name': 'New checklist item'}"])
-        self.assertTrue(expected in "\n".join(cm.output))
-        target.args = None
+        self.assertIn("DEBUG:root:Retrieving checklists from card "
+            "tttttttttttttttttttttttt", cm.output)
+        self.assertEqual([w[:2] for w in self.get_writes(t_pr)], [
+            ("POST", "cards"),
+            ("POST", "cards/%s/attachments" % ("b"*24)),
+            ("POST", "cards/%s/attachments" % ("t"*24)),
+            ("POST", "cards/%s/checklists" % ("t"*24)),
+            ("POST", "checklists/%s/checkItems" % ("w"*24)),
+            ("PUT", "cards/%s" % ("t"*24))])
+        self.assertIn(("POST", "checklists/%s/checkItems" % ("w"*24),
+            {"name": "Board name", "pos": 1}), self.get_writes(t_pr))
+        self.assertIn("INFO:root:Applied the planned operations with 6 "
+            "writes", cm.output)
 
     @patch("syncboom.perform_request")
     def test_process_master_card_one_label_wet_run_unrelated_checklist(self, t_pr):
         """
         Test processing a new master card with one recognized label, no dry_run, with one unrelated checklist
         """
-        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
-        target.config = {"key": "ghi", "token": "jkl",
-            "destination_lists": {
-                "Label One": ["aaa"],
-                "Label Two": ["ddd"],
-                "All Teams": [
-                  "aaa",
-                  "ddd"
-                ]
-            },
-            "friendly_names": {
-                "Label Two": "Nicer Label"
-            }}
-        master_card = {"id": "t"*24, "desc": "abc", "name": "Card name",
-            "labels": [{"name": "Label One"}], "badges": {"attachments": 0},
-            "shortUrl": "https://trello.com/c/eoK0Rngb",
-            "url": "https://trello.com/c/eoK0Rngb/blablabla"}
-        t_pr.side_effect = [{"id": "b"*24, "name": "Slave card One",
-                "idBoard": "k"*24, "idList": "l"*24,
-                "url": "https://trello.com/c/abcd1234/blablabla2"},
-            {"name": "Board name"},
-            {"name": "List name"},
-            {},
-            [{"name": "Unrelated checklist"}],
-            {"id": "w"*24, "name": "New checklist"},
-            {"idBoard": "hhh"},
-            {"name": "Destination board name"},
-            {"name": "New checklist item"},
-            {},
-            {}]
-        with self.assertLogs(level='DEBUG') as cm:
-            output = target.process_master_card(master_card)
+        self.fake_trello(t_pr, self.get_responses([{"id": "u"*24,
+            "name": "Unrelated checklist"}]))
+        with self.assertLogs(level='DEBUG'):
+            output = target.process_master_card(self.master_card)
         self.assertEqual(output, (1, 1, 1))
-        expected = "\n".join(["DEBUG:root:Retrieving checklists from card tttttttttttttttttttttttt",
-            "DEBUG:root:Already 1 checklists on this master card: Unrelated checklist",
-            "DEBUG:root:Creating new checklist",
-            "DEBUG:root:{'id': 'wwwwwwwwwwwwwwwwwwwwwwww', 'name': 'New checklist'}",
-            "DEBUG:root:Adding new checklistitem 'Destination board name' to checklist wwwwwwwwwwwwwwwwwwwwwwww",
-            "DEBUG:root:{'name': 'New checklist item'}"])
-        self.assertTrue(expected in "\n".join(cm.output))
-        target.args = None
-
+        self.assertIn(("POST", "cards/%s/checklists" % ("t"*24),
+            {"name": "Involved Teams"}), self.get_writes(t_pr))
+        self.assertIn(("POST", "checklists/%s/checkItems" % ("w"*24),
+            {"name": "Board name", "pos": 1}), self.get_writes(t_pr))
 
     @patch("syncboom.perform_request")
     def test_process_master_card_one_label_wet_run_friendly_name_checklist(self, t_pr):
@@ -386,84 +257,51 @@ class TestProcessMasterCard(unittest.TestCase):
         Test processing a new master card with one recognized label, no dry_run,
         without a checklist and using a friendly name as checklist item instead of the board's name
         """
-        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
-        target.config = {"key": "ghi", "token": "jkl",
-            "destination_lists": {
-                "Label One": ["a1a1a1a1a1a1a1a1a1a1a1a1"],
-                "Label Two": ["ddd"],
-                "All Teams": [
-                  "a1a1a1a1a1a1a1a1a1a1a1a1",
-                  "ddd"
-                ]
-            },
-            "friendly_names": {
-                "Destination board name": "Nicer Label"
-            }}
-        master_card = {"id": "t"*24, "desc": "abc", "name": "Card name",
-            "labels": [{"name": "Label One"}], "badges": {"attachments": 0},
-            "shortUrl": "https://trello.com/c/eoK0Rngb",
-            "url": "https://trello.com/c/eoK0Rngb/blablabla"}
-        t_pr.side_effect = [{"id": "b"*24, "name": "Slave card One",
-                "idBoard": "k"*24, "idList": "l"*24,
-                "url": "https://trello.com/c/abcd1234/blablabla2"},
-            {"name": "Board name"},
-            {"name": "List name"},
-            {},
-            [],
-            {"id": "w"*24, "name": "New checklist"},
-            {"idBoard": "hhh"},
-            {"name": "Destination board name"},
-            {"name": "New checklist item"},
-            {},
-            {}]
-        with self.assertLogs(level='DEBUG') as cm:
-            output = target.process_master_card(master_card)
+        target.config["friendly_names"] = {"Board name": "Nicer Label"}
+        self.fake_trello(t_pr, self.get_responses())
+        with self.assertLogs(level='DEBUG'):
+            output = target.process_master_card(self.master_card)
         self.assertEqual(output, (1, 1, 1))
-        expected = "\n".join(["DEBUG:root:Retrieving checklists from card tttttttttttttttttttttttt",
-            "DEBUG:root:Creating new checklist",
-            "DEBUG:root:{'id': 'wwwwwwwwwwwwwwwwwwwwwwww', 'name': 'New checklist'}",
-            "DEBUG:root:Adding new checklistitem 'Nicer Label' to checklist wwwwwwwwwwwwwwwwwwwwwwww",
-            "DEBUG:root:{'name': 'New checklist item'}"])
-        self.assertTrue(expected in "\n".join(cm.output))
-        target.args = None
+        self.assertIn(("POST", "checklists/%s/checkItems" % ("w"*24),
+            {"name": "Nicer Label", "pos": 1}), self.get_writes(t_pr))
 
     @patch("syncboom.perform_request")
     def test_process_master_card_one_label_wet_run_related_checklist(self, t_pr):
         """
         Test processing a new master card with one recognized label, no dry_run, with already the related checklist
         """
-        target.args = type(inspect.stack()[0][3], (object,), {"dry_run": False})()
-        target.config = {"key": "ghi", "token": "jkl",
-            "destination_lists": {
-                "Label One": ["a1a1a1a1a1a1a1a1a1a1a1a1"],
-                "Label Two": ["ddd"],
-                "All Teams": [
-                  "a1a1a1a1a1a1a1a1a1a1a1a1",
-                  "ddd"
-                ]
-            }}
-        master_card = {"id": "t"*24, "desc": "abc", "name": "Card name",
-            "labels": [{"name": "Label One"}], "badges": {"attachments": 0},
-            "shortUrl": "https://trello.com/c/eoK0Rngb",
-            "url": "https://trello.com/c/eoK0Rngb/blablabla"}
-        t_pr.side_effect = [{"id": "b"*24, "name": "Slave card One",
-                "idBoard": "k"*24, "idList": "l"*24,
-                "url": "https://trello.com/c/abcd1234/blablabla2"},
-            {"name": "Board name"},
-            {"name": "List name"},
-            {},
-            [{"name": "Involved Teams"}],
-            {},
-            {}]
-        with self.assertLogs(level='DEBUG') as cm:
-            output = target.process_master_card(master_card)
+        self.fake_trello(t_pr, self.get_responses([{"id": "c"*24,
+            "name": "Involved Teams"}]))
+        with self.assertLogs(level='DEBUG'):
+            output = target.process_master_card(self.master_card)
         self.assertEqual(output, (1, 1, 1))
-        expected = "\n".join(["DEBUG:root:Retrieving checklists from card tttttttttttttttttttttttt",
-            "DEBUG:root:Already 1 checklists on this master card: Involved Teams"])
-        self.assertTrue(expected in "\n".join(cm.output))
-        target.args = None
-        target.config
+        self.assertEqual([w[:2] for w in self.get_writes(t_pr)], [
+            ("POST", "cards"),
+            ("POST", "cards/%s/attachments" % ("b"*24)),
+            ("POST", "cards/%s/attachments" % ("t"*24)),
+            ("PUT", "cards/%s" % ("t"*24))])
 
+    @patch("syncboom.perform_request")
+    def test_process_master_card_snapshot(self, t_pr):
+        """
+        Test processing a master card from a board snapshot, with its
+        attachments and checklists already nested in the card
+        """
+        responses = self.get_responses()
+        responses["GET cards/abcd1234"] = {"id": "q"*24,
+            "name": "Slave card One", "idBoard": "k"*24,
+            "idList": "a1a1a1a1a1a1a1a1a1a1a1a1"}
+        self.fake_trello(t_pr, responses)
+        master_card = dict(self.master_card, badges={"attachments": 1},
+            attachments=[{"id": "rrr",
+                "url": "https://trello.com/c/abcd1234/blablabla4"}],
+            checklists=[{"id": "c"*24, "name": "Involved Teams"}])
+        with self.assertLogs(level='DEBUG'):
+            output = target.process_master_card(master_card)
+        self.assertEqual(output, (1, 1, 0))
+        # Neither the attachments nor the checklists have been requested
+        self.assertEqual([c[1][1] for c in t_pr.mock_calls], ["cards/abcd1234",
+            "batch", "cards/tttttttttttttttttttttttt"])
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Running the tests:
+# $ python3 -m unittest discover --start-directory ./tests/
+# Checking the coverage of the tests:
+# $ coverage run --include=./*.py --omit=tests/* -m unittest discover && \
+#   rm -rf html_dev/coverage && coverage html --directory=html_dev/coverage \
+#   --title="Code test coverage for SyncBoom"
+
+import unittest
+import sys
+import time
+from uuid import uuid4
+from requests.exceptions import HTTPError
+from config import Config
+from tests.trello_simulator import TrelloSimulator, CONNECTION_ERROR
+
+sys.path.append('.')
+target = __import__("syncboom")
+
+
+class SimulatorConfig(Config):
+    TESTING = True
+    CACHE_TYPE = 'simple'
+    TRELLO_API_KEY = "ghi"
+    # Leave the rate limits to the simulator, but still honor its Retry-After
+    TRELLO_KEY_RATE_LIMIT = 100000
+    TRELLO_TOKEN_RATE_LIMIT = 100000
+    TRELLO_RETRY_BACKOFF = 0.01
+    TRELLO_RETRY_MAX_BACKOFF = 0.05
+
+
+class SimulatorTestCase(unittest.TestCase):
+    """
+    End-to-end runs of the command line against the Trello simulator: a
+    master board with cards labelled for two teams, each with its own board
+    """
+    def setUp(self):
+        self.simulator = TrelloSimulator(seed=0)
+        self.master_board = self.simulator.add_board("Master board")
+        master_list = self.simulator.add_list(self.master_board, "Backlog")
+        label_a = self.simulator.add_label(self.master_board, "Team A")
+        label_b = self.simulator.add_label(self.master_board, "Team B", "red")
+        self.master_cards = [
+            self.simulator.add_card(master_list, "First card", "First desc",
+                [label_a]),
+            self.simulator.add_card(master_list, "Second card", "Second desc",
+                [label_a, label_b]),
+            self.simulator.add_card(master_list, "Third card", "Third desc")]
+        self.slave_lists = []
+        for team in ("A", "B"):
+            board = self.simulator.add_board("Team %s board" % team)
+            self.slave_lists.append(self.simulator.add_list(board, "Inbox"))
+            self.simulator.add_list(board, "Done")
+        # A new token each time, not to inherit the rate limits of other tests
+        target.config = {"name": "Simulator", "key": "ghi",
+            "token": uuid4().hex, "master_board": self.master_board["id"],
+            "destination_lists": {
+                "Team A": [self.slave_lists[0]["id"]],
+                "Team B": [self.slave_lists[1]["id"]]},
+            "friendly_names": {"Team B board": "Team B"},
+            "cleanup_boards": [l["idBoard"] for l in self.slave_lists]}
+        target.args = type("simulator", (object,), {"dry_run": False})()
+        target.app = target.create_cli_app(SimulatorConfig)
+        self.app_context = target.app.app_context()
+        self.app_context.push()
+        target.cache.clear()
+        self.patcher = self.simulator.patch()
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.app_context.pop()
+        target.args = None
+        target.app = None
+
+    def sync(self):
+        return target.sync_master_cards(target.get_cards_snapshot("boards",
+            self.master_board["id"]))
+
+    def get_list_cards(self, trello_list):
+        return [c for c in self.simulator.cards.values()
+            if c["idList"] == trello_list["id"] and not c["closed"]]
+
+    def test_sync_master_cards(self):
+        """
+        Test syncing the master cards, then syncing them again without changes
+        """
+        with self.assertLogs(level="INFO"):
+            outputs = self.sync()
+        # The snapshot lists the most recent cards first
+        self.assertEqual(outputs, [(0, 0, 0), (1, 2, 2), (1, 1, 1)])
+        self.assertEqual(len(self.get_list_cards(self.slave_lists[0])), 2)
+        self.assertEqual(len(self.get_list_cards(self.slave_lists[1])), 1)
+        slave_card = self.get_list_cards(self.slave_lists[1])[0]
+        self.assertEqual(slave_card["name"], "Second card")
+        self.assertTrue(slave_card["desc"].startswith("Second desc\n\n"
+            "Created from master card"))
+        self.assertEqual(slave_card["idLabels"], [])
+        # The checklist of the teams isn't copied to the slave cards
+        self.assertEqual(slave_card["idChecklists"], [])
+        second_card = self.simulator.cards[self.master_cards[1]["id"]]
+        self.assertEqual(sorted([a["url"] for a in second_card["attachments"]]),
+            sorted([c["url"] for c in self.simulator.cards.values()
+            if c["name"] == "Second card" and c["id"] != second_card["id"]]))
+        self.assertEqual(second_card["desc"], "Second desc%s\n- 'Second card' "
+            "on list '**Team A board|Inbox**'\n- 'Second card' on list "
+            "'**Team B board|Inbox**'" % target.METADATA_SEPARATOR)
+        checklists = [self.simulator.checklists[c]
+            for c in second_card["idChecklists"]]
+        self.assertEqual([c["name"] for c in checklists], ["Involved Teams"])
+        self.assertEqual([i["name"] for i in checklists[0]["checkItems"]],
+            ["Team A board", "Team B"])
+
+        self.simulator.reset_stats()
+        with self.assertLogs(level="INFO"):
+            outputs = self.sync()
+        self.assertEqual(outputs, [(0, 0, 0), (1, 2, 0), (1, 1, 0)])
+        self.assertEqual(len(self.simulator.cards), 6)
+        self.assertTrue(all([c.startswith("GET ")
+            for c in self.simulator.stats["calls"]]))
+
+    def test_sync_master_cards_twice(self):
+        """
+        Test syncing the master cards twice back to back, with what the first
+        run cached, without duplicating the slave cards or the checklists
+        """
+        with self.assertLogs(level="INFO"):
+            self.sync()
+        with self.assertLogs(level="INFO"):
+            outputs = self.sync()
+        self.assertEqual(outputs, [(0, 0, 0), (1, 2, 0), (1, 1, 0)])
+        self.assertEqual(len(self.simulator.cards), 6)
+        self.assertEqual(len(self.get_list_cards(self.slave_lists[0])), 2)
+        self.assertEqual(len(self.get_list_cards(self.slave_lists[1])), 1)
+        for (card, teams) in zip(self.master_cards, (1, 2, 0)):
+            card = self.simulator.cards[card["id"]]
+            self.assertEqual(len(card["attachments"]), teams)
+            self.assertEqual(len(card["idChecklists"]), 1 if teams else 0)
+        self.assertEqual(sorted([len(c["checkItems"])
+            for c in self.simulator.checklists.values()]), [1, 2])
+
+    def test_sync_master_cards_dry_run(self):
+        """
+        Test that a dry run against the simulator only reads from Trello
+        """
+        target.args = type("simulator", (object,), {"dry_run": True})()
+        with self.assertLogs(level="INFO"):
+            outputs = self.sync()
+        self.assertEqual(outputs, [(0, 0, 0), (1, 2, 2), (1, 1, 1)])
+        self.assertEqual(len(self.simulator.cards), 3)
+        self.assertTrue(all([c.startswith("GET ")
+            for c in self.simulator.stats["calls"]]))
+
+    def test_get_changed_master_cards(self):
+        """
+        Test finding the master cards changed since the latest action
+        """
+        latest_action = target.get_latest_board_action(self.master_board["id"])
+        self.simulator.add_card_label(self.master_cards[2],
+            self.simulator.labels[self.master_cards[0]["idLabels"][0]])
+        (master_cards, action) = target.get_changed_master_cards(
+            self.master_board["id"], latest_action["id"])
+        self.assertEqual([c["id"] for c in master_cards],
+            [self.master_cards[2]["id"]])
+        self.assertEqual(action["type"], "addLabelToCard")
+
+    def test_get_changed_master_cards_deleted(self):
+        """
+        Test that a changed master card deleted since is skipped, even when
+        it is the only one that changed
+        """
+        latest_action = target.get_latest_board_action(self.master_board["id"])
+        target.perform_request("PUT", "cards/%s" % self.master_cards[2]["id"],
+            {"name": "Renamed card"})
+        target.perform_request("DELETE", "cards/%s" %
+            self.master_cards[2]["id"])
+        with self.assertLogs(level="WARNING"):
+            (master_cards, action) = target.get_changed_master_cards(
+                self.master_board["id"], latest_action["id"])
+        self.assertEqual(master_cards, [])
+        self.assertEqual(action["type"], "deleteCard")
+
+    def test_get_changed_master_cards_nested(self):
+        """
+        Test that the changed master cards come with their attachments and
+        checklists, not to get them again one card at a time
+        """
+        with self.assertLogs(level="INFO"):
+            self.sync()
+        latest_action = target.get_latest_board_action(self.master_board["id"])
+        for card in self.master_cards[:2]:
+            target.perform_request("PUT", "cards/%s" % card["id"],
+                {"name": "Renamed %s" % card["name"]})
+        (master_cards, action) = target.get_changed_master_cards(
+            self.master_board["id"], latest_action["id"])
+        self.assertEqual([len(c["attachments"]) for c in master_cards], [2, 1])
+        self.assertEqual([[l["name"] for l in c["checklists"]]
+            for c in master_cards], [["Involved Teams"]] * 2)
+        self.simulator.reset_stats()
+        with self.assertLogs(level="INFO"):
+            target.sync_master_cards(master_cards)
+        self.assertEqual(self.simulator.stats["calls"]
+            ["GET cards/(\\w+)/attachments"], 0)
+        self.assertEqual(self.simulator.stats["calls"]
+            ["GET cards/(\\w+)/checklists"], 0)
+
+    def test_cleanup_test_boards(self):
+        """
+        Test cleaning up the boards after a sync
+        """
+        with self.assertLogs(level="INFO"):
+            self.sync()
+        master_cards = target.get_cards_snapshot("boards",
+            self.master_board["id"])
+        with self.assertLogs(level="INFO"):
+            summary = target.cleanup_test_boards(master_cards)
+        self.assertEqual(summary["cleaned_up_master_cards"], 2)
+        self.assertEqual(summary["deleted_slave_cards"], 3)
+        self.assertEqual(summary["erased_destination_boards"], 2)
+        self.assertEqual(summary["erased_destination_lists"], 2)
+        self.assertEqual(sorted(self.simulator.cards),
+            sorted([c["id"] for c in self.master_cards]))
+        for (card, desc) in zip(self.master_cards, ("First desc",
+                "Second desc", "Third desc")):
+            card = self.simulator.cards[card["id"]]
+            self.assertEqual(card["desc"], desc)
+            self.assertEqual(card["attachments"], [])
+            self.assertEqual(card["idChecklists"], [])
+        self.assertEqual(self.simulator.checklists, {})
+
+    def test_retry_transient_errors(self):
+        """
+        Test retrying the GET requests after server and connection errors
+        """
+        self.simulator.fail_next(503, 2)
+        self.simulator.fail_next(CONNECTION_ERROR)
+        retries = target.get_retry_stats()["retries"]
+        with self.assertLogs(level="WARNING") as cm:
+            board = target.perform_request("GET", "boards/%s" %
+                self.master_board["id"])
+        self.assertEqual(board["name"], "Master board")
+        self.assertEqual(target.get_retry_stats()["retries"] - retries, 3)
+        self.assertEqual(len(cm.output), 3)
+        self.assertEqual(self.simulator.stats["injected_errors"], 3)
+
+    def test_post_not_retried(self):
+        """
+        Test that a failed POST isn't retried, not to create a card twice
+        """
+        self.simulator.fail_next(500)
+        with self.assertLogs(level="CRITICAL"), self.assertRaises(HTTPError):
+            target.create_new_slave_card(self.master_cards[0],
+                self.slave_lists[0]["id"])
+        self.assertEqual(len(self.simulator.cards), 3)
+
+    def test_rate_limit(self):
+        """
+        Test waiting for the Retry-After delay when the token's rate limit is
+        exceeded
+        """
+        self.simulator.token_rate_limit = 5
+        self.simulator.rate_limit_period = 0.5
+        started = time.time()
+        with self.assertLogs(level="WARNING") as cm:
+            for card in self.master_cards * 3:
+                target.cache.clear()
+                target.perform_request("GET", "cards/%s" % card["id"])
+        self.assertGreaterEqual(time.time() - started, 0.5)
+        self.assertGreater(self.simulator.stats["throttled"], 0)
+        self.assertIn("Trello rate limit exceeded", cm.output[0])
+
+    def test_batch(self):
+        """
+        Test getting cards through the batch endpoint, even deleted ones
+        """
+        target.perform_request("DELETE", "cards/%s" % self.master_cards[1]["id"])
+        with self.assertLogs(level="WARNING") as cm:
+            cards = target.batch_get(["cards/%s" % c["shortLink"]
+                for c in self.master_cards])
+        self.assertEqual([c["name"] if c else None for c in cards],
+            ["First card", None, "Third card"])
+        self.assertIn("failed: {'statusCode': 404", cm.output[0])
+        self.assertEqual(self.simulator.stats["calls"]["GET batch"], 1)
+
+    def test_webhooks(self):
+        """
+        Test creating, listing and deleting a webhook on the master board
+        """
+        payloads = []
+        self.simulator.webhook_callback = lambda webhook, payload: \
+            payloads.append(payload)
+        target.perform_request("POST", "webhooks", {
+            "callbackURL": "https://syncboom.com/webhooks/1/",
+            "idModel": self.master_board["id"]})
+        self.assertEqual([w["idModel"] for w in target.list_webhooks()],
+            [self.master_board["id"]])
+        target.perform_request("PUT", "cards/%s" % self.master_cards[0]["id"],
+            {"name": "Renamed card"})
+        self.assertEqual([p["action"]["type"] for p in payloads],
+            ["updateCard"])
+        self.assertEqual(payloads[0]["action"]["data"]["old"],
+            {"name": "First card"})
+        target.delete_webhook(self.master_board["id"])
+        target.cache.clear()
+        self.assertEqual(target.list_webhooks(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,7 +11,8 @@
 from datetime import datetime, timedelta
 import unittest
 from app import create_app, db
-from app.models import User, load_user, Task, Mapping
+from app.models import User, load_user, Task, Mapping, MappingDestination, \
+    CardLink
 from app.email import send_email
 from config import Config, basedir
 import sys
@@ -22,9 +23,14 @@ from unittest.mock import patch, call, MagicMock
 from sqlalchemy.exc import IntegrityError
 from redis.exceptions import RedisError
 from rq.exceptions import NoSuchJobError
+from requests.exceptions import HTTPError
 from datetime import datetime, timedelta
 import json
 from urllib.parse import quote
+import base64
+import hashlib
+import hmac
+from tests.trello_simulator import TrelloSimulator
 
 if not os.environ.get("FLASK_DEBUG"):
     # Suppress output when starting up app from website.py or app/tasks.py
@@ -41,7 +47,8 @@ else:
 class TestMakeShellContext(unittest.TestCase):
     def test_make_shell_context(self):
         return_value = make_shell_context()
-        for i in ("db", "User", "Notification", "Task", "Mapping"):
+        for i in ("db", "User", "Notification", "Task", "Mapping", "CardLink",
+                "MappingDestination"):
             self.assertTrue(i in return_value)
 
 
@@ -142,6 +149,23 @@ class UserModelCase(WebsiteTestCase):
         self.assertEqual(u.get_task_in_progress("run_mapping"), t2)
         self.assertEqual(u.get_recent_tasks(), [t2, t1])
 
+    def test_launch_task_shards(self):
+        u = User(username='john', email='john@example.com')
+        mock = MagicMock()
+        mock.get_id.side_effect = ['foobarbaz', 'other_id']
+        with patch.object(self.app.task_queue, 'enqueue', return_value=mock) \
+            as mock_enqueue_method:
+            u.launch_task("run_mapping", (123, "board", "abc"), "Desc",
+                shards=4)
+            u.launch_task("run_mapping", (123, "list", "def"), "Desc 2",
+                shards=4)
+        # Only board runs are split in shards
+        expected_calls = [
+            call('app.tasks.run_mapping', 123, 'board', 'abc', shards=4),
+            call('app.tasks.run_mapping', 123, 'list', 'def')
+        ]
+        self.assertEqual(mock_enqueue_method.mock_calls, expected_calls)
+
     def test_launch_task_invalid(self):
         u = User(username='john', email='john@example.com')
         t1 = u.launch_task("name", (), "description")
@@ -182,6 +206,57 @@ class UserModelCase(WebsiteTestCase):
         self.assertEqual(data["aa"], "abc")
         self.assertEqual(data["bb"], "def")
 
+    @patch("app.models.time")
+    def test_record_last_seen(self, amt):
+        u = self.create_user("john", "abc")
+        self.app.redis = MagicMock()
+        self.app.task_queue = MagicMock()
+        amt.return_value = 1592220000.5
+        self.app.redis.set.side_effect = [True, True, None]
+        u.record_last_seen()
+        u.record_last_seen()
+        self.assertEqual(self.app.redis.set.mock_calls, [
+            call("syncboom-last-seen:%d" % u.id, 1, nx=True, ex=60),
+            call("syncboom-last-seen-flush", 1, nx=True, ex=300),
+            call("syncboom-last-seen:%d" % u.id, 1, nx=True, ex=60)])
+        # Only buffered once within the granularity
+        self.assertEqual(self.app.redis.hset.mock_calls,
+            [call("syncboom-last-seen", u.id, 1592220000.5)])
+        self.assertEqual(self.app.task_queue.enqueue_in.mock_calls,
+            [call(timedelta(seconds=300), 'app.tasks.flush_last_seen')])
+
+    def test_record_last_seen_redis_error(self):
+        u = self.create_user("john", "abc")
+        self.app.redis = MagicMock()
+        self.app.redis.set.side_effect = RedisError()
+        u.last_seen = datetime.utcnow() - timedelta(seconds=30)
+        db.session.commit()
+        last_seen = u.last_seen
+        u.record_last_seen()
+        self.assertEqual(u.last_seen, last_seen)
+        u.last_seen = datetime.utcnow() - timedelta(seconds=90)
+        db.session.commit()
+        u.record_last_seen()
+        self.assertGreater(u.last_seen, last_seen)
+
+    def test_flush_last_seen(self):
+        u1 = self.create_user("john", "abc")
+        u2 = self.create_user("susan", "def")
+        self.app.redis = MagicMock()
+        self.app.redis.pipeline.return_value.execute.return_value = [
+            {str(u1.id).encode(): b"1592220000.5"}, 1]
+        self.assertEqual(User.flush_last_seen(), 1)
+        self.assertEqual(self.app.redis.pipeline.return_value.mock_calls[:2],
+            [call.hgetall("syncboom-last-seen"),
+            call.delete("syncboom-last-seen")])
+        db.session.expire_all()
+        self.assertEqual(User.query.get(u1.id).last_seen,
+            datetime(2020, 6, 15, 11, 20, 0, 500000))
+        self.assertNotEqual(User.query.get(u2.id).last_seen,
+            datetime(2020, 6, 15, 11, 20, 0, 500000))
+        self.app.redis.pipeline.return_value.execute.return_value = [{}, 0]
+        self.assertEqual(User.flush_last_seen(), 0)
+
 
 class TaskModelCase(WebsiteTestCase):
     @patch("rq.job.Job.fetch")
@@ -193,15 +268,38 @@ class TaskModelCase(WebsiteTestCase):
         self.assertEqual(t.get_rq_job(), None)
         self.assertEqual(t.get_rq_job(), "abc")
 
-    @patch("app.models.Task.get_rq_job")
-    def test_task_get_progress(self, tgrj):
-        t = Task()
+    @patch("rq.job.Job.fetch_many")
+    def test_task_get_progress(self, rjjfm):
+        t = Task(id="t1")
         mock_job = MagicMock()
         mock_job.meta.get.return_value = 27
-        tgrj.side_effect = [None, mock_job]
-        # Non-existing job returns 100% done
+        rjjfm.side_effect = [RedisError(), [None], [mock_job]]
+        # Redis errors and non-existing jobs return 100% done
+        self.assertEqual(t.get_progress(), 100)
         self.assertEqual(t.get_progress(), 100)
         self.assertEqual(t.get_progress(), 27)
+        t.complete = True
+        self.assertEqual(t.get_progress(), 100)
+        self.assertEqual(len(rjjfm.mock_calls), 3)
+
+    @patch("rq.job.Job.fetch_many")
+    def test_task_fetch_progress(self, rjjfm):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Task(id="t1", user=u),
+            Task(id="t2", user=u, complete=True), Task(id="t3", user=u)])
+        db.session.commit()
+        mock_job = MagicMock()
+        mock_job.meta = {"progress": 42}
+        rjjfm.return_value = [mock_job, None]
+        with self.app.test_request_context():
+            tasks = u.get_tasks_in_progress()
+            self.assertEqual([t.id for t in tasks], ["t1", "t3"])
+            self.assertEqual([t.get_progress() for t in tasks], [42, 100])
+            self.assertEqual(Task.fetch_progress(Task.query.all()),
+                {"t1": 42, "t2": 100, "t3": 100})
+        # One round trip for all the running tasks of the request
+        self.assertEqual(rjjfm.mock_calls, [call(["t1", "t3"],
+            connection=self.app.redis)])
 
     def test_task_get_duration(self):
         now = datetime.utcnow()
@@ -222,6 +320,7 @@ class TaskModelCase(WebsiteTestCase):
 class MappingModelCase(WebsiteTestCase):
     def test_mapping(self):
         u = User(username='john', email='john@example.com')
+        db.session.add(u)
         destination_lists = {
             "Label One": ["a1a1a1a1a1a1a1a1a1a1a1a1"],
             "Label Two": ["ddd"],
@@ -230,8 +329,8 @@ class MappingModelCase(WebsiteTestCase):
                 "ddd"
             ]
         }
-        dl = json.dumps(destination_lists)
-        m1 = Mapping(name="abc", destination_lists=dl)
+        m1 = Mapping(name="abc")
+        m1.set_destination_lists(destination_lists)
         self.assertEqual(str(m1), "<Mapping abc>")
         self.assertEqual(m1.get_num_labels(), 3)
         self.assertEqual(m1.get_num_dest_lists(), 4)
@@ -239,12 +338,53 @@ class MappingModelCase(WebsiteTestCase):
         m2 = Mapping(name="def")
         u.mappings.append(m2)
         self.assertEqual(u.get_mappings(), [m1, m2])
+        # The destinations are loaded with the mappings
+        db.session.commit()
+        db.session.expire_all()
+        self.assertTrue(all(["destinations" in m.__dict__
+            for m in u.get_mappings()]))
 
     def test_mapping_invalid(self):
         m2 = Mapping(name="def")
         self.assertEqual(m2.get_num_labels(), 0)
         self.assertEqual(m2.get_num_dest_lists(), 0)
 
+    def test_mapping_destinations(self):
+        m = Mapping(name="abc")
+        m.set_destination_lists({"Label One": ["a1"*12],
+            "All Teams": ["a1"*12, "d4"*12]})
+        db.session.add(m)
+        db.session.commit()
+        self.assertEqual([(d.label, d.destination_list)
+            for d in MappingDestination.query.order_by("id")],
+            [("Label One", "a1"*12), ("All Teams", "a1"*12),
+            ("All Teams", "d4"*12)])
+        self.assertEqual(m.get_destination_lists(), {"Label One": ["a1"*12],
+            "All Teams": ["a1"*12, "d4"*12]})
+        # The previous destinations are replaced
+        m.set_destination_lists({"Label Two": ["b2"*12]})
+        db.session.commit()
+        self.assertEqual([(d.label, d.destination_list)
+            for d in MappingDestination.query.all()], [("Label Two", "b2"*12)])
+        m.set_destination_lists({})
+        db.session.commit()
+        self.assertEqual(m.get_destination_lists(), {})
+        self.assertEqual(MappingDestination.query.count(), 0)
+
+    def test_mapping_set_checkpoint(self):
+        m = Mapping(name="abc")
+        m.set_checkpoint({"id": "a"*24, "date": "2020-06-15T11:36:49.712Z"})
+        self.assertEqual(m.last_action_id, "a"*24)
+        self.assertEqual(m.last_action_date,
+            datetime(2020, 6, 15, 11, 36, 49, 712000))
+
+    def test_mapping_clear_checkpoint(self):
+        m = Mapping(name="abc")
+        m.set_checkpoint({"id": "a"*24, "date": "2020-06-15T11:36:49.712Z"})
+        m.clear_checkpoint()
+        self.assertIsNone(m.last_action_id)
+        self.assertIsNone(m.last_action_date)
+
 
 class ConfigCase(unittest.TestCase):
     def test_config_values(self):
@@ -263,6 +403,69 @@ class ConfigCase(unittest.TestCase):
         self.assertEqual(Config.LANGUAGES, ['en'])
         self.assertEqual(Config.REDIS_URL, os.environ.get('REDIS_URL') or 'redis://')
         self.assertEqual(Config.TRELLO_API_KEY, os.environ.get('TRELLO_API_KEY'))
+        self.assertEqual(Config.TRELLO_API_SECRET,
+            os.environ.get('TRELLO_API_SECRET'))
+        self.assertEqual(Config.TRELLO_WEBHOOK_PENDING_TIMEOUT,
+            int(os.environ.get('TRELLO_WEBHOOK_PENDING_TIMEOUT') or 600))
+        self.assertEqual(Config.RUN_CHECKPOINT_TIMEOUT,
+            int(os.environ.get('RUN_CHECKPOINT_TIMEOUT') or 86400))
+        self.assertEqual(Config.TASK_PROGRESS_INTERVAL,
+            int(os.environ.get('TASK_PROGRESS_INTERVAL') or 2))
+        self.assertEqual(Config.LAST_SEEN_GRANULARITY,
+            int(os.environ.get('LAST_SEEN_GRANULARITY') or 60))
+        self.assertEqual(Config.LAST_SEEN_FLUSH_INTERVAL,
+            int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 300))
+        self.assertEqual(Config.NOTIFICATIONS_STREAM_TIMEOUT,
+            int(os.environ.get('NOTIFICATIONS_STREAM_TIMEOUT') or 60))
+        self.assertEqual(Config.NOTIFICATIONS_MAX_STREAMS,
+            int(os.environ.get('NOTIFICATIONS_MAX_STREAMS') or 4))
+        self.assertEqual(Config.RUN_MAPPING_BATCH_SIZE,
+            int(os.environ.get('RUN_MAPPING_BATCH_SIZE') or 100))
+        self.assertEqual(Config.RUN_MAPPING_SHARDS,
+            int(os.environ.get('RUN_MAPPING_SHARDS') or 1))
+        self.assertEqual(Config.RUN_SHARDS_TIMEOUT,
+            int(os.environ.get('RUN_SHARDS_TIMEOUT') or 3600))
+        self.assertEqual(Config.MAPPING_CARDS_PER_PAGE,
+            int(os.environ.get('MAPPING_CARDS_PER_PAGE') or 50))
+        self.assertEqual(Config.TRELLO_POOL_SIZE,
+            int(os.environ.get('TRELLO_POOL_SIZE') or 10))
+        self.assertEqual(Config.TRELLO_ASYNC_POOL_SIZE,
+            int(os.environ.get('TRELLO_ASYNC_POOL_SIZE') or 50))
+        self.assertEqual(Config.TRELLO_KEEP_ALIVE,
+            os.environ.get('TRELLO_KEEP_ALIVE') != "0")
+        self.assertEqual(Config.TRELLO_KEY_RATE_LIMIT,
+            int(os.environ.get('TRELLO_KEY_RATE_LIMIT') or 300))
+        self.assertEqual(Config.TRELLO_TOKEN_RATE_LIMIT,
+            int(os.environ.get('TRELLO_TOKEN_RATE_LIMIT') or 100))
+        self.assertEqual(Config.TRELLO_RATE_LIMIT_PERIOD, 10)
+        self.assertEqual(Config.TRELLO_RATE_LIMIT_BURST,
+            int(os.environ.get('TRELLO_RATE_LIMIT_BURST') or 10))
+        self.assertEqual(Config.TRELLO_RATE_LIMIT_MARGIN,
+            float(os.environ.get('TRELLO_RATE_LIMIT_MARGIN') or 0.1))
+        self.assertEqual(Config.TRELLO_RETRY_MAX_ATTEMPTS,
+            int(os.environ.get('TRELLO_RETRY_MAX_ATTEMPTS') or 5))
+        self.assertEqual(Config.TRELLO_RETRY_DEADLINE,
+            int(os.environ.get('TRELLO_RETRY_DEADLINE') or 120))
+        self.assertEqual(Config.TRELLO_CONNECT_TIMEOUT,
+            int(os.environ.get('TRELLO_CONNECT_TIMEOUT') or 5))
+        self.assertEqual(Config.TRELLO_READ_TIMEOUT,
+            int(os.environ.get('TRELLO_READ_TIMEOUT') or 30))
+        self.assertEqual(Config.TRELLO_CONCURRENCY,
+            int(os.environ.get('TRELLO_CONCURRENCY') or 4))
+        self.assertEqual(Config.TRELLO_LINK_RECONCILE_INTERVAL,
+            int(os.environ.get('TRELLO_LINK_RECONCILE_INTERVAL') or 86400))
+        self.assertEqual(Config.CACHE_TYPE,
+            'redis' if os.environ.get('REDIS_URL') else 'simple')
+        self.assertEqual(Config.CACHE_REDIS_URL, os.environ.get('REDIS_URL'))
+        self.assertEqual(Config.CACHE_KEY_PREFIX, 'syncboom-cache:')
+        self.assertEqual(Config.CACHE_THRESHOLD,
+            int(os.environ.get('CACHE_THRESHOLD') or 500))
+        self.assertEqual(Config.CACHE_MAX_VALUE_SIZE,
+            int(os.environ.get('CACHE_MAX_VALUE_SIZE') or 262144))
+        self.assertEqual(Config.TRELLO_REQUEST_CACHE_TIMEOUT, 60)
+        self.assertEqual(Config.TRELLO_NAME_CACHE_TIMEOUT, 300)
+        self.assertEqual(Config.TRELLO_CATALOG_CACHE_TIMEOUT, 3600)
+        self.assertEqual(Config.TRELLO_CARDS_INDEX_CACHE_TIMEOUT, 300)
 
 
 class MiscTests(WebsiteTestCase):
@@ -400,6 +603,59 @@ class TaskCase(WebsiteTestCase):
         _set_task_progress(100)
         self.assertTrue(t.complete)
 
+    @patch("app.tasks.time.time")
+    @patch("app.tasks.get_current_job")
+    def test_run_task_progress_throttled(self, atgcj, attt):
+        atgcj.return_value.get_id.return_value = "foobarbaz"
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        t = Task(id="foobarbaz", name="run_mapping", user=u)
+        db.session.add(t)
+        db.session.commit()
+        attt.side_effect = [100.0, 101.0, 102.5, 102.6, 102.7]
+        _set_task_progress(0, "Job running...")
+        _set_task_progress(10)
+        _set_task_progress(20)
+        _set_task_progress(30)
+        self.assertEqual(atgcj.return_value.meta.__setitem__.mock_calls[-1],
+            call('progress', 30))
+        # Only the state transitions and one progress update every 2 seconds
+        # are saved
+        self.assertEqual(len(atgcj.return_value.save_meta.mock_calls), 2)
+        self.assertEqual(u.notifications.count(), 1)
+        _set_task_progress(100, "Run complete.")
+        self.assertEqual(len(atgcj.return_value.save_meta.mock_calls), 3)
+        self.assertEqual(json.loads(u.notifications.first().payload_json),
+            {"task_id": "foobarbaz", "progress": 100})
+        self.assertTrue(t.complete)
+        self.assertEqual(t.status, "Run complete.")
+        self.assertEqual(app.tasks.progress_saved, {})
+
+    @patch("app.tasks.get_current_job")
+    def test_run_task_progress_published(self, atgcj):
+        atgcj.return_value.get_id.return_value = "foobarbaz"
+        self.app.redis = MagicMock()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.add(Task(id="foobarbaz", name="run_mapping", user=u))
+        db.session.commit()
+        _set_task_progress(0)
+        _set_task_progress(100, "Run complete.")
+        self.assertEqual(self.app.redis.publish.mock_calls, [
+            call("syncboom-progress:%d" % u.id,
+                '{"task_id": "foobarbaz", "progress": 0}'),
+            call("syncboom-progress:%d" % u.id,
+                '{"task_id": "foobarbaz", "progress": 100}')])
+        self.assertEqual(app.tasks.progress_channels, {})
+
+    @patch("app.tasks.User.flush_last_seen")
+    def test_flush_last_seen(self, atuflc):
+        atuflc.return_value = 3
+        with self.assertLogs(level='INFO') as cm:
+            app.tasks.flush_last_seen()
+        self.assertEqual(cm.output, ["INFO:app:Recorded when 3 users were "
+            "last seen"])
+
     def test_run_mapping_nonexistent_mapping(self):
         f = io.StringIO()
         with self.assertLogs(level='INFO') as cm, contextlib.redirect_stderr(f):
@@ -421,8 +677,8 @@ class TaskCase(WebsiteTestCase):
                 "ddd"
             ]
         }
-        dl = json.dumps(destination_lists)
-        m = Mapping(name="abc", destination_lists=dl)
+        m = Mapping(name="abc")
+        m.set_destination_lists(destination_lists)
         db.session.add(m)
         db.session.commit()
         f = io.StringIO()
@@ -451,9 +707,9 @@ class TaskCase(WebsiteTestCase):
         self.assertEqual(cm.output, expected_logging)
 
     @patch("app.tasks._set_task_progress")
-    @patch("app.tasks.process_master_card")
+    @patch("app.tasks.sync_master_cards")
     @patch("app.tasks.perform_request")
-    def test_run_mapping_vm_valid_args_card(self, atpr, atpmc, atstp):
+    def test_run_mapping_vm_valid_args_card(self, atpr, atsmc, atstp):
         u = User(username='john', email='john@example.com', trello_token="b2"*16)
         db.session.add(u)
         db.session.commit()
@@ -465,29 +721,31 @@ class TaskCase(WebsiteTestCase):
                 "ddd"
             ]
         }
-        dl = json.dumps(destination_lists)
-        m = Mapping(name="abc", destination_lists=dl, user_id=u.id)
+        m = Mapping(name="abc", user_id=u.id)
+        m.set_destination_lists(destination_lists)
         db.session.add(m)
         db.session.commit()
         atpr.return_value = {"name": "Card name"}
-        atpmc.return_value = (1, 2, 3)
+        atsmc.return_value = [(1, 2, 3)]
         f = io.StringIO()
         with self.assertLogs(level='INFO') as cm, contextlib.redirect_stderr(f):
             run_mapping(m.id, "card", "abc")
-        expected_calls = [call('GET', 'cards/abc', key="a1"*16, token="b2"*16)]
+        expected_calls = [call('GET', 'cards/abc', app.tasks.CARD_NESTED_QUERY,
+            key="a1"*16, token="b2"*16)]
         self.assertEqual(atpr.mock_calls, expected_calls)
-        expected_logging = "INFO:app:Processing master card 1/1 - Card name"
+        expected_logging = "INFO:app:Processed master card 1/1 - Card name"
         self.assertEqual(cm.output[1], expected_logging)
-        self.assertTrue(list(atpmc.call_args[0][1].keys()),
-            ['destination_lists', 'key', 'token'])
+        self.assertEqual(atsmc.mock_calls, [call([{"name": "Card name"}],
+            {"destination_lists": destination_lists, "key": "a1"*16,
+            "token": "b2"*16, "mapping_id": m.id})])
         expected_call = call(100, 'Run complete. Processed 1 master cards (' \
             'of which 1 active) that have 2 slave cards (of which 3 new).')
         self.assertEqual(atstp.mock_calls[-1], expected_call)
 
     @patch("app.tasks._set_task_progress")
-    @patch("app.tasks.process_master_card")
-    @patch("app.tasks.perform_request")
-    def test_run_mapping_vm_valid_args_list(self, atpr, atpmc, atstp):
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.get_cards_snapshot")
+    def test_run_mapping_vm_valid_args_list(self, atgcs, atsmc, atstp):
         u = User(username='john', email='john@example.com', trello_token="b2"*16)
         db.session.add(u)
         db.session.commit()
@@ -499,20 +757,23 @@ class TaskCase(WebsiteTestCase):
                 "ddd"
             ]
         }
-        dl = json.dumps(destination_lists)
-        m = Mapping(name="abc", destination_lists=dl, user_id=u.id)
+        m = Mapping(name="abc", user_id=u.id)
+        m.set_destination_lists(destination_lists)
         db.session.add(m)
         db.session.commit()
-        atpr.return_value = [{"name": "Card name"}, {"name": "Second card"}]
-        atpmc.side_effect = [(4, 5, 6), (7, 8, 9)]
+        atgcs.return_value = [{"name": "Card name"}, {"name": "Second card"}]
+        atsmc.return_value = [(4, 5, 6), (7, 8, 9)]
         f = io.StringIO()
         with self.assertLogs(level='INFO') as cm, contextlib.redirect_stderr(f):
             run_mapping(m.id, "list", "def")
-        expected_calls = [call('GET', 'list/def/cards', key="a1"*16, token="b2"*16)]
-        self.assertEqual(atpr.mock_calls, expected_calls)
+        # Both cards are planned then applied together
+        self.assertEqual(len(atsmc.mock_calls), 1)
+        self.assertEqual(atsmc.mock_calls[0][1][0], atgcs.return_value)
+        expected_calls = [call('list', 'def', {"key": "a1"*16, "token": "b2"*16})]
+        self.assertEqual(atgcs.mock_calls, expected_calls)
         expected_logging = ['INFO:app:Starting task for mapping 1, list def',
-            'INFO:app:Processing master card 1/2 - Card name',
-            'INFO:app:Processing master card 2/2 - Second card',
+            'INFO:app:Processed master card 1/2 - Card name',
+            'INFO:app:Processed master card 2/2 - Second card',
             'INFO:app:Completed task for mapping 1, list def']
         self.assertEqual(cm.output, expected_logging)
         expected_calls = [call(0),
@@ -522,6 +783,492 @@ class TaskCase(WebsiteTestCase):
                 'active) that have 13 slave cards (of which 15 new).')]
         self.assertEqual(atstp.mock_calls, expected_calls)
 
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.get_cards_snapshot")
+    def test_run_mapping_batches(self, atgcs, atsmc, atstp):
+        m = self.create_user_and_mapping()
+        self.app.config["RUN_MAPPING_BATCH_SIZE"] = 2
+        atgcs.return_value = [{"id": "c%d" % i, "name": "Card %d" % i}
+            for i in range(3)]
+        atsmc.side_effect = [[(1, 1, 0), (1, 1, 1)], [(0, 0, 0)]]
+        with self.assertLogs(level='INFO'):
+            run_mapping(m.id, "list", "def")
+        self.assertEqual([[mc["id"] for mc in c[1][0]]
+            for c in atsmc.mock_calls], [["c0", "c1"], ["c2"]])
+        self.assertEqual(atstp.mock_calls[-1], call(100, 'Run complete. '
+            'Processed 3 master cards (of which 2 active) that have 2 slave '
+            'cards (of which 1 new).'))
+
+    def create_user_and_mapping(self):
+        u = User(username='john', email='john@example.com', trello_token="b2"*16)
+        db.session.add(u)
+        db.session.commit()
+        m = Mapping(name="abc", user_id=u.id, master_board="m"*24)
+        m.set_destination_lists({"Label One": ["a1a1a1a1a1a1a1a1a1a1a1a1"]})
+        db.session.add(m)
+        db.session.commit()
+        return m
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.get_cards_snapshot")
+    @patch("app.tasks.get_latest_board_action")
+    def test_run_mapping_board_checkpoint(self, atglba, atgcs, atsmc, atstp):
+        m = self.create_user_and_mapping()
+        atglba.return_value = {"id": "a"*24, "date": "2020-06-15T11:36:49.712Z"}
+        atgcs.return_value = [{"name": "Card name"}]
+        atsmc.return_value = [(1, 1, 0)]
+        with self.assertLogs(level='INFO'):
+            run_mapping(m.id, "board", "m"*24)
+        self.assertEqual(atglba.mock_calls, [call("m"*24,
+            {"key": "a1"*16, "token": "b2"*16})])
+        self.assertEqual(atgcs.mock_calls, [call("board", "m"*24,
+            {"key": "a1"*16, "token": "b2"*16})])
+        m = Mapping.query.get(m.id)
+        self.assertEqual(m.last_action_id, "a"*24)
+        self.assertEqual(m.last_action_date,
+            datetime(2020, 6, 15, 11, 36, 49, 712000))
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.get_cards_snapshot")
+    @patch("app.tasks.get_latest_board_action")
+    def test_run_mapping_changes_without_checkpoint(self, atglba, atgcs, atsmc,
+            atstp):
+        m = self.create_user_and_mapping()
+        atglba.return_value = {"id": "a"*24, "date": "2020-06-15T11:36:49.712Z"}
+        atgcs.return_value = []
+        with self.assertLogs(level='INFO'):
+            run_mapping(m.id, "changes", "m"*24)
+        # A full board run is needed the first time
+        self.assertEqual(atgcs.mock_calls, [call("board", "m"*24,
+            {"key": "a1"*16, "token": "b2"*16})])
+        self.assertEqual(Mapping.query.get(m.id).last_action_id, "a"*24)
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.get_cards_snapshot")
+    @patch("app.tasks.get_changed_master_cards")
+    def test_run_mapping_changes(self, atgcmc, atgcs, atsmc, atstp):
+        m = self.create_user_and_mapping()
+        m.last_action_id = "a"*24
+        db.session.commit()
+        atgcmc.return_value = ([{"name": "Card name"}],
+            {"id": "b"*24, "date": "2020-06-16T08:00:00.000Z"})
+        atsmc.return_value = [(1, 2, 1)]
+        with self.assertLogs(level='INFO'):
+            run_mapping(m.id, "changes", "m"*24)
+        self.assertEqual(atgcmc.mock_calls, [call("m"*24, "a"*24,
+            {"key": "a1"*16, "token": "b2"*16})])
+        self.assertEqual(atgcs.mock_calls, [])
+        self.assertEqual(atstp.mock_calls, [call(0),
+            call(0, 'Job running... Processing 1 cards changed since the last '
+                'run.'),
+            call(100, 'Run complete. Processed 1 master cards (of which 1 '
+                'active) that have 2 slave cards (of which 1 new).')])
+        m = Mapping.query.get(m.id)
+        self.assertEqual(m.last_action_id, "b"*24)
+        self.assertEqual(m.last_action_date, datetime(2020, 6, 16, 8, 0, 0))
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.get_changed_master_cards")
+    def test_run_mapping_no_changes(self, atgcmc, atsmc, atstp):
+        m = self.create_user_and_mapping()
+        m.last_action_id = "a"*24
+        db.session.commit()
+        atgcmc.return_value = ([], None)
+        with self.assertLogs(level='INFO'):
+            run_mapping(m.id, "changes", "m"*24)
+        self.assertEqual(atsmc.mock_calls, [])
+        self.assertEqual(Mapping.query.get(m.id).last_action_id, "a"*24)
+
+    @patch.dict(sys.modules["syncboom"].__dict__)
+    @patch("app.tasks._set_task_progress")
+    def test_run_mapping_simulator(self, atstp):
+        # A worker doesn't have the globals the command line's tests leave
+        for name in ("args", "config"):
+            sys.modules["syncboom"].__dict__.pop(name, None)
+        simulator = TrelloSimulator(seed=0)
+        master_board = simulator.add_board("Master board")
+        master_list = simulator.add_list(master_board, "Backlog")
+        label = simulator.add_label(master_board, "Label One")
+        master_cards = [simulator.add_card(master_list, "Card %d" % i,
+            labels=[label] if i % 2 else []) for i in range(4)]
+        slave_list = simulator.add_list(simulator.add_board("Slave board"),
+            "Inbox")
+        u = User(username='john', email='john@example.com', trello_token="b2"*16)
+        db.session.add(u)
+        db.session.commit()
+        m = Mapping(name="abc", user_id=u.id, master_board=master_board["id"])
+        m.set_destination_lists({label["id"]: [slave_list["id"]]})
+        db.session.add(m)
+        db.session.commit()
+        # Only the simulator's rate limits apply
+        self.app.config["TRELLO_KEY_RATE_LIMIT"] = 0
+        self.app.config["TRELLO_TOKEN_RATE_LIMIT"] = 0
+        with simulator.patch(), self.assertLogs(level='INFO'):
+            run_mapping(m.id, "board", master_board["id"])
+        self.assertEqual(atstp.mock_calls[-1], call(100, 'Run complete. '
+            'Processed 4 master cards (of which 2 active) that have 2 slave '
+            'cards (of which 2 new).'))
+        slave_cards = [c for c in simulator.cards.values()
+            if c["idList"] == slave_list["id"]]
+        self.assertEqual(sorted([c["name"] for c in slave_cards]),
+            ["Card 1", "Card 3"])
+        self.assertEqual(sorted([l.slave_card for l in
+            CardLink.query.filter_by(mapping_id=m.id).all()]),
+            sorted([c["id"] for c in slave_cards]))
+        self.assertEqual(Mapping.query.get(m.id).last_action_id,
+            [a for a in simulator.actions
+            if a["data"]["board"]["id"] == master_board["id"]
+            and a["type"] == "createCard"][-1]["id"])
+
+        # The next board run finds the cards in sync, even though the cache
+        # is still filled by the previous one
+        with simulator.patch(), self.assertLogs(level='INFO'):
+            run_mapping(m.id, "board", master_board["id"])
+        self.assertEqual(atstp.mock_calls[-1], call(100, 'Run complete. '
+            'Processed 4 master cards (of which 2 active) that have 2 slave '
+            'cards (of which 0 new).'))
+        self.assertEqual([len(simulator.cards[c["id"]]["idChecklists"])
+            for c in master_cards], [0, 1, 0, 1])
+
+        # Labelling a card is the only change the next run processes
+        simulator.add_card_label(master_cards[0], label)
+        simulator.reset_stats()
+        with simulator.patch(), self.assertLogs(level='INFO'):
+            run_mapping(m.id, "changes", master_board["id"])
+        self.assertEqual(atstp.mock_calls[-1], call(100, 'Run complete. '
+            'Processed 1 master cards (of which 1 active) that have 1 slave '
+            'cards (of which 1 new).'))
+        self.assertEqual(len([c for c in simulator.cards.values()
+            if c["idList"] == slave_list["id"]]), 3)
+        self.assertEqual(simulator.stats["calls"]["POST cards"], 1)
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.get_cards_snapshot")
+    @patch("app.tasks.get_current_job")
+    def test_run_mapping_checkpoints(self, atgcj, atgcs, atsmc, atstp):
+        m = self.create_user_and_mapping()
+        atgcj.return_value.get_id.return_value = "j1"
+        self.app.redis = MagicMock()
+        self.app.redis.hgetall.return_value = {}
+        atgcs.return_value = [{"id": "c1", "name": "Card name"},
+            {"id": "c2", "name": "Second card"}]
+        atsmc.return_value = [(1, 1, 0), (1, 2, 1)]
+        with self.assertLogs(level='INFO'):
+            run_mapping(m.id, "list", "def")
+        key = "syncboom-run-checkpoint:j1"
+        pipeline = self.app.redis.pipeline.return_value
+        self.assertEqual(self.app.redis.hgetall.mock_calls, [call(key)])
+        self.assertEqual(pipeline.hset.mock_calls, [call(key, "c1", "[1, 1, 0]"),
+            call(key, "c2", "[1, 2, 1]")])
+        self.assertEqual(pipeline.expire.mock_calls, [call(key, 86400)] * 2)
+        # The checkpoint isn't needed anymore once the run is complete
+        self.assertEqual(self.app.redis.delete.mock_calls, [call(key)])
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.get_cards_snapshot")
+    @patch("app.tasks.get_current_job")
+    def test_run_mapping_resumed(self, atgcj, atgcs, atsmc, atstp):
+        m = self.create_user_and_mapping()
+        atgcj.return_value.get_id.return_value = "j1"
+        self.app.redis = MagicMock()
+        self.app.redis.hgetall.return_value = {b"c1": b"[1, 1, 0]"}
+        atgcs.return_value = [{"id": "c1", "name": "Card name"},
+            {"id": "c2", "name": "Second card"}]
+        atsmc.return_value = [(1, 2, 1)]
+        with self.assertLogs(level='INFO') as cm:
+            run_mapping(m.id, "list", "def")
+        self.assertEqual(atsmc.mock_calls, [call([{"id": "c2",
+            "name": "Second card"}], {"destination_lists": {"Label One":
+            ["a1a1a1a1a1a1a1a1a1a1a1a1"]}, "key": "a1"*16, "token": "b2"*16,
+            "mapping_id": m.id})])
+        self.assertEqual(cm.output, [
+            'INFO:app:Starting task for mapping 1, list def',
+            'INFO:app:Resuming the run, 1 master cards were already processed',
+            'INFO:app:Processed master card 2/2 - Second card',
+            'INFO:app:Completed task for mapping 1, list def'])
+        # The summary covers both attempts
+        self.assertEqual(atstp.mock_calls[-1], call(100, 'Run complete. '
+            'Processed 2 master cards (of which 2 active) that have 3 slave '
+            'cards (of which 1 new).'))
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.get_cards_snapshot")
+    @patch("app.tasks.get_current_job")
+    def test_run_mapping_new_run_not_resumed(self, atgcj, atgcs, atsmc, atstp):
+        m = self.create_user_and_mapping()
+        atgcj.return_value.get_id.return_value = "j2"
+        self.app.redis = MagicMock()
+        checkpoints = {"syncboom-run-checkpoint:j1": {b"c1": b"[1, 1, 0]"}}
+        self.app.redis.hgetall.side_effect = lambda key: \
+            checkpoints.get(key, {})
+        atgcs.return_value = [{"id": "c1", "name": "Card name"},
+            {"id": "c2", "name": "Second card"}]
+        atsmc.return_value = [(1, 1, 0), (1, 1, 0)]
+        with self.assertLogs(level='INFO'):
+            run_mapping(m.id, "list", "def")
+        self.assertEqual(len(atsmc.mock_calls[0][1][0]), 2)
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.get_cards_snapshot")
+    @patch("app.tasks.get_current_job")
+    def test_run_mapping_checkpoints_redis_error(self, atgcj, atgcs, atsmc,
+            atstp):
+        m = self.create_user_and_mapping()
+        atgcj.return_value.get_id.return_value = "j1"
+        self.app.redis = MagicMock()
+        self.app.redis.hgetall.side_effect = RedisError()
+        self.app.redis.pipeline.return_value.execute.side_effect = RedisError()
+        atgcs.return_value = [{"id": "c1", "name": "Card name"},
+            {"id": "c2", "name": "Second card"}]
+        atsmc.return_value = [(1, 1, 0), (1, 1, 0)]
+        with self.assertLogs(level='INFO') as cm:
+            run_mapping(m.id, "list", "def")
+        self.assertEqual(cm.output, [
+            'INFO:app:Starting task for mapping 1, list def',
+            'WARNING:app:Unable to get the run checkpoint, starting over',
+            'INFO:app:Processed master card 1/2 - Card name',
+            "WARNING:app:Unable to save the run checkpoint, the run won't be "
+                "resumable",
+            'INFO:app:Processed master card 2/2 - Second card',
+            'INFO:app:Completed task for mapping 1, list def'])
+        self.assertEqual(atstp.mock_calls[-1], call(100, 'Run complete. '
+            'Processed 2 master cards (of which 2 active) that have 2 slave '
+            'cards (of which 0 new).'))
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.get_cards_snapshot")
+    @patch("app.tasks.get_latest_board_action")
+    @patch("app.tasks.get_current_job")
+    def test_run_mapping_shards(self, atgcj, atglba, atgcs, atsmc, atstp):
+        m = self.create_user_and_mapping()
+        self.app.redis = MagicMock()
+        self.app.task_queue = MagicMock()
+        atgcj.return_value.get_id.return_value = "p1"
+        atglba.return_value = {"id": "a"*24, "date": "2020-06-15T11:36:49.712Z"}
+        atgcs.return_value = [{"id": "c3", "name": "Third card"},
+            {"id": "c1", "name": "Card name"}, {"id": "c2", "name": "Second"}]
+        with self.assertLogs(level='INFO') as cm:
+            run_mapping(m.id, "board", "m"*24, shards=2)
+        self.assertEqual(atsmc.mock_calls, [])
+        pipeline = self.app.redis.pipeline.return_value
+        self.assertEqual(pipeline.hset.mock_calls, [call(
+            "syncboom-run-shards:p1", mapping={"master_cards": 3,
+            "remaining": 2, "latest_action": json.dumps(
+            atglba.return_value)})])
+        self.assertEqual(self.app.task_queue.enqueue.mock_calls, [
+            call('app.tasks.run_mapping_shard', "p1", m.id, ["c3", "c1"],
+                job_timeout=3600),
+            call('app.tasks.run_mapping_shard', "p1", m.id, ["c2"],
+                job_timeout=3600)])
+        self.assertEqual(self.app.task_queue.enqueue_in.mock_calls, [
+            call(timedelta(seconds=3600), 'app.tasks.check_run_shards', "p1",
+                m.id)])
+        self.assertEqual(atstp.mock_calls[-1], call(0, "Job running... "
+            "Processing 3 cards in 2 shards."))
+        self.assertEqual(cm.output[-1], "INFO:app:Split task for mapping 1, "
+            "board %s in 2 shards" % ("m"*24))
+        # The checkpoint is recorded once all the shards are done
+        self.assertEqual(Mapping.query.get(m.id).last_action_id, None)
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.batch_get")
+    @patch("app.tasks.Job")
+    def test_run_mapping_shard(self, atj, atbg, atsmc, atstp):
+        m = self.create_user_and_mapping()
+        self.app.redis = MagicMock()
+        self.app.redis.hexists.return_value = False
+        self.app.redis.hmget.return_value = [None]
+        pipeline = self.app.redis.pipeline.return_value
+        pipeline.execute.side_effect = [[1, True, 1, b"4", None], [0, 1]]
+        # One card was deleted and one moved to another board since
+        atbg.return_value = [None, {"id": "c1", "name": "Card name",
+            "idBoard": "n"*24}, {"id": "c3", "name": "Third card",
+            "idBoard": m.master_board}]
+        atsmc.return_value = [(1, 2, 0)]
+        with self.assertLogs(level='INFO') as cm:
+            app.tasks.run_mapping_shard("p1", m.id, ["c2", "c1", "c3"])
+        self.assertEqual(atj.fetch.mock_calls, [call("p1",
+            connection=self.app.redis)])
+        self.assertEqual(atbg.mock_calls, [call(["cards/c2", "cards/c1",
+            "cards/c3"], {"key": "a1"*16, "token": "b2"*16},
+            app.tasks.CARD_NESTED_QUERY)])
+        self.assertEqual(atsmc.mock_calls, [call([{"id": "c3",
+            "name": "Third card", "idBoard": m.master_board}],
+            {"destination_lists": {"Label One":
+            ["a1a1a1a1a1a1a1a1a1a1a1a1"]}, "key": "a1"*16, "token": "b2"*16,
+            "mapping_id": m.id})])
+        self.assertEqual(atstp.mock_calls, [call(25,
+            job=atj.fetch.return_value)])
+        self.assertEqual(self.app.redis.hmget.mock_calls, [call(
+            "syncboom-run-checkpoint:p1", ["c3"])])
+        self.assertEqual(pipeline.hset.mock_calls, [call(
+            "syncboom-run-checkpoint:p1", "c3", "[1, 2, 0]")])
+        self.assertEqual(pipeline.expire.mock_calls, [call(
+            "syncboom-run-checkpoint:p1", 86400)])
+        self.assertEqual(pipeline.hincrby.mock_calls, [
+            call("syncboom-run-shards:p1", "errors", 0),
+            call("syncboom-run-shards:p1", "remaining", -1)])
+        self.assertEqual(cm.output, ["INFO:app:Starting shard of task for "
+            "mapping 1, 1 cards",
+            "INFO:app:Processed master card c3 - Third card"])
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.batch_get")
+    @patch("app.tasks.Job")
+    def test_run_mapping_shard_resumed(self, atj, atbg, atsmc, atstp):
+        m = self.create_user_and_mapping()
+        self.app.redis = MagicMock()
+        self.app.redis.hexists.return_value = False
+        # The shard was interrupted after its first card and enqueued again
+        self.app.redis.hmget.return_value = [b"[1, 1, 0]", None]
+        pipeline = self.app.redis.pipeline.return_value
+        pipeline.execute.side_effect = [[0, True, 2, b"2", None], [0, 1]]
+        atbg.return_value = [{"id": "c1", "name": "Card name",
+            "idBoard": m.master_board}, {"id": "c2", "name": "Second card",
+            "idBoard": m.master_board}]
+        atsmc.return_value = [(1, 2, 0)]
+        with self.assertLogs(level='INFO') as cm:
+            app.tasks.run_mapping_shard("p1", m.id, ["c1", "c2"])
+        self.assertEqual(atsmc.mock_calls[0][1][0], [{"id": "c2",
+            "name": "Second card", "idBoard": m.master_board}])
+        self.assertEqual(pipeline.hset.mock_calls, [call(
+            "syncboom-run-checkpoint:p1", "c2", "[1, 2, 0]")])
+        # The progress counts the cards of the checkpoint, each one once
+        self.assertEqual(atstp.mock_calls, [call(99,
+            job=atj.fetch.return_value)])
+        self.assertEqual(cm.output, ["INFO:app:Starting shard of task for "
+            "mapping 1, 2 cards",
+            "INFO:app:Resuming the shard, 1 master cards were already "
+                "processed",
+            "INFO:app:Processed master card c2 - Second card"])
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.sync_master_cards")
+    @patch("app.tasks.batch_get")
+    @patch("app.tasks.Job")
+    def test_run_mapping_shard_last(self, atj, atbg, atsmc, atstp):
+        m = self.create_user_and_mapping()
+        self.app.redis = MagicMock()
+        self.app.redis.hexists.return_value = False
+        pipeline = self.app.redis.pipeline.return_value
+        pipeline.execute.side_effect = [[0, 0], [1, {
+            b"master_cards": b"4", b"remaining": b"0", b"errors": b"0",
+            b"latest_action": json.dumps({"id": "a"*24,
+            "date": "2020-06-15T11:36:49.712Z"}).encode()},
+            [b"[1, 2, 1]", b"[1, 1, 0]", b"[0, 0, 0]", b"[1, 2, 1]"]]]
+        atbg.return_value = [None]
+        with self.assertLogs(level='INFO') as cm:
+            app.tasks.run_mapping_shard("p1", m.id, ["c2"])
+        self.assertEqual(pipeline.hsetnx.mock_calls,
+            [call("syncboom-run-shards:p1", "completed", 1)])
+        self.assertEqual(atstp.mock_calls, [call(100, 'Run complete. Processed '
+            '4 master cards (of which 3 active) that have 5 slave cards (of '
+            'which 2 new).', atj.fetch.return_value)])
+        self.assertEqual(Mapping.query.get(m.id).last_action_id, "a"*24)
+        self.assertEqual(cm.output[-1], "INFO:app:Completed task for mapping "
+            "1, board run in shards")
+        # The checkpoint of the shards isn't needed anymore
+        self.assertEqual(self.app.redis.delete.mock_calls,
+            [call("syncboom-run-checkpoint:p1")])
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.batch_get")
+    @patch("app.tasks.Job")
+    def test_run_mapping_shard_error(self, atj, atbg, atstp):
+        m = self.create_user_and_mapping()
+        self.app.redis = MagicMock()
+        self.app.redis.hexists.return_value = False
+        pipeline = self.app.redis.pipeline.return_value
+        pipeline.execute.side_effect = [[1, 0], [1, {b"errors": b"1"}, []]]
+        atbg.side_effect = ValueError()
+        f = io.StringIO()
+        with self.assertLogs(level='INFO') as cm, contextlib.redirect_stderr(f):
+            app.tasks.run_mapping_shard("p1", m.id, ["c1"])
+        self.assertEqual(pipeline.hincrby.mock_calls[0],
+            call("syncboom-run-shards:p1", "errors", 1))
+        self.assertEqual(atstp.mock_calls, [call(100, 'The job errored out.',
+            atj.fetch.return_value)])
+        self.assertEqual(Mapping.query.get(m.id).last_action_id, None)
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.batch_get")
+    @patch("app.tasks.Job")
+    def test_run_mapping_shard_completed(self, atj, atbg, atstp):
+        m = self.create_user_and_mapping()
+        self.app.redis = MagicMock()
+        self.app.redis.hexists.return_value = True
+        with self.assertLogs(level='WARNING') as cm:
+            app.tasks.run_mapping_shard("p1", m.id, ["c1"])
+        self.assertEqual(atbg.mock_calls, [])
+        self.assertEqual(self.app.redis.pipeline.mock_calls, [])
+        self.assertEqual(cm.output, ["WARNING:app:Ignoring shard of task p1, "
+            "the task was already completed"])
+
+    @patch("app.tasks._set_task_progress")
+    @patch("app.tasks.Job")
+    def test_check_run_shards(self, atj, atstp):
+        m = self.create_user_and_mapping()
+        self.app.redis = MagicMock()
+        pipeline = self.app.redis.pipeline.return_value
+        pipeline.execute.return_value = [1, {b"remaining": b"1",
+            b"errors": b"0"}, []]
+        with self.assertLogs(level='WARNING') as cm:
+            app.tasks.check_run_shards("p1", m.id)
+        self.assertEqual(atstp.mock_calls, [call(100, "The job timed out.",
+            atj.fetch.return_value)])
+        self.assertEqual(cm.output, ["WARNING:app:Shards of task for mapping 1 "
+            "not done after 3600s, 1 of them remaining"])
+        self.assertEqual(Mapping.query.get(m.id).last_action_id, None)
+
+        # The last shard completed the task in the meantime
+        atstp.reset_mock()
+        pipeline.execute.return_value = [0, {b"completed": b"1"}, []]
+        app.tasks.check_run_shards("p1", m.id)
+        self.assertEqual(atstp.mock_calls, [])
+
+        # Nothing left to check once the shards' key expired
+        pipeline.reset_mock()
+        self.app.redis.exists.return_value = 0
+        app.tasks.check_run_shards("p1", m.id)
+        self.assertEqual(pipeline.execute.mock_calls, [])
+
+    @patch("app.tasks.get_rate_limit_stats")
+    def test_run_mapping_rate_limit_wait(self, atgrls):
+        atgrls.side_effect = [
+            {"requests": 10, "throttled": 1, "wait_time": 0.5,
+                "thread_wait_time": 0.5},
+            {"requests": 30, "throttled": 5, "wait_time": 2.75,
+                "thread_wait_time": 8.5}]
+        f = io.StringIO()
+        with self.assertLogs(level='INFO') as cm, contextlib.redirect_stderr(f):
+            run_mapping(0, "", "")
+        self.assertEqual(cm.output[-1], "INFO:app:Waited 2.2s for the Trello " \
+            "rate limits (4 of 20 requests throttled, 8.0s in total across " \
+            "the threads)")
+
+    @patch("app.tasks.get_retry_stats")
+    def test_run_mapping_retries(self, atgrs):
+        atgrs.side_effect = [
+            {"attempts": 10, "retries": 1, "failures": 0, "errors": {}},
+            {"attempts": 40, "retries": 4, "failures": 0, "errors": {}}]
+        f = io.StringIO()
+        with self.assertLogs(level='INFO') as cm, contextlib.redirect_stderr(f):
+            run_mapping(0, "", "")
+        self.assertEqual(cm.output[-1], "INFO:app:Retried 3 Trello requests " \
+            "after transient errors (30 attempts in total)")
+
     @patch("app.tasks._set_task_progress")
     @patch("app.tasks.get_current_job")
     def test_run_mapping_unhandled_exception(self, atgcj, atstp):
@@ -533,8 +1280,8 @@ class TaskCase(WebsiteTestCase):
                 "ddd"
             ]
         }
-        dl = json.dumps(destination_lists)
-        m = Mapping(name="abc", destination_lists=dl)
+        m = Mapping(name="abc")
+        m.set_destination_lists(destination_lists)
         db.session.add(m)
         db.session.commit()
         f = io.StringIO()
@@ -953,6 +1700,91 @@ class MainCase(WebsiteTestCase):
         for ec in expected_content:
             self.assertIn(str.encode(ec), response.data)
 
+    @patch("app.models.Task.get_progress")
+    def test_main_routes_notifications_task_progress(self, amtgp):
+        u = self.create_user("john", "abc")
+        response = self.login("john", "abc")
+        n = u.add_notification("task_progress", {"task_id": "t1",
+            "progress": 0})
+        db.session.add(Task(id="t1", name="run_mapping", user=u))
+        db.session.commit()
+        amtgp.return_value = 42
+        response = self.client.get('/notifications')
+        self.assertEqual(response.status_code, 200)
+        # The progress kept in Redis comes last, without a newer timestamp
+        self.assertEqual(json.loads(response.data), [
+            {"name": "task_progress", "data": {"task_id": "t1", "progress": 0},
+                "timestamp": n.timestamp},
+            {"name": "task_progress", "data": {"task_id": "t1",
+                "progress": 42}, "timestamp": n.timestamp}])
+
+    @patch("app.main.routes.time")
+    def test_main_routes_notifications_stream(self, amrt):
+        u = self.create_user("john", "abc")
+        response = self.login("john", "abc")
+        self.app.redis = MagicMock()
+        pubsub = self.app.redis.pubsub.return_value
+        pubsub.get_message.side_effect = [{"type": "message",
+            "data": b'{"task_id": "t1", "progress": 42}'}, None]
+        amrt.time.side_effect = [0, 1, 2, 61]
+        response = self.client.get('/notifications/stream')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        self.assertEqual(response.data, b'retry: 5000\n\n'
+            b'event: task_progress\ndata: {"task_id": "t1", "progress": 42}\n\n'
+            b': keep-alive\n\n')
+        self.assertEqual(pubsub.subscribe.mock_calls,
+            [call("syncboom-progress:%d" % u.id)])
+        self.assertEqual(pubsub.get_message.mock_calls, [call(timeout=15)] * 2)
+        self.assertEqual(len(pubsub.close.mock_calls), 1)
+        response.close()
+        self.assertEqual(app.main.routes.open_streams["count"], 0)
+        self.assertEqual(len(pubsub.close.mock_calls), 2)
+
+    @patch("app.main.routes.current_user")
+    def test_main_routes_notifications_stream_not_started(self, amrcu):
+        self.app.redis = MagicMock()
+        self.app.config['LOGIN_DISABLED'] = True
+        amrcu.id = 1
+        with self.app.test_request_context('/notifications/stream'):
+            response = app.main.routes.notifications_stream()
+        # The client left before the stream started, its Redis connection is
+        # closed anyway
+        response.close()
+        self.assertEqual(app.main.routes.open_streams["count"], 0)
+        self.assertEqual(
+            len(self.app.redis.pubsub.return_value.close.mock_calls), 1)
+
+    def test_main_routes_notifications_stream_redis_error(self):
+        u = self.create_user("john", "abc")
+        response = self.login("john", "abc")
+        self.app.redis = MagicMock()
+        self.app.redis.pubsub.return_value.subscribe.side_effect = RedisError()
+        response = self.client.get('/notifications/stream')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(app.main.routes.open_streams["count"], 0)
+
+    @patch("app.main.routes.time")
+    def test_main_routes_notifications_stream_max_streams(self, amrt):
+        u = self.create_user("john", "abc")
+        response = self.login("john", "abc")
+        self.app.redis = MagicMock()
+        self.app.redis.pubsub.return_value.get_message.return_value = None
+        self.app.config['NOTIFICATIONS_MAX_STREAMS'] = 1
+        amrt.time.side_effect = [0, 61]
+        # The other streams are refused while one is open
+        response = self.client.get('/notifications/stream', buffered=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/notifications/stream').status_code,
+            503)
+        response.close()
+        self.assertEqual(app.main.routes.open_streams["count"], 0)
+        amrt.time.side_effect = [0, 61]
+        response = self.client.get('/notifications/stream')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        self.assertEqual(app.main.routes.open_streams["count"], 0)
+
     def test_main_routes_account(self):
         u = self.create_user("john", "abc", email='john@example.com',
             trello_username="trello_username")
@@ -1210,14 +2042,13 @@ class MappingCase(WebsiteTestCase):
         u = self.create_user(username, password)
         destination_lists = {
             "bbbbbbbbbbbbbbbbbbbbbbbb": ["eeeeeeeeeeeeeeeeeeeeeeee"]}
-        dl = json.dumps(destination_lists)
         mapping_name = "abc" if not secondary_user else "def"
         m = Mapping(name=mapping_name,
             description = "Mapping description for %s" % mapping_name,
             m_type = "automatic",
-            master_board = "a"*24,
-            destination_lists=dl
+            master_board = "a"*24
         )
+        m.set_destination_lists(destination_lists)
         u.mappings.append(m)
         db.session.commit()
         self.assertEqual(u.get_mappings(), [m])
@@ -1266,28 +2097,54 @@ class MappingCase(WebsiteTestCase):
                 for ec in expected_content:
                     self.assertIn(str.encode(ec), response.data)
 
+    @patch("app.mapping.routes.perform_request")
+    @patch("app.mapping.routes.get_boards_catalog")
+    def test_mapping_edit_checkpoint(self, amrgbc, amrpr):
+        (u, m) = self.create_user_mapping_and_login()
+        m.set_checkpoint({"id": "c"*24, "date": "2020-06-15T11:36:49.712Z"})
+        db.session.commit()
+        amrgbc.return_value = [{"id": "a"*24, "name": "Master board",
+            "lists": [{"id": "e"*24, "name": "Inbox"},
+            {"id": "f"*24, "name": "Done"}]}]
+        amrpr.return_value = [{"id": "b"*24, "name": "Team A"}]
+        data = {"name": "abc", "description": "", "m_type": "automatic",
+            "master_board": "a"*24, "labels": ["b"*24]}
+
+        # Renaming the mapping keeps its checkpoint
+        response = self.client.post("/mapping/%d/edit" % m.id,
+            data=dict(data, name="xyz", map_label0_lists=["e"*24]))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(m.name, "xyz")
+        self.assertEqual(m.last_action_id, "c"*24)
+
+        # Changing the destination lists syncs the whole board next time
+        response = self.client.post("/mapping/%d/edit" % m.id,
+            data=dict(data, map_label0_lists=["f"*24]))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(m.get_destination_lists(), {"b"*24: ["f"*24]})
+        self.assertIsNone(m.last_action_id)
+        self.assertIsNone(m.last_action_date)
+
+    def get_sample_cards_index(self):
+        return [
+            {"id": "357", "name": "stu", "idList": "a"*24},
+            {"id": "456", "name": "opq", "idList": "123"},
+            {"id": "789", "name": "yza", "idList": "123"},
+            {"id": "b"*24, "name": "vwx", "idList": "a"*24},
+            {"id": "579", "name": "efg", "idList": "a"*24}
+        ]
+
     @patch("app.mapping.routes.current_user")
+    @patch("app.mapping.routes.get_cards_index")
     @patch("app.mapping.routes.perform_request")
-    def test_mapping_run(self, amrpr, amrcu):
+    def test_mapping_run(self, amrpr, amrgci, amrcu):
         (u, m) = self.create_user_mapping_and_login()
         # GET
-        pr_return = [
-            [
-                {"id": "123", "name": "hij"},
-                {"id": "a"*24, "name": "klm"}
-            ],
-            [
-                {"id": "456", "name": "opq"},
-                {"id": "789", "name": "yza"}
-            ],
-            [
-                {"id": "357", "name": "stu"},
-                {"id": "b"*24, "name": "vwx"},
-                {"id": "579", "name": "efg"}
-            ]
+        amrpr.return_value = [
+            {"id": "123", "name": "hij"},
+            {"id": "a"*24, "name": "klm"}
         ]
-        # Five groups of these requests are going to be made
-        amrpr.side_effect = pr_return * 5
+        amrgci.return_value = self.get_sample_cards_index()
         amrcu.id = 1
         response = self.client.get("/mapping/%d" % m.id)
         self.assertEqual(response.status_code, 200)
@@ -1295,6 +2152,9 @@ class MappingCase(WebsiteTestCase):
             '<title>Run mapping &#34;abc&#34; - SyncBoom</title>',
             '<h1>Run mapping &#34;abc&#34;</h1>',
             'Would you like to:<br/><br/>',
+            '<input class="btn btn-secondary btn-md" id="submit_changes" name="' \
+                'submit_changes" type="submit" value="Process the cards changed ' \
+                'since the last run">',
             '<input class="btn btn-secondary btn-md" id="submit_board" name="' \
                 'submit_board" type="submit" value="Process the entire master board">',
             '<select class="form-control" id="lists" name="lists"><option ' \
@@ -1302,16 +2162,17 @@ class MappingCase(WebsiteTestCase):
                 '</select>' % ("a"*24),
             '<input class="btn btn-secondary btn-md" id="submit_list" name="' \
                 'submit_list" type="submit" value="Process all cards on this list">',
-            '<select class="form-control" id="cards" name="cards"><option ' \
-                'value="456">hij | opq</option><option value="789">hij | yza' \
-                '</option><option value="357">klm | stu</option><option ' \
-                'value="%s">klm | vwx</option><option value="579">klm | efg' \
-                '</option></select>' % ("b"*24),
+            # The cards are searched from the page
+            '<select class="form-control" id="cards" name="cards"></select>',
             '<input class="btn btn-secondary btn-md" id="submit_card" name="' \
                 'submit_card" type="submit" value="Process only this specific card">'
             ]
         for ec in expected_content:
             self.assertIn(str.encode(ec), response.data)
+        # Only the lists of the master board were needed to show the page
+        self.assertEqual(amrpr.mock_calls, [call("GET", "boards/%s/lists" %
+            ("a"*24), key="a1"*16, token=amrcu.trello_token)])
+        self.assertEqual(amrgci.mock_calls, [])
 
         # POST while task in progress
         amrcu.get_task_in_progress.return_value = True
@@ -1321,14 +2182,23 @@ class MappingCase(WebsiteTestCase):
             'in progress, please wait...</div>'
         self.assertIn(str.encode(ec), response.data)
 
-        # POST entire master board
+        # POST changes on the master board
         amrcu.get_task_in_progress.return_value = False
+        response = self.client.post("/mapping/%d" % m.id,
+            data=dict(submit_changes="submit_changes"))
+        self.assertEqual(response.status_code, 302)
+        expected_call = call.launch_task('run_mapping', (1, 'changes', "a"*24),
+            'Processing the cards changed on the "abc" master board since the '
+            'last run...')
+        self.assertEqual(amrcu.mock_calls[-1], expected_call)
+
+        # POST entire master board
         response = self.client.post("/mapping/%d" % m.id,
             data=dict(submit_board="submit_board"))
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response.headers["Location"], "http://localhost/")
         expected_call = call.launch_task('run_mapping', (1, 'board', "a"*24),
-            'Processing the full "abc" master board...')
+            'Processing the full "abc" master board...', shards=1)
         self.assertEqual(amrcu.mock_calls[-1], expected_call)
 
         # POST list
@@ -1349,6 +2219,106 @@ class MappingCase(WebsiteTestCase):
             "b"*24), 'Processing card "klm | vwx"...')
         self.assertEqual(amrcu.mock_calls[-1], expected_call)
 
+        # POST a card that isn't on the master board
+        amrpr.side_effect = lambda method, url, *args, **kwargs: \
+            {"id": "c"*24, "name": "nop", "idBoard": "d"*24,
+                "idList": "e"*24} if url == "cards/%s" % ("c"*24) \
+            else amrpr.return_value
+        response = self.client.post("/mapping/%d" % m.id,
+            data=dict(submit_card="submit_card", cards="c"*24),
+            follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        ec = '<div class="alert alert-info" role="alert">This card wasn&#39;t ' \
+            'found on the master board.</div>'
+        self.assertIn(str.encode(ec), response.data)
+        self.assertEqual(amrcu.mock_calls[-1],
+            call.get_task_in_progress('run_mapping'))
+        self.assertEqual(amrgci.mock_calls, [call("a"*24,
+            {"key": "a1"*16, "token": amrcu.trello_token})] * 2)
+
+    @patch("app.mapping.routes.current_user")
+    @patch("app.mapping.routes.get_cards_index")
+    @patch("app.mapping.routes.perform_request")
+    def test_mapping_run_card_not_in_index(self, amrpr, amrgci, amrcu):
+        (u, m) = self.create_user_mapping_and_login()
+        lists = [{"id": "123", "name": "hij"}, {"id": "a"*24, "name": "klm"}]
+        cards = {"c"*24: {"id": "c"*24, "name": "nop", "idBoard": "a"*24,
+            "idList": "123", "closed": False},
+            "d"*24: {"id": "d"*24, "name": "qrs", "idBoard": "a"*24,
+            "idList": "123", "closed": True}}
+        def perform_request(method, url, *args, **kwargs):
+            if url.startswith("cards/"):
+                card_id = url.split("/")[1]
+                if card_id not in cards:
+                    raise HTTPError(response=MagicMock(status_code=404))
+                return cards[card_id]
+            return lists
+        amrpr.side_effect = perform_request
+        # The index was cached before these cards were created
+        amrgci.return_value = self.get_sample_cards_index()
+        amrcu.id = 1
+        amrcu.get_task_in_progress.return_value = False
+
+        # A card created since the index was cached is checked on Trello
+        response = self.client.post("/mapping/%d" % m.id,
+            data=dict(submit_card="submit_card", cards="c"*24))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.headers["Location"], "http://localhost/")
+        self.assertEqual(amrcu.mock_calls[-1], call.launch_task('run_mapping',
+            (1, 'card', "c"*24), 'Processing card "hij | nop"...'))
+        self.assertIn(call("GET", "cards/%s" % ("c"*24),
+            {"fields": "name,idBoard,idList,closed"}, key="a1"*16,
+            token=amrcu.trello_token), amrpr.mock_calls)
+
+        # Neither an archived card, a deleted one nor an invalid ID are run
+        ec = '<div class="alert alert-info" role="alert">This card wasn&#39;t ' \
+            'found on the master board.</div>'
+        for card_id in ("d"*24, "e"*24, "../boards/%s" % ("a"*24)):
+            amrcu.reset_mock()
+            response = self.client.post("/mapping/%d" % m.id,
+                data=dict(submit_card="submit_card", cards=card_id),
+                follow_redirects=True)
+            self.assertIn(str.encode(ec), response.data)
+            self.assertNotIn("launch_task", [c[0] for c in amrcu.mock_calls])
+        self.assertNotIn(call("GET", "cards/../boards/%s" % ("a"*24),
+            {"fields": "name,idBoard,idList,closed"}, key="a1"*16,
+            token=amrcu.trello_token), amrpr.mock_calls)
+
+    @patch("app.mapping.routes.current_user")
+    @patch("app.mapping.routes.get_cards_index")
+    @patch("app.mapping.routes.perform_request")
+    def test_mapping_search_cards(self, amrpr, amrgci, amrcu):
+        (u, m) = self.create_user_mapping_and_login()
+        amrpr.return_value = [
+            {"id": "123", "name": "hij"},
+            {"id": "a"*24, "name": "klm"}
+        ]
+        amrgci.return_value = self.get_sample_cards_index()
+        amrcu.id = 1
+        self.app.config['MAPPING_CARDS_PER_PAGE'] = 2
+        # All the cards, in the order of the lists
+        response = self.client.get("/mapping/%d/cards" % m.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {"cards": [
+            {"id": "456", "text": "hij | opq"},
+            {"id": "789", "text": "hij | yza"}], "more": True})
+        response = self.client.get("/mapping/%d/cards?page=3" % m.id)
+        self.assertEqual(response.get_json(), {"cards": [
+            {"id": "579", "text": "klm | efg"}], "more": False})
+        # Search by list or card name, case insensitive
+        response = self.client.get("/mapping/%d/cards?q=KLM+%%7C+" % m.id)
+        self.assertEqual(response.get_json(), {"cards": [
+            {"id": "357", "text": "klm | stu"},
+            {"id": "b"*24, "text": "klm | vwx"}], "more": True})
+        response = self.client.get("/mapping/%d/cards?q=vw&page=0" % m.id)
+        self.assertEqual(response.get_json(), {"cards": [
+            {"id": "b"*24, "text": "klm | vwx"}], "more": False})
+        response = self.client.get("/mapping/%d/cards?q=none" % m.id)
+        self.assertEqual(response.get_json(), {"cards": [], "more": False})
+        # Not this user's mapping
+        response = self.client.get("/mapping/999/cards")
+        self.assertEqual(response.status_code, 403)
+
     def retrieve_and_check(self, method, url, expected_status_code,
         expected_content, unexpected_content, data=None, redirect_url=None, display=None):
         if method == 'GET':
@@ -1405,21 +2375,19 @@ class MappingCase(WebsiteTestCase):
         ]
         return t_boards, t_labels, t_lists1, t_lists2
 
-    @patch("app.mapping.routes.perform_request")
-    def test_mapping_no_boards(self, amrpr):
+    def get_sample_catalog(self):
+        t_boards, t_labels, t_lists1, t_lists2 = self.get_sample_values()
+        return [dict(t_boards[0], lists=t_lists1),
+            dict(t_boards[2], lists=t_lists2)]
+
+    @patch("app.mapping.routes.invalidate_boards_catalog")
+    @patch("app.mapping.routes.get_boards_catalog")
+    def test_mapping_no_boards(self, amrgbc, amribc):
         (u, m) = self.create_user_mapping_and_login()
         self.assertEqual(m.id, 1)
         ds1ok, ds2ok, ds3ok, ds4ok = self.get_data_step_valid()
-        amrpr.side_effect = [
-            # No boards at all
-            [],
-            # Only closed boards
-            [
-                {"id": "123", "name": "hij", "closed": True},
-                {"id": "456", "name": "nop", "closed": True},
-                {"id": "a"*24, "name": "klm", "closed": True}
-            ]
-        ]
+        # No open boards at all
+        amrgbc.return_value = []
 
         # GET step 1
         expected_content = [
@@ -1444,33 +2412,35 @@ class MappingCase(WebsiteTestCase):
             '<select class="form-control" id="master_board" ' \
                 'name="master_board"><option',
         ]
-        # Test no boards at all
-        self.retrieve_and_check("GET", "/mapping/new", 200, expected_content,
-            unexpected_content)
-        # Test only closed boards
         self.retrieve_and_check("GET", "/mapping/new", 200, expected_content,
             unexpected_content)
+        # Starting a new mapping refreshes the catalog of boards
+        pr_args = {"key": "a1"*16, "token": None}
+        self.assertEqual(amribc.mock_calls, [call(pr_args)])
+        self.assertEqual(amrgbc.mock_calls, [call(pr_args)])
 
     @patch("app.mapping.routes.flash")
     @patch("app.mapping.routes.current_user")
     @patch("app.mapping.routes.perform_request")
+    @patch("app.mapping.routes.get_boards_catalog")
+    @patch("app.mapping.routes.invalidate_boards_catalog")
     @patch("app.mapping.routes.new_webhook")
-    def test_mapping_new(self, amrnw, amrpr, amrcu, amrf):
+    def test_mapping_new(self, amrnw, amribc, amrgbc, amrpr, amrcu, amrf):
         (u, m) = self.create_user_mapping_and_login()
         self.assertEqual(m.id, 1)
         ds1ok, ds2ok, ds3ok, ds4ok = self.get_data_step_valid()
         t_boards, t_labels, t_lists1, t_lists2 = self.get_sample_values()
+        amrgbc.return_value = self.get_sample_catalog()
         amrpr.side_effect = [
-            t_boards,
-            t_boards, t_labels,
-            t_boards, t_labels,
-            t_boards, t_labels,
-            t_boards, [],
-            t_boards, t_labels,
-            t_boards, t_labels,
-            t_boards, t_labels, t_lists1, t_lists2,
-            t_boards, t_labels, t_lists1, t_lists2,
-            t_boards, t_labels
+            t_labels,
+            t_labels,
+            t_labels,
+            [],
+            t_labels,
+            t_labels,
+            t_labels,
+            t_labels,
+            t_labels
         ]
         amrcu.id = 1
 
@@ -1597,22 +2567,22 @@ class MappingCase(WebsiteTestCase):
         self.assertEqual(len(amrnw.mock_calls), 1)
         m2 = Mapping.query.filter_by(id=m.id+1).first()
         self.assertEqual(m2.id, 2)
+        # Only the first step refreshed the catalog, the others reused it
+        self.assertEqual(len(amribc.mock_calls), 1)
+        self.assertEqual(len(amrgbc.mock_calls), 10)
 
     @patch("app.mapping.routes.flash")
     @patch("app.mapping.routes.current_user")
     @patch("app.mapping.routes.perform_request")
-    def test_mapping_edit(self, amrpr, amrcu, amrf):
+    @patch("app.mapping.routes.get_boards_catalog")
+    @patch("app.mapping.routes.invalidate_boards_catalog")
+    def test_mapping_edit(self, amribc, amrgbc, amrpr, amrcu, amrf):
         (u, m) = self.create_user_mapping_and_login()
         self.assertEqual(m.id, 1)
         ds1ok, ds2ok, ds3ok, ds4ok = self.get_data_step_valid()
         t_boards, t_labels, t_lists1, t_lists2 = self.get_sample_values()
-        amrpr.side_effect = [
-            t_boards, t_labels, t_lists1, t_lists2,
-            t_boards, t_labels, t_lists1, t_lists2,
-            t_boards, t_labels, t_lists1, t_lists2,
-            t_boards, t_labels, t_lists1, t_lists2,
-            t_boards, t_labels, t_lists1, t_lists2,
-        ]
+        amrgbc.return_value = self.get_sample_catalog()
+        amrpr.side_effect = [t_labels] * 5
         amrcu.id = 1
 
         # GET step 1
@@ -1666,41 +2636,40 @@ class MappingCase(WebsiteTestCase):
         self.retrieve_and_check("POST", "/mapping/1/edit", 200, expected_content,
             None, data=dict(ds3ok, map_label0_lists="invalid_list"))
 
-        # GET with invalid destination_lists
+        # GET without destination lists
         # Expect all elements until step 3 (included)
         expected_content = expected_content_step_1[:8]
-        saved_destination_lists = m.destination_lists
-        m.destination_lists = ""
-        self.retrieve_and_check("GET", "/mapping/1/edit", 200,
-            expected_content, None)
-        m.destination_lists = None
+        saved_destination_lists = m.get_destination_lists()
+        m.set_destination_lists({})
         self.retrieve_and_check("GET", "/mapping/1/edit", 200,
             expected_content, None)
 
         # POST, all good on step 4
         expected_content = None
-        m.destination_lists = saved_destination_lists
+        m.set_destination_lists(saved_destination_lists)
         self.retrieve_and_check("POST", "/mapping/1/edit", 302, expected_content,
             None, data=ds4ok, redirect_url="http://localhost/")
         self.assertEqual(amrf.mock_calls,[call('Your mapping "Mapping name" ' \
             'has been updated.')])
+        # Opening the edit page refreshes the catalog, the next steps reuse it
+        self.assertEqual(len(amribc.mock_calls), 2)
 
     @patch("app.mapping.routes.flash")
     @patch("app.mapping.routes.current_user")
     @patch("app.mapping.routes.perform_request")
-    def test_mapping_large_map_labelN_lists(self, amrpr, amrcu, amrf):
+    @patch("app.mapping.routes.get_boards_catalog")
+    def test_mapping_large_map_labelN_lists(self, amrgbc, amrpr, amrcu, amrf):
         (u, m) = self.create_user_mapping_and_login()
         self.assertEqual(m.id, 1)
         ds1ok, ds2ok, ds3ok, ds4ok = self.get_data_step_valid()
         t_boards, t_labels, t_lists1, t_lists2 = self.get_sample_values()
         t_lists = t_lists1 * 5
+        # 6 open boards, with 20 lists each
+        amrgbc.return_value = [dict(b, lists=t_lists) for b in t_boards * 3
+            if not b["closed"]]
         amrpr.side_effect = [
-            # 9 boards, of which only 6 are not closed
-            t_boards * 3,
             # 120 labels
             t_labels * 30,
-            # 6 sets of 20 lists each
-            t_lists, t_lists, t_lists, t_lists, t_lists, t_lists
         ]
         amrcu.id = 1
 
@@ -1713,5 +2682,182 @@ class MappingCase(WebsiteTestCase):
             unexpected_content, data=dict(ds2ok, labels=selected_labels), display=False)
 
 
+class WebhookCase(WebsiteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config["TRELLO_API_SECRET"] = "s3cr3t"
+        self.app.redis = MagicMock()
+        self.app.task_queue = MagicMock()
+
+    def create_mapping(self, m_type="automatic"):
+        u = User(username='john', email='john@example.com',
+            trello_token="b2"*16)
+        db.session.add(u)
+        db.session.commit()
+        m = Mapping(name="abc", m_type=m_type, master_board="m"*24,
+            user_id=u.id)
+        m.set_destination_lists({"label_id_1": ["list_id_1"]})
+        db.session.add(m)
+        db.session.commit()
+        return m
+
+    def post_action(self, action, signature=None):
+        body = json.dumps({"action": action, "model": {"id": "m"*24}})
+        if signature is None:
+            content = body + "http://localhost/webhooks/1/?c=config"
+            signature = base64.b64encode(hmac.new(b"s3cr3t",
+                content.encode("utf-8"), hashlib.sha1).digest()).decode()
+        return self.client.post("/webhooks/1/?c=config", data=body,
+            headers={"X-Trello-Webhook": signature},
+            content_type="application/json")
+
+    def test_webhook_head(self):
+        response = self.client.head("/webhooks/1/?c=config")
+        self.assertEqual(response.status_code, 200)
+
+    def test_webhook_invalid_signature(self):
+        self.create_mapping()
+        action = {"type": "updateCard", "data": {"card": {"id": "c"*24}}}
+        response = self.post_action(action, "invalid")
+        self.assertEqual(response.status_code, 403)
+        self.app.config["TRELLO_API_SECRET"] = None
+        response = self.post_action(action)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.app.task_queue.mock_calls, [])
+
+    def test_webhook_invalid_payload(self):
+        content = "abc" + "http://localhost/webhooks/1/"
+        signature = base64.b64encode(hmac.new(b"s3cr3t",
+            content.encode("utf-8"), hashlib.sha1).digest()).decode()
+        response = self.client.post("/webhooks/1/", data="abc",
+            headers={"X-Trello-Webhook": signature})
+        self.assertEqual(response.status_code, 400)
+
+    @patch("app.webhooks.routes.invalidate_cached_entities")
+    def test_webhook_card_action(self, awrice):
+        m = self.create_mapping()
+        self.app.redis.set.return_value = True
+        action = {"type": "addLabelToCard", "data": {
+            "card": {"id": "c"*24, "shortLink": "abcd1234"},
+            "board": {"id": "m"*24}}}
+        response = self.post_action(action)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(awrice.mock_calls,
+            [call(["c"*24, "abcd1234", "m"*24])])
+        pending_key = "syncboom-webhook-pending:%d:%s" % (m.id, "c"*24)
+        self.assertEqual(self.app.redis.set.mock_calls,
+            [call(pending_key, 1, nx=True, ex=600)])
+        self.assertEqual(self.app.task_queue.enqueue.mock_calls,
+            [call("app.tasks.run_webhook_card", m.id, "c"*24, pending_key)])
+
+    def test_webhook_card_action_coalesced(self):
+        self.create_mapping()
+        # A run is already waiting in the queue for this card
+        self.app.redis.set.return_value = None
+        action = {"type": "updateCard", "data": {"card": {"id": "c"*24}}}
+        response = self.post_action(action)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.app.redis.set.mock_calls), 1)
+        self.assertEqual(self.app.task_queue.enqueue.mock_calls, [])
+
+    def test_webhook_ignored_actions(self):
+        m = self.create_mapping(m_type="manual")
+        self.app.redis.set.return_value = True
+        # Manual mapping
+        action = {"type": "updateCard", "data": {"card": {"id": "c"*24}}}
+        self.assertEqual(self.post_action(action).status_code, 200)
+        m.m_type = "automatic"
+        db.session.commit()
+        # Not an action that changes the sync of a card
+        action = {"type": "addChecklistToCard",
+            "data": {"card": {"id": "c"*24}}}
+        self.assertEqual(self.post_action(action).status_code, 200)
+        # Not an action on a card
+        action = {"type": "updateList", "data": {"list": {"id": "l"*24}}}
+        self.assertEqual(self.post_action(action).status_code, 200)
+        self.assertEqual(self.app.task_queue.enqueue.mock_calls, [])
+
+    @patch("app.webhooks.routes.invalidate_boards_catalog")
+    def test_webhook_boards_catalog_action(self, awribc):
+        m = self.create_mapping()
+        User.query.filter_by(username="john").first().mappings.append(m)
+        db.session.commit()
+        action = {"type": "createList", "data": {
+            "list": {"id": "l"*24}, "board": {"id": "m"*24}}}
+        response = self.post_action(action)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(awribc.mock_calls, [call({"token": "b2"*16})])
+        self.assertEqual(self.app.task_queue.enqueue.mock_calls, [])
+        # Card actions don't change the catalogs
+        action = {"type": "updateCard", "data": {"card": {"id": "c"*24}}}
+        self.post_action(action)
+        self.assertEqual(len(awribc.mock_calls), 1)
+
+    def test_webhook_redis_error(self):
+        self.create_mapping()
+        self.app.redis.set.side_effect = RedisError()
+        action = {"type": "updateCard", "data": {"card": {"id": "c"*24}}}
+        with self.assertLogs(level='ERROR') as cm:
+            response = self.post_action(action)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(cm.output, ["ERROR:app:Unable to queue the webhook "
+            "run for card %s" % ("c"*24)])
+
+    @patch("app.tasks.process_master_card")
+    @patch("app.tasks.perform_request")
+    def test_run_webhook_card(self, atpr, atpmc):
+        m = self.create_mapping()
+        atpr.return_value = {"id": "c"*24, "name": "Card name",
+            "idBoard": "m"*24}
+        atpmc.return_value = (1, 2, 1)
+        with self.assertLogs(level='INFO') as cm:
+            app.tasks.run_webhook_card(m.id, "c"*24, "pending")
+        self.assertEqual(self.app.redis.delete.mock_calls, [call("pending")])
+        self.assertEqual(atpr.mock_calls, [call("GET", "cards/%s" % ("c"*24),
+            app.tasks.CARD_NESTED_QUERY, key="a1"*16, token="b2"*16)])
+        self.assertEqual(atpmc.mock_calls, [call(atpr.return_value,
+            {"destination_lists": {"label_id_1": ["list_id_1"]},
+            "key": "a1"*16, "token": "b2"*16, "mapping_id": m.id})])
+        self.assertEqual(cm.output, ["INFO:app:Processing master card %s - "
+            "Card name for mapping 1" % ("c"*24), "INFO:app:Completed webhook "
+            "task for mapping 1, card %s. Processed 1 master cards (of which 1 "
+            "active) that have 2 slave cards (of which 1 new)." % ("c"*24)])
+
+    @patch("app.tasks.process_master_card")
+    @patch("app.tasks.perform_request")
+    def test_run_webhook_card_moved(self, atpr, atpmc):
+        m = self.create_mapping()
+        atpr.return_value = {"id": "c"*24, "name": "Card name",
+            "idBoard": "o"*24}
+        with self.assertLogs(level='INFO') as cm:
+            app.tasks.run_webhook_card(m.id, "c"*24, "pending")
+        self.assertEqual(atpmc.mock_calls, [])
+        self.assertEqual(cm.output, ["INFO:app:Card %s is no longer on the "
+            "master board of mapping 1, ignoring" % ("c"*24)])
+
+    @patch("app.tasks.process_master_card")
+    @patch("app.tasks.perform_request")
+    def test_run_webhook_card_archived(self, atpr, atpmc):
+        m = self.create_mapping()
+        atpr.return_value = {"id": "c"*24, "name": "Card name",
+            "idBoard": "m"*24, "closed": True}
+        with self.assertLogs(level='INFO') as cm:
+            app.tasks.run_webhook_card(m.id, "c"*24, "pending")
+        # Only the card was read, nothing is written to Trello
+        self.assertEqual(len(atpr.mock_calls), 1)
+        self.assertEqual(atpmc.mock_calls, [])
+        self.assertEqual(cm.output, ["INFO:app:Card %s is archived, ignoring"
+            % ("c"*24)])
+
+    @patch("app.tasks.perform_request")
+    def test_run_webhook_card_invalid(self, atpr):
+        f = io.StringIO()
+        with self.assertLogs(level='INFO') as cm, \
+                contextlib.redirect_stderr(f):
+            app.tasks.run_webhook_card(999, "c"*24, "pending")
+        self.assertEqual(cm.output, ["ERROR:app:Invalid webhook task, ignoring"])
+        self.assertEqual(atpr.mock_calls, [])
+
+
 if __name__ == '__main__':
     unittest.main()
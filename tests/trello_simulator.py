@@ -0,0 +1,734 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of SyncBoom and is MIT-licensed.
+
+"""
+In-process simulator of the parts of the Trello API SyncBoom uses, to test
+and benchmark whole runs offline. The simulator is a requests transport
+adapter: the requests never leave the process, but they go through the same
+session, retries and rate limits as real calls to api.trello.com, and the
+requests of the async client through a fake aiohttp session.
+
+    simulator = TrelloSimulator(latency=0.05, token_rate_limit=100)
+    board = simulator.add_board("Master board")
+    todo = simulator.add_list(board, "To do")
+    simulator.add_card(todo, "Card name", labels=[simulator.add_label(board, "Team A")])
+    with simulator.patch():
+        syncboom.sync_master_cards(...)
+    print(simulator.stats)
+"""
+
+import asyncio
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from unittest.mock import patch
+from urllib.parse import urlsplit, parse_qsl
+import aiohttp
+import requests
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+TRELLO_API_URL = "https://api.trello.com/"
+WEBHOOK_SITE_URL = "https://webhook.site/"
+SHORT_LINK_ALPHABET = \
+    "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+# Trello accepts the singular of its resources too, e.g. board/{id}/cards
+SINGULAR_RESOURCE = re.compile(
+    r"^(board|list|card|checklist|webhook|member)/")
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized",
+    404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error",
+    502: "Bad Gateway", 503: "Service Unavailable", 504: "Gateway Timeout"}
+# The simulated failure of a request before it reaches Trello
+CONNECTION_ERROR = "connection error"
+
+
+class TrelloError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class TrelloSimulator(BaseAdapter):
+    """
+    Fake Trello API keeping its boards, lists, cards, labels, checklists,
+    attachments, actions and webhooks in memory.
+
+    latency and jitter: seconds each request takes, plus up to jitter more.
+    key_rate_limit and token_rate_limit: requests allowed per key and per
+    token every rate_limit_period seconds, answered with a 429 beyond that.
+    error_rate: share of the requests failing with one of error_statuses,
+    drawn from a generator seeded with seed. fail_next() makes the next
+    requests fail instead, e.g. to test the retries.
+    webhook_callback: called with each webhook and the payload Trello would
+    post to its callbackURL, for the actions on the webhook's model.
+    """
+    def __init__(self, latency=0, jitter=0, key_rate_limit=None,
+        token_rate_limit=None, rate_limit_period=10, error_rate=0,
+        error_statuses=(500, 502, 503, 504), seed=None, webhook_callback=None):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.key_rate_limit = key_rate_limit
+        self.token_rate_limit = token_rate_limit
+        self.rate_limit_period = rate_limit_period
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.random = random.Random(seed)
+        self.webhook_callback = webhook_callback
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.boards = {}
+        self.lists = {}
+        self.cards = {}
+        self.labels = {}
+        self.checklists = {}
+        self.actions = []
+        self.webhooks = {}
+        self.webhook_tokens = {}
+        self.injected_errors = deque()
+        self.rate_limit_windows = {}
+        self.in_flight = 0
+        self.reset_stats()
+        self.routes = {TRELLO_API_URL: self.compile_routes([
+            ("GET", r"members/me/boards", self.get_member_boards),
+            ("GET", r"boards/(\w+)", self.get_board),
+            ("GET", r"boards/(\w+)/lists", self.get_board_lists),
+            ("GET", r"boards/(\w+)/labels", self.get_board_labels),
+            ("GET", r"boards/(\w+)/cards", self.get_board_cards),
+            ("GET", r"boards/(\w+)/actions", self.get_board_actions),
+            ("GET", r"lists/(\w+)", self.get_list),
+            ("GET", r"lists/(\w+)/board", self.get_list_board),
+            ("GET", r"lists/(\w+)/cards", self.get_list_cards),
+            ("POST", r"lists/(\w+)/archiveAllCards", self.archive_all_cards),
+            ("POST", r"cards", self.create_card),
+            ("GET", r"cards/(\w+)", self.get_card),
+            ("PUT", r"cards/(\w+)", self.update_card),
+            ("DELETE", r"cards/(\w+)", self.delete_card),
+            ("GET", r"cards/(\w+)/attachments", self.get_card_attachments),
+            ("POST", r"cards/(\w+)/attachments", self.create_attachment),
+            ("DELETE", r"cards/(\w+)/attachments/(\w+)",
+                self.delete_attachment),
+            ("GET", r"cards/(\w+)/checklists", self.get_card_checklists),
+            ("POST", r"cards/(\w+)/checklists", self.create_checklist),
+            ("DELETE", r"checklists/(\w+)", self.delete_checklist),
+            ("POST", r"checklists/(\w+)/checkItems", self.create_check_item),
+            ("GET", r"batch", self.get_batch),
+            ("POST", r"webhooks", self.create_webhook),
+            ("GET", r"tokens/(\w+)/webhooks", self.get_token_webhooks),
+            ("DELETE", r"webhooks/(\w+)", self.delete_webhook)]),
+            WEBHOOK_SITE_URL: self.compile_routes([
+            ("POST", r"token", self.create_webhook_token),
+            ("GET", r"token/([\w-]+)", self.get_webhook_token)])}
+
+    @staticmethod
+    def compile_routes(routes):
+        return [(method, re.compile(pattern), handler)
+            for (method, pattern, handler) in routes]
+
+    def session(self):
+        """A requests session sending the Trello and webhook.site calls here"""
+        session = requests.Session()
+        session.mount(TRELLO_API_URL, self)
+        session.mount(WEBHOOK_SITE_URL, self)
+        return session
+
+    def async_session(self):
+        """An aiohttp-like session sending the requests here"""
+        return AsyncSession(self)
+
+    def patch(self):
+        """Send the requests of SyncBoom to the simulator instead of Trello"""
+        session = self.session()
+        return patch.multiple("syncboom", get_session=lambda: session,
+            get_async_session=self.async_session)
+
+    def reset_stats(self):
+        self.stats = {"requests": 0, "throttled": 0, "injected_errors": 0,
+            "max_in_flight": 0, "calls": Counter()}
+
+    def fail_next(self, status=500, count=1):
+        """Fail the next requests with that status, or CONNECTION_ERROR"""
+        with self.lock:
+            self.injected_errors.extend([status] * count)
+
+    # Seeding the data of the tests and benchmarks
+
+    def new_id(self):
+        return "%024x" % next(self.ids)
+
+    def add_board(self, name):
+        board = {"id": self.new_id(), "name": name, "closed": False}
+        board["shortLink"] = self.new_short_link()
+        board["url"] = "https://trello.com/b/%s/%s" % (board["shortLink"],
+            self.slugify(name))
+        self.boards[board["id"]] = board
+        return board
+
+    def add_list(self, board, name):
+        board_id = self.get_id(board)
+        trello_list = {"id": self.new_id(), "name": name, "closed": False,
+            "idBoard": board_id, "pos": self.next_pos(self.lists, board_id)}
+        self.lists[trello_list["id"]] = trello_list
+        self.record_action("createList", board_id, list=trello_list)
+        return trello_list
+
+    def add_label(self, board, name, color="green"):
+        label = {"id": self.new_id(), "idBoard": self.get_id(board),
+            "name": name, "color": color}
+        self.labels[label["id"]] = label
+        return label
+
+    def add_card(self, trello_list, name, desc="", labels=[]):
+        with self.lock:
+            return self.create_card({"idList": self.get_id(trello_list),
+                "name": name, "desc": desc, "pos": "bottom",
+                "idLabels": ",".join([self.get_id(l) for l in labels])})
+
+    def add_card_label(self, card, label):
+        """Label a card, as a user would do in Trello"""
+        with self.lock:
+            card = self.find_card(self.get_id(card))
+            card["idLabels"].append(self.get_id(label))
+            self.record_action("addLabelToCard", card["idBoard"], card=card,
+                label=self.labels[self.get_id(label)])
+
+    @staticmethod
+    def get_id(record):
+        return record["id"] if isinstance(record, dict) else record
+
+    def new_short_link(self):
+        number = next(self.ids)
+        short_link = ""
+        for i in range(8):
+            (number, digit) = divmod(number, len(SHORT_LINK_ALPHABET))
+            short_link = SHORT_LINK_ALPHABET[digit] + short_link
+        return short_link
+
+    @staticmethod
+    def slugify(name):
+        return re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-")
+
+    @staticmethod
+    def next_pos(records, parent_id, parent_field="idBoard"):
+        return max([r["pos"] for r in records.values()
+            if r[parent_field] == parent_id] + [0]) + 16384
+
+    # The transport adapter
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+        cert=None, proxies=None):
+        with self.lock:
+            self.in_flight += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"],
+                self.in_flight)
+        try:
+            if self.latency or self.jitter:
+                time.sleep(self.latency + self.random.uniform(0, self.jitter))
+            with self.lock:
+                (status, body, headers) = self.handle(request)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        if status == CONNECTION_ERROR:
+            raise requests.exceptions.ConnectionError(
+                "Simulated connection error", request=request)
+        return self.build_response(request, status, body, headers)
+
+    async def send_async(self, request):
+        """send() for the async client, the latency not blocking the loop"""
+        with self.lock:
+            self.in_flight += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"],
+                self.in_flight)
+        try:
+            if self.latency or self.jitter:
+                await asyncio.sleep(self.latency +
+                    self.random.uniform(0, self.jitter))
+            with self.lock:
+                (status, body, headers) = self.handle(request)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        if status == CONNECTION_ERROR:
+            raise aiohttp.ClientConnectionError("Simulated connection error")
+        return self.build_response(request, status, body, headers)
+
+    def close(self):
+        pass
+
+    def handle(self, request):
+        url = urlsplit(request.url)
+        base_url = "%s://%s/" % (url.scheme, url.netloc)
+        path = url.path.lstrip("/")
+        if base_url == TRELLO_API_URL:
+            path = SINGULAR_RESOURCE.sub(r"\1s/", re.sub(r"^1/", "", path))
+        query = dict(parse_qsl(url.query, keep_blank_values=True))
+        self.stats["requests"] += 1
+        if base_url == TRELLO_API_URL:
+            if not (query.get("key") and query.get("token")):
+                return (401, "unauthorized permission requested", {})
+            rate_limited = self.check_rate_limits(query["key"], query["token"])
+            if rate_limited:
+                return rate_limited
+        if self.injected_errors:
+            status = self.injected_errors.popleft()
+        elif self.error_rate and self.random.random() < self.error_rate:
+            status = self.random.choice(self.error_statuses)
+        else:
+            status = None
+        if status:
+            self.stats["injected_errors"] += 1
+            return (status, "Simulated error", {})
+        try:
+            return (200, self.route(base_url, request.method, path, query), {})
+        except TrelloError as error:
+            return (error.status, error.message, {})
+
+    def route(self, base_url, method, path, query):
+        for (route_method, pattern, handler) in self.routes.get(base_url, []):
+            match = pattern.fullmatch(path)
+            if match and route_method == method:
+                self.stats["calls"]["%s %s" % (method, pattern.pattern)] += 1
+                return handler(query, *match.groups())
+        raise TrelloError(404, "Cannot %s /%s" % (method, path))
+
+    def check_rate_limits(self, key, token):
+        """Sliding windows of the requests per key and per token"""
+        now = time.time()
+        limits = (("API_KEY", key, self.key_rate_limit),
+            ("API_TOKEN", token, self.token_rate_limit))
+        for (kind, value, limit) in limits:
+            if not limit:
+                continue
+            window = self.rate_limit_windows.setdefault((kind, value), deque())
+            while window and window[0] <= now - self.rate_limit_period:
+                window.popleft()
+            if len(window) >= limit:
+                self.stats["throttled"] += 1
+                retry_after = window[0] + self.rate_limit_period - now
+                return (429, {"error": "%s_LIMIT_EXCEEDED" % kind,
+                    "message": "Rate limit exceeded"},
+                    {"Retry-After": "%.3f" % retry_after})
+        for (kind, value, limit) in limits:
+            if limit:
+                self.rate_limit_windows[(kind, value)].append(now)
+        return None
+
+    @staticmethod
+    def build_response(request, status, body, headers):
+        response = Response()
+        response.status_code = status
+        response.reason = REASONS.get(status, "")
+        response.url = request.url
+        response.request = request
+        response.encoding = "utf-8"
+        if isinstance(body, str):
+            response._content = body.encode("utf-8")
+            content_type = "text/plain; charset=utf-8"
+        else:
+            response._content = json.dumps(body).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        response.headers = CaseInsensitiveDict(headers)
+        response.headers["Content-Type"] = content_type
+        return response
+
+    # Rendering the records as Trello does
+
+    @staticmethod
+    def select_fields(record, fields):
+        if not fields or fields == "all":
+            return dict(record)
+        return {f: record[f] for f in ["id"] + fields.split(",") if f in record}
+
+    def render_list(self, trello_list, query={}, prefix=""):
+        return self.select_fields(trello_list, query.get(prefix + "fields"))
+
+    def render_board(self, board, query={}):
+        rendered = self.select_fields(board, query.get("fields"))
+        if query.get("lists") in ("open", "all"):
+            rendered["lists"] = [self.render_list(l, query, "list_")
+                for l in self.get_lists(board["id"], query["lists"] == "all")]
+        return rendered
+
+    def render_card(self, card, query={}):
+        attachments = card["attachments"]
+        checklists = [self.checklists[c] for c in card["idChecklists"]]
+        full_card = dict(card,
+            labels=[dict(self.labels[l]) for l in card["idLabels"]],
+            idChecklists=list(card["idChecklists"]),
+            idLabels=list(card["idLabels"]),
+            badges={"attachments": len(attachments),
+                "checkItems": sum([len(c["checkItems"]) for c in checklists]),
+                "checkItemsChecked": 0})
+        del full_card["attachments"]
+        rendered = self.select_fields(full_card, query.get("fields"))
+        if query.get("attachments") in ("true", "cover"):
+            rendered["attachments"] = [self.select_fields(a,
+                query.get("attachment_fields")) for a in attachments]
+        if query.get("checklists", "none") != "none":
+            rendered["checklists"] = [self.render_checklist(c,
+                query.get("checklist_fields")) for c in checklists]
+        return rendered
+
+    def render_checklist(self, checklist, fields=None):
+        rendered = self.select_fields(checklist, fields)
+        rendered["checkItems"] = [dict(i) for i in checklist["checkItems"]]
+        return rendered
+
+    def render_cards(self, cards, query):
+        cards = sorted([c for c in cards if not c["closed"]],
+            key=lambda c: c["id"], reverse=True)
+        # Trello pages through the cards from the most recent to the oldest
+        if query.get("before"):
+            cards = [c for c in cards if c["id"] < query["before"]]
+        if query.get("since"):
+            cards = [c for c in cards if c["id"] > query["since"]]
+        if query.get("limit"):
+            cards = cards[:min(int(query["limit"]), 1000)]
+        return [self.render_card(c, query) for c in cards]
+
+    # Finding the records
+
+    def find(self, records, record_id, name):
+        if record_id not in records:
+            raise TrelloError(404, "The requested %s was not found." % name)
+        return records[record_id]
+
+    def find_card(self, card_id):
+        if card_id in self.cards:
+            return self.cards[card_id]
+        for card in self.cards.values():
+            if card["shortLink"] == card_id:
+                return card
+        raise TrelloError(404, "The requested card was not found.")
+
+    def get_lists(self, board_id, closed=False):
+        return sorted([l for l in self.lists.values() if l["idBoard"] ==
+            board_id and (closed or not l["closed"])], key=lambda l: l["pos"])
+
+    def record_action(self, action_type, board_id, old=None, **records):
+        board = self.boards.get(board_id)
+        data = {"board": {"id": board_id,
+            "name": board["name"] if board else None}}
+        for (name, record) in records.items():
+            data[name] = {f: record[f] for f in ("id", "name", "shortLink",
+                "url") if f in record}
+        if old:
+            data["old"] = old
+        action = {"id": self.new_id(), "type": action_type,
+            "date": datetime.utcnow().isoformat()[:23] + "Z",
+            "idMemberCreator": "simulator", "data": data}
+        self.actions.append(action)
+        if self.webhook_callback:
+            for webhook in list(self.webhooks.values()):
+                if webhook["active"] and webhook["idModel"] in (board_id,
+                        data.get("card", {}).get("id")):
+                    self.webhook_callback(webhook, {"action": dict(action),
+                        "model": {"id": webhook["idModel"]}})
+        return action
+
+    # Members, boards and lists
+
+    def get_member_boards(self, query):
+        boards = [b for b in self.boards.values()
+            if query.get("filter", "all") != "open" or not b["closed"]]
+        return [self.render_board(b, query) for b in boards]
+
+    def get_board(self, query, board_id):
+        return self.render_board(self.find(self.boards, board_id, "board"),
+            query)
+
+    def get_board_lists(self, query, board_id):
+        self.find(self.boards, board_id, "board")
+        return [self.render_list(l, query) for l in self.get_lists(board_id,
+            query.get("filter") == "all")]
+
+    def get_board_labels(self, query, board_id):
+        self.find(self.boards, board_id, "board")
+        return [self.select_fields(l, query.get("fields"))
+            for l in self.labels.values() if l["idBoard"] == board_id]
+
+    def get_board_cards(self, query, board_id):
+        self.find(self.boards, board_id, "board")
+        return self.render_cards([c for c in self.cards.values()
+            if c["idBoard"] == board_id], query)
+
+    def get_board_actions(self, query, board_id):
+        self.find(self.boards, board_id, "board")
+        actions = [a for a in self.actions
+            if a["data"]["board"]["id"] == board_id]
+        since = query.get("since")
+        if since:
+            field = "id" if re.fullmatch(r"[0-9a-f]{24}", since) else "date"
+            actions = [a for a in actions if a[field] > since]
+        if query.get("before"):
+            actions = [a for a in actions if a["id"] < query["before"]]
+        actions = sorted(actions, key=lambda a: a["id"], reverse=True)
+        actions = actions[:min(int(query.get("limit", 50)), 1000)]
+        return [self.select_fields(a, query.get("fields")) for a in actions]
+
+    def get_list(self, query, list_id):
+        return self.render_list(self.find(self.lists, list_id, "list"), query)
+
+    def get_list_board(self, query, list_id):
+        trello_list = self.find(self.lists, list_id, "list")
+        return self.render_board(self.boards[trello_list["idBoard"]], query)
+
+    def get_list_cards(self, query, list_id):
+        self.find(self.lists, list_id, "list")
+        return self.render_cards([c for c in self.cards.values()
+            if c["idList"] == list_id], query)
+
+    def archive_all_cards(self, query, list_id):
+        trello_list = self.find(self.lists, list_id, "list")
+        for card in self.cards.values():
+            if card["idList"] == list_id and not card["closed"]:
+                card["closed"] = True
+                self.record_action("updateCard", trello_list["idBoard"],
+                    old={"closed": False}, card=card, list=trello_list)
+        return {}
+
+    # Cards, attachments and checklists
+
+    def create_card(self, query):
+        trello_list = self.find(self.lists, query.get("idList"), "list")
+        source = None
+        if query.get("idCardSource"):
+            source = self.find_card(query["idCardSource"])
+        card_id = self.new_id()
+        short_link = self.new_short_link()
+        name = query.get("name") or (source["name"] if source else "")
+        cards_on_list = [c for c in self.cards.values()
+            if c["idList"] == trello_list["id"]]
+        card = {"id": card_id, "name": name,
+            "desc": query.get("desc", source["desc"] if source else ""),
+            "closed": False, "idBoard": trello_list["idBoard"],
+            "idList": trello_list["id"], "idLabels": [], "idChecklists": [],
+            "idShort": len(self.cards) + 1, "shortLink": short_link,
+            "shortUrl": "https://trello.com/c/%s" % short_link,
+            "url": "https://trello.com/c/%s/%d-%s" % (short_link,
+                len(self.cards) + 1, self.slugify(name) or "card"),
+            "pos": 16384 if query.get("pos") == "top" else max(
+                [c["pos"] for c in cards_on_list] + [0]) + 16384,
+            "dateLastActivity": datetime.utcnow().isoformat()[:23] + "Z",
+            "attachments": []}
+        if query.get("idLabels"):
+            card["idLabels"] = query["idLabels"].split(",")
+        self.cards[card_id] = card
+        keep = query.get("keepFromSource", "all").split(",") if source else []
+        if "all" in keep or "labels" in keep:
+            card["idLabels"] = list(source["idLabels"])
+        if "all" in keep or "attachments" in keep:
+            for attachment in source["attachments"]:
+                self.create_attachment({"url": attachment["url"],
+                    "name": attachment["name"]}, card_id, record=False)
+        if "all" in keep or "checklists" in keep:
+            for checklist_id in source["idChecklists"]:
+                checklist = self.checklists[checklist_id]
+                new_checklist = self.create_checklist(
+                    {"name": checklist["name"]}, card_id, record=False)
+                for item in checklist["checkItems"]:
+                    self.create_check_item({"name": item["name"],
+                        "pos": item["pos"]}, new_checklist["id"])
+        if source:
+            self.record_action("copyCard", card["idBoard"], card=card,
+                cardSource=source, list=trello_list)
+        else:
+            self.record_action("createCard", card["idBoard"], card=card,
+                list=trello_list)
+        return self.render_card(card)
+
+    def get_card(self, query, card_id):
+        return self.render_card(self.find_card(card_id), query)
+
+    def update_card(self, query, card_id):
+        card = self.find_card(card_id)
+        old = {}
+        for field in ("name", "desc", "closed", "idList", "pos"):
+            if field not in query:
+                continue
+            value = query[field]
+            if field == "closed":
+                value = value == "true"
+            elif field == "pos":
+                value = float(value) if re.fullmatch(r"[0-9.]+", value) \
+                    else card["pos"]
+            elif field == "idList":
+                card["idBoard"] = self.find(self.lists, value, "list")["idBoard"]
+            if card[field] != value:
+                old[field] = card[field]
+                card[field] = value
+        if old:
+            card["dateLastActivity"] = datetime.utcnow().isoformat()[:23] + "Z"
+            self.record_action("updateCard", card["idBoard"], old=old,
+                card=card)
+        return self.render_card(card)
+
+    def delete_card(self, query, card_id):
+        card = self.find_card(card_id)
+        for checklist_id in card["idChecklists"]:
+            del self.checklists[checklist_id]
+        del self.cards[card["id"]]
+        self.record_action("deleteCard", card["idBoard"],
+            card={"id": card["id"], "shortLink": card["shortLink"]})
+        return {"limits": {}}
+
+    def get_card_attachments(self, query, card_id):
+        return [self.select_fields(a, query.get("fields"))
+            for a in self.find_card(card_id)["attachments"]]
+
+    def create_attachment(self, query, card_id, record=True):
+        card = self.find_card(card_id)
+        if not query.get("url"):
+            raise TrelloError(400, "invalid value for url")
+        attachment = {"id": self.new_id(), "url": query["url"],
+            "name": query.get("name") or query["url"], "isUpload": False,
+            "date": datetime.utcnow().isoformat()[:23] + "Z"}
+        card["attachments"].append(attachment)
+        if record:
+            self.record_action("addAttachmentToCard", card["idBoard"],
+                card=card, attachment=attachment)
+        return dict(attachment)
+
+    def delete_attachment(self, query, card_id, attachment_id):
+        card = self.find_card(card_id)
+        attachments = [a for a in card["attachments"]
+            if a["id"] == attachment_id]
+        if not attachments:
+            raise TrelloError(404, "The requested attachment was not found.")
+        card["attachments"].remove(attachments[0])
+        self.record_action("deleteAttachmentFromCard", card["idBoard"],
+            card=card, attachment=attachments[0])
+        return {"limits": {}}
+
+    def get_card_checklists(self, query, card_id):
+        return [self.render_checklist(self.checklists[c], query.get("fields"))
+            for c in self.find_card(card_id)["idChecklists"]]
+
+    def create_checklist(self, query, card_id, record=True):
+        card = self.find_card(card_id)
+        checklist = {"id": self.new_id(), "name": query.get("name", ""),
+            "idCard": card["id"], "idBoard": card["idBoard"],
+            "pos": len(card["idChecklists"]) * 16384 + 16384, "checkItems": []}
+        self.checklists[checklist["id"]] = checklist
+        card["idChecklists"].append(checklist["id"])
+        if record:
+            self.record_action("addChecklistToCard", card["idBoard"],
+                card=card, checklist=checklist)
+        return self.render_checklist(checklist)
+
+    def delete_checklist(self, query, checklist_id):
+        checklist = self.find(self.checklists, checklist_id, "checklist")
+        card = self.cards[checklist["idCard"]]
+        card["idChecklists"].remove(checklist_id)
+        del self.checklists[checklist_id]
+        self.record_action("removeChecklistFromCard", card["idBoard"],
+            card=card, checklist=checklist)
+        return {"limits": {}}
+
+    def create_check_item(self, query, checklist_id):
+        checklist = self.find(self.checklists, checklist_id, "checklist")
+        positions = [i["pos"] for i in checklist["checkItems"]]
+        if query.get("pos", "bottom") == "bottom":
+            pos = max(positions + [0]) + 16384
+        elif query["pos"] == "top":
+            pos = min(positions + [16384]) / 2
+        else:
+            pos = float(query["pos"])
+        item = {"id": self.new_id(), "name": query.get("name", ""),
+            "state": "incomplete", "idChecklist": checklist_id, "pos": pos}
+        checklist["checkItems"].append(item)
+        checklist["checkItems"].sort(key=lambda i: i["pos"])
+        return dict(item)
+
+    # Batch, webhooks and webhook.site tokens
+
+    def get_batch(self, query):
+        urls = [u for u in query.get("urls", "").split(",") if u]
+        if len(urls) > 10:
+            raise TrelloError(400, "Too many URLs, the maximum is 10")
+        responses = []
+        for url in urls:
+            url = urlsplit(url)
+            try:
+                path = SINGULAR_RESOURCE.sub(r"\1s/", url.path.lstrip("/"))
+                responses.append({"200": self.route(TRELLO_API_URL, "GET",
+                    path, dict(parse_qsl(url.query)))})
+            except TrelloError as error:
+                responses.append({"statusCode": error.status,
+                    "message": error.message})
+        return responses
+
+    def create_webhook(self, query):
+        if not (query.get("callbackURL") and query.get("idModel")):
+            raise TrelloError(400, "invalid value for callbackURL or idModel")
+        webhook = {"id": self.new_id(), "description": query.get(
+            "description", ""), "idModel": query["idModel"],
+            "callbackURL": query["callbackURL"], "active": True,
+            "token": query["token"]}
+        self.webhooks[webhook["id"]] = webhook
+        return {f: v for (f, v) in webhook.items() if f != "token"}
+
+    def get_token_webhooks(self, query, token):
+        return [{f: v for (f, v) in w.items() if f != "token"}
+            for w in self.webhooks.values() if w["token"] == token]
+
+    def delete_webhook(self, query, webhook_id):
+        self.find(self.webhooks, webhook_id, "webhook")
+        del self.webhooks[webhook_id]
+        return {"_value": None}
+
+    def create_webhook_token(self, query):
+        token = {"uuid": "%08x-0000-4000-8000-%012x" % (next(self.ids),
+            self.random.getrandbits(48)), "created_at": str(datetime.utcnow())}
+        self.webhook_tokens[token["uuid"]] = token
+        return token
+
+    def get_webhook_token(self, query, uuid):
+        return self.find(self.webhook_tokens, uuid, "token")
+
+
+class AsyncSession(object):
+    """The parts of an aiohttp ClientSession the async client uses"""
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def request(self, method, url, params=None, timeout=None):
+        request = requests.Request(method, url, params=params).prepare()
+        return AsyncResponse(self.simulator.send_async(request))
+
+
+class AsyncResponse(object):
+    """The parts of an aiohttp ClientResponse the async client uses"""
+    def __init__(self, sent):
+        self.sent = sent
+
+    async def __aenter__(self):
+        response = await self.sent
+        self.status = response.status_code
+        self.reason = response.reason
+        self.url = response.url
+        self.headers = response.headers
+        self.content = response.content
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def read(self):
+        return self.content
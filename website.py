@@ -5,7 +5,8 @@
 #    Originally based on microblog, licensed under the MIT License.
 
 from app import create_app, db, cli
-from app.models import User, Notification, Task, Mapping
+from app.models import User, Notification, Task, Mapping, CardLink, \
+    MappingDestination
 
 app = create_app()
 cli.register(app)
@@ -14,4 +15,5 @@ cli.register(app)
 @app.shell_context_processor
 def make_shell_context():
     return {'db': db, 'User': User, 'Notification': Notification, 'Task': Task,
-        'Mapping': Mapping}
+        'Mapping': Mapping, 'CardLink': CardLink,
+        'MappingDestination': MappingDestination}